@@ -1,18 +1,21 @@
 ###TODO: Smart logging for sub functions of download
 ###      Making everything into classes might make everything easier?
 
-import requests
 import sys
 import os
 import warnings
 from pathlib import Path, PurePath
 import math
 import re
+import time
+import random
+import threading
 from datetime import datetime
+from urllib.parse import urlparse
 import json
 
-import pandas as pd
-import simplekml
+#requests, simplekml, numpy (via subclasses and vors) are imported inside the
+#functions that need them, so parsing-only callers and the CLI start fast.
 
 # sys.path.insert(0, "/Users/ryanpurciel/Development/wexlib/src")
 # sys.path.insert(0, "/Users/rpurciel/Development/wexlib/src") #FOR TESTING ONLY!!!
@@ -49,6 +52,22 @@ DEF_AIRMET_TYPE_TO_COND_DICT = {
 
 DEF_ANCILLARY_PATH_TO_VORS_RELATIVE_TO_SRC = "ancillary/vors.csv"
 
+DEF_IEM_BASE_URL = "https://mesonet.agron.iastate.edu"
+
+DEF_IEM_HEADERS = {"Accept": "application/json"}
+
+DEF_HTTP_TIMEOUT_S = (5, 30) #(connect, read)
+
+DEF_HTTP_RETRIES = 4
+
+DEF_HTTP_BACKOFF_S = 0.5
+
+DEF_HTTP_MAX_BACKOFF_S = 30
+
+DEF_HTTP_MAX_PER_HOST = 4
+
+DEF_HTTP_RETRY_STATUSES = (429, 500, 502, 503, 504)
+
 def str_to_bool(string):
     if string in ['true', 'True', 'TRUE', 't', 'T', 'yes', 'Yes', 'YES', 'y', 'Y', True]:
         return True
@@ -59,6 +78,15 @@ def str_to_bool(string):
 
 def download(save_dir, year, month, day, **kwargs):
 
+    if str_to_bool(kwargs.get("all_products")) == True: #AIRMETs, SIGMETs and convective SIGMETs in one pass, see router.py
+        import router
+        kwargs.pop("all_products")
+        return router.download_all(save_dir, year, month, day, **kwargs)
+
+    if str_to_bool(kwargs.get("pipelined")) == True: #Concurrent fetch/parse/write, see pipeline.py
+        import pipeline
+        return pipeline.download_pipelined(save_dir, year, month, day, **kwargs)
+
     start_time = datetime.now()
 
     if not os.path.exists(save_dir):
@@ -80,17 +108,11 @@ def download(save_dir, year, month, day, **kwargs):
     if debug:
         print("DEBUG: Kwargs passed:", kwargs)
 
-    headers = {"Accept": "application/json"}
+    base_url = kwargs.get("base_url", DEF_IEM_BASE_URL)
     date = f"{str(year).zfill(4)}-{str(month).zfill(2)}-{str(day).zfill(2)}"
-    all_product_url = f"https://mesonet.agron.iastate.edu/api/1/nws/afos/list.json?cccc=kkci&date={date}"
-
-    if verbose:
-        print(f"SCRAPER: Scraping all products from URL {all_product_url}")
 
     try:
-        all_product_request = requests.get(all_product_url, headers=headers)
-        if verbose:
-            print(f"SCRAPER: Success")
+        product_list = fetch_product_list(date, base_url=base_url, verbose=verbose, **http_kwargs(kwargs))
     except Exception as e:
         error_str = ("ERROR: ", e)
 
@@ -100,11 +122,22 @@ def download(save_dir, year, month, day, **kwargs):
         elapsed_time = datetime.now() - start_time
         return 0, elapsed_time.total_seconds(), error_str
 
-    json_data = all_product_request.json()
-    all_prods = []
-    all_airmets_raw_text = []
+    compression = kwargs.get("compression")
+    pretty = str_to_bool(kwargs.get("pretty"))
 
-    for prod in json_data["data"]:
+    import archive
+    import quarantine
+
+    #A product that overruns its parse budget is set aside, raw text and all, instead of stalling the day
+    parse_budget = kwargs.get("parse_budget", quarantine.DEF_PARSE_BUDGET_S)
+    held = quarantine.Quarantine(kwargs.get("quarantine_path") or quarantine.quarantine_path(save_dir, date.replace('-', '')))
+
+    #Both files are streamed as products come in, and only appear under their final names once complete
+    raw_file = archive.open_output(os.path.join(save_dir, f"AllAIRMET_RawText_{date.replace('-', '')}.txt"), compression=compression)
+    json_file = archive.open_output(os.path.join(save_dir, f"AllAIRMETS_{date.replace('-', '')}.json"), compression=compression)
+    json_writer = archive.JSONArrayWriter(json_file, pretty=pretty, index=True)
+
+    for prod in product_list:
         if debug:
             print(f"DEBUG: Selected product: \n {prod}")
         sel_pil = prod["pil"]
@@ -114,138 +147,334 @@ def download(save_dir, year, month, day, **kwargs):
             pass
         else:
             sel_prod_id = prod["product_id"]
-            airmet_url = f"https://mesonet.agron.iastate.edu/api/1/nwstext/{sel_prod_id}"
             if debug:
                 print(f"DEBUG: Product is an AIRMET")
-            if verbose:
-                print(f"SCRAPER: Getting AIRMET with ID {sel_prod_id} from URL {airmet_url}")
             try:
-                airmet_request = requests.get(airmet_url, headers=headers)
-                if verbose:
-                    print(f"SCRAPER: Success")
+                airmet_raw_text = fetch_product_text(sel_prod_id, base_url=base_url, verbose=verbose, **http_kwargs(kwargs))
             except Exception as e:
                 if verbose:
                     print("FATAL ERROR:", e)
 
+                raw_file.abort()
+                json_file.abort()
+
                 elapsed_time = datetime.now() - start_time
                 return 0, elapsed_time.total_seconds(), e
 
-            airmet_raw_text = airmet_request.text
-            all_airmets_raw_text += [airmet_raw_text]
-            if debug:
-                print("DEBUG: Raw AIRMET: \n", airmet_raw_text)
-            san_airmet = _sanitize_for_reading(airmet_raw_text)
-            
-            airmet_block = san_airmet[:san_airmet.rfind("=")]
-            if debug:
-                print("DEBUG: AIRMET block: \n", airmet_block)
-            airmet_groups = airmet_block.split("+")
-            groups_list = []
-            num_groups = len(airmet_groups)
-            group_idx = 1
+            raw_file.write(airmet_raw_text)
 
-            for group in airmet_groups:
+            try:
+                main_dict = quarantine.parse_with_budget(parse_airmet, airmet_raw_text, year, month, budget_s=parse_budget, verbose=verbose, debug=debug)
+            except quarantine.ParseBudgetExceeded as e:
+                held.add(airmet_raw_text, e, product_id=sel_prod_id, pil=sel_pil)
                 if verbose:
-                    print(f"PARSING: Starting parsing airmet group {group_idx}/{num_groups}")
-                if debug:
-                    print("PARSING: Selected AIRMET group: \n", group)
-                #group_raw_text = _reverse_sanitize_for_printing(group, kwargs)
-                if group.find("*") != -1: #Header block
-                    if debug:
-                        print("PARSING: Group is a header block, parsing accordingly...")
-                    header = group.replace("*", "")
-                    header_dict = _header_to_dict(header)
-                    
-                    group_idx += 1
-                    if verbose:
-                        print("PARSING: Finished parsing airmet header")
-                    if debug:
-                        print(f"PARSING: Parsed header: {header_dict}")
-                    
-                else:
-                    sigmet_series_match = re.search(r"\$(\w+|\s)+\$\#\.", group) #Remove any "SEE SIGMET XRAY SERIES" messages, they mess everything up
-                    if sigmet_series_match:
-                      group = group[sigmet_series_match.end():]
-
-                    if debug:
-                        print("PARSING: Parsing VORs from airmet...")
-                    airmet_no_vor, vors = _pop_vors(group)
-                    if debug:
-                        print(f"PARSING: Parsed VORs: {vors}")
-
-                    if debug:
-                        print("PARSING: Parsing states from airmet...")
-                    airmet_no_vor.replace("##", "$") #Able to use double pound from VOR block to mark end of states block
-                    airmet_no_vor_no_state, states = _pop_states(airmet_no_vor)
-                    if debug:
-                        print(f"PARSING: Parsed states: {states}")
-
-                    if debug:
-                        print("PARSING: Parsing description from airmet...")
-                    airmet_no_vsd, desc = _pop_description(airmet_no_vor_no_state)
-                    if debug:
-                        print(f"PARSING: Parsed description: {desc}")
-
-                    if debug:
-                        print("PARSING: Parsing qualifiers from airmet...")
-                    quals = _pop_qualifiers(airmet_no_vsd)
-                    if debug:
-                        print(f"PARSING: Parsed qualifiers: {quals}")
-                    
-                    frz_present = False
-                    for qual in quals:
-                        if qual.find("FRZ") != -1:
-                            frz_present = True
-
-                    if frz_present:
-                        if debug:
-                            print("PARSING: Freezing level data found. Parsing not yet implemented.")
-                        airmet_group = {"qualifiers" : quals, "error" : "Freezing level data parsing not yet implemented."}
-                        groups_list.append(airmet_group)
-                    else:
-                        airmet_group = {
-                            "qualifiers" : quals,
-                            "vors": vors,
-                            "states" : states,
-                            "desc" : desc,
-                        }
-
-                        groups_list.append(airmet_group)
-                        if verbose:
-                            print("PARSING: Finished parsing airmet group")
-                        group_idx += 1
-                        
-            main_dict = header_dict.copy()
-            main_dict.update({"raw_text" : airmet_raw_text.replace('', '').replace('', ''), "subgroups" : groups_list})
+                    print(f"PARSING: {sel_prod_id} quarantined to {held.path}, {e}")
+                continue
+            
+            json_writer.write(main_dict, product_id=sel_prod_id)
+            
+    if verbose:
+        print("PARSING: Parsing of ALL AIRMETs finished. Saving to file...")
+
+    raw_file.close()
+
+    json_writer.close()
+    json_file.close()
+    dest_path = json_file.path
+
+    elapsed_time = datetime.now() - start_time
+    return 1, elapsed_time.total_seconds(), dest_path
+
+def fetch_product_list(date, **kwargs):
+    '''Fetches the list of all KKCI products issued
+       on date (YYYY-MM-DD) from the IEM AFOS API.
+       Returns the list of product entries, each a dict
+       with (at least) "product_id" and "pil".
+    '''
+
+    base_url = kwargs.get("base_url", DEF_IEM_BASE_URL)
+    verbose = str_to_bool(kwargs.get("verbose"))
+
+    all_product_url = f"{base_url}/api/1/nws/afos/list.json?cccc=kkci&date={date}"
+
+    if verbose:
+        print(f"SCRAPER: Scraping all products from URL {all_product_url}")
+
+    json_data = _http_get(all_product_url, as_json=True, **kwargs)
+    if verbose:
+        print(f"SCRAPER: Success")
+
+    return json_data["data"]
+
+def fetch_product_text(product_id, **kwargs):
+    '''Fetches the raw text of a single product
+       from the IEM nwstext API.
+    '''
+
+    base_url = kwargs.get("base_url", DEF_IEM_BASE_URL)
+    verbose = str_to_bool(kwargs.get("verbose"))
+
+    airmet_url = f"{base_url}/api/1/nwstext/{product_id}"
+
+    if verbose:
+        print(f"SCRAPER: Getting AIRMET with ID {product_id} from URL {airmet_url}")
+
+    airmet_raw_text = _http_get(airmet_url, **kwargs)
+    if verbose:
+        print(f"SCRAPER: Success")
+
+    return airmet_raw_text
+
+def http_kwargs(kwargs):
+    '''Picks the _http_get options (timeout, retries,
+       backoff, max_per_host) out of a kwargs dict so
+       callers can pass them through.
+    '''
+    return {key : kwargs[key] for key in ("timeout", "retries", "backoff", "max_per_host") if key in kwargs}
+
+def _http_get(url, **kwargs):
+    '''GET with a (connect, read) timeout, retries with
+       jittered exponential backoff, and a cap on
+       concurrent requests per host. Connection errors,
+       timeouts, truncated bodies, 429 and 5xx responses
+       are retried, other 4xx responses raise at once.
+       Returns the body text, or the decoded JSON with
+       as_json=True (a body that fails to decode counts
+       as truncated and is retried).
+    '''
+
+    import requests
+
+    timeout = kwargs.get("timeout", DEF_HTTP_TIMEOUT_S)
+    retries = kwargs.get("retries", DEF_HTTP_RETRIES)
+    backoff = kwargs.get("backoff", DEF_HTTP_BACKOFF_S)
+    as_json = kwargs.get("as_json", False)
+    verbose = str_to_bool(kwargs.get("verbose"))
+
+    limiter = _host_limiter(urlparse(url).netloc, kwargs.get("max_per_host", DEF_HTTP_MAX_PER_HOST))
+
+    attempt = 0
+    while True:
+        _count_http("requests")
+        try:
+            with limiter:
+                response = _http_session().get(url, headers=DEF_IEM_HEADERS, timeout=timeout)
+                if response.status_code not in DEF_HTTP_RETRY_STATUSES:
+                    response.raise_for_status()
+                    return response.json() if as_json else response.text
+                error = requests.HTTPError(f"{response.status_code} Server Error for url: {url}", response=response)
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError, ValueError) as e:
+            #ValueError covers a truncated JSON body
+            error = e
+
+        if attempt >= retries:
+            _count_http("failures")
+            raise error
+
+        attempt += 1
+        _count_http("retries")
+        delay = random.uniform(0, min(DEF_HTTP_MAX_BACKOFF_S, backoff * (2 ** attempt)))
+        if verbose:
+            print(f"SCRAPER: {error!r}, retry {attempt}/{retries} in {delay:.2f}s")
+        time.sleep(delay)
+
+_http_local = threading.local()
+
+_host_limiters = {}
+
+_host_limiters_lock = threading.Lock()
+
+http_stats = {"requests" : 0, "retries" : 0, "failures" : 0}
+
+def _http_session():
+    #One keep-alive session per thread, requests.Session isn't thread safe
+    session = getattr(_http_local, "session", None)
+    if session is None:
+        import requests
+
+        session = requests.Session()
+        _http_local.session = session
+    return session
+
+def _host_limiter(host, max_per_host):
+    with _host_limiters_lock:
+        limiter = _host_limiters.get(host)
+        if limiter is None:
+            limiter = threading.BoundedSemaphore(max_per_host)
+            _host_limiters[host] = limiter
+        return limiter
+
+def _count_http(stat):
+    with _host_limiters_lock:
+        http_stats[stat] += 1
+
+def split_raw_products(raw_text, date, **kwargs):
+    '''Splits the contents of an AllAIRMET_RawText_*.txt
+       file back into single products, giving each one
+       a synthetic product_id on date (YYYYMMDD) in the
+       IEM format (YYYYMMDDHHMM-KKCI-WAUSnn-PIL).
+    '''
+
+    products = []
+    for idx, text in enumerate(raw_text.split("\x01")[1:]):
+        text = "\x01" + text
+        lines = [line.strip() for line in text.split("\n") if line.strip()]
+        wmo_header = lines[1] if len(lines) > 1 else "WAUS00 KKCI 000000"
+        pil = lines[2] if len(lines) > 2 else "WA"
+        ddhhmm = wmo_header.split(" ")[-1]
+        product_id = f"{date}{ddhhmm[2:6]}-KKCI-{wmo_header.split(' ')[0]}-{pil}"
+        #Avoid collisions between products issued in the same minute
+        if any(prod["product_id"] == product_id for prod in products):
+            product_id += f"-{idx}"
+        products.append({"product_id" : product_id, "pil" : pil, "text" : text})
+
+    return products
+
+def parse_airmet(airmet_raw_text, year, month, **kwargs):
+    '''Parses the raw text of a single AIRMET bulletin
+       into the dict format written by download(), i.e.
+       the header fields plus "raw_text" and "subgroups".
+
+       year and month are needed since the bulletin
+       itself only carries the day of issuance.
+
+       Each subgroup's hazard, intensity and altitude
+       band are decoded once here into "conditions"
+       (see subclasses.Conditions).
+    '''
+
+    from subclasses import decode_conditions
+
+    if str_to_bool(kwargs.get("verbose")) == True:
+        verbose = True
+    else:
+        verbose = False
+
+    if str_to_bool(kwargs.get("debug")) == True:
+        debug = True
+        verbose = True
+    else:
+        debug = False
+
+    if debug:
+        print("DEBUG: Raw AIRMET: \n", airmet_raw_text)
+    san_airmet = _sanitize_for_reading(airmet_raw_text)
+    
+    airmet_block = san_airmet[:san_airmet.rfind("=")]
+    if debug:
+        print("DEBUG: AIRMET block: \n", airmet_block)
+    airmet_groups = airmet_block.split("+")
+    groups_list = []
+    num_groups = len(airmet_groups)
+    group_idx = 1
+    header_dict = {}
+
+    for group in airmet_groups:
+        if verbose:
+            print(f"PARSING: Starting parsing airmet group {group_idx}/{num_groups}")
+        if debug:
+            print("PARSING: Selected AIRMET group: \n", group)
+        #group_raw_text = _reverse_sanitize_for_printing(group, kwargs)
+        if group.find("*") != -1: #Header block
+            if debug:
+                print("PARSING: Group is a header block, parsing accordingly...")
+            header = group.replace("*", "")
+            header_dict = _header_to_dict(header, year=year, month=month)
+            
+            group_idx += 1
             if verbose:
-                print(f"PARSING: AIRMET parsing finished")
+                print("PARSING: Finished parsing airmet header")
             if debug:
-                print(f"PARSING: AIRMET data: \n{main_dict}")
+                print(f"PARSING: Parsed header: {header_dict}")
             
-            all_prods.append(main_dict)
+        else:
+            sigmet_series_match = re.search(r"\$[\w\s]+\$\#\.", group) #Remove any "SEE SIGMET XRAY SERIES" messages, they mess everything up
+            if sigmet_series_match:
+              group = group[sigmet_series_match.end():]
+
+            if debug:
+                print("PARSING: Parsing VORs from airmet...")
+            airmet_no_vor, vors = _pop_vors(group)
+            if debug:
+                print(f"PARSING: Parsed VORs: {vors}")
+
+            if debug:
+                print("PARSING: Parsing states from airmet...")
+            airmet_no_vor.replace("##", "$") #Able to use double pound from VOR block to mark end of states block
+            airmet_no_vor_no_state, states = _pop_states(airmet_no_vor)
+            if debug:
+                print(f"PARSING: Parsed states: {states}")
+
+            if debug:
+                print("PARSING: Parsing description from airmet...")
+            airmet_no_vsd, desc = _pop_description(airmet_no_vor_no_state)
+            if debug:
+                print(f"PARSING: Parsed description: {desc}")
+
+            if debug:
+                print("PARSING: Parsing qualifiers from airmet...")
+            quals = _pop_qualifiers(airmet_no_vsd)
+            if debug:
+                print(f"PARSING: Parsed qualifiers: {quals}")
             
+            frz_present = False
+            for qual in quals:
+                if qual.find("FRZ") != -1:
+                    frz_present = True
+
+            if frz_present:
+                if debug:
+                    print("PARSING: Freezing level data found, parsing contours...")
+                airmet_group = _parse_frzlvl(group)
+                airmet_group["conditions"] = decode_conditions(airmet_group["qualifiers"], "FRZLVL " + airmet_group["desc"])
+                groups_list.append(airmet_group)
+                if debug:
+                    print(f"PARSING: Parsed freezing level: {airmet_group}")
+                group_idx += 1
+            else:
+                airmet_group = {
+                    "qualifiers" : quals,
+                    "vors": vors,
+                    "states" : states,
+                    "desc" : desc,
+                    "conditions" : decode_conditions(quals, desc),
+                }
+
+                groups_list.append(airmet_group)
+                if verbose:
+                    print("PARSING: Finished parsing airmet group")
+                group_idx += 1
+                
+    main_dict = header_dict.copy()
+    main_dict.update({"raw_text" : airmet_raw_text.replace('\x01', '').replace('\x1e', ''), "subgroups" : groups_list})
     if verbose:
-        print("PARSING: Parsing of ALL AIRMETs finished. Saving to file...")
+        print(f"PARSING: AIRMET parsing finished")
+    if debug:
+        print(f"PARSING: AIRMET data: \n{main_dict}")
 
-    file_name = f"AllAIRMET_RawText_{date.replace('-', '')}.txt"
-    dest_path = os.path.join(save_dir, file_name)
+    return main_dict
 
-    file_object = open(dest_path, "w")
-    for text in all_airmets_raw_text:
-        file_object.write(text)
-    file_object.close()
+def airmet_times(airmet_dict):
+    '''Returns (iss_time, valid_time) datetimes for a
+       parsed AIRMET dict. The bulletin only carries the
+       day of month, so a valid time that lands before the
+       issuance time is rolled over into the next month.
+    '''
 
-    file_name = f"AllAIRMETS_{date.replace('-', '')}.json"
-    dest_path = os.path.join(save_dir, file_name)
+    iss_time = datetime(airmet_dict["iss_year"], airmet_dict["iss_month"], airmet_dict["iss_day"],
+                        airmet_dict["iss_hour"], airmet_dict["iss_minute"])
 
-    file_object = open(dest_path, "w")
-    file_object.write(json.dumps(all_prods, indent=2))
-    file_object.close()
+    valid_year, valid_month = airmet_dict["valid_year"], airmet_dict["valid_month"]
+    if airmet_dict["valid_day"] < airmet_dict["iss_day"]:
+        valid_month += 1
+        if valid_month > 12:
+            valid_year, valid_month = valid_year + 1, 1
+    valid_time = datetime(valid_year, valid_month, airmet_dict["valid_day"],
+                          airmet_dict["valid_hour"], airmet_dict["valid_minute"])
 
-    elapsed_time = datetime.now() - start_time
-    return 1, elapsed_time.total_seconds(), dest_path
+    return iss_time, valid_time
 
-def plot_kmz(save_dir, sugroups, airmet_type, airmet_id, airmet_raw_text, valid_time, iss_time, **kwargs):
+def plot_kmz(save_dir, subgroups, airmet_type, airmet_id, airmet_raw_text, valid_time, iss_time, **kwargs):
 
     start_time = datetime.now()
 
@@ -268,6 +497,9 @@ def plot_kmz(save_dir, sugroups, airmet_type, airmet_id, airmet_raw_text, valid_
     if debug:
         print("DEBUG: Kwargs passed:", kwargs)
 
+    import simplekml
+    from subclasses import states_to_mask
+
     airmet_kml = simplekml.Kml()
 
     iss_time_str = iss_time.strftime("%Y-%m-%d %H:%M:%S UTC")
@@ -283,6 +515,8 @@ def plot_kmz(save_dir, sugroups, airmet_type, airmet_id, airmet_raw_text, valid_
         if arg == 'filter_by_states':
             state_filter = value
 
+    state_filter_mask = states_to_mask(state_filter) if state_filter else 0
+
     num_polygons = 0
 
     for group in subgroups:
@@ -319,14 +553,11 @@ def plot_kmz(save_dir, sugroups, airmet_type, airmet_id, airmet_raw_text, valid_
                     print(f"!!! PLOTTER: State filtering turned ON\nPLOTTER: Plotting AIRMETS that only intersect the following states: {state_filter}")
 
                 states = group.get("states")
-                includes_state_flag = False
 
                 if not states:
                     states = []
 
-                for state in states:
-                    if state in selected_states:
-                        includes_state_flag = True
+                includes_state_flag = (states_to_mask(states) & state_filter_mask) != 0
 
                 if includes_state_flag:
                     if verbose:
@@ -378,6 +609,99 @@ def plot_kmz(save_dir, sugroups, airmet_type, airmet_id, airmet_raw_text, valid_
         elapsed_time = datetime.now() - start_time
         return 1, elapsed_time.total_seconds(), dest_path
     
+def plot_kmz_batch(save_dir, airmets, **kwargs):
+    '''Plots many parsed AIRMETs into a single KMZ,
+       one folder per bulletin with its validity as a
+       TimeSpan. Every polygon is written at each of
+       the geometry.DEF_LOD_TOLERANCES_DEG detail
+       levels, each inside a KML Region whose Lod
+       (geometry.DEF_LOD_PIXELS) makes viewers show the
+       coarse outlines when zoomed out and the full
+       ones when zoomed in. Detail levels are cached
+       per VOR list, so repeated polygons (common over
+       a month) are only simplified once.
+
+       kwargs: file_name (default derived from the time
+       range), filter_by_states, lod_levels (list of
+       level indices to write, default all).
+    '''
+
+    start_time = datetime.now()
+
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+
+    verbose = str_to_bool(kwargs.get("verbose"))
+
+    import simplekml
+    import geometry
+    from subclasses import states_to_mask
+
+    state_filter_mask = states_to_mask(kwargs["filter_by_states"]) if kwargs.get("filter_by_states") else 0
+    lod_levels = kwargs.get("lod_levels", range(len(geometry.DEF_LOD_TOLERANCES_DEG)))
+
+    airmet_kml = simplekml.Kml()
+    styles = {}
+    num_polygons = 0
+    times = []
+
+    for airmet_dict in airmets:
+        if "iss_day" not in airmet_dict:
+            continue
+        iss_time, valid_time = airmet_times(airmet_dict)
+        airmet_type = airmet_dict["airmet_type"]
+        cond_str = DEF_AIRMET_TYPE_TO_COND_DICT.get(airmet_type)
+
+        folder = None
+        for group in airmet_dict.get("subgroups") or []:
+            quals = group.get("qualifiers") or []
+            if not any((qual.find("AIRMET") != -1) or (qual.find("LLWS") != -1) for qual in quals):
+                continue
+            if state_filter_mask and not (states_to_mask(group.get("states") or []) & state_filter_mask):
+                continue
+
+            lods = geometry.subgroup_lods(group.get("vors"))
+            if lods is None:
+                if verbose:
+                    print(f"PLOTTER: Skipping unresolvable group in {airmet_dict['airmet_id']}")
+                continue
+
+            if folder is None:
+                folder = airmet_kml.newfolder(name=f"{airmet_dict['airmet_id']} [{cond_str}]")
+                folder.timespan.begin = iss_time.strftime("%Y-%m-%dT%H:%M:%SZ")
+                folder.timespan.end = valid_time.strftime("%Y-%m-%dT%H:%M:%SZ")
+                times += [iss_time, valid_time]
+            if airmet_type not in styles:
+                styles[airmet_type] = _style_kml(simplekml.Style(), airmet_type)
+
+            if any(qual.find("LLWS") != -1 for qual in quals):
+                airmet_title = "LLWS POTENTIAL"
+                desc_text = "FOR LLWS POTENTIAL\n" + group.get("desc", "")
+            else:
+                airmet_title = f"AIRMET {airmet_type}"
+                desc_text = "FOR " + quals[0][7:] + "\n" + group.get("desc", "")
+
+            min_lat, min_lon, max_lat, max_lon = geometry.bbox(lods[0])
+            for level in lod_levels:
+                min_pixels, max_pixels = geometry.DEF_LOD_PIXELS[level]
+                level_folder = folder.newfolder(name=f"LOD {level}")
+                level_folder.region = simplekml.Region(simplekml.LatLonAltBox(north=max_lat, south=min_lat, east=max_lon, west=min_lon),
+                                                       simplekml.Lod(minlodpixels=min_pixels, maxlodpixels=max_pixels))
+                _add_points_to_kml(level_folder, [(lon, lat) for lat, lon in lods[level]], airmet_type, airmet_title, desc_text,
+                                   style=styles[airmet_type])
+            num_polygons += 1
+
+    if num_polygons == 0:
+        elapsed_time = datetime.now() - start_time
+        return 0, elapsed_time.total_seconds(), "NoPolygons"
+
+    file_name = kwargs.get("file_name") or f"AIRMETs_{min(times).strftime('%Y%m%d_%H%M%S')}_{max(times).strftime('%Y%m%d_%H%M%S')}"
+    dest_path = os.path.join(save_dir, file_name + ".kmz")
+    airmet_kml.savekmz(dest_path)
+
+    elapsed_time = datetime.now() - start_time
+    return 1, elapsed_time.total_seconds(), dest_path
+
 def _add_poly_to_kml(kml, list_of_vors, airmet_type, airmet_title, desc, **kwargs):
 
     if str_to_bool(kwargs.get("verbose")) == True:
@@ -401,25 +725,12 @@ def _add_poly_to_kml(kml, list_of_vors, airmet_type, airmet_title, desc, **kwarg
     for vor in list_of_vors:
         if debug:
             print(f"DEBUG: Selected vor {vor}")
-        dir_args = []
-        if vor.find(" ") != -1:
-            if debug:
-                print(f"DEBUG: Combination VOR/DIR, splitting...")
-            dir_vor = vor.split(" ")
-            dist_carddir = dir_vor[0]
-            vor = dir_vor[1]
 
-            number_match = re.match(r"^\d*", dist_carddir)
-            dist_nm = dist_carddir[:number_match.end()]
-            card_dir = dist_carddir[number_match.end():]
-
-            if debug:
-                print(f"DEBUG: VOR distance: {dist_nm}\nDEBUG: VOR cardinal direction: {card_dir}")
-
-            dir_args.append(dist_nm.strip())
-            dir_args.append(card_dir.strip())
-
-        point_lat, point_lon = _vor_dir_to_lat_lon(vor, dir_args)
+        point_lat, point_lon = resolve_vor(vor, near=(airmet_points[-1][1], airmet_points[-1][0]) if airmet_points else None)
+        if math.isnan(point_lat):
+            if verbose:
+                print(f"PLOTTER: Could not resolve VOR {vor}, skipping polygon")
+            return kml, 0
 
         if debug:
         	print(f"DEBUG: Selected point: ({point_lat}, {point_lon})")
@@ -432,6 +743,32 @@ def _add_poly_to_kml(kml, list_of_vors, airmet_type, airmet_title, desc, **kwarg
     	print(f"DEBUG: AIRMET points:")
     	print(airmet_points)
 
+    return _add_points_to_kml(kml, airmet_points, airmet_type, airmet_title, desc)
+
+def _add_points_to_kml(kml, airmet_points, airmet_type, airmet_title, desc, **kwargs):
+    '''Adds one styled polygon, given as (lon, lat)
+       points, to kml. Holes can be passed as a list
+       of point lists with inner_points=.
+    '''
+
+    airmet_poly = kml.newpolygon(name=airmet_title,
+                                 description=desc,
+                                 outerboundaryis=airmet_points,)
+    if kwargs.get("inner_points"):
+        airmet_poly.innerboundaryis = kwargs["inner_points"]
+
+    #Batch exports share one style per AIRMET type instead of writing one per polygon
+    if kwargs.get("style") is not None:
+        airmet_poly.style = kwargs["style"]
+    else:
+        _style_kml(airmet_poly.style, airmet_type)
+
+    return kml, 1
+
+def _style_kml(style, airmet_type):
+
+    import simplekml
+
     if airmet_type == "SIERRA":
         polygon_line_color = simplekml.Color.violet
         polygon_line_width = 5
@@ -449,17 +786,49 @@ def _add_poly_to_kml(kml, list_of_vors, airmet_type, airmet_title, desc, **kwarg
         polygon_line_width = 5
         polygon_color = simplekml.Color.changealphaint(60, simplekml.Color.red)
 
-    airmet_poly = kml.newpolygon(name=airmet_title,
-                                 description=desc,
-                                 outerboundaryis=airmet_points,)
+    style.linestyle.color = polygon_line_color
+    style.linestyle.width = polygon_line_width
+    style.polystyle.color = polygon_color
+    return style
+
+def resolve_vor(vor, **kwargs):
+    '''Resolves a parsed VOR string, either a bare
+       VOR ("GEG") or a distance/direction from one
+       ("50NNE GEG"), to a (lat, lon) tuple.
+
+       Unknown or garbled VORs go through the fuzzy
+       resolver (vors.VorResolver), which only accepts
+       a match close to the near= point; one it can't
+       resolve with confidence gives (nan, nan) and is
+       listed in its report.
+    '''
 
-    airmet_poly.style.linestyle.color = polygon_line_color
-    airmet_poly.style.linestyle.width = polygon_line_width
-    airmet_poly.style.polystyle.color = polygon_color
+    dir_args = []
+    if vor.find(" ") != -1:
+        dir_vor = vor.split(" ")
+        dist_carddir = dir_vor[0]
+        vor = dir_vor[1]
 
-    return kml, 1
+        number_match = re.match(r"^\d*", dist_carddir)
+        dist_nm = dist_carddir[:number_match.end()]
+        card_dir = dist_carddir[number_match.end():]
+
+        dir_args.append(dist_nm.strip())
+        dir_args.append(card_dir.strip())
+
+    return _vor_dir_to_lat_lon(vor, dir_args, near=kwargs.get("near"))
 
-def _vor_dir_to_lat_lon(vor, *args):
+def resolve_vors(list_of_vors):
+    '''Resolves a list of parsed VOR strings to a
+       list of (lat, lon) tuples, each VOR hinted
+       with the point before it.
+    '''
+    points = []
+    for vor in list_of_vors:
+        points.append(resolve_vor(vor, near=points[-1] if points else None))
+    return points
+
+def _vor_dir_to_lat_lon(vor, *args, **kwargs):
 
     complex_vor_flag = False
 
@@ -471,18 +840,13 @@ def _vor_dir_to_lat_lon(vor, *args):
         complex_vor_flag = True
 
 
-    vor_path = PurePath.joinpath(Path.cwd().parent, DEF_ANCILLARY_PATH_TO_VORS_RELATIVE_TO_SRC)
+    from vors import get_vor_resolver, DEF_ACCEPTED_CONFIDENCES
 
-    vors_master_list = pd.read_csv(vor_path, sep=",", na_values = ["0","M"], index_col=0)
+    match = get_vor_resolver().resolve(vor, near=kwargs.get("near"))
+    if match["confidence"] not in DEF_ACCEPTED_CONFIDENCES:
+        return math.nan, math.nan
+    vor_lat, vor_lon = match["lat"], match["lon"]
 
-    try:
-        vor_data = vors_master_list.loc[vor]
-    except:
-        print("ERROR: VOR data not found. Please add an issue on Github with details of this issue.")
-
-    #print(vor_data)
-    vor_lat = vor_data.lat
-    vor_lon = vor_data.lon
     #print(f"LAT: {vor_lat}\nLON: {vor_lon}")
 
     if complex_vor_flag:
@@ -551,6 +915,9 @@ def _sanitize_for_reading(raw_text, **kwargs):
     # The function below delineates the end of the header block with "*+".
     san_text = re.sub("00\n\.\n", "00*+", san_text)
 
+    # A lone "." after a line without one (the end of a FRZLVL contour list) also ends a group.
+    san_text = re.sub("(?<=[^.\n])\n\.\n", "+\n", san_text)
+
     # The function below replaces all newlines with "#", for easier parsing
     san_text = san_text.replace("\n", "#")
 
@@ -567,11 +934,13 @@ def _sanitize_for_reading(raw_text, **kwargs):
     return san_text
 
 def _pop_vors(text, **kwargs):
-    initalvor_scheme1 = re.search(r"FROM(\s|\#)(((\d|[A-Z]){3,6}(\s|\#)([A-Z]){3})|([A-Z]){3}(?!-))", text) #Matches inital VOR (FROM [...]) in typical AIRMET scheme
-    vors_scheme1 = re.finditer(r"TO(\s|\#)(((\d|[A-Z]){3,6}(\s|\#)([A-Z]){3})|([A-Z]){3}(?!-))", text) #Matches all other VORs (TO [...]) in typical AIRMET scheme
+    from subclasses import DEF_SCHEME1_FROM_RE, DEF_SCHEME1_TO_RE, DEF_SCHEME2_BOUNDED_RE, DEF_SCHEME2_DASH_RE #linear time, see subclasses.py
+
+    initalvor_scheme1 = re.search(DEF_SCHEME1_FROM_RE, text) #Matches inital VOR (FROM [...]) in typical AIRMET scheme
+    vors_scheme1 = re.finditer(DEF_SCHEME1_TO_RE, text) #Matches all other VORs (TO [...]) in typical AIRMET scheme
     
-    initalvor_scheme2 = re.search(r"(BOUNDED BY)(\s|\#)(((\d|[A-Z]){3,6}(\s|\#)([A-Z]){3})|([A-Z]){3})", text) #Matches inital VOR from alternate scheme (BOUNDED BY [...]-[...])
-    vors_scheme2 = re.finditer(r"-(\#(\s)*)*(((\d|[A-Z]){3,6}(\s|\#)([A-Z]){3})|([A-Z]){3})", text) #Matches all other VORs from alternate scheme (BOUNDED BY [...]-[...])
+    initalvor_scheme2 = re.search(DEF_SCHEME2_BOUNDED_RE, text) #Matches inital VOR from alternate scheme (BOUNDED BY [...]-[...])
+    vors_scheme2 = re.finditer(DEF_SCHEME2_DASH_RE, text) #Matches all other VORs from alternate scheme (BOUNDED BY [...]-[...])
     
     vors_with_endpos = []
     start_pos_of_vors = 0
@@ -663,7 +1032,6 @@ def _pop_states(text, **kwargs):
         
     states_text = states_text.replace("#", " ").lstrip()
         
-    print(states_text)
 
     trailer_waters_match = states_text.find("WTRS$UPDT") #Found a case where "AND CSTL WTRS$UPDT" was included. This will get rid of that.
     if trailer_waters_match != -1:
@@ -684,8 +1052,6 @@ def _pop_states(text, **kwargs):
     
     # #print("TRAILER:", trailer_match)
 
-
-    print(states_text)
     # print("STATES:", bool(states_only_match), states_only_match)
     # print("WATERS:", bool(coastal_waters_match), coastal_waters_match)
     if states_only_match:
@@ -694,7 +1060,6 @@ def _pop_states(text, **kwargs):
         no_state_text = text[:start_of_block] + text[end_of_block:]
     elif coastal_waters_match: #If states doesnt match but coastal waters does assume its a block of states since coastal waters would only be with locations anyway
         # print("NO BUT WATERS")
-        print(states_text)
         states_text = states_text.replace("CSTL#WTRS", "CSTL_WTRS").replace("CSTL WTRS", "CSTL_WTRS").replace("AND CSTL_WTRS", "CSTL_WTRS")
         states = states_text.split(" ")
         states[states.index("CSTL_WTRS")] = "CSTL WTRS"
@@ -716,6 +1081,64 @@ def _pop_description(text, **kwargs):
     
     return no_desc_text, desc
 
+DEF_FRZLVL_LEVEL_RE = r"(SFC|\d{3})"
+
+def _frzlvl_ft(level):
+    return 0 if level == "SFC" else int(level) * 100
+
+def _parse_frzlvl(text):
+    '''Parses a sanitized FRZLVL group, e.g.
+
+       FRZLVL...RANGING FROM SFC-120 ACRS AREA
+          MULT FRZLVL BLW 080 BOUNDED BY 40ENE SLT-...
+          SFC ALG 50SW YXC-40W GEG-...
+          040 ALG 40NNE HVR-...
+
+       into its range, contour lines ("ALG", one
+       per level line) and areas ("MULT FRZLVL ...
+       BOUNDED BY"). Levels are in feet MSL, an area
+       below a level has a low_ft of None.
+    '''
+
+    from subclasses import parse_vor_string
+
+    lines = [line.strip() for line in text.replace("$", "...").split("#") if line.strip()]
+    if lines and lines[-1] == ".":
+        lines = lines[:-1]
+
+    #Wrapped lines continue the contour or area above them
+    joined = []
+    for line in lines[1:]:
+        if joined and not re.match(rf"^({DEF_FRZLVL_LEVEL_RE}\sALG|MULT\s)", line):
+            joined[-1] = (joined[-1] + " " + line).replace("- ", "-")
+        else:
+            joined.append(line)
+
+    header = lines[0] if lines else "FRZLVL"
+    desc = header.split("...", 1)[1] if header.find("...") != -1 else ""
+    range_match = re.search(rf"RANGING\sFROM\s{DEF_FRZLVL_LEVEL_RE}-{DEF_FRZLVL_LEVEL_RE}", desc)
+
+    contours, areas = [], []
+    for line in joined:
+        contour_match = re.match(rf"^{DEF_FRZLVL_LEVEL_RE}\sALG\s(.+)$", line)
+        area_match = re.match(rf"^MULT\sFRZLVL\s(BLW\s{DEF_FRZLVL_LEVEL_RE}|{DEF_FRZLVL_LEVEL_RE}-{DEF_FRZLVL_LEVEL_RE})\sBOUNDED\sBY\s(.+)$", line)
+        if contour_match:
+            contours.append({"level" : contour_match.group(1), "level_ft" : _frzlvl_ft(contour_match.group(1)),
+                             "vors" : parse_vor_string(contour_match.group(2))})
+        elif area_match:
+            low = area_match.group(3)
+            high = area_match.group(2) or area_match.group(4)
+            areas.append({"low_ft" : _frzlvl_ft(low) if low else None, "high_ft" : _frzlvl_ft(high),
+                          "vors" : parse_vor_string("BOUNDED BY " + area_match.group(5))})
+
+    return {
+        "qualifiers" : ["FRZLVL"],
+        "desc" : desc,
+        "range_ft" : [_frzlvl_ft(range_match.group(1)), _frzlvl_ft(range_match.group(2))] if range_match else None,
+        "contours" : contours,
+        "areas" : areas,
+    }
+
 def _pop_qualifiers(text):
     
     if not text:
@@ -729,6 +1152,9 @@ def _pop_qualifiers(text):
     return qualifiers
 
 def _header_to_dict(header, **kwargs):
+
+    year = kwargs.get("year")
+    month = kwargs.get("month")
     
     main_block_match = re.search(r"\#([A-Z]|\d){4}\s.+", header)
     
@@ -792,62 +1218,6 @@ def _header_to_dict(header, **kwargs):
     
 if __name__ == "__main__":
 
-    save_dir = "/Users/rpurciel/Documents/Solis v RAPCO/AIRMETS"
-
-    year = 2020
-
-    month = 3
-
-    day = 13
-
-    print("starting download")
-
-    _, _, fpath = download(save_dir, year, month, day, verbose=True, debug=True)
-
-
-    print("done")
-
-    #selected_states = ["TN", "AL", "GA", "SC", "NC"]
-
-    selected_states = ["WA"]
-
-    with open(fpath) as file:
-        data = file.read()
-
-    #print(data)
-    main_list = json.loads(data)
-
-    save_dir = "/Users/rpurciel/Documents/Solis v RAPCO/AIRMETS"
-
-    # test_airmet = [{"airmet_id": "WA4Z", "iss_airport": "DFWZ", "iss_time": "102045", "airmet_type": "ZULU", "valid_time": "110300", "conditions": ["ICE", "FRZLVL"], "subgroups": [{"qualifiers": ["AIRMET ICE"], "vors": ["30ENE ASP", "40S ECK", "FWA", "CVG", "HNN", "50S HNN", "50ENE DYR", "20WNW STL", "30SSE BAE", "30ENE ASP"], "states": ["TN", "MO", "WI", "LM", "MI", "IL", "IN", "KY"], "desc": "MOD ICE BTN FRZLVL AND FL220. FRZLVL 080-120. CONDS CONTG BYD 03Z THRU 09Z."}]}]
-    airmets = len(main_list)
-    index = 1
-
-    for airmet in main_list:
-        print(f"Plotting airmet {index} of {airmets}", end="\r")
-        airmet_id = airmet.get("airmet_id")
-        airmet_type = airmet.get("airmet_type")
-        iss_time = datetime(airmet.get("iss_year"), airmet.get("iss_month"), airmet.get("iss_day"), airmet.get("iss_hour"), airmet.get("iss_minute"))
-        valid_time = datetime(airmet.get("valid_year"), airmet.get("valid_month"), airmet.get("valid_day"), airmet.get("valid_hour"), airmet.get("valid_minute"))
-        airmet_raw_text = airmet.get("raw_text")
-
-        iss_str = "ISSUED " + iss_time.strftime("%Y-%m-%d %H:%M:%S")
-        valid_str = "VALID UNTIL " + valid_time.strftime("%Y-%m-%d %H:%M:%S") 
-
-        #print(airmet_id, airmet_type, cond_str)
-
-        subgroups = airmet.get("subgroups")
-        if not subgroups:
-            subgroups = []
-
-        _, _, _, = plot_kmz(save_dir, subgroups, airmet_type, airmet_id, airmet_raw_text, valid_time, iss_time, debug=True)
-        index += 1
-
-
-    
-
-
-
-
-
+    from cli import main
 
+    sys.exit(main())
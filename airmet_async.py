@@ -0,0 +1,212 @@
+import sys
+import os
+import random
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+
+import airmet
+import quarantine
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+DEF_MAX_CONCURRENCY = 8
+
+DEF_REQUEST_TIMEOUT_S = 30
+
+DEF_PARSE_PROCESSES = 2
+
+class AsyncAirmetClient():
+    ''' Non-blocking counterpart of download(),
+        for embedding in asyncio services.
+
+        One aiohttp session (and so one pool of
+        keep-alive connections) is shared by every
+        request made through the client, and at most
+        max_concurrency requests are in flight at once.
+        Parsing runs on a process pool so the event
+        loop never blocks on regex work; pass
+        parse_processes=0 to parse inline, or an
+        existing executor with executor=.
+
+        Every parse runs under a budget of
+        parse_budget seconds (0 disables it), so a
+        pathological bulletin can't hold the event
+        loop or a pool worker. A product that
+        overruns is yielded as an error and appended
+        to the quarantine file at quarantine_path
+        (if any).
+
+        Use as an async context manager:
+
+            async with AsyncAirmetClient() as client:
+                async for airmet_dict in client.iter_airmets(2020, 3, 13):
+                    ...
+    '''
+
+    def __init__(self, **kwargs):
+
+        if aiohttp is None:
+            raise ImportError("AsyncAirmetClient requires aiohttp (pip install aiohttp)")
+
+        self.base_url = kwargs.get("base_url", airmet.DEF_IEM_BASE_URL)
+        self.max_concurrency = kwargs.get("max_concurrency", DEF_MAX_CONCURRENCY)
+        self.timeout_s = kwargs.get("timeout", DEF_REQUEST_TIMEOUT_S)
+        self.retries = kwargs.get("retries", airmet.DEF_HTTP_RETRIES)
+        self.backoff = kwargs.get("backoff", airmet.DEF_HTTP_BACKOFF_S)
+        self.parse_processes = kwargs.get("parse_processes", DEF_PARSE_PROCESSES)
+        self.pil_prefix = kwargs.get("pil_prefix", "WA")
+        self.parser = quarantine.BudgetedParser(kwargs.get("parser", airmet.parse_airmet), kwargs.get("parse_budget", quarantine.DEF_PARSE_BUDGET_S))
+        self.quarantine = quarantine.Quarantine(kwargs.get("quarantine_path"))
+        self.verbose = airmet.str_to_bool(kwargs.get("verbose"))
+
+        self._executor = kwargs.get("executor")
+        self._owns_executor = False
+        self._session = None
+        self._semaphore = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def open(self):
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency)
+        self._session = aiohttp.ClientSession(connector=connector,
+                                              headers=airmet.DEF_IEM_HEADERS,
+                                              timeout=aiohttp.ClientTimeout(total=self.timeout_s))
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        if self._executor is None and self.parse_processes:
+            self._executor = ProcessPoolExecutor(max_workers=self.parse_processes)
+            self._owns_executor = True
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        if self._owns_executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+            self._owns_executor = False
+
+    async def fetch_product_list(self, date):
+        url = f"{self.base_url}/api/1/nws/afos/list.json?cccc=kkci&date={date}"
+        if self.verbose:
+            print(f"SCRAPER: Scraping all products from URL {url}")
+        json_data = await self._get(url, as_json=True)
+        return json_data["data"]
+
+    async def fetch_product_text(self, product_id):
+        url = f"{self.base_url}/api/1/nwstext/{product_id}"
+        if self.verbose:
+            print(f"SCRAPER: Getting AIRMET with ID {product_id} from URL {url}")
+        return await self._get(url)
+
+    async def _get(self, url, as_json=False):
+        #Same retry policy as airmet._http_get: 429/5xx, timeouts, dropped
+        #connections and truncated bodies are retried with jittered backoff
+        attempt = 0
+        while True:
+            try:
+                async with self._semaphore:
+                    async with self._session.get(url) as response:
+                        if response.status not in airmet.DEF_HTTP_RETRY_STATUSES:
+                            response.raise_for_status()
+                            return await response.json(content_type=None) if as_json else await response.text()
+                        error = aiohttp.ClientResponseError(response.request_info, response.history, status=response.status)
+            except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError, ValueError) as e:
+                error = e
+
+            if attempt >= self.retries:
+                raise error
+            attempt += 1
+            await asyncio.sleep(random.uniform(0, min(airmet.DEF_HTTP_MAX_BACKOFF_S, self.backoff * (2 ** attempt))))
+
+    async def parse(self, airmet_raw_text, year, month):
+        if self._executor is None:
+            return self.parser(airmet_raw_text, year, month)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self.parser, airmet_raw_text, year, month)
+
+    async def fetch_airmet(self, product_id, **kwargs):
+        '''Fetches and parses a single product. One
+           that overruns the parse budget is quarantined
+           and returned as a {"product_id", "error"} dict.
+        '''
+        airmet_raw_text = await self.fetch_product_text(product_id)
+        try:
+            airmet_dict = await self.parse(airmet_raw_text, int(product_id[0:4]), int(product_id[4:6]))
+        except quarantine.ParseBudgetExceeded as e:
+            self.quarantine.add(airmet_raw_text, e, product_id=product_id, pil=kwargs.get("pil"))
+            if self.verbose:
+                print(f"PARSING: {product_id} quarantined, {e}")
+            return {"product_id" : product_id, "error" : repr(e)}
+        airmet_dict["product_id"] = product_id
+        return airmet_dict
+
+    async def iter_airmets(self, year, month, day, **kwargs):
+        '''Async generator yielding every parsed AIRMET
+           issued on the given day, as each one completes
+           (or in listing order with ordered=True).
+
+           Products that fail to fetch or parse are
+           yielded as {"product_id", "error"} dicts
+           unless raise_errors=True (quarantined ones
+           always are). Cancelling the
+           consumer (or breaking out of the loop)
+           cancels every outstanding request.
+        '''
+
+        ordered = kwargs.get("ordered", False)
+        raise_errors = kwargs.get("raise_errors", False)
+
+        date = f"{str(year).zfill(4)}-{str(month).zfill(2)}-{str(day).zfill(2)}"
+        product_list = await self.fetch_product_list(date)
+        products = [prod for prod in product_list if prod["pil"].startswith(self.pil_prefix)]
+
+        tasks = [asyncio.ensure_future(self._fetch_airmet_or_error(prod["product_id"], raise_errors, pil=prod["pil"])) for prod in products]
+
+        try:
+            if ordered:
+                for task in tasks:
+                    yield await task
+            else:
+                for next_done in asyncio.as_completed(tasks):
+                    yield await next_done
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _fetch_airmet_or_error(self, product_id, raise_errors, **kwargs):
+        try:
+            return await self.fetch_airmet(product_id, **kwargs)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if raise_errors:
+                raise
+            if self.verbose:
+                print(f"ERROR: {product_id}: {e!r}")
+            return {"product_id" : product_id, "error" : repr(e)}
+
+async def download_async(year, month, day, **kwargs):
+    '''Returns the list of parsed AIRMETs for a day,
+       the async equivalent of the JSON download()
+       writes. kwargs are passed to AsyncAirmetClient.
+    '''
+
+    async with AsyncAirmetClient(**kwargs) as client:
+        return [airmet_dict async for airmet_dict in client.iter_airmets(year, month, day, ordered=True)]
+
+if __name__ == "__main__":
+
+    year, month, day = int(sys.argv[1]), int(sys.argv[2]), int(sys.argv[3])
+
+    airmets = asyncio.run(download_async(year, month, day, verbose=True))
+    print(f"Fetched {len(airmets)} AIRMETs")
@@ -0,0 +1,467 @@
+import sys
+import os
+import io
+import gzip
+import json
+
+DEF_COMPRESSION_SUFFIXES = {
+    None : "",
+    "gzip" : ".gz",
+    "zstd" : ".zst",
+}
+
+DEF_GZIP_LEVEL = 6
+
+DEF_ZSTD_LEVEL = 10
+
+DEF_GZIP_MAGIC = b"\x1f\x8b"
+
+DEF_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+DEF_COMPACT_SEPARATORS = (",", ":")
+
+DEF_INDEX_SUFFIX = ".idx"
+
+DEF_INDEX_VERSION = 2
+
+#Indexed files compress records in blocks of up to this many records (or
+#bytes of JSON), so random access decodes one block, not the whole file
+DEF_INDEX_BLOCK_RECORDS = 64
+
+DEF_INDEX_BLOCK_BYTES = 256 * 1024
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("zstd compression requires the zstandard package (pip install zstandard)")
+    return zstandard
+
+class OutputFile():
+    ''' A text file written as a stream, optionally
+        gzip or zstd compressed. Data goes to a
+        ".part" file that only replaces path on
+        close(), so readers never see a partial
+        file and abort() leaves nothing behind.
+
+        path is the final path, including the
+        compression suffix.
+
+        mark() ends the current gzip member or zstd
+        frame and returns the byte offset the next
+        write starts at, so a byte range between two
+        marks can be decompressed on its own.
+    '''
+
+    def __init__(self, path, **kwargs):
+
+        self.compression = kwargs.get("compression")
+        if self.compression not in DEF_COMPRESSION_SUFFIXES:
+            raise ValueError(f"Unknown compression '{self.compression}', expected one of {list(DEF_COMPRESSION_SUFFIXES)}")
+        self.level = kwargs.get("level", DEF_ZSTD_LEVEL if self.compression == "zstd" else DEF_GZIP_LEVEL)
+
+        suffix = DEF_COMPRESSION_SUFFIXES[self.compression]
+        self.path = path if path.endswith(suffix) else path + suffix
+        self.part_path = self.path + ".part"
+
+        self._raw = open(self.part_path, "wb")
+        self._binary = None
+        self._closed = False
+        if self.compression == "zstd":
+            self._zstd = _zstandard()
+            self._compressor = self._zstd.ZstdCompressor(level=self.level)
+
+    def _open_member(self):
+        if self.compression == "gzip":
+            #mtime=0 keeps the output byte-identical between runs
+            self._binary = gzip.GzipFile(fileobj=self._raw, mode="wb", compresslevel=self.level, mtime=0)
+        elif self.compression == "zstd":
+            self._binary = self._compressor.stream_writer(self._raw, closefd=False)
+        else:
+            self._binary = self._raw
+
+    def _close_member(self):
+        if self._binary is None:
+            return
+        if self._binary is not self._raw:
+            self._binary.close()
+        self._binary = None
+
+    def write(self, text):
+        if self._binary is None:
+            self._open_member()
+        return self._binary.write(text.encode("utf-8"))
+
+    def mark(self):
+        self._close_member()
+        return self._raw.tell()
+
+    def close(self):
+        self._close_streams()
+        os.replace(self.part_path, self.path)
+
+    def abort(self):
+        self._close_streams()
+        if os.path.exists(self.part_path):
+            os.remove(self.part_path)
+
+    def _close_streams(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._close_member()
+        self._raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+def open_output(path, **kwargs):
+    return OutputFile(path, **kwargs)
+
+def resolve_input_path(path):
+    '''Returns path, or path with a compression
+       suffix if only the compressed file exists, so
+       callers can keep building uncompressed names.
+    '''
+
+    if os.path.exists(path):
+        return path
+    for suffix in DEF_COMPRESSION_SUFFIXES.values():
+        if suffix and os.path.exists(path + suffix):
+            return path + suffix
+    raise FileNotFoundError(path)
+
+def detect_compression(path):
+    with open(path, "rb") as file:
+        magic = file.read(4)
+    if magic.startswith(DEF_GZIP_MAGIC):
+        return "gzip"
+    if magic == DEF_ZSTD_MAGIC:
+        return "zstd"
+    return None
+
+def open_input(path):
+    '''Opens a text file for reading, transparently
+       decompressing gzip or zstd (detected from the
+       file's magic bytes, not its name).
+    '''
+
+    path = resolve_input_path(path)
+    compression = detect_compression(path)
+
+    if compression == "gzip":
+        return gzip.open(path, "rt", encoding="utf-8", newline="")
+    if compression == "zstd":
+        raw = open(path, "rb")
+        #Indexed files are a run of independent frames, one per record
+        reader = _zstandard().ZstdDecompressor().stream_reader(raw, closefd=True, read_across_frames=True)
+        return io.TextIOWrapper(reader, encoding="utf-8", newline="")
+    return open(path, encoding="utf-8", newline="")
+
+def read_text(path):
+    with open_input(path) as file:
+        return file.read()
+
+def index_path(path):
+    return path + DEF_INDEX_SUFFIX
+
+def _id_key(airmet_dict):
+    #SIGMET outputs (see router.py) share the archive format, keyed by sigmet_id
+    return airmet_dict.get("airmet_id", airmet_dict.get("sigmet_id"))
+
+def _iss_key(airmet_dict):
+    if "iss_day" not in airmet_dict:
+        return None
+    return (f"{airmet_dict['iss_year']:04d}{airmet_dict['iss_month']:02d}{airmet_dict['iss_day']:02d}"
+            f"{airmet_dict['iss_hour']:02d}{airmet_dict['iss_minute']:02d}")
+
+class JSONArrayWriter():
+    ''' Streams a JSON array one element at a
+        time. Compact by default; pretty=True
+        gives the indent=2 layout download()
+        used to write.
+
+        With index=True (file must be an
+        OutputFile) elements are grouped into
+        blocks of up to block_records elements or
+        block_bytes bytes of JSON, each its own
+        gzip member / zstd frame, and close() writes
+        a sidecar index of (airmet_id, iss_time,
+        product_id, block start, block end, offset,
+        length) next to the file, for AirmetArchive
+        to seek with: an element is bytes offset to
+        offset + length of its decompressed block.
+    '''
+
+    def __init__(self, file, **kwargs):
+
+        self.file = file
+        self.pretty = kwargs.get("pretty", False)
+        self.index = kwargs.get("index", False)
+        self.block_records = kwargs.get("block_records", DEF_INDEX_BLOCK_RECORDS)
+        self.block_bytes = kwargs.get("block_bytes", DEF_INDEX_BLOCK_BYTES)
+        self.num_written = 0
+        self.records = []
+        self._block = [] #records of the open block, waiting for its end offset
+        self._block_start = 0
+        self._block_pos = 0 #bytes of JSON written to the open block
+        self._write("[")
+
+    def _write(self, text):
+        self.file.write(text)
+        size = len(text.encode("utf-8"))
+        self._block_pos += size
+        return size
+
+    def _end_block(self):
+        end = self.file.mark()
+        for record in self._block:
+            record[3], record[4] = self._block_start, end
+        self._block = []
+        self._block_start = end
+        self._block_pos = 0
+        return end
+
+    def write(self, element, **kwargs):
+        if self.pretty:
+            text = json.dumps(element, indent=2)
+            text = "\n" + "\n".join("  " + line for line in text.split("\n"))
+        else:
+            text = json.dumps(element, separators=DEF_COMPACT_SEPARATORS)
+
+        #The separator goes in the same block as the element after it
+        if self.num_written:
+            self._write(",")
+        offset = self._block_pos
+        length = self._write(text)
+        self.num_written += 1
+
+        if self.index:
+            record = [_id_key(element), _iss_key(element), kwargs.get("product_id", element.get("product_id")), None, None, offset, length]
+            self.records.append(record)
+            self._block.append(record)
+            if len(self._block) >= self.block_records or self._block_pos >= self.block_bytes:
+                self._end_block()
+
+    def close(self):
+        self._write("\n]" if (self.pretty and self.num_written) else "]")
+        if self.index:
+            size = self._end_block()
+            index = {"version" : DEF_INDEX_VERSION, "compression" : self.file.compression, "size" : size, "records" : self.records}
+            with open_output(index_path(self.file.path)) as index_file:
+                index_file.write(json.dumps(index, separators=DEF_COMPACT_SEPARATORS))
+
+def read_index(path):
+    '''Returns the sidecar index for a data file, or
+       None if there isn't one or it no longer matches
+       the file (e.g. the file was rewritten without it).
+    '''
+
+    try:
+        with open(index_path(path)) as file:
+            index = json.load(file)
+    except FileNotFoundError:
+        return None
+    if index.get("version") != DEF_INDEX_VERSION or index.get("size") != os.path.getsize(path):
+        return None
+    return index
+
+def _decompress(data, compression):
+    if compression == "gzip":
+        return gzip.decompress(data)
+    if compression == "zstd":
+        return _zstandard().ZstdDecompressor().decompressobj().decompress(data)
+    return data
+
+class AirmetArchive():
+    ''' Random access into one parsed AIRMET file
+        through its sidecar index. Records are only
+        read (and decompressed) when asked for, so
+        looking one up costs one seek and one block's
+        worth of decoding however big the file is.
+        The last block read is kept, so iterating
+        decodes each block once.
+
+        Files without a usable index fall back to
+        loading the whole file once.
+
+            with AirmetArchive("AllAIRMETS_20200313.json.gz") as archive:
+                airmet_dict = archive.get("WA4Z", iss_time=datetime(2020, 3, 13, 14, 45))
+                for airmet_dict in archive:
+                    ...
+    '''
+
+    def __init__(self, path):
+
+        self.path = resolve_input_path(path)
+        self.index = read_index(self.path)
+        self._file = None
+        self._loaded = None
+        self._block = (None, None) #(start, decompressed bytes)
+
+        self.by_airmet_id = {}
+        self.by_product_id = {}
+        for pos, record in enumerate(self.records()):
+            self.by_airmet_id.setdefault(record[0], []).append(pos)
+            if record[2]:
+                self.by_product_id[record[2]] = pos
+
+    def records(self):
+        '''Index records, [airmet_id, iss_time, product_id,
+           block start, block end, offset, length] with
+           iss_time as YYYYMMDDHHMM.
+        '''
+
+        if self.index is not None:
+            return self.index["records"]
+        return [[_id_key(airmet_dict), _iss_key(airmet_dict), airmet_dict.get("product_id"), None, None, None, None]
+                for airmet_dict in self._load()]
+
+    def _load(self):
+        if self._loaded is None:
+            self._loaded = load_airmets(self.path)
+        return self._loaded
+
+    def read(self, pos):
+        '''Returns the pos-th record of the file.'''
+
+        if self.index is None:
+            return self._load()[pos]
+
+        _, _, _, start, end, offset, length = self.index["records"][pos]
+        if self._block[0] != start:
+            if self._file is None:
+                self._file = open(self.path, "rb")
+            self._file.seek(start)
+            self._block = (start, _decompress(self._file.read(end - start), self.index["compression"]))
+        return json.loads(self._block[1][offset:offset + length])
+
+    def find(self, airmet_id, **kwargs):
+        '''Returns every record for airmet_id, optionally
+           only those issued at iss_time (a datetime).
+        '''
+
+        iss_time = kwargs.get("iss_time")
+        iss_key = iss_time.strftime("%Y%m%d%H%M") if iss_time else None
+
+        records = self.records()
+        return [self.read(pos) for pos in self.by_airmet_id.get(airmet_id, [])
+                if iss_key is None or records[pos][1] == iss_key]
+
+    def get(self, airmet_id, **kwargs):
+        matches = self.find(airmet_id, **kwargs)
+        if not matches:
+            raise KeyError(airmet_id)
+        return matches[0]
+
+    def get_product(self, product_id):
+        if product_id not in self.by_product_id:
+            raise KeyError(product_id)
+        return self.read(self.by_product_id[product_id])
+
+    def __len__(self):
+        return len(self.records())
+
+    def __iter__(self):
+        for pos in range(len(self)):
+            yield self.read(pos)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._block = (None, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def daily_path(save_dir, date):
+    return os.path.join(save_dir, f"AllAIRMETS_{date.strftime('%Y%m%d')}.json")
+
+def lookup(save_dir, airmet_id, iss_time, **kwargs):
+    '''Finds one AIRMET in a directory of daily
+       files, opening only the file for its
+       issuance day. Pass an archives dict to
+       keep files (and their indexes) open
+       across calls.
+    '''
+
+    archives = kwargs.get("archives")
+    path = daily_path(save_dir, iss_time)
+
+    if archives is None:
+        with AirmetArchive(path) as archive:
+            return archive.get(airmet_id, iss_time=iss_time)
+
+    if path not in archives:
+        archives[path] = AirmetArchive(path)
+    return archives[path].get(airmet_id, iss_time=iss_time)
+
+def load_airmets(path):
+    '''Loads a parsed AIRMET file, JSON array or
+       NDJSON, compressed or not.
+    '''
+
+    with open_input(path) as file:
+        text = file.read()
+
+    stripped = text.lstrip()
+    if not stripped:
+        return []
+    if stripped[0] == "[":
+        return json.loads(text)
+    return [json.loads(line) for line in text.split("\n") if line.strip()]
+
+def iter_ndjson(path):
+    with open_input(path) as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+def rewrite(path, **kwargs):
+    '''Rewrites an existing output file with the given
+       compression. Parsed AIRMET arrays are rewritten
+       record by record so they get a fresh index.
+       Returns the new path.
+    '''
+
+    base_path = path
+    for suffix in DEF_COMPRESSION_SUFFIXES.values():
+        if suffix and base_path.endswith(suffix):
+            base_path = base_path[:-len(suffix)]
+
+    text = read_text(path)
+    with open_output(base_path, compression=kwargs.get("compression")) as output:
+        if text.lstrip().startswith("["):
+            old_index = read_index(path)
+            product_ids = [record[2] for record in old_index["records"]] if old_index else []
+            writer = JSONArrayWriter(output, pretty=kwargs.get("pretty", False), index=True)
+            for pos, airmet_dict in enumerate(json.loads(text)):
+                writer.write(airmet_dict, product_id=product_ids[pos] if pos < len(product_ids) else None)
+            writer.close()
+        else:
+            output.write(text)
+
+    if output.path != path:
+        os.remove(path)
+        if os.path.exists(index_path(path)):
+            os.remove(index_path(path))
+    return output.path
+
+if __name__ == "__main__":
+
+    #Recompress (and reindex) existing outputs in place, e.g. python archive.py gzip AllAIRMETS_*.json
+    compression = None if sys.argv[1] == "none" else sys.argv[1]
+    for path in sys.argv[2:]:
+        if path.endswith(DEF_INDEX_SUFFIX):
+            continue
+        print(f"{path} -> {rewrite(path, compression=compression)}")
@@ -0,0 +1,76 @@
+import sys
+import os
+import time
+import statistics
+import subprocess
+import tempfile
+from datetime import datetime
+
+#Cold-start budget for "import airmet" / "cli.py --help" / "cli.py parse"
+#of one bulletin, measured as the median wall time on top of a bare
+#"python -c pass" on the same machine.
+DEF_STARTUP_TARGET_MS = 50
+
+DEF_NUM_RUNS = 15
+
+#Cases whose overhead is held to the target
+DEF_BUDGETED_CASES = ("import airmet", "cli --help", "cli parse")
+
+DEF_STARTUP_CASES = {
+    "interpreter" : ["-c", "pass"],
+    "import airmet" : ["-c", "import airmet"],
+    "cli --help" : ["cli.py", "--help"],
+    "cli parse" : ["cli.py", "parse", "{raw_text}"],
+    "eager deps (old import airmet)" : ["-c", "import requests, numpy, simplekml"],
+}
+
+def time_command(args, num_runs=DEF_NUM_RUNS):
+    '''Returns the median wall time in ms of running
+       the interpreter with args, num_runs times.
+    '''
+
+    src_dir = os.path.dirname(os.path.abspath(__file__))
+    timings = []
+    for _ in range(num_runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + args, cwd=src_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+def run_startup_benchmark(**kwargs):
+    '''Times every case in DEF_STARTUP_CASES and
+       returns {case: median ms}, plus "overhead_ms",
+       the worst DEF_BUDGETED_CASES case minus the
+       bare interpreter, and "passed" against the
+       target. "cli parse" parses one synthetic
+       bulletin, written beforehand.
+    '''
+
+    num_runs = kwargs.get("num_runs", DEF_NUM_RUNS)
+    target_ms = kwargs.get("target_ms", DEF_STARTUP_TARGET_MS)
+
+    import synthetic
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        raw_text_path = os.path.join(tmp_dir, "AllAIRMET_RawText_20200301.txt")
+        with open(raw_text_path, "w") as file:
+            file.write(synthetic.SyntheticCorpus().bulletin(datetime(2020, 3, 1, 2, 45), "SFO", "S"))
+
+        results = {case : time_command([arg.format(raw_text=raw_text_path) for arg in args], num_runs)
+                   for case, args in DEF_STARTUP_CASES.items()}
+    overhead_ms = max(results[case] for case in DEF_BUDGETED_CASES) - results["interpreter"]
+
+    results["overhead_ms"] = overhead_ms
+    results["target_ms"] = target_ms
+    results["passed"] = overhead_ms <= target_ms
+    return results
+
+if __name__ == "__main__":
+
+    results = run_startup_benchmark()
+
+    for case in DEF_STARTUP_CASES:
+        print(f"{case:<32} {results[case]:8.1f} ms")
+    print(f"{'startup overhead':<32} {results['overhead_ms']:8.1f} ms (target <= {results['target_ms']} ms): {'PASS' if results['passed'] else 'FAIL'}")
+
+    sys.exit(0 if results["passed"] else 1)
@@ -0,0 +1,448 @@
+import sys
+import os
+import io
+import gc
+import json
+import math
+import time
+import random
+import shutil
+import argparse
+import contextlib
+import tempfile
+import tracemalloc
+from datetime import datetime
+
+import airmet
+import archive
+import synthetic
+
+DEF_BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+
+#A case regresses when its throughput drops more than this fraction below the baseline
+DEF_REGRESSION_TOLERANCE = 0.2
+
+DEF_NUM_DAYS = 2
+
+DEF_NUM_EXTRA = 8
+
+DEF_KMZ_LIMIT = 20
+
+DEF_NUM_SUBSCRIPTIONS = 100000
+
+DEF_NUM_FUZZ = 5000
+
+#Fragments the fuzzer splices into real VOR blocks, besides single characters
+DEF_FUZZ_TOKENS = ("FROM ", "TO ", "BOUNDED BY ", "-", "#", " ", "-#", "# ", "40NW ", "30SSW ", "SPS", "12Z", "100", "MTNS", "$")
+
+#Characters of each adversarial input in the vor_adversarial and parse_adversarial cases
+DEF_ADVERSARIAL_LENGTH = 1 << 16
+
+#Near-misses for the VOR patterns, each built to n characters: separator runs
+#after a dash, dash/separator soup, keywords and offsets with no VOR after
+#them, and runs that a nested quantifier would try to split every way
+DEF_ADVERSARIAL_INPUTS = {
+    "dash_separator_run" : lambda n: "BOUNDED BY SPS-" + ("# " * n)[:n],
+    "dash_soup" : lambda n: "BOUNDED BY SPS" + ("-# -#  - " * n)[:n],
+    "keyword_runs" : lambda n: "FROM " + ("TO FROM# " * n)[:n],
+    "offset_runs" : lambda n: ("40NW 30SSW# " * n)[:n],
+    "alnum_run" : lambda n: "FROM " + "A" * n,
+    "scheme3_near_chain" : lambda n: ("SPS # # # # -# 40NW " * n)[:n],
+    "word_run" : lambda n: "$" + ("A" * 60 + " ") * (n // 61) + "#",
+}
+
+#vor_scaling: run time growing faster than length**exponent fails the check
+DEF_MAX_SCALING_EXPONENT = 1.3
+
+class BenchContext():
+    ''' Synthetic corpus plus the intermediate
+        representations each case starts from,
+        built once so cases only time their own
+        stage.
+    '''
+
+    def __init__(self, **kwargs):
+
+        self.num_days = kwargs.get("num_days", DEF_NUM_DAYS)
+        generator = synthetic.SyntheticCorpus(seed=kwargs.get("seed", 0))
+
+        self.products = []
+        for date, products in generator.corpus(datetime(2020, 3, 1), self.num_days, num_extra=kwargs.get("num_extra", DEF_NUM_EXTRA)):
+            self.products += products
+
+        self.texts = [prod["text"] for prod in self.products]
+        self.sanitized = [airmet._sanitize_for_reading(text) for text in self.texts]
+
+        self.headers = []
+        self.groups = []
+        for san_airmet in self.sanitized:
+            for group in san_airmet[:san_airmet.rfind("=")].split("+"):
+                if group.find("*") != -1:
+                    self.headers.append(group.replace("*", ""))
+                elif group:
+                    self.groups.append(group)
+
+        self.no_vor_groups = [airmet._pop_vors(group)[0] for group in self.groups]
+        self.parsed = [airmet.parse_airmet(text, 2020, 3) for text in self.texts]
+        #Only time VOR lists/strings that resolve, the parser can still mis-split some fixes
+        self.vor_lists = [group["vors"] for airmet_dict in self.parsed for group in airmet_dict["subgroups"]
+                          if group.get("vors") and _resolves(airmet.resolve_vors, group["vors"])]
+        self.vor_strings = [line for text in self.texts for line in _vor_strings(text) if _resolves(_bounds, line)]
+        self.plottable = [airmet_dict for airmet_dict in self.parsed
+                          if all(_resolves(airmet.resolve_vors, group.get("vors") or []) for group in airmet_dict["subgroups"])]
+
+        self.num_subscriptions = kwargs.get("num_subscriptions", DEF_NUM_SUBSCRIPTIONS)
+        self._registry = None
+
+        self.num_fuzz = kwargs.get("num_fuzz", DEF_NUM_FUZZ)
+        self.seed = kwargs.get("seed", 0)
+        self._fuzzed = None
+
+        self.tmp_dir = tempfile.mkdtemp(prefix="airmet_bench_")
+
+    def registry(self):
+        #Built on first use, only the subscription case pays for it
+        if self._registry is None:
+            import subscriptions
+
+            self._registry = subscriptions.SubscriptionRegistry()
+            for sub_id, spec in subscriptions.synthetic_subscriptions(self.num_subscriptions):
+                self._registry.add(sub_id, **spec)
+        return self._registry
+
+    def fuzzed(self):
+        #Real groups and VOR strings with random edits, built on first use
+        if self._fuzzed is None:
+            rng = random.Random(self.seed)
+            sources = self.groups + self.vor_strings
+            self._fuzzed = [_mutate(rng, rng.choice(sources)) for _ in range(self.num_fuzz)]
+        return self._fuzzed
+
+    def adversarial_bulletins(self):
+        #A real header with one subgroup whose states line and body are each adversarial input
+        header = self.texts[0][:self.texts[0].index("\n.\n") + 3]
+        return [f"{header}AIRMET IFR...WA OR CA{build(DEF_ADVERSARIAL_LENGTH)}\n{build(DEF_ADVERSARIAL_LENGTH)}\n....\n"
+                for build in DEF_ADVERSARIAL_INPUTS.values()]
+
+    def close(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+def _resolves(func, arg):
+    #Unresolvable VORs come back as NaN points rather than raising
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            points = func(arg)
+    except KeyError:
+        return False
+    return not any(math.isnan(lat) or math.isnan(lon) for lat, lon in points)
+
+def _mutate(rng, text):
+    chars = list(text)
+    for _ in range(rng.randint(1, 8)):
+        idx = rng.randrange(len(chars) + 1)
+        op = rng.random()
+        if op < 0.3:
+            chars.insert(idx, rng.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789 #-.$"))
+        elif op < 0.5 and chars:
+            del chars[min(idx, len(chars) - 1)]
+        elif op < 0.8:
+            chars[idx:idx] = rng.choice(DEF_FUZZ_TOKENS)
+        else: #duplicate a slice, e.g. repeat part of a VOR list
+            other = rng.randrange(len(chars) + 1)
+            chars[idx:idx] = chars[min(idx, other):max(idx, other)][:200]
+    return "".join(chars)
+
+def _extract_vors(text):
+    from subclasses import parse_vor_string
+
+    airmet._pop_vors(text)
+    parse_vor_string(text)
+
+def vor_scaling(**kwargs):
+    '''Times VOR extraction on every adversarial
+       input at doubling lengths. Returns {input :
+       {"chars_per_s" : at the longest length,
+       "exponent" : growth of run time with length}},
+       where an exponent near 1 is linear time and 2
+       quadratic.
+    '''
+
+    lengths = kwargs.get("lengths") or [DEF_ADVERSARIAL_LENGTH << shift for shift in range(4)]
+    repeat = kwargs.get("repeat", 3)
+
+    results = {}
+    for name, build in DEF_ADVERSARIAL_INPUTS.items():
+        times = []
+        for length in lengths:
+            text = build(length)
+            _extract_vors(text)
+            best_s = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                _extract_vors(text)
+                elapsed_s = time.perf_counter() - start
+                best_s = elapsed_s if best_s is None else min(best_s, elapsed_s)
+            times.append(best_s)
+        #Least squares slope of log(time) over log(length)
+        xs = [math.log(length) for length in lengths]
+        ys = [math.log(elapsed_s) for elapsed_s in times]
+        x_mean, y_mean = sum(xs) / len(xs), sum(ys) / len(ys)
+        results[name] = {
+            "chars_per_s" : lengths[-1] / times[-1],
+            "exponent" : sum((x - x_mean) * (y - y_mean) for x, y in zip(xs, ys)) / sum((x - x_mean) ** 2 for x in xs),
+        }
+    return results
+
+def _bounds(vor_string):
+    from subclasses import Bounds
+
+    return list(Bounds(vor_string))
+
+def _vor_strings(text):
+    #The FROM/BOUNDED BY blocks of a bulletin joined onto one line, as Bounds expects
+    strings = []
+    current = None
+    for line in text.split("\n"):
+        if line.startswith("FROM ") or line.startswith("BOUNDED BY "):
+            current = [line]
+            strings.append(current)
+        elif current is not None and (line.find(" TO ") != -1 or line.find("-") != -1) and line.find(".") == -1:
+            current.append(line)
+        else:
+            current = None
+    return [" ".join(parts) for parts in strings]
+
+###Cases
+#Each case takes the BenchContext and returns the number of items it processed
+
+def bench_sanitize(ctx):
+    for text in ctx.texts:
+        airmet._sanitize_for_reading(text)
+    return len(ctx.texts)
+
+def bench_pop_vors(ctx):
+    for group in ctx.groups:
+        airmet._pop_vors(group)
+    return len(ctx.groups)
+
+def bench_pop_states(ctx):
+    for group in ctx.no_vor_groups:
+        airmet._pop_states(group)
+    return len(ctx.no_vor_groups)
+
+def bench_header_to_dict(ctx):
+    for header in ctx.headers:
+        airmet._header_to_dict(header, year=2020, month=3)
+    return len(ctx.headers)
+
+def bench_parse_airmet(ctx):
+    for text in ctx.texts:
+        airmet.parse_airmet(text, 2020, 3)
+    return len(ctx.texts)
+
+def bench_bounds(ctx):
+    from subclasses import Bounds
+
+    for vor_string in ctx.vor_strings:
+        list(Bounds(vor_string))
+    return len(ctx.vor_strings)
+
+def bench_vor_resolution(ctx):
+    num_vors = 0
+    for vors in ctx.vor_lists:
+        airmet.resolve_vors(vors)
+        num_vors += len(vors)
+    return num_vors
+
+def bench_json_write(ctx):
+    with archive.open_output(os.path.join(ctx.tmp_dir, "bench.json")) as file:
+        writer = archive.JSONArrayWriter(file, index=True)
+        for airmet_dict in ctx.parsed:
+            writer.write(airmet_dict)
+        writer.close()
+    return len(ctx.parsed)
+
+def bench_json_write_gzip(ctx):
+    with archive.open_output(os.path.join(ctx.tmp_dir, "bench.json"), compression="gzip") as file:
+        writer = archive.JSONArrayWriter(file, index=True)
+        for airmet_dict in ctx.parsed:
+            writer.write(airmet_dict)
+        writer.close()
+    return len(ctx.parsed)
+
+def bench_plot_kmz(ctx):
+    save_dir = os.path.join(ctx.tmp_dir, "kmz")
+    num_plotted = 0
+    for airmet_dict in ctx.plottable[:DEF_KMZ_LIMIT]:
+        iss_time, valid_time = airmet.airmet_times(airmet_dict)
+        airmet.plot_kmz(save_dir, airmet_dict["subgroups"], airmet_dict["airmet_type"], airmet_dict["airmet_id"],
+                        airmet_dict["raw_text"], valid_time, iss_time)
+        num_plotted += 1
+    return num_plotted
+
+def bench_subscription_match(ctx):
+    registry = ctx.registry()
+    num_groups = 0
+    for airmet_dict in ctx.plottable:
+        registry.match_bulletin(airmet_dict, outlooks=True)
+        num_groups += len(airmet_dict["subgroups"])
+    return num_groups
+
+def bench_vor_fuzz(ctx):
+    for text in ctx.fuzzed():
+        _extract_vors(text)
+    return len(ctx.fuzzed())
+
+def bench_vor_adversarial(ctx):
+    #Items are KiB, so items/s is the worst-case extraction throughput
+    num_chars = 0
+    for build in DEF_ADVERSARIAL_INPUTS.values():
+        text = build(DEF_ADVERSARIAL_LENGTH)
+        _extract_vors(text)
+        num_chars += len(text)
+    return num_chars // 1024
+
+def bench_parse_adversarial(ctx):
+    import quarantine
+
+    bulletins = ctx.adversarial_bulletins()
+    for text in bulletins:
+        try:
+            quarantine.parse_with_budget(airmet.parse_airmet, text, 2020, 3)
+        except Exception: #over budget or too garbled to parse, only the time matters here
+            pass
+    return len(bulletins)
+
+DEF_BENCH_CASES = {
+    "sanitize_for_reading" : bench_sanitize,
+    "pop_vors" : bench_pop_vors,
+    "pop_states" : bench_pop_states,
+    "header_to_dict" : bench_header_to_dict,
+    "parse_airmet" : bench_parse_airmet,
+    "bounds" : bench_bounds,
+    "vor_resolution" : bench_vor_resolution,
+    "json_write" : bench_json_write,
+    "json_write_gzip" : bench_json_write_gzip,
+    "plot_kmz" : bench_plot_kmz,
+    "subscription_match" : bench_subscription_match,
+    "vor_fuzz" : bench_vor_fuzz,
+    "vor_adversarial" : bench_vor_adversarial,
+    "parse_adversarial" : bench_parse_adversarial,
+}
+
+def run_case(case, ctx, **kwargs):
+    '''Runs a case repeat times and returns its best
+       throughput (items/s) and its peak traced memory.
+    '''
+
+    repeat = kwargs.get("repeat", 3)
+    func = DEF_BENCH_CASES[case]
+
+    func(ctx) #warm up caches (VOR table, compiled regexes, lazy imports)
+
+    best_s = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        num_items = func(ctx)
+        elapsed_s = time.perf_counter() - start
+        if best_s is None or elapsed_s < best_s:
+            best_s = elapsed_s
+
+    gc.collect()
+    tracemalloc.start()
+    func(ctx)
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "items" : num_items,
+        "best_s" : best_s,
+        "items_per_s" : num_items / best_s if best_s > 0 else float("inf"),
+        "peak_kib" : peak_bytes / 1024,
+    }
+
+def compare_to_baseline(results, baseline, **kwargs):
+    '''Returns a list of (case, baseline items/s,
+       current items/s) for every case that is slower
+       than the baseline by more than the tolerance.
+    '''
+
+    tolerance = kwargs.get("tolerance", DEF_REGRESSION_TOLERANCE)
+    regressions = []
+    for case, result in results.items():
+        base = baseline.get(case)
+        if base and result["items_per_s"] < base["items_per_s"] * (1 - tolerance):
+            regressions.append((case, base["items_per_s"], result["items_per_s"]))
+    return regressions
+
+def run_benchmarks(**kwargs):
+    cases = kwargs.get("cases") or list(DEF_BENCH_CASES)
+    ctx = BenchContext(**kwargs)
+    try:
+        return {case : run_case(case, ctx, **kwargs) for case in cases}
+    finally:
+        ctx.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the AIRMET parser on a synthetic corpus.")
+    parser.add_argument("--days", type=int, default=DEF_NUM_DAYS, help="days of synthetic bulletins (96 + extra per day)")
+    parser.add_argument("--extra", type=int, default=DEF_NUM_EXTRA, help="extra amended bulletins per day")
+    parser.add_argument("--subscriptions", type=int, default=DEF_NUM_SUBSCRIPTIONS, help="registry size for the subscription_match case")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--cases", nargs="+", choices=list(DEF_BENCH_CASES))
+    parser.add_argument("--baseline", default=DEF_BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=DEF_REGRESSION_TOLERANCE)
+    parser.add_argument("--startup", action="store_true", help="also run the cold start benchmark")
+    parser.add_argument("--vor-scaling", action="store_true", help="also check VOR extraction stays linear time on adversarial input")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(num_days=args.days, num_extra=args.extra, repeat=args.repeat, cases=args.cases,
+                             num_subscriptions=args.subscriptions)
+
+    print(f"{'case':<22} {'items':>7} {'items/s':>12} {'peak KiB':>10}")
+    for case, result in results.items():
+        print(f"{case:<22} {result['items']:>7} {result['items_per_s']:>12.1f} {result['peak_kib']:>10.1f}")
+
+    exit_code = 0
+
+    if args.startup:
+        import bench_startup
+
+        startup = bench_startup.run_startup_benchmark()
+        print(f"startup overhead {startup['overhead_ms']:.1f} ms (target <= {startup['target_ms']} ms)")
+        if not startup["passed"]:
+            exit_code = 1
+
+    if args.vor_scaling:
+        scaling = vor_scaling(repeat=args.repeat)
+        for name, result in scaling.items():
+            print(f"vor_scaling {name:<20} {result['chars_per_s'] / 1024:>10.1f} KiB/s  exponent {result['exponent']:.2f}")
+        worst = min(scaling, key=lambda name: scaling[name]["chars_per_s"])
+        print(f"vor_scaling worst case {worst}: {scaling[worst]['chars_per_s'] / 1024:.1f} KiB/s")
+        for name, result in scaling.items():
+            if result["exponent"] > DEF_MAX_SCALING_EXPONENT:
+                print(f"SUPERLINEAR: {name}: run time grows as length**{result['exponent']:.2f}")
+                exit_code = 1
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as file:
+            json.dump(results, file, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        regressions = compare_to_baseline(results, baseline, tolerance=args.tolerance)
+        for case, base_rate, rate in regressions:
+            print(f"REGRESSION: {case}: {rate:.1f} items/s vs baseline {base_rate:.1f} items/s")
+        if regressions:
+            exit_code = 1
+        else:
+            print(f"No regressions against {args.baseline}")
+
+    return exit_code
+
+if __name__ == "__main__":
+
+    sys.exit(main())
@@ -0,0 +1,541 @@
+import sys
+import os
+import re
+import gc
+import json
+import time
+import heapq
+import shutil
+import hashlib
+import tempfile
+from datetime import datetime
+
+import numpy as np
+
+import airmet
+import archive
+import geometry
+
+#Everything here works on daily files in time order, a chunk of whole
+#days at a time. A chunk is sized so that its parsed dicts fit in the
+#memory budget, its results are spilled to disk, and the per-chunk
+#results are merged in a final pass that streams them back. Caches that
+#would otherwise grow with the archive (resolved polygons, LOD levels)
+#are dropped between chunks, so peak RSS depends on the chunk size,
+#not on how many years are processed.
+
+DEF_MEMORY_BUDGET_MB = 512
+
+#Rough bytes of Python objects per byte of JSON text, and JSON bytes per compressed byte
+DEF_OBJECT_OVERHEAD = 6
+
+DEF_COMPRESSION_RATIO = {None : 1, "gzip" : 8, "zstd" : 8}
+
+DEF_RAW_FILE_RE = re.compile(r"^AllAIRMET_RawText_(\d{8})\.txt(\.gz|\.zst)?$")
+
+DEF_JSON_FILE_RE = re.compile(r"^AllAIRMETS_(\d{8})\.json(\.gz|\.zst)?$")
+
+#Rasters cover the CONUS at DEF_RASTER_RES_DEG, (min_lat, min_lon, max_lat, max_lon)
+DEF_RASTER_BOUNDS = (20.0, -130.0, 55.0, -60.0)
+
+DEF_RASTER_RES_DEG = 0.25
+
+#Rows buffered per write while merging, and at most this many cell ids sorted per pass
+DEF_MERGE_BLOCK = 1 << 16
+
+DEF_MERGE_WINDOW = 1 << 22
+
+###Memory
+
+def current_rss_mb():
+    '''Resident set size right now, from /proc where
+       available (falls back to the peak elsewhere).
+    '''
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1 << 20)
+    except (OSError, ValueError, IndexError):
+        return peak_rss_mb()
+
+def peak_rss_mb():
+    '''Peak RSS of the process so far.'''
+    import resource
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / 1024 #bytes on macOS, KiB on Linux
+
+def _clear_caches():
+    geometry._cached_lods.cache_clear()
+    if "frzlvl" in sys.modules:
+        sys.modules["frzlvl"]._field_cache.clear()
+    gc.collect()
+
+class RunMetrics():
+    ''' Metrics of one chunked run: chunks, files
+        and records processed, bytes spilled, and
+        RSS sampled after every chunk, next to the
+        process peak.
+    '''
+
+    def __init__(self, task, budget_mb):
+
+        self.task = task
+        self.budget_mb = budget_mb
+        self.start = time.perf_counter()
+        self.start_rss_mb = current_rss_mb()
+        self.counts = {"chunks" : 0, "files" : 0, "records" : 0, "spilled_bytes" : 0, "reused_chunks" : 0}
+        self.max_rss_mb = self.start_rss_mb
+
+    def sample(self):
+        rss_mb = current_rss_mb()
+        self.max_rss_mb = max(self.max_rss_mb, rss_mb)
+        return rss_mb
+
+    def as_dict(self):
+        self.sample()
+        metrics = {"task" : self.task, "wall_s" : time.perf_counter() - self.start, "budget_mb" : self.budget_mb,
+                   "start_rss_mb" : round(self.start_rss_mb, 1), "max_rss_mb" : round(self.max_rss_mb, 1),
+                   "peak_rss_mb" : round(peak_rss_mb(), 1)}
+        metrics.update(self.counts)
+        return metrics
+
+###Planning
+
+def daily_files(data_dir, **kwargs):
+    '''Daily files in data_dir, oldest first: parsed
+       AllAIRMETS files, or raw text files with
+       raw=True. start/end (dates) limit the range.
+    '''
+
+    pattern = DEF_RAW_FILE_RE if kwargs.get("raw") else DEF_JSON_FILE_RE
+    start, end = kwargs.get("start"), kwargs.get("end")
+
+    files = []
+    for file_name in os.listdir(data_dir):
+        match = pattern.match(file_name)
+        if not match:
+            continue
+        date = datetime.strptime(match.group(1), "%Y%m%d")
+        if (start and date < start) or (end and date > end):
+            continue
+        files.append((date, os.path.join(data_dir, file_name)))
+    return [path for _, path in sorted(files)]
+
+def estimated_mb(path):
+    '''Rough in-memory size of a daily file once
+       loaded as dicts.
+    '''
+    ratio = DEF_COMPRESSION_RATIO.get(archive.detect_compression(path), 1)
+    return os.path.getsize(path) * ratio * DEF_OBJECT_OVERHEAD / (1 << 20)
+
+class ChunkedRunner():
+    ''' Hands out time-ordered chunks of daily
+        files, each sized so its estimated
+        footprint fits in what's left of budget_mb
+        (memory budget, MB) over the RSS at start.
+        If a chunk still pushes RSS over the budget,
+        later chunks are planned at half the size.
+
+        Per-chunk results go to spill_dir (a
+        temporary directory by default, removed on
+        close). A spill file is named after the
+        chunk's files, sizes and mtimes, so rerunning
+        with the same spill_dir reuses the chunks an
+        interrupted run already finished.
+    '''
+
+    def __init__(self, paths, task, **kwargs):
+
+        self.paths = list(paths)
+        self.budget_mb = kwargs.get("memory_budget_mb") or DEF_MEMORY_BUDGET_MB
+        self.verbose = airmet.str_to_bool(kwargs.get("verbose"))
+        self.metrics = RunMetrics(task, self.budget_mb)
+        self.scale = 1.0
+
+        self._own_spill_dir = not kwargs.get("spill_dir")
+        self.spill_dir = kwargs.get("spill_dir") or tempfile.mkdtemp(prefix=f"airmet_{task}_")
+        if not os.path.exists(self.spill_dir):
+            os.makedirs(self.spill_dir)
+
+    def _target_mb(self):
+        headroom = max(self.budget_mb - self.metrics.start_rss_mb, self.budget_mb * 0.1)
+        return headroom * self.scale / 2 #half, for the per-chunk results next to the loaded dicts
+
+    def chunks(self):
+        '''Yields (chunk key, list of paths).'''
+
+        pos = 0
+        while pos < len(self.paths):
+            chunk, chunk_mb = [self.paths[pos]], estimated_mb(self.paths[pos])
+            pos += 1
+            while pos < len(self.paths) and chunk_mb + estimated_mb(self.paths[pos]) <= self._target_mb():
+                chunk_mb += estimated_mb(self.paths[pos])
+                chunk.append(self.paths[pos])
+                pos += 1
+
+            yield self._chunk_key(chunk), chunk
+
+            self.metrics.counts["chunks"] += 1
+            self.metrics.counts["files"] += len(chunk)
+            _clear_caches()
+            rss_mb = self.metrics.sample()
+            if rss_mb > self.budget_mb and self.scale > 1 / 64:
+                self.scale /= 2
+            if self.verbose:
+                print(f"CHUNKED: {self.metrics.task}: {len(chunk)} file(s) up to {os.path.basename(chunk[-1])}, RSS {rss_mb:.0f}MB")
+
+    def _chunk_key(self, chunk):
+        digest = hashlib.sha1()
+        for path in chunk:
+            stat = os.stat(path)
+            digest.update(f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+        return f"{os.path.basename(chunk[0]).split('.')[0]}_{len(chunk)}_{digest.hexdigest()[:12]}"
+
+    def spill_path(self, key, suffix):
+        return os.path.join(self.spill_dir, f"{self.metrics.task}_{key}{suffix}")
+
+    def spilled(self, path):
+        '''Records a finished spill file.'''
+        self.metrics.counts["spilled_bytes"] += os.path.getsize(path)
+        return path
+
+    def close(self):
+        if self._own_spill_dir:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def _iter_airmets(paths):
+    #One record at a time through the index, never a whole file list at once
+    for path in paths:
+        with archive.AirmetArchive(path) as airmets:
+            for record, airmet_dict in zip(airmets.records(), airmets):
+                airmet_dict.setdefault("product_id", record[2])
+                yield airmet_dict
+
+###Parse
+
+def parse_files(raw_paths, save_dir, **kwargs):
+    '''Parses raw text files into daily JSON files
+       (same names and format as download()), one
+       day per chunk, streaming every product straight
+       to its output. Returns the run metrics.
+    '''
+
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+
+    with ChunkedRunner(raw_paths, "parse", **kwargs) as runner:
+        for _, chunk in runner.chunks():
+            for raw_path in chunk:
+                date_str = DEF_RAW_FILE_RE.match(os.path.basename(raw_path)).group(1)
+                year, month = int(date_str[0:4]), int(date_str[4:6])
+                products = airmet.split_raw_products(archive.read_text(raw_path), date_str)
+                with archive.open_output(os.path.join(save_dir, f"AllAIRMETS_{date_str}.json"), compression=kwargs.get("compression")) as output:
+                    writer = archive.JSONArrayWriter(output, index=True)
+                    for prod in products:
+                        writer.write(airmet.parse_airmet(prod["text"], year, month), product_id=prod["product_id"])
+                        runner.metrics.counts["records"] += 1
+                    writer.close()
+                del products
+        return runner.metrics.as_dict()
+
+###Export
+
+def export_geojson(json_paths, out_path, **kwargs):
+    '''Writes every subgroup of the given daily files
+       to one GeoJSON FeatureCollection (see
+       geometry.subgroup_features). Features are
+       streamed to the output chunk by chunk, which is
+       the merge: chunks are already in time order.
+       Returns the run metrics, with the output path.
+    '''
+
+    with ChunkedRunner(json_paths, "export", **kwargs) as runner:
+        def features():
+            for _, chunk in runner.chunks():
+                for feature in geometry.subgroup_features(_iter_airmets(chunk), lod_level=kwargs.get("lod_level", 0)):
+                    runner.metrics.counts["records"] += 1
+                    yield feature
+
+        dest_path = geometry.write_geojson(out_path, features(), compression=kwargs.get("compression"))
+        metrics = runner.metrics.as_dict()
+    metrics["output"] = dest_path
+    return metrics
+
+###Rasterize
+
+def raster_axes(**kwargs):
+    '''(lats, lons) of the raster cell centres.'''
+    min_lat, min_lon, max_lat, max_lon = kwargs.get("bounds", DEF_RASTER_BOUNDS)
+    res_deg = kwargs.get("res_deg", DEF_RASTER_RES_DEG)
+    lats = min_lat + (np.arange(int(round((max_lat - min_lat) / res_deg))) + 0.5) * res_deg
+    lons = min_lon + (np.arange(int(round((max_lon - min_lon) / res_deg))) + 0.5) * res_deg
+    return lats, lons
+
+def _rasterize_chunk(paths, lats, lons, runner):
+    import composite
+
+    res_deg = lats[1] - lats[0] if len(lats) > 1 else DEF_RASTER_RES_DEG
+    grids = {}
+    for airmet_dict in _iter_airmets(paths):
+        if "iss_day" not in airmet_dict:
+            continue
+        iss_time, valid_time = airmet.airmet_times(airmet_dict)
+        hours = (valid_time - iss_time).total_seconds() / 3600
+        for group in airmet_dict.get("subgroups") or []:
+            hazard = composite.composite_hazard(group)
+            lods = geometry.subgroup_lods(group.get("vors")) if hazard else None
+            if lods is None:
+                continue
+            runner.metrics.counts["records"] += 1
+            min_lat, min_lon, max_lat, max_lon = geometry.bbox(lods[0])
+            rows = np.nonzero((lats >= min_lat - res_deg) & (lats <= max_lat + res_deg))[0]
+            cols = np.nonzero((lons >= min_lon - res_deg) & (lons <= max_lon + res_deg))[0]
+            if not len(rows) or not len(cols):
+                continue
+            grid = grids.setdefault(hazard, np.zeros((len(lats), len(lons)), dtype=np.float32))
+            mask = geometry.rasterize_polygon(lods[0], lats[rows], lons[cols])
+            grid[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1] += mask * np.float32(hours)
+    return grids
+
+def rasterize(json_paths, out_path, **kwargs):
+    '''Rasterizes subgroup coverage: for each hazard
+       (composite.composite_hazard), the hours each
+       grid cell spent inside an issued AIRMET polygon,
+       summed over every bulletin. Each chunk's grids are
+       spilled as a .npz and the merge sums them one at a
+       time into out_path (.npz with "lats", "lons" and
+       one array per hazard). bounds/res_deg set the grid.
+       Returns the run metrics.
+    '''
+
+    lats, lons = raster_axes(**kwargs)
+    spills = []
+    with ChunkedRunner(json_paths, "rasterize", **kwargs) as runner:
+        for key, chunk in runner.chunks():
+            spill_path = runner.spill_path(key, ".npz")
+            if not os.path.exists(spill_path):
+                grids = _rasterize_chunk(chunk, lats, lons, runner)
+                np.savez(spill_path + ".part.npz", **{hazard.replace(" ", "_") : grid for hazard, grid in grids.items()})
+                os.replace(spill_path + ".part.npz", spill_path)
+                del grids
+            else:
+                runner.metrics.counts["reused_chunks"] += 1
+            spills.append(runner.spilled(spill_path))
+
+        totals = {}
+        for spill_path in spills:
+            with np.load(spill_path) as grids:
+                for hazard in grids.files:
+                    if hazard not in totals:
+                        totals[hazard] = np.zeros((len(lats), len(lons)), dtype=np.float64)
+                    totals[hazard] += grids[hazard]
+
+        part_path = out_path + ".part.npz"
+        np.savez_compressed(part_path, lats=lats, lons=lons, **totals)
+        os.replace(part_path, out_path)
+        metrics = runner.metrics.as_dict()
+    metrics["output"] = out_path
+    metrics["hazards"] = sorted(totals)
+    return metrics
+
+###Query index
+
+def _index_chunk(paths, runner, spill_base):
+    import service
+
+    entries = []
+    for path in paths:
+        entries += service.load_entries(path)
+    entries.sort(key=lambda entry: entry["_iss"])
+    runner.metrics.counts["records"] += len(entries)
+
+    with open(spill_base + ".part.ndjson", "w") as file:
+        for entry in entries:
+            file.write(json.dumps(entry, separators=archive.DEF_COMPACT_SEPARATORS) + "\n")
+    np.save(spill_base + ".part.npy", np.fromiter((entry["_iss"] for entry in entries), dtype=np.int64, count=len(entries)))
+    os.replace(spill_base + ".part.ndjson", spill_base + ".ndjson")
+    os.replace(spill_base + ".part.npy", spill_base + ".npy")
+
+def _merged_entries(spill_bases):
+    #k-way merge of the spilled chunks by issuance time, each chunk streamed line by line
+    def stream(chunk_idx, spill_base):
+        iss = np.load(spill_base + ".npy", mmap_mode="r")
+        with open(spill_base + ".ndjson") as file:
+            for pos, line in enumerate(file):
+                yield int(iss[pos]), chunk_idx, line
+
+    return heapq.merge(*(stream(chunk_idx, spill_base) for chunk_idx, spill_base in enumerate(spill_bases)))
+
+def build_index(json_paths, index_dir, **kwargs):
+    '''Builds an on-disk query index (served by
+       service.MappedAirmetIndex) over the given daily
+       files. Each chunk's subgroup entries are spilled
+       sorted by issuance time, then merged in a single
+       streaming pass that appends to the index columns.
+       The grid is laid out with a windowed counting sort
+       over a spilled (cell, id) list, so no step holds
+       more than one chunk's entries. Returns the run
+       metrics.
+    '''
+
+    import service
+    from subclasses import states_to_mask, altitude_band
+
+    grid_deg = kwargs.get("grid_deg", service.DEF_GRID_DEG)
+    part_dir = index_dir.rstrip(os.sep) + ".part"
+    shutil.rmtree(part_dir, ignore_errors=True)
+    os.makedirs(part_dir)
+
+    with ChunkedRunner(json_paths, "index", **kwargs) as runner:
+        spill_bases = []
+        for key, chunk in runner.chunks():
+            spill_base = runner.spill_path(key, "")
+            if not (os.path.exists(spill_base + ".ndjson") and os.path.exists(spill_base + ".npy")):
+                _index_chunk(chunk, runner, spill_base)
+            else:
+                runner.metrics.counts["reused_chunks"] += 1
+            runner.spilled(spill_base + ".ndjson")
+            runner.spilled(spill_base + ".npy")
+            spill_bases.append(spill_base)
+
+        num_entries = sum(len(np.load(spill_base + ".npy", mmap_mode="r")) for spill_base in spill_bases)
+        column = lambda name, dtype, length, row_shape=(): _ColumnWriter(os.path.join(part_dir, name + ".npy"), dtype, length, row_shape)
+        out = {"iss" : column("iss", np.int64, num_entries), "valid" : column("valid", np.int64, num_entries),
+               "outlook" : column("outlook", bool, num_entries), "masks" : column("masks", np.uint64, num_entries),
+               "bbox" : column("bbox", np.float64, num_entries, (4,)), "alt" : column("alt", np.float64, num_entries, (2,)), "offsets" : column("offsets", np.int64, num_entries + 1)}
+
+        cell_counts = {}
+        offset = 0
+        max_span = 0
+        cells_path = os.path.join(part_dir, "cells.bin")
+        with open(os.path.join(part_dir, "entries.ndjson"), "w") as entries_file, open(cells_path, "wb") as cells_file:
+            for idx, (iss, _, line) in enumerate(_merged_entries(spill_bases)):
+                entry = json.loads(line)
+                out["iss"].append(iss)
+                out["valid"].append(entry["_valid"])
+                out["outlook"].append(entry["outlook"])
+                out["masks"].append(states_to_mask(entry["states"]))
+                out["alt"].append(altitude_band(entry.get("conditions")))
+                out["offsets"].append(offset)
+                max_span = max(max_span, entry["_valid"] - iss)
+                entries_file.write(line)
+                offset += len(line.encode())
+
+                if entry["polygon"] is None:
+                    out["bbox"].append((np.nan,) * 4)
+                    continue
+                box = geometry.bbox(entry["polygon"])
+                out["bbox"].append(box)
+                keys = [service.cell_key(cell) for cell in _cells(box, grid_deg)]
+                for key in keys:
+                    cell_counts[key] = cell_counts.get(key, 0) + 1
+                cells_file.write(np.array([(key, idx) for key in keys], dtype=np.int64).tobytes())
+            out["offsets"].append(offset)
+        for writer in out.values():
+            writer.close()
+
+        cell_keys = np.array(sorted(cell_counts), dtype=np.int64)
+        cell_starts = np.zeros(len(cell_keys) + 1, dtype=np.int64)
+        cell_starts[1:] = np.cumsum([cell_counts[key] for key in cell_keys])
+        window_ids = min(DEF_MERGE_WINDOW, max(DEF_MERGE_BLOCK, int(runner._target_mb() * (1 << 20) / 16)))
+        _sort_cells(cells_path, cell_keys, cell_starts, os.path.join(part_dir, "cell_ids.npy"), window_ids)
+        os.remove(cells_path)
+        np.save(os.path.join(part_dir, "cell_keys.npy"), cell_keys)
+        np.save(os.path.join(part_dir, "cell_starts.npy"), cell_starts)
+
+        with open(os.path.join(part_dir, service.DEF_INDEX_META_FILE), "w") as file:
+            json.dump({"version" : service.DEF_INDEX_VERSION, "grid_deg" : grid_deg, "entries" : num_entries,
+                       "cells" : len(cell_keys), "files" : len(runner.paths), "max_span" : max_span}, file)
+
+        shutil.rmtree(index_dir, ignore_errors=True)
+        os.replace(part_dir, index_dir)
+        metrics = runner.metrics.as_dict()
+    metrics["output"] = index_dir
+    metrics["entries"] = num_entries
+    return metrics
+
+class _ColumnWriter():
+    ''' Appends rows to a .npy file of known length
+        through a small buffer, so an index column is
+        never held (or mapped) whole while building.
+    '''
+
+    def __init__(self, path, dtype, length, row_shape=()):
+        self.dtype = np.dtype(dtype)
+        self.file = open(path, "wb")
+        np.lib.format.write_array_header_1_0(self.file, {"descr" : np.lib.format.dtype_to_descr(self.dtype),
+                                                         "fortran_order" : False, "shape" : (length,) + tuple(row_shape)})
+        self.buffer = []
+
+    def append(self, row):
+        self.buffer.append(row)
+        if len(self.buffer) >= DEF_MERGE_BLOCK:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.file.write(np.asarray(self.buffer, dtype=self.dtype).tobytes())
+            self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+def _sort_cells(cells_path, cell_keys, cell_starts, out_path, window_ids):
+    '''Counting sort of the spilled (cell key, id) pairs
+       into cell_ids, window by window: each pass over
+       cells_path fills up to window ids of consecutive
+       cells in memory and appends them.
+       Ids come out ascending within each cell.
+    '''
+
+    writer = _ColumnWriter(out_path, np.int64, int(cell_starts[-1]))
+    window_start = 0
+    while window_start < len(cell_keys):
+        window_end = int(np.searchsorted(cell_starts, cell_starts[window_start] + window_ids, side="right")) - 1
+        window_end = min(max(window_end, window_start + 1), len(cell_keys))
+        base = cell_starts[window_start]
+        window = np.empty(int(cell_starts[window_end] - base), dtype=np.int64)
+        cursor = cell_starts[window_start:window_end] - base
+
+        with open(cells_path, "rb") as file:
+            while True:
+                block = np.fromfile(file, dtype=np.int64, count=2 * DEF_MERGE_BLOCK).reshape(-1, 2)
+                if not len(block):
+                    break
+                key_pos = np.searchsorted(cell_keys, block[:, 0])
+                in_window = (key_pos >= window_start) & (key_pos < window_end)
+                key_pos, ids = key_pos[in_window] - window_start, block[in_window, 1]
+                order = np.argsort(key_pos, kind="stable")
+                sorted_pos = key_pos[order]
+                first = np.searchsorted(sorted_pos, sorted_pos, side="left")
+                window[cursor[sorted_pos] + (np.arange(len(order)) - first)] = ids[order]
+                cursor += np.bincount(key_pos, minlength=len(cursor))
+
+        window.tofile(writer.file)
+        window_start = window_end
+    writer.close()
+
+def _cells(box, grid_deg):
+    import math
+
+    min_lat, min_lon, max_lat, max_lon = box
+    for lat_cell in range(math.floor(min_lat / grid_deg), math.floor(max_lat / grid_deg) + 1):
+        for lon_cell in range(math.floor(min_lon / grid_deg), math.floor(max_lon / grid_deg) + 1):
+            yield (lat_cell, lon_cell)
+
+DEF_TASKS = {"parse" : parse_files, "export" : export_geojson, "rasterize" : rasterize, "index" : build_index}
+
+if __name__ == "__main__":
+
+    #e.g. python chunked.py index data_dir index_dir 256
+    task, data_dir, output = sys.argv[1], sys.argv[2], sys.argv[3]
+    budget_mb = float(sys.argv[4]) if len(sys.argv) > 4 else DEF_MEMORY_BUDGET_MB
+    paths = daily_files(data_dir, raw=task == "parse")
+    print(json.dumps(DEF_TASKS[task](paths, output, memory_budget_mb=budget_mb, verbose=True), indent=2))
@@ -0,0 +1,487 @@
+import sys
+import os
+import json
+import argparse
+import threading
+from datetime import datetime, timedelta
+
+import airmet
+
+#Only stdlib (and airmet, which defers its own heavy imports) is imported
+#at module level. Each subcommand imports what it needs, so "--help" or a
+#"parse" run never pay for requests, numpy or simplekml.
+
+def _parse_date(date_str):
+    for fmt in ("%Y-%m-%d", "%Y%m%d"):
+        try:
+            return datetime.strptime(date_str, fmt)
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError(f"invalid date '{date_str}', expected YYYY-MM-DD")
+
+def _parse_time(time_str):
+    for fmt in ("%Y-%m-%dT%H:%M", "%Y-%m-%dT%H:%MZ", "%Y-%m-%d %H:%M", "%Y%m%d%H%M"):
+        try:
+            return datetime.strptime(time_str, fmt)
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError(f"invalid time '{time_str}', expected YYYY-MM-DDTHH:MM")
+
+def _load_airmets(path):
+    import archive
+
+    return archive.load_airmets(path)
+
+def _output_exists(path):
+    import archive
+
+    try:
+        archive.resolve_input_path(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+def _add_output_args(parser):
+    parser.add_argument("--compression", choices=["gzip", "zstd"], help="compress outputs as they are written")
+    parser.add_argument("--pretty", action="store_true", help="indent JSON output (compact by default)")
+
+def _add_budget_args(parser):
+    parser.add_argument("--parse-budget", type=float, default=30, metavar="SECONDS",
+                        help="quarantine products that take longer to parse to Quarantine_*.ndjson (0: no limit)")
+
+def cmd_fetch(args):
+    status, elapsed_s, result = airmet.download(args.save_dir, args.date.year, args.date.month, args.date.day,
+                                                verbose=args.verbose, debug=args.debug,
+                                                pipelined=args.pipelined, base_url=args.base_url,
+                                                compression=args.compression, pretty=args.pretty,
+                                                all_products=args.all_products, parse_budget=args.parse_budget)
+    if not status:
+        print(f"ERROR: Fetch failed after {elapsed_s:.1f}s: {result}", file=sys.stderr)
+        return 1
+    if isinstance(result, dict):
+        for path in result.values():
+            print(path)
+    else:
+        print(result)
+    return 0
+
+def cmd_parse(args):
+    date_str = args.date.strftime("%Y%m%d") if args.date else os.path.basename(args.raw_text).split("_")[-1][:8]
+    year, month = int(date_str[0:4]), int(date_str[4:6])
+
+    import archive
+    import quarantine
+
+    products = airmet.split_raw_products(archive.read_text(args.raw_text), date_str)
+
+    held = quarantine.Quarantine(quarantine.quarantine_path(os.path.dirname(args.output or args.raw_text) or os.getcwd(), date_str))
+    all_prods, product_ids = [], []
+    for prod in products:
+        try:
+            all_prods.append(quarantine.parse_with_budget(airmet.parse_airmet, prod["text"], year, month, budget_s=args.parse_budget,
+                                                          verbose=args.verbose, debug=args.debug))
+        except quarantine.ParseBudgetExceeded as e:
+            held.add(prod["text"], e, product_id=prod["product_id"], pil=prod["pil"])
+            print(f"WARNING: {prod['product_id']} quarantined to {held.path}, {e}", file=sys.stderr)
+            continue
+        product_ids.append(prod["product_id"])
+
+    if args.output:
+        with archive.open_output(args.output, compression=args.compression) as output:
+            writer = archive.JSONArrayWriter(output, pretty=args.pretty, index=True)
+            for airmet_dict, product_id in zip(all_prods, product_ids):
+                writer.write(airmet_dict, product_id=product_id)
+            writer.close()
+    else:
+        print(json.dumps(all_prods, indent=2 if args.pretty else None))
+    return 0
+
+def cmd_plot(args):
+    if args.batch or args.geojson:
+        return _plot_batch(args)
+
+    num_plotted = 0
+    for json_path in args.json_files:
+        for airmet_dict in _load_airmets(json_path):
+            if "iss_day" not in airmet_dict:
+                continue
+            iss_time, valid_time = airmet.airmet_times(airmet_dict)
+            kwargs = {"verbose" : args.verbose, "debug" : args.debug}
+            if args.states:
+                kwargs["filter_by_states"] = args.states
+            status, _, _ = airmet.plot_kmz(args.save_dir, airmet_dict.get("subgroups") or [], airmet_dict["airmet_type"], airmet_dict["airmet_id"],
+                                           airmet_dict.get("raw_text", ""), valid_time, iss_time, **kwargs)
+            num_plotted += status
+    print(f"Plotted {num_plotted} AIRMET(s) to {args.save_dir}")
+    return 0
+
+def _plot_batch(args):
+    airmets = []
+    for json_path in args.json_files:
+        airmets += _load_airmets(json_path)
+
+    if args.geojson:
+        import geometry
+        from subclasses import states_to_mask
+
+        state_mask = states_to_mask(args.states) if args.states else 0
+        features = (feature for feature in geometry.subgroup_features(airmets, lod_level=args.lod_level)
+                    if not state_mask or states_to_mask(feature["properties"]["states"]) & state_mask)
+        print(geometry.write_geojson(args.geojson, features))
+
+    if args.batch:
+        kwargs = {"verbose" : args.verbose, "file_name" : args.batch if isinstance(args.batch, str) else None}
+        if args.states:
+            kwargs["filter_by_states"] = args.states
+        status, _, result = airmet.plot_kmz_batch(args.save_dir, airmets, **kwargs)
+        print(result)
+        if not status:
+            return 1
+    return 0
+
+def cmd_backfill(args):
+    num_failed = 0
+    date = args.start
+    while date <= args.end:
+        date_str = date.strftime("%Y%m%d")
+        if args.skip_existing and _output_exists(os.path.join(args.save_dir, f"AllAIRMETS_{date_str}.json")):
+            if args.verbose:
+                print(f"BACKFILL: {date_str} already downloaded, skipping...")
+        else:
+            status, elapsed_s, result = airmet.download(args.save_dir, date.year, date.month, date.day,
+                                                        verbose=args.verbose, debug=args.debug,
+                                                        pipelined=args.pipelined, base_url=args.base_url,
+                                                        compression=args.compression, pretty=args.pretty,
+                                                        parse_budget=args.parse_budget)
+            if status:
+                print(f"BACKFILL: {date_str} done in {elapsed_s:.1f}s")
+            else:
+                num_failed += 1
+                print(f"BACKFILL: {date_str} FAILED: {result}", file=sys.stderr)
+        date += timedelta(days=1)
+    return 1 if num_failed else 0
+
+def query_airmets(airmets, **kwargs):
+    '''Yields the AIRMETs matching every given filter,
+       each reduced to its matching subgroups:
+
+       - states: any-of list of state codes
+       - hazard: substring of a subgroup qualifier (e.g. "ICE", "LLWS")
+       - at: datetime the AIRMET must be valid at
+       - airmet_id: exact airmet_id (e.g. "WA4Z AMD")
+    '''
+
+    states = kwargs.get("states")
+    hazard = kwargs.get("hazard")
+    at = kwargs.get("at")
+    airmet_id = kwargs.get("airmet_id")
+
+    state_mask = 0
+    if states:
+        from subclasses import states_to_mask
+        state_mask = states_to_mask(states)
+
+    for airmet_dict in airmets:
+        if "iss_day" not in airmet_dict:
+            continue
+        if airmet_id and airmet_dict.get("airmet_id") != airmet_id:
+            continue
+        if at:
+            iss_time, valid_time = airmet.airmet_times(airmet_dict)
+            if not (iss_time <= at <= valid_time):
+                continue
+
+        subgroups = []
+        for group in airmet_dict.get("subgroups") or []:
+            if hazard and not any(qual.find(hazard) != -1 for qual in group.get("qualifiers") or []):
+                continue
+            if state_mask and not (states_to_mask(group.get("states") or []) & state_mask):
+                continue
+            subgroups.append(group)
+
+        if (hazard or state_mask) and not subgroups:
+            continue
+
+        match = dict(airmet_dict)
+        match["subgroups"] = subgroups
+        yield match
+
+def cmd_query(args):
+    num_matches = 0
+    for json_path in args.json_files:
+        for match in query_airmets(_load_airmets(json_path), states=args.states, hazard=args.hazard, at=args.at, airmet_id=args.airmet_id):
+            if not args.raw:
+                match.pop("raw_text", None)
+            print(json.dumps(match))
+            num_matches += 1
+    return 0 if num_matches else 1
+
+def cmd_diff(args):
+    import diff
+    import archive
+
+    airmets = []
+    for json_path in args.json_files:
+        with archive.AirmetArchive(json_path) as json_file:
+            for record, airmet_dict in zip(json_file.records(), json_file):
+                airmet_dict.setdefault("product_id", record[2])
+                airmets.append(airmet_dict)
+    for delta in diff.diff_stream(airmets):
+        print(json.dumps(delta))
+    return 0
+
+def cmd_composite(args):
+    import composite
+
+    airmets = []
+    for json_path in args.json_files:
+        airmets += _load_airmets(json_path)
+    for path in composite.write_composites(args.save_dir, airmets, formats=args.formats, compression=args.compression, verbose=args.verbose):
+        print(path)
+    return 0
+
+def cmd_frzlvl(args):
+    import frzlvl
+
+    airmets = []
+    for json_path in args.json_files:
+        airmets += _load_airmets(json_path)
+    level_ft = frzlvl.FreezingLevelIndex(airmets).at(args.lat, args.lon, args.at)
+    print(json.dumps({"lat" : args.lat, "lon" : args.lon, "at" : args.at.strftime("%Y-%m-%dT%H:%MZ"), "frzlvl_ft" : level_ft}))
+    return 0 if level_ft is not None else 1
+
+def cmd_match(args):
+    import subscriptions
+
+    registry = subscriptions.load_subscriptions(args.subscriptions)
+    for json_path in args.json_files:
+        for airmet_dict in _load_airmets(json_path):
+            matches = registry.match_bulletin(airmet_dict, outlooks=args.outlooks)
+            if matches:
+                print(json.dumps({"airmet_id" : airmet_dict.get("airmet_id"), "iss_time" : airmet_dict.get("iss_time_str"), "matches" : matches}))
+    return 0
+
+def cmd_tiles(args):
+    import tiles
+
+    stats = tiles.export_mbtiles(args.mbtiles, args.json_files, min_zoom=args.min_zoom, max_zoom=args.max_zoom,
+                                 processes=args.processes, full=args.full, verbose=args.verbose)
+    print(json.dumps(stats))
+    return 0
+
+def cmd_chunked(args):
+    import chunked
+
+    paths = chunked.daily_files(args.data_dir, raw=args.task == "parse", start=args.start, end=args.end)
+    kwargs = {"memory_budget_mb" : args.memory_budget, "spill_dir" : args.spill_dir, "verbose" : args.verbose}
+    if args.compression:
+        kwargs["compression"] = args.compression
+    metrics = chunked.DEF_TASKS[args.task](paths, args.output, **kwargs)
+    print(json.dumps(metrics))
+    return 0
+
+def cmd_watch(args):
+    import watch
+
+    output_stream = open(args.output, "a") if args.output else sys.stdout
+    try:
+        watch.watch(base_url=args.base_url, poll_interval=args.interval, output_stream=output_stream,
+                    cursor_path=args.cursor, deltas=args.deltas, parse_budget=args.parse_budget,
+                    quarantine_path=args.quarantine, verbose=args.verbose, debug=args.debug)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.output:
+            output_stream.close()
+    return 0
+
+def cmd_queue(args):
+    import workqueue
+
+    if args.action == "work":
+        counts = workqueue.run_worker(args.db_path, worker_id=args.worker_id, batch=args.batch, lease_s=args.lease,
+                                      base_url=args.base_url, parse_budget=args.parse_budget, verbose=args.verbose)
+        print(json.dumps(counts))
+        return 0
+
+    with workqueue.WorkQueue(args.db_path, lease_s=args.lease) as work_queue:
+        if args.action == "enqueue":
+            if not (args.start and args.end):
+                print("ERROR: enqueue needs --start and --end", file=sys.stderr)
+                return 1
+            routes = None if args.all_products else ["airmet"]
+            print(json.dumps(work_queue.enqueue_days(args.start, args.end, base_url=args.base_url, routes=routes, relist=args.relist)))
+        elif args.action == "status":
+            print(json.dumps(work_queue.status(), indent=2))
+        elif args.action == "export":
+            exported = work_queue.export_ready(args.save_dir, compression=args.compression, pretty=args.pretty, force=args.force)
+            for paths in exported.values():
+                for path in paths.values():
+                    print(path)
+        elif args.action == "retry":
+            print(json.dumps({"requeued" : work_queue.retry_failed()}))
+    return 0
+
+def cmd_serve(args):
+    import service
+
+    with service.AirmetQueryService(args.data_dir, port=args.port, cache_size=args.cache_size, cache_ttl=args.cache_ttl,
+                                    reload_interval=args.reload_interval, verbose=args.verbose) as query_service:
+        print(f"Serving {query_service.store.num_files} file(s) on {query_service.url}")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="airmet", description="Download, parse, plot and query KKCI AIRMETs.")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    parser.add_argument("--debug", action="store_true")
+    parser.add_argument("--vor-report", help="write fuzzy-matched and unresolved VORs seen by the command to this JSON file")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    fetch_parser = subparsers.add_parser("fetch", help="download and parse all AIRMETs for one day")
+    fetch_parser.add_argument("date", type=_parse_date)
+    fetch_parser.add_argument("-d", "--save-dir", default=os.getcwd())
+    fetch_parser.add_argument("--pipelined", action="store_true", help="fetch, parse and write concurrently")
+    fetch_parser.add_argument("--base-url", default=airmet.DEF_IEM_BASE_URL)
+    fetch_parser.add_argument("--all-products", action="store_true",
+                              help="also fetch SIGMETs and convective SIGMETs, in the same pass (always pipelined)")
+    _add_output_args(fetch_parser)
+    _add_budget_args(fetch_parser)
+    fetch_parser.set_defaults(func=cmd_fetch)
+
+    parse_parser = subparsers.add_parser("parse", help="parse a saved AllAIRMET_RawText_*.txt file offline")
+    parse_parser.add_argument("raw_text")
+    parse_parser.add_argument("--date", type=_parse_date, help="issuance date, taken from the file name by default")
+    parse_parser.add_argument("-o", "--output", help="JSON output path (default: stdout)")
+    _add_output_args(parse_parser)
+    _add_budget_args(parse_parser)
+    parse_parser.set_defaults(func=cmd_parse)
+
+    plot_parser = subparsers.add_parser("plot", help="plot parsed AIRMETs to KMZ")
+    plot_parser.add_argument("json_files", nargs="+")
+    plot_parser.add_argument("-d", "--save-dir", default=os.getcwd())
+    plot_parser.add_argument("--states", nargs="+", help="only plot AIRMETs covering any of these states")
+    plot_parser.add_argument("--batch", nargs="?", const=True, metavar="FILE_NAME",
+                             help="write one KMZ with level-of-detail regions instead of one KMZ per AIRMET")
+    plot_parser.add_argument("--geojson", metavar="PATH", help="also write every polygon to a GeoJSON file")
+    plot_parser.add_argument("--lod-level", type=int, default=0, help="GeoJSON detail level, 0 (as issued) to 3 (coarsest)")
+    plot_parser.set_defaults(func=cmd_plot)
+
+    backfill_parser = subparsers.add_parser("backfill", help="download every day in a date range")
+    backfill_parser.add_argument("start", type=_parse_date)
+    backfill_parser.add_argument("end", type=_parse_date)
+    backfill_parser.add_argument("-d", "--save-dir", default=os.getcwd())
+    backfill_parser.add_argument("--skip-existing", action="store_true")
+    backfill_parser.add_argument("--pipelined", action="store_true")
+    backfill_parser.add_argument("--base-url", default=airmet.DEF_IEM_BASE_URL)
+    _add_output_args(backfill_parser)
+    _add_budget_args(backfill_parser)
+    backfill_parser.set_defaults(func=cmd_backfill)
+
+    query_parser = subparsers.add_parser("query", help="filter parsed AIRMETs, prints NDJSON")
+    query_parser.add_argument("json_files", nargs="+")
+    query_parser.add_argument("--states", nargs="+")
+    query_parser.add_argument("--hazard")
+    query_parser.add_argument("--at", type=_parse_time, help="only AIRMETs valid at this UTC time")
+    query_parser.add_argument("--airmet-id")
+    query_parser.add_argument("--raw", action="store_true", help="include raw_text in the output")
+    query_parser.set_defaults(func=cmd_query)
+
+    watch_parser = subparsers.add_parser("watch", help="poll for new AIRMETs, prints NDJSON")
+    watch_parser.add_argument("--interval", type=float, default=30)
+    watch_parser.add_argument("-o", "--output", help="append NDJSON here instead of stdout")
+    watch_parser.add_argument("--cursor", help="persist the seen-product cursor to this file")
+    watch_parser.add_argument("--base-url", default=airmet.DEF_IEM_BASE_URL)
+    watch_parser.add_argument("--deltas", action="store_true", help="emit only what changed since the previous issuance of each series")
+    watch_parser.add_argument("--parse-budget", type=float, default=30, metavar="SECONDS",
+                              help="skip products that take longer to parse (0: no limit)")
+    watch_parser.add_argument("--quarantine", help="append skipped products, with their raw text, to this NDJSON file")
+    watch_parser.set_defaults(func=cmd_watch)
+
+    diff_parser = subparsers.add_parser("diff", help="print issuance-to-issuance changes of parsed AIRMETs, as NDJSON")
+    diff_parser.add_argument("json_files", nargs="+")
+    diff_parser.set_defaults(func=cmd_diff)
+
+    composite_parser = subparsers.add_parser("composite", help="merge regional AIRMETs into national layers per hazard and valid time")
+    composite_parser.add_argument("json_files", nargs="+")
+    composite_parser.add_argument("-d", "--save-dir", default=os.getcwd())
+    composite_parser.add_argument("--formats", nargs="+", choices=["kmz", "geojson"], default=["kmz", "geojson"])
+    composite_parser.add_argument("--compression", choices=["gzip", "zstd"], help="compress the GeoJSON output")
+    composite_parser.set_defaults(func=cmd_composite)
+
+    frzlvl_parser = subparsers.add_parser("frzlvl", help="look up the freezing level at a point and time")
+    frzlvl_parser.add_argument("json_files", nargs="+")
+    frzlvl_parser.add_argument("--lat", type=float, required=True)
+    frzlvl_parser.add_argument("--lon", type=float, required=True)
+    frzlvl_parser.add_argument("--at", type=_parse_time, required=True, help="UTC time")
+    frzlvl_parser.set_defaults(func=cmd_frzlvl)
+
+    match_parser = subparsers.add_parser("match", help="match parsed AIRMETs against watched points, routes, areas and states, prints NDJSON")
+    match_parser.add_argument("subscriptions", help="NDJSON file, one {\"id\", and one of point/line/polygon/states} per line")
+    match_parser.add_argument("json_files", nargs="+")
+    match_parser.add_argument("--outlooks", action="store_true", help="match outlook subgroups as well")
+    match_parser.set_defaults(func=cmd_match)
+
+    tiles_parser = subparsers.add_parser("tiles", help="add parsed AIRMETs to an MBTiles vector tile set")
+    tiles_parser.add_argument("mbtiles")
+    tiles_parser.add_argument("json_files", nargs="+")
+    tiles_parser.add_argument("--min-zoom", type=int, default=0)
+    tiles_parser.add_argument("--max-zoom", type=int, default=8)
+    tiles_parser.add_argument("--processes", type=int, default=os.cpu_count() or 1)
+    tiles_parser.add_argument("--full", action="store_true", help="re-render every tile, not just those touched by new files")
+    tiles_parser.set_defaults(func=cmd_tiles)
+
+    chunked_parser = subparsers.add_parser("chunked", help="parse, export, rasterize or index a multi-year archive under a memory budget")
+    chunked_parser.add_argument("task", choices=["parse", "export", "rasterize", "index"])
+    chunked_parser.add_argument("data_dir", help="directory of daily files (raw text files for parse)")
+    chunked_parser.add_argument("output", help="save dir (parse), .geojson (export), .npz (rasterize) or index dir (index)")
+    chunked_parser.add_argument("--memory-budget", type=float, default=512, metavar="MB")
+    chunked_parser.add_argument("--spill-dir", help="keep chunk results here, so a rerun resumes (temporary by default)")
+    chunked_parser.add_argument("--start", type=_parse_date)
+    chunked_parser.add_argument("--end", type=_parse_date)
+    chunked_parser.add_argument("--compression", choices=["gzip", "zstd"])
+    chunked_parser.set_defaults(func=cmd_chunked)
+
+    queue_parser = subparsers.add_parser("queue", help="backfill from several processes or nodes through a shared work-lease queue")
+    queue_parser.add_argument("action", choices=["enqueue", "work", "status", "export", "retry"])
+    queue_parser.add_argument("db_path", help="queue database, on a filesystem every worker can reach")
+    queue_parser.add_argument("--start", type=_parse_date)
+    queue_parser.add_argument("--end", type=_parse_date)
+    queue_parser.add_argument("--all-products", action="store_true", help="enqueue SIGMETs and convective SIGMETs as well")
+    queue_parser.add_argument("--relist", action="store_true", help="list days enqueued before again, adding new products")
+    queue_parser.add_argument("--base-url", default=airmet.DEF_IEM_BASE_URL)
+    queue_parser.add_argument("--worker-id", help="defaults to host-pid")
+    queue_parser.add_argument("--batch", type=int, default=8, help="units claimed at a time")
+    queue_parser.add_argument("--lease", type=float, default=120, help="seconds a claimed unit stays leased without a heartbeat")
+    queue_parser.add_argument("-d", "--save-dir", default=os.getcwd())
+    queue_parser.add_argument("--force", action="store_true", help="export days exported before again")
+    _add_budget_args(queue_parser)
+    _add_output_args(queue_parser)
+    queue_parser.set_defaults(func=cmd_queue)
+
+    serve_parser = subparsers.add_parser("serve", help="serve point/bbox/time/state/hazard queries over parsed files")
+    serve_parser.add_argument("data_dir", help="directory of daily files, or an index built with 'chunked index'")
+    serve_parser.add_argument("--port", type=int, default=8765)
+    serve_parser.add_argument("--cache-size", type=int, default=1024)
+    serve_parser.add_argument("--cache-ttl", type=float, default=60)
+    serve_parser.add_argument("--reload-interval", type=float, default=30)
+    serve_parser.set_defaults(func=cmd_serve)
+
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        return args.func(args)
+    finally:
+        if args.vor_report:
+            from vors import get_vor_resolver
+
+            get_vor_resolver().write_report(args.vor_report)
+
+if __name__ == "__main__":
+
+    sys.exit(main())
@@ -0,0 +1,294 @@
+import sys
+import os
+import json
+from collections import OrderedDict
+from datetime import datetime
+
+import airmet
+import geometry
+
+#Resolved VOR lists a CompositeBuilder keeps, least recently used dropped first
+DEF_POLYGON_CACHE_SIZE = 4096
+
+def _shapely():
+    try:
+        from shapely.geometry import Polygon
+        from shapely.ops import unary_union
+    except ImportError:
+        raise ImportError("Composites require the shapely package (pip install shapely)")
+    return Polygon, unary_union
+
+def composite_hazard(group):
+    '''Hazard a subgroup contributes to, or None for
+       groups plot_kmz doesn't plot either (outlooks,
+       freezing levels, ...): "LLWS" for LLWS potential,
+       otherwise the hazard of its "AIRMET ..." qualifier
+       (e.g. "IFR", "TURB", "STG SFC WNDS").
+    '''
+    quals = group.get("qualifiers") or []
+    if any(qual.find("LLWS") != -1 for qual in quals):
+        return "LLWS"
+    for qual in quals:
+        if qual.startswith("AIRMET "):
+            return qual[len("AIRMET "):].strip()
+    return None
+
+def current_bulletins(airmets):
+    '''Drops bulletins superseded by a later issuance
+       (amendment or correction) of the same series
+       with the same valid time.
+    '''
+    import diff
+
+    latest = {}
+    for airmet_dict in airmets:
+        if "iss_day" not in airmet_dict:
+            continue
+        iss_time, valid_time = airmet.airmet_times(airmet_dict)
+        key = (diff.series_id(airmet_dict["airmet_id"]), valid_time)
+        if key not in latest or iss_time >= latest[key][0]:
+            latest[key] = (iss_time, airmet_dict)
+    return [airmet_dict for _, airmet_dict in latest.values()]
+
+def cluster_polygons(polygons):
+    '''Groups polygons into clusters of (transitively)
+       overlapping ones. Candidate pairs come from a
+       sweep over bounding boxes sorted by min lon, so
+       only nearby polygons are ever tested exactly.
+       Returns a list of lists of indices.
+    '''
+
+    boxes = [geometry.bbox(polygon) for polygon in polygons]
+    parents = list(range(len(polygons)))
+
+    def find(idx):
+        while parents[idx] != idx:
+            parents[idx] = parents[parents[idx]]
+            idx = parents[idx]
+        return idx
+
+    order = sorted(range(len(polygons)), key=lambda idx: boxes[idx][1])
+    active = []
+    for idx in order:
+        active = [other for other in active if boxes[other][3] >= boxes[idx][1]]
+        for other in active:
+            if find(other) == find(idx):
+                continue
+            if geometry.polygons_intersect(polygons[idx], polygons[other], bbox_a=boxes[idx], bbox_b=boxes[other]):
+                parents[find(other)] = find(idx)
+        active.append(idx)
+
+    clusters = {}
+    for idx in range(len(polygons)):
+        clusters.setdefault(find(idx), []).append(idx)
+    return sorted(clusters.values())
+
+def merge_polygons(polygons):
+    '''Merges overlapping polygons. Returns a list of
+       polygons, each a list of (lat, lon) rings,
+       exterior first: each cluster is dissolved into
+       its outline with shapely, holes kept.
+    '''
+
+    Polygon, unary_union = _shapely()
+    merged = []
+    for cluster in cluster_polygons(polygons):
+        if len(cluster) == 1:
+            merged += [[polygons[idx]] for idx in cluster]
+            continue
+        union = unary_union([Polygon([(lon, lat) for lat, lon in polygons[idx]]).buffer(0) for idx in cluster])
+        for part in getattr(union, "geoms", [union]):
+            rings = [part.exterior] + list(part.interiors)
+            merged.append([[(lat, lon) for lon, lat in ring.coords] for ring in rings])
+    return merged
+
+class CompositeBuilder():
+    ''' Builds national composite layers: every
+        current subgroup with the same hazard and
+        valid time, whichever region issued it,
+        merged into one layer.
+
+        Results are cached per (hazard, valid time)
+        together with the issuances they were built
+        from, so calling build() again after one
+        region amends only rebuilds that hazard's
+        layer. Layers whose valid time has passed are
+        dropped, and the last polygon_cache_size
+        resolved VOR lists are kept, so a long running
+        builder stays bounded.
+    '''
+
+    def __init__(self, **kwargs):
+
+        self.verbose = airmet.str_to_bool(kwargs.get("verbose"))
+        self.polygon_cache_size = kwargs.get("polygon_cache_size", DEF_POLYGON_CACHE_SIZE)
+        self.cache = {} #(hazard, valid_time) -> (sources, composite)
+        self.polygon_cache = OrderedDict() #tuple of vors -> polygon or None
+        self.stats = {"hits" : 0, "misses" : 0, "expired" : 0}
+
+    def _polygon(self, vors):
+        key = tuple(vors)
+        if key in self.polygon_cache:
+            self.polygon_cache.move_to_end(key)
+            return self.polygon_cache[key]
+        polygon = self.polygon_cache[key] = geometry.subgroup_polygon(vors)
+        while len(self.polygon_cache) > self.polygon_cache_size:
+            self.polygon_cache.popitem(last=False)
+        return polygon
+
+    def expire(self, now):
+        '''Drops cached layers valid before now. Returns
+           how many were dropped.
+        '''
+        expired = [key for key in self.cache if key[1] < now]
+        for key in expired:
+            del self.cache[key]
+        self.stats["expired"] += len(expired)
+        return len(expired)
+
+    def group(self, airmets):
+        '''Returns {(hazard, valid_time) : [(airmet_dict, group, polygon), ...]}.'''
+
+        groups = {}
+        for airmet_dict in current_bulletins(airmets):
+            _, valid_time = airmet.airmet_times(airmet_dict)
+            for group in airmet_dict.get("subgroups") or []:
+                hazard = composite_hazard(group)
+                if hazard is None or not group.get("vors"):
+                    continue
+                polygon = self._polygon(group["vors"])
+                if polygon is None:
+                    if self.verbose:
+                        print(f"COMPOSITE: Skipping unresolvable {hazard} group in {airmet_dict['airmet_id']}")
+                    continue
+                groups.setdefault((hazard, valid_time), []).append((airmet_dict, group, polygon))
+        return groups
+
+    def build(self, airmets, **kwargs):
+        '''Returns the composites for airmets, a list of
+           dicts with "hazard", "airmet_type", "valid_time",
+           "iss_time" (latest contributing issuance),
+           "sources", "states" and "polygons".
+
+           Cached layers valid before now (by default the
+           latest issuance in airmets, not the wall clock,
+           so archive replays expire too) are dropped
+           afterwards.
+        '''
+
+        groups = self.group(airmets)
+        now = kwargs.get("now") or max((airmet.airmet_times(airmet_dict)[0] for members in groups.values() for airmet_dict, _, _ in members), default=None)
+        composites = []
+        for (hazard, valid_time), members in sorted(groups.items()):
+            sources = tuple(sorted({(airmet_dict["airmet_id"], airmet.airmet_times(airmet_dict)[0]) for airmet_dict, _, _ in members}))
+            cached = self.cache.get((hazard, valid_time))
+            if cached is not None and cached[0] == sources:
+                self.stats["hits"] += 1
+                composites.append(cached[1])
+                continue
+
+            self.stats["misses"] += 1
+            states = []
+            for _, group, _ in members:
+                states += [state for state in group.get("states") or [] if state not in states]
+            composite = {
+                "hazard" : hazard,
+                "airmet_type" : members[0][0].get("airmet_type"),
+                "valid_time" : valid_time,
+                "iss_time" : max(iss_time for _, iss_time in sources),
+                "sources" : [airmet_id for airmet_id, _ in sources],
+                "states" : states,
+                "polygons" : merge_polygons([polygon for _, _, polygon in members]),
+            }
+            self.cache[(hazard, valid_time)] = (sources, composite)
+            composites.append(composite)
+
+        if now is not None:
+            self.expire(now)
+        return composites
+
+def _file_stem(composite):
+    hazard = composite["hazard"].replace(" ", "_")
+    return f"NATIONAL_{hazard}_iss{composite['iss_time'].strftime('%Y%m%d_%H%M%S')}_valid{composite['valid_time'].strftime('%Y%m%d_%H%M%S')}"
+
+def plot_composite_kmz(save_dir, composite):
+    '''Writes one composite next to the per-bulletin
+       KMZs plot_kmz writes, styled the same way.
+       Returns (status, elapsed_s, dest_path).
+    '''
+
+    start_time = datetime.now()
+
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+
+    import simplekml
+
+    kml = simplekml.Kml()
+    iss_time_str = composite["iss_time"].strftime("%Y-%m-%d %H:%M:%S UTC")
+    valid_time_str = composite["valid_time"].strftime("%Y-%m-%d %H:%M:%S UTC")
+    kml.document.name = f"NATIONAL {composite['hazard']}"
+    kml.document.description = f"{iss_time_str} THRU {valid_time_str}\nFROM {', '.join(composite['sources'])}"
+
+    title = "LLWS POTENTIAL" if composite["hazard"] == "LLWS" else f"AIRMET {composite['hazard']}"
+    for rings in composite["polygons"]:
+        to_points = lambda ring: [(lon, lat) for lat, lon in ring]
+        airmet._add_points_to_kml(kml, to_points(rings[0]), composite["airmet_type"], title, ", ".join(composite["states"]),
+                                  inner_points=[to_points(ring) for ring in rings[1:]])
+
+    dest_path = os.path.join(save_dir, _file_stem(composite) + ".kmz")
+    kml.savekmz(dest_path)
+
+    elapsed_time = datetime.now() - start_time
+    return 1, elapsed_time.total_seconds(), dest_path
+
+def composite_features(composites, **kwargs):
+    tolerance = geometry.DEF_LOD_TOLERANCES_DEG[kwargs.get("lod_level", 0)]
+    for composite in composites:
+        polygons = [[geometry.simplify_polygon(ring, tolerance) for ring in rings] for rings in composite["polygons"]]
+        yield geometry.to_geojson_feature(polygons, {
+            "hazard" : composite["hazard"],
+            "airmet_type" : composite["airmet_type"],
+            "iss_time" : composite["iss_time"].strftime("%Y-%m-%dT%H:%MZ"),
+            "valid_time" : composite["valid_time"].strftime("%Y-%m-%dT%H:%MZ"),
+            "sources" : composite["sources"],
+            "states" : composite["states"],
+        })
+
+def write_composites(save_dir, airmets, **kwargs):
+    '''Builds the composites for airmets and writes
+       them as KMZs and/or one GeoJSON file per valid
+       time (formats=("kmz", "geojson")), simplified to
+       lod_level. Returns the list of written paths.
+    '''
+
+    formats = kwargs.get("formats", ("kmz", "geojson"))
+    builder = kwargs.get("builder") or CompositeBuilder(verbose=kwargs.get("verbose"))
+    composites = builder.build(airmets)
+
+    paths = []
+    if "kmz" in formats:
+        for composite in composites:
+            paths.append(plot_composite_kmz(save_dir, composite)[2])
+    if "geojson" in formats:
+        if not os.path.exists(save_dir):
+            os.makedirs(save_dir)
+        by_valid = {}
+        for composite in composites:
+            by_valid.setdefault(composite["valid_time"], []).append(composite)
+        for valid_time, valid_composites in sorted(by_valid.items()):
+            path = os.path.join(save_dir, f"NATIONAL_valid{valid_time.strftime('%Y%m%d_%H%M%S')}.geojson")
+            features = composite_features(valid_composites, lod_level=kwargs.get("lod_level", 0))
+            paths.append(geometry.write_geojson(path, features, compression=kwargs.get("compression")))
+    return paths
+
+if __name__ == "__main__":
+
+    import archive
+
+    save_dir = sys.argv[1]
+    airmets = []
+    for path in sys.argv[2:]:
+        airmets += archive.load_airmets(path)
+    for path in write_composites(save_dir, airmets, verbose=True):
+        print(path)
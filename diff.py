@@ -0,0 +1,245 @@
+import sys
+import re
+import json
+import difflib
+
+import airmet
+import geometry
+from subclasses import states_to_mask, mask_to_states
+
+DEF_OUTLOOK_RE = re.compile(r"^OTLK VALID \d{4}-\d{4}Z")
+
+#Matched subgroups must score at least this much (0-2, states + polygon overlap) to count as the same area
+DEF_MIN_MATCH_SCORE = 0.2
+
+def series_id(airmet_id):
+    '''"WA4Z AMD" -> "WA4Z", the series that
+       amendments and corrections belong to.
+    '''
+    return airmet_id.split(" ")[0]
+
+def subgroup_hazard(group):
+    '''Hazard key of a subgroup, e.g. "IFR",
+       "MTN OBSCN" or "OTLK IFR". Only subgroups
+       with the same key are ever matched.
+    '''
+    parts = []
+    for qual in group.get("qualifiers") or []:
+        if DEF_OUTLOOK_RE.match(qual):
+            parts.append("OTLK")
+            qual = DEF_OUTLOOK_RE.sub("", qual).strip(". ")
+        if qual.startswith("AIRMET "):
+            qual = qual[len("AIRMET "):]
+        if qual:
+            parts.append(qual)
+    return " ".join(parts)
+
+def _vertices(vors):
+    #Polygons repeat their first vertex to close, which isn't a real change point
+    if len(vors) > 1 and vors[0] == vors[-1]:
+        return tuple(vors[:-1])
+    return tuple(vors)
+
+class _Signature():
+    ''' What a subgroup is compared on, computed
+        once per subgroup (and kept by DiffTracker
+        for the previous issuance). polygon is None
+        if any of its VORs can't be resolved.
+    '''
+
+    __slots__ = ("group", "hazard", "mask", "vertices", "vertex_set", "polygon", "bbox")
+
+    def __init__(self, group):
+        self.group = group
+        self.hazard = subgroup_hazard(group)
+        self.mask = states_to_mask(group.get("states") or [])
+        self.vertices = _vertices(group.get("vors") or [])
+        self.vertex_set = frozenset(self.vertices)
+        self.polygon = geometry.subgroup_polygon(group.get("vors")) if len(self.vertices) >= 3 else None
+        self.bbox = geometry.bbox(self.polygon) if self.polygon else None
+
+    def overlap(self, other):
+        '''IoU of the resolved polygons, so a boundary
+           moved off one VOR onto "40NW" of it still
+           scores as (nearly) the same area. Jaccard of
+           the VOR strings if either can't be resolved.
+        '''
+        if self.polygon and other.polygon:
+            return geometry.polygon_iou(self.polygon, other.polygon, bbox_a=self.bbox, bbox_b=other.bbox)
+        union_vertices = self.vertex_set | other.vertex_set
+        return len(self.vertex_set & other.vertex_set) / len(union_vertices) if union_vertices else 1
+
+    def score(self, other):
+        '''Similarity in [0, 2]: Jaccard of the states
+           plus the overlap() of the polygons.
+        '''
+        union_mask = self.mask | other.mask
+        state_score = bin(self.mask & other.mask).count("1") / bin(union_mask).count("1") if union_mask else 1
+        return state_score + self.overlap(other)
+
+def signatures(airmet_dict):
+    return [_Signature(group) for group in airmet_dict.get("subgroups") or []
+            if group.get("vors") or group.get("qualifiers")]
+
+def vertex_changes(before, after):
+    '''Vertex-level edit script between two polygons,
+       as a list of {"op", "at", "before", "after"}
+       with op one of insert/delete/replace and at the
+       index in the old polygon.
+    '''
+    changes = []
+    for op, old_start, old_end, new_start, new_end in difflib.SequenceMatcher(None, before, after, autojunk=False).get_opcodes():
+        if op == "equal":
+            continue
+        changes.append({"op" : op, "at" : old_start, "before" : list(before[old_start:old_end]), "after" : list(after[new_start:new_end])})
+    return changes
+
+def _modification(old, new):
+    change = {"hazard" : new.hazard}
+    if old.vertices != new.vertices:
+        change["vertices"] = vertex_changes(old.vertices, new.vertices)
+        if old.polygon and new.polygon:
+            area_before, area_after = geometry.polygon_area_nm2(old.polygon), geometry.polygon_area_nm2(new.polygon)
+            change["geometry"] = {"iou" : round(old.overlap(new), 3), "area_before_nm2" : round(area_before),
+                                  "area_after_nm2" : round(area_after),
+                                  "area_change" : round(area_after / area_before - 1, 3) if area_before else None}
+    if old.mask != new.mask:
+        change["states_added"] = mask_to_states(new.mask & ~old.mask)
+        change["states_removed"] = mask_to_states(old.mask & ~new.mask)
+    if old.group.get("desc") != new.group.get("desc"):
+        change["desc"] = {"before" : old.group.get("desc"), "after" : new.group.get("desc")}
+    if len(change) == 1:
+        return None
+    change["before"] = old.group
+    change["after"] = new.group
+    return change
+
+def diff_signatures(old_sigs, new_sigs):
+    '''Matches subgroups across two issuances and
+       returns (added, removed, modified, num_unchanged).
+       Candidates must share a hazard; pairs are then
+       taken greedily from the most similar down.
+    '''
+
+    candidates = []
+    for old_idx, old in enumerate(old_sigs):
+        for new_idx, new in enumerate(new_sigs):
+            if old.hazard != new.hazard:
+                continue
+            score = old.score(new)
+            if score >= DEF_MIN_MATCH_SCORE:
+                candidates.append((-score, old_idx, new_idx))
+    candidates.sort()
+
+    old_matched, new_matched = set(), set()
+    modified = []
+    num_unchanged = 0
+    for _, old_idx, new_idx in candidates:
+        if old_idx in old_matched or new_idx in new_matched:
+            continue
+        old_matched.add(old_idx)
+        new_matched.add(new_idx)
+        change = _modification(old_sigs[old_idx], new_sigs[new_idx])
+        if change is None:
+            num_unchanged += 1
+        else:
+            modified.append(change)
+
+    added = [sig.group for idx, sig in enumerate(new_sigs) if idx not in new_matched]
+    removed = [sig.group for idx, sig in enumerate(old_sigs) if idx not in old_matched]
+    return added, removed, modified, num_unchanged
+
+def diff_airmets(old_dict, new_dict):
+    '''Diff between two parsed bulletins of the same
+       series. old_dict may be None, in which case
+       every subgroup of new_dict is added.
+    '''
+    old_sigs = signatures(old_dict) if old_dict else []
+    return _delta(old_dict, new_dict, *diff_signatures(old_sigs, signatures(new_dict)))
+
+def _delta(old_dict, new_dict, added, removed, modified, num_unchanged):
+    iss_time, valid_time = airmet.airmet_times(new_dict)
+    return {
+        "series" : series_id(new_dict["airmet_id"]),
+        "airmet_id" : new_dict["airmet_id"],
+        "product_id" : new_dict.get("product_id"),
+        "previous_airmet_id" : old_dict["airmet_id"] if old_dict else None,
+        "previous_product_id" : old_dict.get("product_id") if old_dict else None,
+        "iss_time" : iss_time.strftime("%Y-%m-%dT%H:%MZ"),
+        "valid_time" : valid_time.strftime("%Y-%m-%dT%H:%MZ"),
+        "added" : added,
+        "removed" : removed,
+        "modified" : modified,
+        "unchanged" : num_unchanged,
+    }
+
+def is_empty(delta):
+    return not (delta["added"] or delta["removed"] or delta["modified"])
+
+class DiffTracker():
+    ''' Incremental diffing for a stream of
+        bulletins (e.g. from the watcher). Keeps
+        only the latest issuance of each series,
+        with its subgroup signatures already
+        computed, so each update costs one
+        bulletin's worth of work.
+
+        Bulletins older than the latest seen for
+        their series (e.g. a late listing) are
+        ignored and return None.
+
+        state() is the JSON-serializable latest
+        bulletin of each series; DiffTracker(state=...)
+        picks up from it after a restart.
+    '''
+
+    def __init__(self, **kwargs):
+
+        self.latest = {} #series -> (iss_time, airmet_dict, signatures)
+        for airmet_dict in (kwargs.get("state") or {}).values():
+            self.update(airmet_dict)
+
+    def state(self):
+        return {series : airmet_dict for series, (_, airmet_dict, _) in self.latest.items()}
+
+    def update(self, airmet_dict):
+        '''Returns the delta from the previous issuance
+           of airmet_dict's series, or None if it can't
+           be diffed (unparsed, or stale).
+        '''
+
+        if "iss_day" not in airmet_dict or "airmet_id" not in airmet_dict:
+            return None
+
+        series = series_id(airmet_dict["airmet_id"])
+        iss_time, _ = airmet.airmet_times(airmet_dict)
+        previous = self.latest.get(series)
+        if previous is not None and iss_time < previous[0]:
+            return None
+
+        new_sigs = signatures(airmet_dict)
+        old_dict, old_sigs = (previous[1], previous[2]) if previous else (None, [])
+        self.latest[series] = (iss_time, airmet_dict, new_sigs)
+
+        return _delta(old_dict, airmet_dict, *diff_signatures(old_sigs, new_sigs))
+
+def diff_stream(airmets):
+    '''Yields the non-empty deltas of a sequence of
+       bulletins, processed in issuance order.
+    '''
+    tracker = DiffTracker()
+    parsed = [airmet_dict for airmet_dict in airmets if "iss_day" in airmet_dict]
+    for airmet_dict in sorted(parsed, key=lambda airmet_dict: airmet.airmet_times(airmet_dict)[0]):
+        delta = tracker.update(airmet_dict)
+        if delta is not None and not is_empty(delta):
+            yield delta
+
+if __name__ == "__main__":
+
+    import archive
+
+    airmets = []
+    for path in sys.argv[1:]:
+        airmets += archive.load_airmets(path)
+    for delta in diff_stream(airmets):
+        print(json.dumps(delta))
@@ -0,0 +1,233 @@
+import sys
+import os
+
+import numpy as np
+
+import archive
+import geometry
+from subclasses import DEF_HAZARD_TRANSLATION_TABLE, DEF_INTENSITIES, DEF_FREQUENCIES, DEF_ALTITUDE_REFS, decode_conditions, states_mask_column, altitude_band_column, filter_any_of, filter_all_of
+
+DEF_FRAME_LEVELS = ("headers", "subgroups", "vertices")
+
+DEF_TIME_FIELDS = ("year", "month", "day", "hour", "minute")
+
+#Fixed categories, so frames loaded separately concatenate without re-encoding
+DEF_HAZARD_CODES = tuple(sorted(set(DEF_HAZARD_TRANSLATION_TABLE.values())))
+
+def _pandas():
+    try:
+        import pandas
+    except ImportError:
+        raise ImportError("to_frame requires the pandas package (pip install pandas)")
+    return pandas
+
+class AirmetFrames():
+    ''' Parsed AIRMETs as three pandas DataFrames,
+        one row per:
+
+        - headers: bulletin (airmet_id, type, issuing
+          office, issuance and valid datetimes)
+        - subgroups: subgroup, with its decoded hazard,
+          intensity, frequency, altitude band, state
+          mask and bounding box
+        - vertices: VOR of a subgroup's polygon, with
+          its resolved lat/lon
+
+        Repeated strings are categoricals, numbers are
+        the narrowest fitting dtype. Rows are linked by
+        "bulletin" (and "subgroup"), plain integer keys,
+        so joins are ordinary merges, e.g.
+        frames.subgroups.merge(frames.headers, on="bulletin").
+    '''
+
+    def __init__(self, headers, subgroups, vertices):
+
+        self.headers = headers
+        self.subgroups = subgroups
+        self.vertices = vertices
+
+    def __getitem__(self, level):
+        if level not in DEF_FRAME_LEVELS:
+            raise KeyError(f"Unknown frame level '{level}', expected one of {list(DEF_FRAME_LEVELS)}")
+        return getattr(self, level)
+
+    def memory_usage(self):
+        '''Bytes held by each frame, deep.'''
+        return {level : int(self[level].memory_usage(deep=True).sum()) for level in DEF_FRAME_LEVELS}
+
+    def valid_at(self, at):
+        '''Subgroups of bulletins issued by and valid at
+           the datetime at.
+        '''
+        subgroups = self.subgroups
+        return subgroups[(subgroups["iss_time"] <= at) & (subgroups["valid_time"] >= at)]
+
+def states_any_of(frame, states):
+    '''Boolean mask of the rows of a subgroups frame
+       covering any of states.
+    '''
+    return filter_any_of(frame["states_mask"].to_numpy(), states)
+
+def states_all_of(frame, states):
+    return filter_all_of(frame["states_mask"].to_numpy(), states)
+
+def _iter_sources(source, **kwargs):
+    '''Yields (product_id, airmet_dict) from a daily
+       file, a directory of them (start/end limit the
+       dates), a list of files, or parsed dicts.
+    '''
+    if isinstance(source, str) and os.path.isdir(source):
+        import chunked
+
+        source = chunked.daily_files(source, start=kwargs.get("start"), end=kwargs.get("end"))
+    elif isinstance(source, str):
+        source = [source]
+
+    for item in source:
+        if isinstance(item, dict):
+            yield item.get("product_id"), item
+            continue
+        with archive.AirmetArchive(item) as airmets:
+            for record, airmet_dict in zip(airmets.records(), airmets):
+                yield record[2], airmet_dict
+
+def _times(pandas, columns, prefix):
+    #Vectorized airmet.airmet_times: a valid day before the issuance day rolls into the next month
+    fields = {field : np.asarray(columns[f"{prefix}_{field}"], dtype=np.int64) for field in DEF_TIME_FIELDS}
+    if prefix == "valid":
+        rolled = fields["day"] < np.asarray(columns["iss_day"], dtype=np.int64)
+        month = fields["month"] + rolled
+        fields["year"] = fields["year"] + (month > 12)
+        fields["month"] = np.where(month > 12, 1, month)
+    return pandas.to_datetime(pandas.DataFrame(fields)).astype("datetime64[s]")
+
+def _categorical(pandas, values, categories=None, **kwargs):
+    return pandas.Categorical(values, categories=categories, ordered=kwargs.get("ordered", False))
+
+def to_frames(source, **kwargs):
+    '''Loads parsed AIRMETs (see _iter_sources for
+       what source can be) into AirmetFrames in one
+       pass. vertices=False skips resolving polygons
+       (no vertices rows, NaN bounding boxes);
+       raw=True keeps each bulletin's raw_text.
+    '''
+
+    pandas = _pandas()
+    with_vertices = kwargs.get("vertices", True)
+    with_raw = kwargs.get("raw", False)
+
+    headers = {key : [] for key in ["product_id", "airmet_id", "airmet_type", "iss_airport", "raw_text"] +
+               [f"{prefix}_{field}" for prefix in ("iss", "valid") for field in DEF_TIME_FIELDS]}
+    subgroups = {key : [] for key in ("bulletin", "subgroup", "qualifiers", "outlook", "states", "conditions", "num_vertices", "bbox")}
+    vertices = {key : [] for key in ("bulletin", "subgroup", "vertex", "vor", "lat", "lon")}
+    polygons = {} #VOR tuple -> polygon, resolved once per distinct list
+
+    bulletin = 0
+    for product_id, airmet_dict in _iter_sources(source, **kwargs):
+        if "iss_day" not in airmet_dict:
+            continue
+        headers["product_id"].append(product_id)
+        for key in ("airmet_id", "airmet_type", "iss_airport"):
+            headers[key].append(airmet_dict.get(key))
+        headers["raw_text"].append(airmet_dict.get("raw_text") if with_raw else None)
+        for prefix in ("iss", "valid"):
+            for field in DEF_TIME_FIELDS:
+                headers[f"{prefix}_{field}"].append(airmet_dict[f"{prefix}_{field}"])
+
+        for group_idx, group in enumerate(airmet_dict.get("subgroups") or []):
+            qualifiers = group.get("qualifiers") or []
+            vors = group.get("vors") or []
+            subgroups["bulletin"].append(bulletin)
+            subgroups["subgroup"].append(group_idx)
+            subgroups["qualifiers"].append(" ".join(qualifiers))
+            subgroups["outlook"].append(any(qual.startswith("OTLK") for qual in qualifiers))
+            subgroups["states"].append(group.get("states") or [])
+            subgroups["conditions"].append(group.get("conditions") or decode_conditions(qualifiers, group.get("desc", "")))
+            subgroups["num_vertices"].append(len(vors))
+
+            polygon = None
+            if with_vertices and vors:
+                key = tuple(vors)
+                if key not in polygons:
+                    polygons[key] = geometry.subgroup_polygon(vors)
+                polygon = polygons[key]
+            subgroups["bbox"].append(geometry.bbox(polygon) if polygon else (np.nan,) * 4)
+            if polygon:
+                for vertex_idx, (vor, (lat, lon)) in enumerate(zip(vors, polygon)):
+                    vertices["bulletin"].append(bulletin)
+                    vertices["subgroup"].append(group_idx)
+                    vertices["vertex"].append(vertex_idx)
+                    vertices["vor"].append(vor)
+                    vertices["lat"].append(lat)
+                    vertices["lon"].append(lon)
+        bulletin += 1
+
+    iss_time = _times(pandas, headers, "iss")
+    valid_time = _times(pandas, headers, "valid")
+    headers_frame = pandas.DataFrame({
+        "bulletin" : np.arange(bulletin, dtype=np.int32),
+        "product_id" : pandas.array(headers["product_id"], dtype="string"),
+        "airmet_id" : _categorical(pandas, headers["airmet_id"]),
+        "airmet_type" : _categorical(pandas, headers["airmet_type"]),
+        "iss_airport" : _categorical(pandas, headers["iss_airport"]),
+        "iss_time" : iss_time,
+        "valid_time" : valid_time,
+    })
+    if with_raw:
+        headers_frame["raw_text"] = pandas.array(headers["raw_text"], dtype="string")
+
+    conditions = subgroups["conditions"]
+    group_bulletins = np.asarray(subgroups["bulletin"], dtype=np.int32)
+    bands = altitude_band_column(conditions)
+    bboxes = np.asarray(subgroups["bbox"], dtype=np.float32).reshape(-1, 4)
+    subgroups_frame = pandas.DataFrame({
+        "bulletin" : group_bulletins,
+        "subgroup" : np.asarray(subgroups["subgroup"], dtype=np.int16),
+        "iss_time" : iss_time.to_numpy()[group_bulletins],
+        "valid_time" : valid_time.to_numpy()[group_bulletins],
+        "qualifiers" : _categorical(pandas, subgroups["qualifiers"]),
+        "outlook" : np.asarray(subgroups["outlook"], dtype=bool),
+        "hazard" : _categorical(pandas, [cond.get("hazard") for cond in conditions], DEF_HAZARD_CODES),
+        "intensity" : _categorical(pandas, [cond.get("intensity") for cond in conditions], DEF_INTENSITIES, ordered=True),
+        "frequency" : _categorical(pandas, [cond.get("frequency") for cond in conditions], DEF_FREQUENCIES, ordered=True),
+        "floor_ft" : np.array([cond.get("floor_ft") for cond in conditions], dtype=np.float32),
+        "floor_ref" : _categorical(pandas, [cond.get("floor_ref") for cond in conditions], DEF_ALTITUDE_REFS),
+        "ceiling_ft" : np.array([cond.get("ceiling_ft") for cond in conditions], dtype=np.float32),
+        "ceiling_ref" : _categorical(pandas, [cond.get("ceiling_ref") for cond in conditions], DEF_ALTITUDE_REFS),
+        "low_ft" : bands[:, 0].astype(np.float32),
+        "high_ft" : bands[:, 1].astype(np.float32),
+        "states_mask" : states_mask_column(subgroups["states"]),
+        "num_vertices" : np.asarray(subgroups["num_vertices"], dtype=np.int16),
+        "min_lat" : bboxes[:, 0],
+        "min_lon" : bboxes[:, 1],
+        "max_lat" : bboxes[:, 2],
+        "max_lon" : bboxes[:, 3],
+    })
+
+    vertices_frame = pandas.DataFrame({
+        "bulletin" : np.asarray(vertices["bulletin"], dtype=np.int32),
+        "subgroup" : np.asarray(vertices["subgroup"], dtype=np.int16),
+        "vertex" : np.asarray(vertices["vertex"], dtype=np.int16),
+        "vor" : _categorical(pandas, vertices["vor"]),
+        "lat" : np.asarray(vertices["lat"], dtype=np.float32),
+        "lon" : np.asarray(vertices["lon"], dtype=np.float32),
+    })
+
+    return AirmetFrames(headers_frame, subgroups_frame, vertices_frame)
+
+def to_frame(source, level="subgroups", **kwargs):
+    '''One level ("headers", "subgroups" or "vertices")
+       of to_frames().
+    '''
+    if level not in DEF_FRAME_LEVELS:
+        raise KeyError(f"Unknown frame level '{level}', expected one of {list(DEF_FRAME_LEVELS)}")
+    if level == "headers":
+        kwargs.setdefault("vertices", False)
+    return to_frames(source, **kwargs)[level]
+
+if __name__ == "__main__":
+
+    frames = to_frames(sys.argv[1:] if len(sys.argv) > 2 else sys.argv[1])
+    for level in DEF_FRAME_LEVELS:
+        print(f"{level}: {len(frames[level])} rows, {frames.memory_usage()[level] / (1 << 20):.1f} MiB")
+        print(frames[level].dtypes.to_string())
@@ -0,0 +1,200 @@
+import sys
+import math
+from collections import OrderedDict
+from datetime import datetime
+
+import numpy as np
+
+import airmet
+import geometry
+
+#Fields are laid on this global lat/lon lattice, each bulletin only
+#over the bounding box of its contours padded by DEF_FIELD_PAD_DEG
+DEF_FIELD_RES_DEG = 0.25
+
+DEF_FIELD_PAD_DEG = 1.0
+
+#Fields kept in memory by field_for(), least recently used dropped first
+DEF_FIELD_CACHE_SIZE = 256
+
+def frzlvl_group(airmet_dict):
+    '''The parsed FRZLVL subgroup of a bulletin, or None.'''
+    for group in airmet_dict.get("subgroups") or []:
+        if group.get("qualifiers") == ["FRZLVL"] and group.get("contours") is not None:
+            return group
+    return None
+
+def _resolve(vors):
+    #(lat, lon) array of a VOR list, or None if any VOR can't be resolved
+    if not vors:
+        return None
+    points = np.array(airmet.resolve_vors(vors), dtype=float)
+    return None if np.isnan(points).any() else points
+
+def _polyline_distance(points, grid_lat, grid_lon):
+    '''Distance (degrees, longitudes scaled to the
+       latitude) from every grid point to the nearest
+       segment of the polyline, one segment at a time
+       over the whole grid.
+    '''
+    cos_lat = np.cos(np.radians(grid_lat))
+    px, py = grid_lon * cos_lat, grid_lat
+    if len(points) == 1:
+        return np.hypot(px - points[0][1] * cos_lat, py - points[0][0])
+
+    dist = np.full(grid_lat.shape, np.inf)
+    for (start_lat, start_lon), (end_lat, end_lon) in zip(points[:-1], points[1:]):
+        sx, sy = start_lon * cos_lat, start_lat
+        dx, dy = (end_lon - start_lon) * cos_lat, end_lat - start_lat
+        length_sq = dx * dx + dy * dy
+        t = np.clip(((px - sx) * dx + (py - sy) * dy) / np.where(length_sq == 0, 1, length_sq), 0, 1)
+        np.minimum(dist, np.hypot(px - (sx + t * dx), py - (sy + t * dy)), out=dist)
+    return dist
+
+class FreezingLevelField():
+    ''' Freezing level (ft MSL) of one bulletin's
+        FRZLVL group, on a DEF_FIELD_RES_DEG grid
+        over its contours. Each grid point is
+        interpolated between its two nearest
+        contour levels, inversely to their
+        distance, clipped to the stated range and
+        to any "MULT FRZLVL" area it lies in.
+        Points off the grid are NaN.
+    '''
+
+    def __init__(self, group, **kwargs):
+
+        self.res_deg = kwargs.get("res_deg", DEF_FIELD_RES_DEG)
+        pad_deg = kwargs.get("pad_deg", DEF_FIELD_PAD_DEG)
+
+        contours = [(contour["level_ft"], _resolve(contour["vors"])) for contour in group.get("contours") or []]
+        contours = [(level_ft, points) for level_ft, points in contours if points is not None]
+        areas = [(area, _resolve(area["vors"])) for area in group.get("areas") or []]
+        areas = [(area, points) for area, points in areas if points is not None]
+        self.range_ft = group.get("range_ft")
+
+        all_points = [points for _, points in contours] + [points for _, points in areas]
+        if not all_points:
+            self.lats = self.lons = np.empty(0)
+            self.grid = np.empty((0, 0), dtype=np.float32)
+            return
+
+        stacked = np.concatenate(all_points)
+        lat_start = math.floor((stacked[:, 0].min() - pad_deg) / self.res_deg)
+        lon_start = math.floor((stacked[:, 1].min() - pad_deg) / self.res_deg)
+        lat_end = math.ceil((stacked[:, 0].max() + pad_deg) / self.res_deg)
+        lon_end = math.ceil((stacked[:, 1].max() + pad_deg) / self.res_deg)
+        self.lats = np.arange(lat_start, lat_end + 1) * self.res_deg
+        self.lons = np.arange(lon_start, lon_end + 1) * self.res_deg
+        self.grid = self._interpolate(contours, areas).astype(np.float32)
+
+    def _interpolate(self, contours, areas):
+        grid_lat, grid_lon = np.meshgrid(self.lats, self.lons, indexing="ij")
+
+        #Distance to each level, over every contour line drawn at it
+        levels = sorted({level_ft for level_ft, _ in contours})
+        if not levels:
+            values = np.full(grid_lat.shape, np.nan)
+        elif len(levels) == 1:
+            values = np.full(grid_lat.shape, float(levels[0]))
+        else:
+            dist = np.stack([np.min([_polyline_distance(points, grid_lat, grid_lon) for level_ft, points in contours if level_ft == level], axis=0)
+                             for level in levels])
+            nearest = np.argsort(dist, axis=0)[:2]
+            d1, d2 = np.take_along_axis(dist, nearest, axis=0)
+            l1, l2 = np.asarray(levels, dtype=float)[nearest]
+            total = d1 + d2
+            values = np.where(total == 0, l1, (l1 * d2 + l2 * d1) / np.where(total == 0, 1, total))
+
+        if self.range_ft:
+            values = np.clip(values, self.range_ft[0], self.range_ft[1])
+        for area, points in areas:
+            inside = geometry.rasterize_polygon([tuple(point) for point in points], self.lats, self.lons)
+            low_ft = area["low_ft"] if area["low_ft"] is not None else -np.inf
+            values[inside] = np.clip(np.nan_to_num(values[inside], nan=area["high_ft"]), low_ft, area["high_ft"])
+        return values
+
+    def at(self, lat, lon):
+        '''Freezing level (ft) at lat, lon, scalars or
+           arrays of points. A grid lookup, NaN off
+           the grid.
+        '''
+        lat, lon = np.asarray(lat, dtype=float), np.asarray(lon, dtype=float)
+        if not self.grid.size:
+            return np.full(np.broadcast(lat, lon).shape, np.nan)[()]
+        lat_idx = np.rint((lat - self.lats[0]) / self.res_deg).astype(np.int64)
+        lon_idx = np.rint((lon - self.lons[0]) / self.res_deg).astype(np.int64)
+        on_grid = (lat_idx >= 0) & (lat_idx < len(self.lats)) & (lon_idx >= 0) & (lon_idx < len(self.lons))
+        values = np.where(on_grid, self.grid[np.clip(lat_idx, 0, len(self.lats) - 1), np.clip(lon_idx, 0, len(self.lons) - 1)], np.nan)
+        return values[()]
+
+_field_cache = OrderedDict() #bulletin key -> FreezingLevelField or None
+
+def _bulletin_key(airmet_dict):
+    return (airmet_dict.get("airmet_id"), airmet_dict.get("iss_year"), airmet_dict.get("iss_month"), airmet_dict.get("iss_time_str"))
+
+def field_for(airmet_dict, **kwargs):
+    '''The FreezingLevelField of a parsed bulletin, or
+       None if it has no FRZLVL group. Built once per
+       bulletin (airmet_id and issuance time), then
+       served from an LRU cache.
+    '''
+    key = _bulletin_key(airmet_dict)
+    if key in _field_cache:
+        _field_cache.move_to_end(key)
+        return _field_cache[key]
+
+    group = frzlvl_group(airmet_dict)
+    field = None if group is None else FreezingLevelField(group, **kwargs)
+    _field_cache[key] = field
+    while len(_field_cache) > kwargs.get("cache_size", DEF_FIELD_CACHE_SIZE):
+        _field_cache.popitem(last=False)
+    return field
+
+class FreezingLevelIndex():
+    ''' Freezing level at a point and time over many
+        bulletins. Bulletins with a FRZLVL group are
+        kept sorted by issuance time; a lookup takes
+        the latest issued ones valid at the time and
+        reads the first field covering the point.
+    '''
+
+    def __init__(self, airmets, **kwargs):
+
+        self.kwargs = kwargs
+        bulletins = []
+        for airmet_dict in airmets:
+            if "iss_day" not in airmet_dict or frzlvl_group(airmet_dict) is None:
+                continue
+            iss_time, valid_time = airmet.airmet_times(airmet_dict)
+            bulletins.append((iss_time, valid_time, airmet_dict))
+        bulletins.sort(key=lambda bulletin: bulletin[0])
+
+        self.bulletins = [airmet_dict for _, _, airmet_dict in bulletins]
+        self.iss = np.array([iss_time.timestamp() for iss_time, _, _ in bulletins], dtype=np.float64)
+        self.valid = np.array([valid_time.timestamp() for _, valid_time, _ in bulletins], dtype=np.float64)
+
+    def __len__(self):
+        return len(self.bulletins)
+
+    def at(self, lat, lon, at):
+        '''Freezing level (ft MSL) at lat, lon and the
+           datetime at, or None if no bulletin valid then
+           covers the point.
+        '''
+        stamp = at.timestamp()
+        num_issued = int(np.searchsorted(self.iss, stamp, side="right"))
+        for idx in np.nonzero(self.valid[:num_issued] >= stamp)[0][::-1]:
+            value = field_for(self.bulletins[idx], **self.kwargs).at(lat, lon)
+            if not np.isnan(value):
+                return float(value)
+        return None
+
+if __name__ == "__main__":
+
+    import archive
+
+    lat, lon = float(sys.argv[2]), float(sys.argv[3])
+    at = datetime.strptime(sys.argv[4], "%Y-%m-%dT%H:%MZ")
+    with archive.AirmetArchive(sys.argv[1]) as airmets:
+        print(FreezingLevelIndex(list(airmets)).at(lat, lon, at))
@@ -0,0 +1,361 @@
+import math
+import json
+import functools
+
+import airmet
+import archive
+
+#Polygons are lists of (lat, lon) vertices, as returned by
+#airmet.resolve_vors(). Rings are closed (first == last) when they
+#come from a subgroup, but nothing here depends on it.
+
+def subgroup_polygon(vors):
+    '''Returns the polygon of a subgroup's VOR list,
+       or None if any VOR can't be resolved (the parser
+       still mis-splits some) or has no coordinates.
+    '''
+
+    if not vors:
+        return None
+    polygon = airmet.resolve_vors(vors)
+    if any(math.isnan(lat) or math.isnan(lon) for lat, lon in polygon):
+        return None
+    return polygon
+
+def bbox(polygon):
+    '''Returns (min_lat, min_lon, max_lat, max_lon).'''
+    lats = [lat for lat, _ in polygon]
+    lons = [lon for _, lon in polygon]
+    return (min(lats), min(lons), max(lats), max(lons))
+
+def bboxes_overlap(box_a, box_b):
+    return box_a[0] <= box_b[2] and box_b[0] <= box_a[2] and box_a[1] <= box_b[3] and box_b[1] <= box_a[3]
+
+def point_in_polygon(lat, lon, polygon):
+    inside = False
+    lat_j, lon_j = polygon[-1]
+    for lat_i, lon_i in polygon:
+        if (lat_i > lat) != (lat_j > lat):
+            if lon < (lon_j - lon_i) * (lat - lat_i) / (lat_j - lat_i) + lon_i:
+                inside = not inside
+        lat_j, lon_j = lat_i, lon_i
+    return inside
+
+def points_in_polygon(lats, lons, polygon):
+    '''Boolean array, True where (lats[i], lons[i]) is
+       inside polygon, the same even-odd rule as
+       point_in_polygon, vectorized over the points.
+    '''
+
+    import numpy as np
+
+    lats, lons = np.asarray(lats, dtype=float), np.asarray(lons, dtype=float)
+    inside = np.zeros(lats.shape, dtype=bool)
+    lat_j, lon_j = polygon[-1]
+    for lat_i, lon_i in polygon:
+        if lat_i != lat_j:
+            crosses = (lat_i > lats) != (lat_j > lats)
+            inside ^= crosses & (lons < (lon_j - lon_i) * (lats - lat_i) / (lat_j - lat_i) + lon_i)
+        lat_j, lon_j = lat_i, lon_i
+    return inside
+
+def rasterize_polygon(polygon, lats, lons):
+    '''Boolean (len(lats), len(lons)) mask of the grid
+       points (cell centres) inside polygon.
+    '''
+
+    import numpy as np
+
+    grid_lat, grid_lon = np.meshgrid(np.asarray(lats, dtype=float), np.asarray(lons, dtype=float), indexing="ij")
+    return points_in_polygon(grid_lat, grid_lon, polygon)
+
+def _orientation(p, q, r):
+    value = (q[1] - p[1]) * (r[0] - q[0]) - (q[0] - p[0]) * (r[1] - q[1])
+    return 0 if value == 0 else (1 if value > 0 else -1)
+
+def _on_segment(p, q, r):
+    return min(p[0], r[0]) <= q[0] <= max(p[0], r[0]) and min(p[1], r[1]) <= q[1] <= max(p[1], r[1])
+
+def segments_intersect(p1, p2, q1, q2):
+    o1, o2 = _orientation(p1, p2, q1), _orientation(p1, p2, q2)
+    o3, o4 = _orientation(q1, q2, p1), _orientation(q1, q2, p2)
+    if o1 != o2 and o3 != o4:
+        return True
+    return ((o1 == 0 and _on_segment(p1, q1, p2)) or (o2 == 0 and _on_segment(p1, q2, p2)) or
+            (o3 == 0 and _on_segment(q1, p1, q2)) or (o4 == 0 and _on_segment(q1, p2, q2)))
+
+def _orientations(p_lats, p_lons, q_lats, q_lons, r_lats, r_lons):
+    import numpy as np
+
+    return np.sign((q_lons - p_lons) * (r_lats - q_lats) - (q_lats - p_lats) * (r_lons - q_lons))
+
+def _on_segments(p_lats, p_lons, q_lats, q_lons, r_lats, r_lons):
+    import numpy as np
+
+    return ((np.minimum(p_lats, r_lats) <= q_lats) & (q_lats <= np.maximum(p_lats, r_lats)) &
+            (np.minimum(p_lons, r_lons) <= q_lons) & (q_lons <= np.maximum(p_lons, r_lons)))
+
+def segments_intersect_many(p1, p2, start_lats, start_lons, end_lats, end_lons):
+    '''segments_intersect of the segment p1-p2 against
+       many segments given as coordinate arrays, the
+       same rule vectorized. Returns a boolean array.
+    '''
+
+    import numpy as np
+
+    (p1_lat, p1_lon), (p2_lat, p2_lon) = p1, p2
+    q1_lats, q1_lons = np.asarray(start_lats, dtype=float), np.asarray(start_lons, dtype=float)
+    q2_lats, q2_lons = np.asarray(end_lats, dtype=float), np.asarray(end_lons, dtype=float)
+    o1 = _orientations(p1_lat, p1_lon, p2_lat, p2_lon, q1_lats, q1_lons)
+    o2 = _orientations(p1_lat, p1_lon, p2_lat, p2_lon, q2_lats, q2_lons)
+    o3 = _orientations(q1_lats, q1_lons, q2_lats, q2_lons, p1_lat, p1_lon)
+    o4 = _orientations(q1_lats, q1_lons, q2_lats, q2_lons, p2_lat, p2_lon)
+    return (((o1 != o2) & (o3 != o4)) |
+            ((o1 == 0) & _on_segments(p1_lat, p1_lon, q1_lats, q1_lons, p2_lat, p2_lon)) |
+            ((o2 == 0) & _on_segments(p1_lat, p1_lon, q2_lats, q2_lons, p2_lat, p2_lon)) |
+            ((o3 == 0) & _on_segments(q1_lats, q1_lons, p1_lat, p1_lon, q2_lats, q2_lons)) |
+            ((o4 == 0) & _on_segments(q1_lats, q1_lons, p2_lat, p2_lon, q2_lats, q2_lons)))
+
+#Cells per side of the grid polygon_iou() samples the union bbox on
+DEF_IOU_GRID_CELLS = 64
+
+def polygon_area_nm2(polygon):
+    '''Area in square NM (shoelace formula on an
+       equirectangular projection around the mean
+       latitude, close enough at AIRMET scale).
+    '''
+
+    cos_lat = math.cos(math.radians(sum(lat for lat, _ in polygon) / len(polygon)))
+    points = [(lon * 60 * cos_lat, lat * 60) for lat, lon in polygon]
+    return abs(sum(x_a * y_b - x_b * y_a for (x_a, y_a), (x_b, y_b) in zip(points, points[1:] + points[:1]))) / 2
+
+def polygon_iou(polygon_a, polygon_b, **kwargs):
+    '''Intersection over union of two polygons in
+       [0, 1], sampled on a cells x cells grid
+       (DEF_IOU_GRID_CELLS by default) over their
+       joint bbox. Pass precomputed bboxes as
+       bbox_a/bbox_b to skip recomputing them.
+    '''
+
+    import numpy as np
+
+    box_a, box_b = kwargs.get("bbox_a") or bbox(polygon_a), kwargs.get("bbox_b") or bbox(polygon_b)
+    if not bboxes_overlap(box_a, box_b):
+        return 0.0
+    cells = kwargs.get("cells", DEF_IOU_GRID_CELLS)
+    min_lat, min_lon = min(box_a[0], box_b[0]), min(box_a[1], box_b[1])
+    max_lat, max_lon = max(box_a[2], box_b[2]), max(box_a[3], box_b[3])
+    lats = min_lat + (np.arange(cells) + 0.5) * (max_lat - min_lat) / cells
+    lons = min_lon + (np.arange(cells) + 0.5) * (max_lon - min_lon) / cells
+    inside_a, inside_b = rasterize_polygon(polygon_a, lats, lons), rasterize_polygon(polygon_b, lats, lons)
+    union = np.count_nonzero(inside_a | inside_b)
+    return float(np.count_nonzero(inside_a & inside_b) / union) if union else 0.0
+
+def _edges(polygon):
+    return [(polygon[idx - 1], polygon[idx]) for idx in range(len(polygon))]
+
+def polygons_intersect(polygon_a, polygon_b, **kwargs):
+    '''True if the polygons overlap or touch. Pass
+       precomputed bboxes as bbox_a/bbox_b to skip
+       recomputing them.
+    '''
+
+    if not bboxes_overlap(kwargs.get("bbox_a") or bbox(polygon_a), kwargs.get("bbox_b") or bbox(polygon_b)):
+        return False
+    if point_in_polygon(*polygon_a[0], polygon_b) or point_in_polygon(*polygon_b[0], polygon_a):
+        return True
+    edges_b = _edges(polygon_b)
+    return any(segments_intersect(a1, a2, b1, b2) for a1, a2 in _edges(polygon_a) for b1, b2 in edges_b)
+
+def line_intersects_polygon(line, polygon, **kwargs):
+    '''True if the polyline crosses, touches or lies
+       inside the polygon. Pass precomputed bboxes as
+       bbox_line/bbox_polygon to skip recomputing them.
+    '''
+
+    if not bboxes_overlap(kwargs.get("bbox_line") or bbox(line), kwargs.get("bbox_polygon") or bbox(polygon)):
+        return False
+    if point_in_polygon(*line[0], polygon):
+        return True
+    edges = _edges(polygon)
+    return any(segments_intersect(a1, a2, b1, b2) for a1, a2 in zip(line[:-1], line[1:]) for b1, b2 in edges)
+
+def _geojson_ring(ring):
+    coords = [[round(lon, 5), round(lat, 5)] for lat, lon in ring]
+    if coords and coords[0] != coords[-1]:
+        coords.append(coords[0])
+    return coords
+
+def to_geojson_geometry(polygons):
+    '''polygons is a list of polygons, each a list of
+       rings (exterior first, then holes). One polygon
+       gives a GeoJSON Polygon, more a MultiPolygon.
+    '''
+    if len(polygons) == 1:
+        return {"type" : "Polygon", "coordinates" : [_geojson_ring(ring) for ring in polygons[0]]}
+    return {"type" : "MultiPolygon", "coordinates" : [[_geojson_ring(ring) for ring in rings] for rings in polygons]}
+
+def to_geojson_feature(polygons, properties):
+    return {"type" : "Feature", "geometry" : to_geojson_geometry(polygons), "properties" : properties}
+
+def write_geojson(path, features, **kwargs):
+    '''Writes a FeatureCollection, streamed and
+       optionally compressed like the JSON outputs.
+       Returns the final path.
+    '''
+
+    with archive.open_output(path, compression=kwargs.get("compression")) as file:
+        file.write('{"type":"FeatureCollection","features":[')
+        for idx, feature in enumerate(features):
+            file.write(("," if idx else "") + json.dumps(feature, separators=archive.DEF_COMPACT_SEPARATORS))
+        file.write("]}")
+    return file.path
+
+def subgroup_features(airmets, **kwargs):
+    '''Yields one GeoJSON feature per resolvable
+       subgroup of the given parsed bulletins, at
+       detail level lod_level (0, full detail, by
+       default).
+    '''
+
+    lod_level = kwargs.get("lod_level", 0)
+
+    for airmet_dict in airmets:
+        if "iss_day" not in airmet_dict:
+            continue
+        iss_time, valid_time = airmet.airmet_times(airmet_dict)
+        for group in airmet_dict.get("subgroups") or []:
+            lods = subgroup_lods(group.get("vors"))
+            if lods is None:
+                continue
+            yield to_geojson_feature([[lods[lod_level]]], {
+                "airmet_id" : airmet_dict["airmet_id"],
+                "airmet_type" : airmet_dict.get("airmet_type"),
+                "iss_time" : iss_time.strftime("%Y-%m-%dT%H:%MZ"),
+                "valid_time" : valid_time.strftime("%Y-%m-%dT%H:%MZ"),
+                "qualifiers" : group.get("qualifiers") or [],
+                "states" : group.get("states") or [],
+                "desc" : group.get("desc", ""),
+            })
+
+###Level of detail
+#Level 0 is the polygon as issued; each further level drops
+#vertices closer than its tolerance (in degrees) to the simplified
+#outline. DEF_LOD_PIXELS is the KML Lod (minLodPixels, maxLodPixels)
+#range each level is shown at, coarsest when the polygon is small
+#on screen.
+
+DEF_LOD_TOLERANCES_DEG = (0.0, 0.05, 0.2, 0.5)
+
+DEF_LOD_PIXELS = ((1024, -1), (256, 1024), (64, 256), (0, 64))
+
+#Distinct (VOR list, tolerances) kept by subgroup_lods, least recently used
+#dropped first. A day of bulletins has a few hundred distinct VOR lists.
+DEF_LOD_CACHE_SIZE = 4096
+
+def _segment_distance(point, start, end, cos_lat):
+    #Planar distance in degrees, with longitudes scaled to the latitude
+    px, py = point[1] * cos_lat, point[0]
+    sx, sy = start[1] * cos_lat, start[0]
+    ex, ey = end[1] * cos_lat, end[0]
+    dx, dy = ex - sx, ey - sy
+    if dx == 0 and dy == 0:
+        return math.hypot(px - sx, py - sy)
+    t = max(0, min(1, ((px - sx) * dx + (py - sy) * dy) / (dx * dx + dy * dy)))
+    return math.hypot(px - (sx + t * dx), py - (sy + t * dy))
+
+def _farthest_between(ring, start, end, cos_lat):
+    '''Index of the vertex strictly between start and end
+       (walking forward around the ring) farthest from the
+       start-end segment, and its distance. (None, 0) if
+       there is none.
+    '''
+    best_idx, best_dist = None, 0
+    idx = (start + 1) % len(ring)
+    while idx != end:
+        dist = _segment_distance(ring[idx], ring[start], ring[end % len(ring)], cos_lat)
+        if best_idx is None or dist > best_dist:
+            best_idx, best_dist = idx, dist
+        idx = (idx + 1) % len(ring)
+    return best_idx, best_dist
+
+def _crossings(ring, kept, skip):
+    '''Yields the pairs of non-adjacent kept edges that
+       intersect, each edge as its (start, end) ring
+       indices, leaving out the pairs in skip.
+    '''
+    edges = [(kept[pos], kept[(pos + 1) % len(kept)]) for pos in range(len(kept))]
+    for pos_a in range(len(edges)):
+        for pos_b in range(pos_a + 2, len(edges)):
+            if pos_a == 0 and pos_b == len(edges) - 1:
+                continue
+            if (edges[pos_a], edges[pos_b]) in skip:
+                continue
+            if segments_intersect(ring[edges[pos_a][0]], ring[edges[pos_a][1]], ring[edges[pos_b][0]], ring[edges[pos_b][1]]):
+                yield edges[pos_a], edges[pos_b]
+
+def simplify_polygon(polygon, tolerance):
+    '''Douglas-Peucker simplification of a polygon ring
+       that never introduces a self-intersection: while
+       two simplified edges cross, the farthest dropped
+       vertex of each is put back. Crossings between
+       two edges of the original ring (nothing was
+       dropped from either) are left as issued and the
+       rest are still checked. Always keeps at least a
+       triangle. A closed input stays closed.
+    '''
+
+    closed = len(polygon) > 1 and polygon[0] == polygon[-1]
+    ring = list(polygon[:-1]) if closed else list(polygon)
+    if tolerance <= 0 or len(ring) <= 3:
+        return list(polygon)
+
+    cos_lat = math.cos(math.radians(sum(lat for lat, _ in ring) / len(ring)))
+
+    #Split the ring at vertex 0 and the vertex farthest from it, then simplify both chains
+    far = max(range(len(ring)), key=lambda idx: _segment_distance(ring[idx], ring[0], ring[0], cos_lat))
+    kept = {0, far}
+    stack = [(0, far), (far, 0)]
+    while stack:
+        start, end = stack.pop()
+        idx, dist = _farthest_between(ring, start, end, cos_lat)
+        if idx is not None and dist > tolerance:
+            kept.add(idx)
+            stack += [(start, idx), (idx, end)]
+
+    kept = sorted(kept)
+    while len(kept) < 3:
+        candidates = [idx for idx in range(len(ring)) if idx not in kept]
+        kept = sorted(kept + [max(candidates, key=lambda idx: _segment_distance(ring[idx], ring[kept[0]], ring[kept[-1]], cos_lat))])
+
+    original_crossings = set() #kept vertices are never dropped again, so these edges stay as they are
+    while True:
+        restored = []
+        for crossing in _crossings(ring, kept, original_crossings):
+            restored = [idx for idx, _ in (_farthest_between(ring, start, end, cos_lat) for start, end in crossing) if idx is not None]
+            if restored:
+                break
+            original_crossings.add(crossing)
+        if not restored:
+            break
+        kept = sorted(set(kept + restored))
+
+    simplified = [ring[idx] for idx in kept]
+    return simplified + [simplified[0]] if closed else simplified
+
+def simplify_levels(polygon, tolerances=DEF_LOD_TOLERANCES_DEG):
+    return [simplify_polygon(polygon, tolerance) for tolerance in tolerances]
+
+@functools.lru_cache(maxsize=DEF_LOD_CACHE_SIZE)
+def _cached_lods(vors, tolerances):
+    polygon = subgroup_polygon(list(vors))
+    return None if polygon is None else simplify_levels(polygon, tolerances)
+
+def subgroup_lods(vors, tolerances=DEF_LOD_TOLERANCES_DEG):
+    '''Every detail level of a subgroup's polygon, or
+       None if it can't be resolved. Computed once per
+       VOR list and tolerances and kept in a bounded
+       LRU cache, so long runs (watch, serve, month
+       long exports) don't grow without limit.
+    '''
+    return _cached_lods(tuple(vors or []), tuple(tolerances))
@@ -0,0 +1,613 @@
+import sys
+import os
+import time
+import json
+import heapq
+import queue
+import sqlite3
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import airmet
+import archive
+import quarantine
+
+DEF_QUEUE_SIZE = 64
+
+DEF_NUM_FETCHERS = 4
+
+DEF_NUM_PARSERS = 2
+
+DEF_NUM_WRITERS = 1
+
+_STOP = object()
+
+###Sources
+#A source lists work units (product entries, dicts with at least
+#"product_id" and "pil") and fetches the raw text for one unit.
+#fetch() is called concurrently from the fetcher threads.
+
+class NetworkSource():
+    ''' Lists and fetches products for one day
+        from the IEM API. If cache_dir is given,
+        every fetched product is also written
+        there, named by product_id, so it can be
+        replayed later with CacheSource.
+    '''
+
+    def __init__(self, year, month, day, **kwargs):
+
+        self.year = year
+        self.month = month
+        self.date = f"{str(year).zfill(4)}-{str(month).zfill(2)}-{str(day).zfill(2)}"
+        self.base_url = kwargs.get("base_url", airmet.DEF_IEM_BASE_URL)
+        self.pil_prefix = kwargs.get("pil_prefix", "WA")
+        self.cache_dir = kwargs.get("cache_dir")
+        self.http_kwargs = airmet.http_kwargs(kwargs)
+
+        if self.cache_dir and not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def list_units(self):
+        product_list = airmet.fetch_product_list(self.date, base_url=self.base_url, **self.http_kwargs)
+        return [prod for prod in product_list if prod["pil"].startswith(self.pil_prefix)]
+
+    def fetch(self, unit):
+        raw_text = airmet.fetch_product_text(unit["product_id"], base_url=self.base_url, **self.http_kwargs)
+        if self.cache_dir:
+            with open(os.path.join(self.cache_dir, unit["product_id"] + ".txt"), "w") as file:
+                file.write(raw_text)
+        return raw_text
+
+class CacheSource():
+    ''' Replays products previously written
+        by NetworkSource(cache_dir=...), one
+        file per product_id.
+    '''
+
+    def __init__(self, cache_dir, **kwargs):
+
+        self.cache_dir = cache_dir
+        self.pil_prefix = kwargs.get("pil_prefix", "WA")
+        self.date_prefix = kwargs.get("date", "").replace("-", "")
+
+    def list_units(self):
+        units = []
+        for file_name in sorted(os.listdir(self.cache_dir)):
+            for suffix in archive.DEF_COMPRESSION_SUFFIXES.values():
+                if suffix and file_name.endswith(suffix):
+                    file_name = file_name[:-len(suffix)]
+            if not file_name.endswith(".txt"):
+                continue
+            product_id = file_name[:-4]
+            pil = product_id.split("-")[-1]
+            if pil.startswith(self.pil_prefix) and product_id.startswith(self.date_prefix):
+                units.append({"product_id" : product_id, "pil" : pil})
+        return units
+
+    def fetch(self, unit):
+        return archive.read_text(os.path.join(self.cache_dir, unit["product_id"] + ".txt"))
+
+class FileSource():
+    ''' Replays the products in an
+        AllAIRMET_RawText_YYYYMMDD.txt file.
+    '''
+
+    def __init__(self, raw_text_path, **kwargs):
+
+        self.raw_text_path = raw_text_path
+        self.date = kwargs.get("date", os.path.basename(raw_text_path).split("_")[-1].split(".")[0])
+        self._products = None
+
+    def list_units(self):
+        raw_text = archive.read_text(self.raw_text_path)
+        self._products = {prod["product_id"] : prod for prod in airmet.split_raw_products(raw_text, self.date)}
+        return [{"product_id" : prod["product_id"], "pil" : prod["pil"]} for prod in self._products.values()]
+
+    def fetch(self, unit):
+        return self._products[unit["product_id"]]["text"]
+
+###Sinks
+#A sink is opened once, receives every item from the writer
+#stage, and is closed at the end of the run, or aborted (its
+#outputs discarded) if the run failed with abort_on_error=True.
+#Items are dicts with
+#"seq", "unit", "raw_text" and one of "airmet", "error" or "quarantined".
+#With more than one writer, write() must be thread safe.
+
+class RawTextSink():
+
+    def __init__(self, path, **kwargs):
+        self.path = path
+        self.compression = kwargs.get("compression")
+
+    def open(self):
+        self._file = archive.open_output(self.path, compression=self.compression)
+        self.path = self._file.path
+
+    def write(self, item):
+        if item.get("raw_text"):
+            self._file.write(item["raw_text"])
+
+    def close(self):
+        self._file.close()
+
+    def abort(self):
+        self._file.abort()
+
+class JSONSink():
+    ''' Writes a JSON array of parsed
+        AIRMETs, streaming each element as it
+        arrives instead of holding the whole
+        list in memory. Compact unless pretty=True.
+    '''
+
+    def __init__(self, path, **kwargs):
+        self.path = path
+        self.compression = kwargs.get("compression")
+        self.pretty = kwargs.get("pretty", False)
+
+    def open(self):
+        self._file = archive.open_output(self.path, compression=self.compression)
+        self.path = self._file.path
+        self._writer = archive.JSONArrayWriter(self._file, pretty=self.pretty, index=True)
+
+    def write(self, item):
+        if "airmet" in item:
+            self._writer.write(item["airmet"], product_id=item["unit"]["product_id"])
+
+    def close(self):
+        self._writer.close()
+        self._file.close()
+
+    def abort(self):
+        self._file.abort()
+
+class NDJSONSink():
+
+    def __init__(self, path, **kwargs):
+        self.path = path
+        self.compression = kwargs.get("compression")
+
+    def open(self):
+        self._file = archive.open_output(self.path, compression=self.compression)
+        self.path = self._file.path
+
+    def write(self, item):
+        if "airmet" in item:
+            self._file.write(json.dumps(item["airmet"], separators=archive.DEF_COMPACT_SEPARATORS) + "\n")
+
+    def close(self):
+        self._file.close()
+
+    def abort(self):
+        self._file.abort()
+
+class SQLiteSink():
+    ''' Writes one row per parsed AIRMET into
+        the "airmets" table, with the header
+        fields as columns and the full dict as
+        JSON in the "data" column.
+    '''
+
+    def __init__(self, path, **kwargs):
+        self.path = path
+        self.commit_every = kwargs.get("commit_every", 500)
+
+    def open(self):
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS airmets (
+                                product_id TEXT PRIMARY KEY,
+                                airmet_id TEXT,
+                                airmet_type TEXT,
+                                iss_airport TEXT,
+                                iss_time TEXT,
+                                valid_time TEXT,
+                                data TEXT)""")
+        self._lock = threading.Lock()
+        self._pending = 0
+
+    def write(self, item):
+        if "airmet" not in item:
+            return
+        airmet_dict = item["airmet"]
+        row = (item["unit"]["product_id"],
+               airmet_dict.get("airmet_id"),
+               airmet_dict.get("airmet_type"),
+               airmet_dict.get("iss_airport"),
+               _dict_time_str(airmet_dict, "iss"),
+               _dict_time_str(airmet_dict, "valid"),
+               json.dumps(airmet_dict))
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO airmets VALUES (?, ?, ?, ?, ?, ?, ?)", row)
+            self._pending += 1
+            if self._pending >= self.commit_every:
+                self._conn.commit()
+                self._pending = 0
+
+    def close(self):
+        self._conn.commit()
+        self._conn.close()
+
+    def abort(self):
+        #Rows since the last periodic commit are dropped, earlier ones stay
+        self._conn.rollback()
+        self._conn.close()
+
+class KMZSink():
+    ''' Plots every parsed AIRMET to its own
+        KMZ with airmet.plot_kmz(). kwargs are
+        passed through (e.g. filter_by_states).
+    '''
+
+    def __init__(self, save_dir, **kwargs):
+        self.save_dir = save_dir
+        self.plot_kwargs = kwargs
+
+    def open(self):
+        pass
+
+    def write(self, item):
+        airmet_dict = item.get("airmet")
+        if not airmet_dict or "iss_day" not in airmet_dict:
+            return
+        iss_time = datetime(airmet_dict["iss_year"], airmet_dict["iss_month"], airmet_dict["iss_day"], airmet_dict["iss_hour"], airmet_dict["iss_minute"])
+        valid_time = datetime(airmet_dict["valid_year"], airmet_dict["valid_month"], airmet_dict["valid_day"], airmet_dict["valid_hour"], airmet_dict["valid_minute"])
+        airmet.plot_kmz(self.save_dir, airmet_dict.get("subgroups") or [], airmet_dict["airmet_type"], airmet_dict["airmet_id"],
+                        airmet_dict["raw_text"], valid_time, iss_time, **self.plot_kwargs)
+
+    def close(self):
+        pass
+
+def _dict_time_str(airmet_dict, prefix):
+    try:
+        return datetime(airmet_dict[f"{prefix}_year"], airmet_dict[f"{prefix}_month"], airmet_dict[f"{prefix}_day"],
+                        airmet_dict[f"{prefix}_hour"], airmet_dict[f"{prefix}_minute"]).strftime("%Y-%m-%dT%H:%MZ")
+    except (KeyError, TypeError, ValueError):
+        return None
+
+def abort_sink(sink):
+    abort = getattr(sink, "abort", None) #sinks without outputs to discard needn't define it
+    if abort is not None:
+        abort()
+    else:
+        sink.close()
+
+###Pipeline
+
+class _StageQueue():
+    ''' A bounded queue.Queue that also tracks
+        its depth for tuning.
+    '''
+
+    def __init__(self, name, maxsize):
+        self.name = name
+        self.maxsize = maxsize
+        self._queue = queue.Queue(maxsize=maxsize)
+        self.max_depth = 0
+        self.num_puts = 0
+        self.depth_total = 0
+        self.blocked_s = 0.0
+
+    def put(self, item):
+        start = time.perf_counter()
+        self._queue.put(item) #blocks when full, which is what gives backpressure upstream
+        self.blocked_s += time.perf_counter() - start
+        depth = self._queue.qsize()
+        self.num_puts += 1
+        self.depth_total += depth
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def get(self):
+        return self._queue.get()
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        return {
+            "maxsize" : self.maxsize,
+            "depth" : self.qsize(),
+            "max_depth" : self.max_depth,
+            "mean_depth" : self.depth_total / self.num_puts if self.num_puts else 0,
+            "put_blocked_s" : self.blocked_s,
+        }
+
+class _Stage():
+
+    def __init__(self, name, num_workers):
+        self.name = name
+        self.num_workers = num_workers
+        self.num_items = 0
+        self.busy_s = 0.0
+        self.lock = threading.Lock()
+        self.remaining_workers = num_workers
+
+    def record(self, busy_s):
+        with self.lock:
+            self.num_items += 1
+            self.busy_s += busy_s
+
+    def worker_done(self):
+        '''Returns True for the last worker of the stage to finish.'''
+        with self.lock:
+            self.remaining_workers -= 1
+            return self.remaining_workers == 0
+
+    def stats(self, wall_s):
+        return {
+            "workers" : self.num_workers,
+            "items" : self.num_items,
+            "busy_s" : self.busy_s,
+            "utilization" : self.busy_s / (wall_s * self.num_workers) if wall_s > 0 else 0,
+        }
+
+class Pipeline():
+    ''' Fetch -> parse -> write pipeline. Each
+        stage runs its own pool of worker threads,
+        connected by bounded queues so a slow
+        stage applies backpressure instead of
+        letting work pile up in memory.
+
+        Parsing is regex-bound and holds the GIL,
+        so with parse_processes > 0 the parser
+        threads hand the work to a process pool.
+
+        With ordered=True (the default) the writer
+        stage re-sequences items so sinks see them
+        in listing order, matching download().
+
+        With abort_on_error=True, a run that
+        recorded any error aborts its sinks instead
+        of closing them, so (like download()) a
+        failed day leaves no output files behind.
+
+        parser (airmet.parse_airmet by default) is
+        called as parser(raw_text, year, month,
+        pil=unit pil), e.g. router.parse_product to
+        parse every KKCI product family in one run.
+        It must be picklable to use parse_processes.
+
+        Every parse runs under a budget of
+        parse_budget seconds (0 disables it, see
+        quarantine.py). A product that overruns is
+        not written to the JSON sinks but to the
+        quarantine file at quarantine_path (if any),
+        with its raw text, and doesn't fail the run.
+    '''
+
+    def __init__(self, source, sinks, **kwargs):
+
+        self.source = source
+        self.sinks = sinks
+        self.num_fetchers = kwargs.get("fetchers", DEF_NUM_FETCHERS)
+        self.num_parsers = kwargs.get("parsers", DEF_NUM_PARSERS)
+        self.num_writers = kwargs.get("writers", DEF_NUM_WRITERS)
+        self.parse_processes = kwargs.get("parse_processes", 0)
+        self.parser = kwargs.get("parser", airmet.parse_airmet)
+        self.queue_size = kwargs.get("queue_size", DEF_QUEUE_SIZE)
+        self.ordered = kwargs.get("ordered", True)
+        self.verbose = airmet.str_to_bool(kwargs.get("verbose"))
+        self.abort_on_error = airmet.str_to_bool(kwargs.get("abort_on_error"))
+        self.parse_budget = kwargs.get("parse_budget", quarantine.DEF_PARSE_BUDGET_S)
+        self.quarantine = quarantine.Quarantine(kwargs.get("quarantine_path"))
+
+        if self.parse_budget:
+            self.parser = quarantine.BudgetedParser(self.parser, self.parse_budget)
+
+        if self.ordered and self.num_writers != 1:
+            raise ValueError("ordered=True requires a single writer")
+
+        self.unit_queue = _StageQueue("units", self.queue_size)
+        self.fetched_queue = _StageQueue("fetched", self.queue_size)
+        self.parsed_queue = _StageQueue("parsed", self.queue_size)
+
+        self.fetch_stage = _Stage("fetch", self.num_fetchers)
+        self.parse_stage = _Stage("parse", self.num_parsers)
+        self.write_stage = _Stage("write", self.num_writers)
+
+        self.errors = []
+        self._errors_lock = threading.Lock()
+        self._start_time = None
+        self._end_time = None
+        self._pool = None
+
+    def run(self):
+        '''Runs the pipeline to completion and
+           returns the stats() dict.
+        '''
+
+        self._start_time = time.perf_counter()
+
+        for sink in self.sinks:
+            sink.open()
+
+        if self.parse_processes:
+            self._pool = ProcessPoolExecutor(max_workers=self.parse_processes)
+
+        threads = []
+        threads += [threading.Thread(target=self._fetch_worker, daemon=True) for _ in range(self.num_fetchers)]
+        threads += [threading.Thread(target=self._parse_worker, daemon=True) for _ in range(self.num_parsers)]
+        threads += [threading.Thread(target=self._write_worker, daemon=True) for _ in range(self.num_writers)]
+        for thread in threads:
+            thread.start()
+
+        try:
+            units = self.source.list_units()
+            if self.verbose:
+                print(f"PIPELINE: {len(units)} unit(s) listed")
+            for seq, unit in enumerate(units):
+                self.unit_queue.put({"seq" : seq, "unit" : unit})
+        except Exception as e:
+            self._record_error(None, "list", e)
+        finally:
+            for _ in range(self.num_fetchers):
+                self.unit_queue.put(_STOP)
+
+        try:
+            for thread in threads:
+                thread.join()
+        except BaseException: #e.g. KeyboardInterrupt, the outputs are incomplete
+            for sink in self.sinks:
+                abort_sink(sink)
+            raise
+
+        if self._pool is not None:
+            self._pool.shutdown()
+
+        for sink in self.sinks:
+            if self.abort_on_error and self.errors:
+                abort_sink(sink)
+            else:
+                sink.close()
+
+        self._end_time = time.perf_counter()
+        stats = self.stats()
+
+        if self.verbose:
+            print(f"PIPELINE: Finished in {stats['wall_s']:.2f}s")
+            for name, stage in stats["stages"].items():
+                print(f"PIPELINE: {name}: {stage['items']} item(s), utilization {stage['utilization']:.0%}")
+
+        return stats
+
+    def stats(self):
+        end_time = self._end_time if self._end_time else time.perf_counter()
+        wall_s = end_time - self._start_time if self._start_time else 0
+        return {
+            "wall_s" : wall_s,
+            "stages" : {stage.name : stage.stats(wall_s) for stage in (self.fetch_stage, self.parse_stage, self.write_stage)},
+            "queues" : {q.name : q.stats() for q in (self.unit_queue, self.fetched_queue, self.parsed_queue)},
+            "errors" : list(self.errors),
+            "quarantined" : self.quarantine.summary(),
+        }
+
+    def _record_error(self, item, stage, e):
+        with self._errors_lock:
+            self.errors.append({"stage" : stage,
+                                "product_id" : item["unit"]["product_id"] if item else None,
+                                "error" : str(e)})
+
+    def _fetch_worker(self):
+        while True:
+            item = self.unit_queue.get()
+            if item is _STOP:
+                break
+            start = time.perf_counter()
+            try:
+                item["raw_text"] = self.source.fetch(item["unit"])
+            except Exception as e:
+                item["error"] = str(e)
+                self._record_error(item, "fetch", e)
+            self.fetch_stage.record(time.perf_counter() - start)
+            self.fetched_queue.put(item)
+
+        if self.fetch_stage.worker_done():
+            for _ in range(self.num_parsers):
+                self.fetched_queue.put(_STOP)
+
+    def _parse_worker(self):
+        while True:
+            item = self.fetched_queue.get()
+            if item is _STOP:
+                break
+            start = time.perf_counter()
+            if "error" not in item:
+                product_id = item["unit"]["product_id"]
+                year, month = int(product_id[0:4]), int(product_id[4:6])
+                pil = item["unit"].get("pil")
+                try:
+                    if self._pool is not None:
+                        item["airmet"] = self._pool.submit(self.parser, item["raw_text"], year, month, pil=pil).result()
+                    else:
+                        item["airmet"] = self.parser(item["raw_text"], year, month, pil=pil)
+                except quarantine.ParseBudgetExceeded as e:
+                    item["quarantined"] = True
+                    self.quarantine.add(item["raw_text"], e, product_id=product_id, pil=pil)
+                    if self.verbose:
+                        print(f"PIPELINE: {product_id} quarantined, {e}")
+                except Exception as e:
+                    item["error"] = str(e)
+                    self._record_error(item, "parse", e)
+            self.parse_stage.record(time.perf_counter() - start)
+            self.parsed_queue.put(item)
+
+        quarantine.close_sandbox()
+        if self.parse_stage.worker_done():
+            for _ in range(self.num_writers):
+                self.parsed_queue.put(_STOP)
+
+    def _write_worker(self):
+        next_seq = 0
+        reorder_heap = []
+
+        while True:
+            item = self.parsed_queue.get()
+            if item is _STOP:
+                break
+            if not self.ordered:
+                self._write(item)
+                continue
+            heapq.heappush(reorder_heap, (item["seq"], id(item), item))
+            while reorder_heap and reorder_heap[0][0] == next_seq:
+                self._write(heapq.heappop(reorder_heap)[2])
+                next_seq += 1
+
+        while reorder_heap: #only left over if units were lost upstream
+            self._write(heapq.heappop(reorder_heap)[2])
+
+        self.write_stage.worker_done()
+
+    def _write(self, item):
+        start = time.perf_counter()
+        for sink in self.sinks:
+            try:
+                sink.write(item)
+            except Exception as e:
+                self._record_error(item, "write", e)
+        self.write_stage.record(time.perf_counter() - start)
+
+def download_pipelined(save_dir, year, month, day, **kwargs):
+    '''Same outputs and return value as airmet.download()
+       (AllAIRMET_RawText_*.txt and AllAIRMETS_*.json),
+       but fetches, parses and writes concurrently.
+       Pipeline kwargs (fetchers, parsers, queue_size,
+       parse_budget, ...) are passed through. Products
+       over the parse budget go to
+       Quarantine_*.ndjson in save_dir. On any error
+       both files are discarded, as download() does.
+    '''
+
+    start_time = datetime.now()
+
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+
+    date_str = f"{str(year).zfill(4)}{str(month).zfill(2)}{str(day).zfill(2)}"
+    dest_path = os.path.join(save_dir, f"AllAIRMETS_{date_str}.json")
+
+    source = kwargs.pop("source", None) or NetworkSource(year, month, day, base_url=kwargs.get("base_url", airmet.DEF_IEM_BASE_URL),
+                                                         cache_dir=kwargs.get("cache_dir"), **airmet.http_kwargs(kwargs))
+    kwargs.setdefault("quarantine_path", quarantine.quarantine_path(save_dir, date_str))
+    compression = kwargs.get("compression")
+    json_sink = JSONSink(dest_path, compression=compression, pretty=airmet.str_to_bool(kwargs.get("pretty")))
+    sinks = [RawTextSink(os.path.join(save_dir, f"AllAIRMET_RawText_{date_str}.txt"), compression=compression), json_sink]
+
+    kwargs.setdefault("abort_on_error", True)
+    pipeline = Pipeline(source, sinks, **kwargs)
+    stats = pipeline.run()
+    dest_path = json_sink.path
+
+    elapsed_time = datetime.now() - start_time
+    if stats["errors"]:
+        return 0, elapsed_time.total_seconds(), stats["errors"]
+    return 1, elapsed_time.total_seconds(), dest_path
+
+if __name__ == "__main__":
+
+    year, month, day = int(sys.argv[1]), int(sys.argv[2]), int(sys.argv[3])
+    save_dir = sys.argv[4] if len(sys.argv) > 4 else os.getcwd()
+
+    print(download_pipelined(save_dir, year, month, day, verbose=True))
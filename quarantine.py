@@ -0,0 +1,288 @@
+import sys
+import os
+import json
+import time
+import signal
+import threading
+from datetime import datetime, timezone
+
+#Seconds one bulletin may take to parse before it is given up on and quarantined.
+#Real bulletins parse in milliseconds, this only catches pathological ones.
+DEF_PARSE_BUDGET_S = 30
+
+class ParseBudgetExceeded(Exception):
+    ''' Raised out of a parse that ran past its
+        budget. Picklable, so it comes back intact
+        from a process pool.
+    '''
+
+    def __init__(self, budget_s=None, elapsed_s=None):
+        super().__init__(budget_s, elapsed_s)
+        self.budget_s = budget_s
+        self.elapsed_s = elapsed_s
+
+    def __str__(self):
+        if self.budget_s is None:
+            return "parse budget exceeded"
+        return f"parse ran {self.elapsed_s:.1f}s, over its {self.budget_s:g}s budget"
+
+class _SignalBudget():
+    ''' Main thread budget: a SIGALRM timer, which
+        interrupts even a regex search that is still
+        running. The previous SIGALRM handler and
+        ITIMER_REAL timer are put back on exit, with
+        the time spent parsing taken off the timer.
+    '''
+
+    def __init__(self, budget_s):
+
+        self.budget_s = budget_s
+        self.fired = False
+        self._armed = False
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self._previous_handler = signal.signal(signal.SIGALRM, self._on_alarm)
+        self._armed = True
+        self._previous_timer = signal.setitimer(signal.ITIMER_REAL, self.budget_s)
+        return self
+
+    def _on_alarm(self, signum, frame):
+        if not self._armed:
+            return
+        self.fired = True
+        raise ParseBudgetExceeded
+
+    def __exit__(self, exc_type, exc, traceback):
+        self._armed = False
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, self._previous_handler)
+        elapsed_s = time.perf_counter() - self.start
+        delay, interval = self._previous_timer
+        if delay:
+            #A timer that came due while parsing fires right away
+            signal.setitimer(signal.ITIMER_REAL, max(delay - elapsed_s, 1e-6), interval)
+
+        if self.fired:
+            raise ParseBudgetExceeded(self.budget_s, elapsed_s) from None
+        return False
+
+def _signal_budget_usable(budget_s):
+    #Only the main thread gets signals, and a host timer due before the budget runs out must not be held back
+    if threading.current_thread() is not threading.main_thread() or not hasattr(signal, "setitimer"):
+        return False
+    delay, _ = signal.getitimer(signal.ITIMER_REAL)
+    return not delay or delay > budget_s
+
+def _sandbox_main(conn):
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+        parser, args, kwargs = task
+        try:
+            reply = ("ok", parser(*args, **kwargs))
+        except Exception as e:
+            reply = ("error", e)
+        try:
+            conn.send(reply)
+        except Exception as e: #an unpicklable result or exception
+            conn.send(("error", RuntimeError(f"{type(e).__name__}: {e}")))
+
+class ParseSandbox():
+    ''' A child process that parses on behalf of
+        one thread, so a parse can be stopped
+        however it is stuck: when it overruns its
+        budget the child is killed (and a new one
+        started for the next parse). Costs one
+        round trip of the raw text and the result
+        per parse.
+    '''
+
+    def __init__(self):
+
+        self._process = None
+        self._conn = None
+
+    def _start(self):
+        import multiprocessing
+
+        self._conn, child_conn = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(target=_sandbox_main, args=(child_conn,), daemon=True)
+        self._process.start()
+        child_conn.close()
+
+    def run(self, budget_s, parser, *args, **kwargs):
+        if self._process is None or not self._process.is_alive():
+            self.close()
+            self._start()
+
+        start = time.perf_counter()
+        self._conn.send((parser, args, kwargs))
+        if not self._conn.poll(budget_s):
+            self.kill()
+            raise ParseBudgetExceeded(budget_s, time.perf_counter() - start)
+        try:
+            status, value = self._conn.recv()
+        except EOFError: #the child died mid-parse
+            self.kill()
+            raise RuntimeError("parse sandbox exited unexpectedly")
+        if status == "error":
+            raise value
+        return value
+
+    def kill(self):
+        if self._process is not None:
+            self._process.kill()
+            self._process.join()
+        self._process = None
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def close(self):
+        if self._process is not None and self._process.is_alive():
+            try:
+                self._conn.send(None)
+                self._process.join(1)
+            except OSError:
+                pass
+        self.kill()
+
+_sandboxes = threading.local()
+
+def close_sandbox():
+    '''Stops the calling thread's ParseSandbox, if
+       it has one. Threads that parse under a budget
+       call this when they are done.
+    '''
+    sandbox = getattr(_sandboxes, "sandbox", None)
+    if sandbox is not None:
+        sandbox.close()
+        _sandboxes.sandbox = None
+
+def parse_with_budget(parser, raw_text, year, month, **kwargs):
+    '''parser(raw_text, year, month, **kwargs), given
+       kwargs["budget_s"] seconds (0 or None: no
+       limit) before ParseBudgetExceeded is raised.
+
+       In the main thread the parse runs in process
+       under a SIGALRM timer; elsewhere (or if the
+       host has a timer of its own due first) it runs
+       in the thread's ParseSandbox process, which is
+       killed on overrun. Either way a parse stuck
+       inside one regex search is stopped.
+    '''
+    budget_s = kwargs.pop("budget_s", DEF_PARSE_BUDGET_S)
+    if not budget_s:
+        return parser(raw_text, year, month, **kwargs)
+    if _signal_budget_usable(budget_s):
+        with _SignalBudget(budget_s):
+            return parser(raw_text, year, month, **kwargs)
+
+    sandbox = getattr(_sandboxes, "sandbox", None)
+    if sandbox is None:
+        sandbox = _sandboxes.sandbox = ParseSandbox()
+    return sandbox.run(budget_s, parser, raw_text, year, month, **kwargs)
+
+class BudgetedParser():
+    ''' A parser (raw_text, year, month, **kwargs)
+        wrapped to run under a parse budget. Module
+        level and plain, so it pickles as long as
+        the wrapped parser does, e.g. for
+        Pipeline(parse_processes=...).
+    '''
+
+    def __init__(self, parser, budget_s=DEF_PARSE_BUDGET_S):
+
+        self.parser = parser
+        self.budget_s = budget_s
+
+    def __call__(self, raw_text, year, month, **kwargs):
+        return parse_with_budget(self.parser, raw_text, year, month, budget_s=self.budget_s, **kwargs)
+
+###Quarantine
+
+def quarantine_path(save_dir, date_str):
+    return os.path.join(save_dir, f"Quarantine_{date_str}.ndjson")
+
+def quarantine_record(raw_text, error, **kwargs):
+    '''The record kept for a bulletin that raised
+       error, a ParseBudgetExceeded.
+    '''
+    return {
+        "product_id" : kwargs.get("product_id"),
+        "pil" : kwargs.get("pil"),
+        "budget_s" : error.budget_s,
+        "elapsed_s" : round(error.elapsed_s, 3) if error.elapsed_s is not None else None,
+        "quarantined_at" : datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "raw_text" : raw_text,
+    }
+
+class Quarantine():
+    ''' Bulletins that ran over their parse budget,
+        appended with their raw text, one JSON
+        object per line, to path (created on the
+        first one) for later review with
+        review_quarantine(). Thread safe. With
+        path=None they are only kept in records.
+    '''
+
+    def __init__(self, path=None):
+
+        self.path = path
+        self.records = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.records)
+
+    def add(self, raw_text, error, **kwargs):
+        return self.append(quarantine_record(raw_text, error, **kwargs))
+
+    def append(self, record):
+        with self._lock:
+            self.records.append(record)
+            if self.path:
+                with open(self.path, "a") as file:
+                    file.write(json.dumps(record) + "\n")
+        return record
+
+    def summary(self):
+        '''The records without their raw text.'''
+        with self._lock:
+            return [{key : value for key, value in record.items() if key != "raw_text"} for record in self.records]
+
+def load_quarantine(path):
+    with open(path) as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+def review_quarantine(path, **kwargs):
+    '''Parses every quarantined bulletin again with
+       its route's parser, under kwargs["budget_s"]
+       (none by default), and yields (record,
+       elapsed_s, result or the exception), e.g. to
+       check a parser fix against them.
+    '''
+
+    import router
+
+    budget_s = kwargs.get("budget_s")
+    for record in load_quarantine(path):
+        product_id = record.get("product_id") or ""
+        year, month = (int(product_id[0:4]), int(product_id[4:6])) if product_id[:6].isdigit() else (kwargs.get("year"), kwargs.get("month"))
+        start = time.perf_counter()
+        try:
+            result = parse_with_budget(router.parse_product, record["raw_text"], year, month, budget_s=budget_s, pil=record.get("pil") or "WA")
+        except Exception as e:
+            result = e
+        yield record, time.perf_counter() - start, result
+
+if __name__ == "__main__":
+
+    budget_s = float(sys.argv[2]) if len(sys.argv) > 2 else None
+    for record, elapsed_s, result in review_quarantine(sys.argv[1], budget_s=budget_s):
+        status = f"FAILED ({result})" if isinstance(result, Exception) else "ok"
+        print(f"{record['product_id']} {record['pil']}: quarantined after {record['elapsed_s']}s, reparsed in {elapsed_s:.2f}s {status}")
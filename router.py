@@ -0,0 +1,190 @@
+import sys
+import os
+from datetime import datetime
+
+import airmet
+import pipeline
+import quarantine
+
+###Routes
+#Every product in the KKCI listing is routed by its pil to the
+#registered route with the longest matching prefix, so "WST" (convective
+#SIGMETs) wins over "WS" (SIGMETs). Each route has its own parser and
+#its own pair of daily output files.
+
+class Route():
+    ''' One KKCI product family: the pil prefix
+        it's listed under, the parser for its raw
+        text (called as parser(raw_text, year,
+        month)) and the stems of its daily raw text
+        and JSON files.
+    '''
+
+    def __init__(self, name, pil_prefix, parser, raw_stem, json_stem):
+
+        self.name = name
+        self.pil_prefix = pil_prefix
+        self.parser = parser
+        self.raw_stem = raw_stem
+        self.json_stem = json_stem
+
+    def raw_path(self, save_dir, date_str):
+        return os.path.join(save_dir, f"{self.raw_stem}_{date_str}.txt")
+
+    def json_path(self, save_dir, date_str):
+        return os.path.join(save_dir, f"{self.json_stem}_{date_str}.json")
+
+_routes = {} #pil prefix -> Route
+
+def register(name, pil_prefix, parser, raw_stem, json_stem):
+    '''Registers (or replaces) the route for a pil
+       prefix. Parsers run in parse_processes must be
+       registered at import time of a module the worker
+       processes import as well.
+    '''
+    _routes[pil_prefix] = Route(name, pil_prefix, parser, raw_stem, json_stem)
+    return _routes[pil_prefix]
+
+def routes(names=None):
+    '''Registered routes, optionally only those in names.'''
+    return [route for route in _routes.values() if names is None or route.name in names]
+
+def route_for(pil):
+    '''The registered route with the longest prefix
+       of pil, or None.
+    '''
+    best = None
+    for route in _routes.values():
+        if pil.startswith(route.pil_prefix) and (best is None or len(route.pil_prefix) > len(best.pil_prefix)):
+            best = route
+    return best
+
+def parse_product(raw_text, year, month, **kwargs):
+    '''Parses a product with its route's parser,
+       picked by kwargs["pil"]. Module level so it can
+       be handed to Pipeline(parser=...) and pickled.
+    '''
+    route = route_for(kwargs.get("pil") or "")
+    if route is None:
+        raise KeyError(f"No parser registered for pil '{kwargs.get('pil')}'")
+    return route.parser(raw_text, year, month)
+
+def _parse_sigmet(raw_text, year, month, **kwargs):
+    import sigmet
+
+    return sigmet.parse_sigmet(raw_text, year, month, **kwargs)
+
+def _parse_convective_sigmet(raw_text, year, month, **kwargs):
+    import sigmet
+
+    return sigmet.parse_convective_sigmet(raw_text, year, month, **kwargs)
+
+register("airmet", "WA", airmet.parse_airmet, "AllAIRMET_RawText", "AllAIRMETS")
+register("sigmet", "WS", _parse_sigmet, "AllSIGMET_RawText", "AllSIGMETS")
+register("convective_sigmet", "WST", _parse_convective_sigmet, "AllConvectiveSIGMET_RawText", "AllConvectiveSIGMETS")
+
+###Source and sink
+
+class RoutedSource():
+    ''' Wraps a pipeline source, keeping only the
+        units whose route is one of names (every
+        routed unit by default).
+    '''
+
+    def __init__(self, source, **kwargs):
+        self.source = source
+        self.names = kwargs.get("names")
+
+    def list_units(self):
+        units = []
+        for unit in self.source.list_units():
+            route = route_for(unit.get("pil") or "")
+            if route is not None and (self.names is None or route.name in self.names):
+                units.append(unit)
+        return units
+
+    def fetch(self, unit):
+        return self.source.fetch(unit)
+
+class RoutedSink():
+    ''' Fans items out to per-route sinks, by
+        the pil of the item's unit. Items of a
+        route without sinks are dropped.
+    '''
+
+    def __init__(self, sinks_by_route, **kwargs):
+        self.sinks_by_route = sinks_by_route #route name -> [sink, ...]
+
+    def open(self):
+        for sinks in self.sinks_by_route.values():
+            for sink in sinks:
+                sink.open()
+
+    def write(self, item):
+        route = route_for(item["unit"].get("pil") or "")
+        for sink in self.sinks_by_route.get(route.name if route else None, []):
+            sink.write(item)
+
+    def close(self):
+        for sinks in self.sinks_by_route.values():
+            for sink in sinks:
+                sink.close()
+
+    def abort(self):
+        for sinks in self.sinks_by_route.values():
+            for sink in sinks:
+                pipeline.abort_sink(sink)
+
+def download_all(save_dir, year, month, day, **kwargs):
+    '''One pass over a day's KKCI listing for every
+       routed product family (or only the route names
+       in kwargs["routes"]): the listing is fetched once,
+       every product goes through the same fetch workers
+       and HTTP sessions, and is parsed and written to
+       its family's raw text and JSON files (AIRMETs to
+       the same files as airmet.download()).
+
+       Returns (status, elapsed_s, {route name : JSON
+       path}) on success, (0, elapsed_s, errors) if any
+       product failed. Pipeline kwargs (fetchers,
+       parsers, cache_dir, parse_budget, ...) are
+       passed through. Products over the parse budget
+       go to Quarantine_*.ndjson in save_dir. On any
+       error every route's files are discarded.
+    '''
+
+    start_time = datetime.now()
+
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+
+    date_str = f"{str(year).zfill(4)}{str(month).zfill(2)}{str(day).zfill(2)}"
+    names = kwargs.pop("routes", None)
+    selected = routes(names)
+
+    source = kwargs.pop("source", None) or pipeline.NetworkSource(year, month, day, base_url=kwargs.get("base_url", airmet.DEF_IEM_BASE_URL),
+                                                                  cache_dir=kwargs.get("cache_dir"), pil_prefix=tuple(route.pil_prefix for route in selected),
+                                                                  **airmet.http_kwargs(kwargs))
+    kwargs.setdefault("quarantine_path", quarantine.quarantine_path(save_dir, date_str))
+    compression = kwargs.get("compression")
+    pretty = airmet.str_to_bool(kwargs.get("pretty"))
+
+    json_sinks = {route.name : pipeline.JSONSink(route.json_path(save_dir, date_str), compression=compression, pretty=pretty) for route in selected}
+    sinks_by_route = {route.name : [pipeline.RawTextSink(route.raw_path(save_dir, date_str), compression=compression), json_sinks[route.name]]
+                      for route in selected}
+
+    kwargs.setdefault("abort_on_error", True)
+    run = pipeline.Pipeline(RoutedSource(source, names=names), [RoutedSink(sinks_by_route)], parser=parse_product, **kwargs)
+    stats = run.run()
+
+    elapsed_time = datetime.now() - start_time
+    if stats["errors"]:
+        return 0, elapsed_time.total_seconds(), stats["errors"]
+    return 1, elapsed_time.total_seconds(), {name : sink.path for name, sink in json_sinks.items()}
+
+if __name__ == "__main__":
+
+    year, month, day = int(sys.argv[1]), int(sys.argv[2]), int(sys.argv[3])
+    save_dir = sys.argv[4] if len(sys.argv) > 4 else os.getcwd()
+
+    print(download_all(save_dir, year, month, day, verbose=True))
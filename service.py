@@ -0,0 +1,679 @@
+import sys
+import os
+import re
+import math
+import time
+import json
+import random
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, urlencode
+
+import numpy as np
+
+import airmet
+import archive
+import geometry
+from subclasses import states_mask_column, filter_any_of, decode_conditions, altitude_band_column
+
+DEF_SERVICE_PORT = 8765
+
+DEF_CACHE_SIZE = 1024
+
+DEF_CACHE_TTL_S = 60
+
+DEF_RELOAD_INTERVAL_S = 30
+
+DEF_GRID_DEG = 1.0
+
+DEF_RESULT_LIMIT = 500
+
+DEF_DAILY_FILE_RE = re.compile(r"^AllAIRMETS_(\d{8})\.json(\.gz|\.zst)?$")
+
+DEF_EPOCH = datetime(1970, 1, 1)
+
+#On-disk index directories (see chunked.build_index) are recognised by this file
+DEF_INDEX_META_FILE = "index.json"
+
+DEF_INDEX_VERSION = 2
+
+#Grid cells are stored as single int64 keys, (lat_cell + offset) * stride + (lon_cell + offset)
+DEF_CELL_KEY_OFFSET = 1 << 20
+
+DEF_CELL_KEY_STRIDE = 1 << 21
+
+class LRUCache():
+    ''' Thread safe LRU cache whose entries also
+        expire ttl seconds after being stored.
+        Used for encoded query responses.
+    '''
+
+    def __init__(self, **kwargs):
+
+        self.maxsize = kwargs.get("maxsize", DEF_CACHE_SIZE)
+        self.ttl = kwargs.get("ttl", DEF_CACHE_TTL_S)
+        self._now = kwargs.get("now", time.monotonic)
+        self._entries = OrderedDict() #key -> (expires, value)
+        self._lock = threading.Lock()
+        self.stats = {"hits" : 0, "misses" : 0, "evictions" : 0, "expirations" : 0}
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            if entry[0] <= self._now():
+                del self._entries[key]
+                self.stats["expirations"] += 1
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (self._now() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+def _minutes(dt):
+    return int((dt - DEF_EPOCH).total_seconds() // 60)
+
+def load_entries(path, **kwargs):
+    '''Flattens one daily file into subgroup entries,
+       the unit the service indexes and returns.
+    '''
+
+    entries = []
+
+    with archive.AirmetArchive(path) as airmets:
+        for record, airmet_dict in zip(airmets.records(), airmets):
+            if "iss_day" not in airmet_dict:
+                continue
+            iss_time, valid_time = airmet.airmet_times(airmet_dict)
+            for group in airmet_dict.get("subgroups") or []:
+                if not group.get("vors"):
+                    continue
+                qualifiers = group.get("qualifiers") or []
+                entries.append({
+                    "product_id" : record[2],
+                    "airmet_id" : airmet_dict["airmet_id"],
+                    "airmet_type" : airmet_dict.get("airmet_type"),
+                    "iss_time" : iss_time.strftime("%Y-%m-%dT%H:%MZ"),
+                    "valid_time" : valid_time.strftime("%Y-%m-%dT%H:%MZ"),
+                    "outlook" : any(qual.startswith("OTLK") for qual in qualifiers),
+                    "qualifiers" : qualifiers,
+                    "states" : group.get("states") or [],
+                    "vors" : group["vors"],
+                    "desc" : group.get("desc", ""),
+                    "conditions" : group.get("conditions") or decode_conditions(qualifiers, group.get("desc", "")),
+                    "polygon" : geometry.subgroup_polygon(group["vors"]),
+                    "_iss" : _minutes(iss_time),
+                    "_valid" : _minutes(valid_time),
+                })
+    return entries
+
+class AirmetIndex():
+    ''' Immutable in-memory index over subgroup
+        entries. Entries are kept sorted by
+        issuance time, so time queries binary
+        search the issuance column for both ends:
+        nothing issued after end, nor more than the
+        longest validity span (max_span) before
+        start, can overlap them. Polygons are
+        bucketed into a DEF_GRID_DEG lat/lon grid
+        by bounding box; points are then checked
+        against the polygon itself, bboxes against
+        the polygon's bounding box.
+    '''
+
+    def __init__(self, entries, **kwargs):
+
+        self.grid_deg = kwargs.get("grid_deg", DEF_GRID_DEG)
+        self.entries = sorted(entries, key=lambda entry: entry["_iss"])
+
+        num_entries = len(self.entries)
+        self.iss = np.fromiter((entry["_iss"] for entry in self.entries), dtype=np.int64, count=num_entries)
+        self.valid = np.fromiter((entry["_valid"] for entry in self.entries), dtype=np.int64, count=num_entries)
+        self.outlook = np.fromiter((entry["outlook"] for entry in self.entries), dtype=bool, count=num_entries)
+        self.masks = states_mask_column([entry["states"] for entry in self.entries])
+        self.alt = altitude_band_column([entry.get("conditions") for entry in self.entries]) #low_ft, high_ft
+        self.max_span = int((self.valid - self.iss).max()) if num_entries else 0 #minutes
+
+        self.bbox = np.full((num_entries, 4), np.nan) #min_lat, min_lon, max_lat, max_lon
+        cells = {}
+        for idx, entry in enumerate(self.entries):
+            if entry["polygon"] is None:
+                continue
+            lats = [lat for lat, _ in entry["polygon"]]
+            lons = [lon for _, lon in entry["polygon"]]
+            self.bbox[idx] = (min(lats), min(lons), max(lats), max(lons))
+            for cell in self._cells(*self.bbox[idx]):
+                cells.setdefault(cell, []).append(idx)
+        self.grid = {cell : np.array(ids, dtype=np.int64) for cell, ids in cells.items()}
+
+    def _cells(self, min_lat, min_lon, max_lat, max_lon):
+        for lat_cell in range(math.floor(min_lat / self.grid_deg), math.floor(max_lat / self.grid_deg) + 1):
+            for lon_cell in range(math.floor(min_lon / self.grid_deg), math.floor(max_lon / self.grid_deg) + 1):
+                yield (lat_cell, lon_cell)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _grid_ids(self, cell):
+        return self.grid.get(cell, np.empty(0, dtype=np.int64))
+
+    def _entry(self, idx):
+        return self.entries[idx]
+
+    def query(self, **kwargs):
+        '''Returns the matching entries, oldest issuance first:
+
+           - point: (lat, lon) inside the subgroup polygon
+           - bbox: (min_lat, min_lon, max_lat, max_lon) overlapping
+             the polygon's bounding box
+           - at: datetime the AIRMET is valid at
+           - start/end: datetimes the validity overlaps
+           - states: any-of list of state codes
+           - hazard: decoded hazard code (e.g. "ICE"), or a
+             substring of a subgroup qualifier
+           - altitude: feet, or a (low_ft, high_ft) range,
+             overlapping the decoded altitude band
+           - outlooks: include outlook subgroups (default False)
+        '''
+
+        point = kwargs.get("point")
+        bbox = kwargs.get("bbox")
+        start = kwargs.get("start") or kwargs.get("at")
+        end = kwargs.get("end") or kwargs.get("at")
+        states = kwargs.get("states")
+        hazard = kwargs.get("hazard")
+        altitude = kwargs.get("altitude")
+        limit = kwargs.get("limit", DEF_RESULT_LIMIT)
+
+        ids = None
+        if point is not None:
+            cell = (math.floor(point[0] / self.grid_deg), math.floor(point[1] / self.grid_deg))
+            ids = self._grid_ids(cell)
+        elif bbox is not None:
+            cell_ids = [ids for ids in (self._grid_ids(cell) for cell in self._cells(*bbox)) if len(ids)]
+            ids = np.unique(np.concatenate(cell_ids)) if cell_ids else np.empty(0, dtype=np.int64)
+
+        first_id, num_issued = 0, len(self)
+        if end is not None:
+            num_issued = int(np.searchsorted(self.iss, _minutes(end), side="right"))
+        if start is not None:
+            first_id = int(np.searchsorted(self.iss, _minutes(start) - self.max_span, side="left"))
+        ids = np.arange(first_id, num_issued) if ids is None else ids[(ids >= first_id) & (ids < num_issued)]
+        if start is not None:
+            ids = ids[self.valid[ids] >= _minutes(start)]
+
+        if not kwargs.get("outlooks"):
+            ids = ids[~self.outlook[ids]]
+        if states:
+            ids = ids[filter_any_of(self.masks[ids], states)]
+        if altitude is not None:
+            low_ft, high_ft = altitude if isinstance(altitude, (list, tuple)) else (altitude, altitude)
+            bands = self.alt[ids]
+            ids = ids[(bands[:, 0] <= high_ft) & (bands[:, 1] >= low_ft)]
+        if bbox is not None:
+            boxes = self.bbox[ids]
+            ids = ids[(boxes[:, 0] <= bbox[2]) & (boxes[:, 2] >= bbox[0]) & (boxes[:, 1] <= bbox[3]) & (boxes[:, 3] >= bbox[1])]
+
+        results = []
+        for idx in ids:
+            entry = self._entry(idx)
+            if hazard and (entry.get("conditions") or {}).get("hazard") != hazard and not any(qual.find(hazard) != -1 for qual in entry["qualifiers"]):
+                continue
+            if point is not None and not geometry.point_in_polygon(point[0], point[1], entry["polygon"]):
+                continue
+            results.append(entry)
+            if len(results) >= limit:
+                break
+        return results
+
+def cell_key(cell):
+    return (cell[0] + DEF_CELL_KEY_OFFSET) * DEF_CELL_KEY_STRIDE + (cell[1] + DEF_CELL_KEY_OFFSET)
+
+class MappedAirmetIndex(AirmetIndex):
+    ''' The same queries as AirmetIndex, over an
+        index directory written by chunked.build_index.
+        Columns and grid are memory mapped and entries
+        are read from entries.ndjson on demand, so a
+        multi-year index costs little resident memory.
+    '''
+
+    def __init__(self, index_dir, **kwargs):
+
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, DEF_INDEX_META_FILE)) as file:
+            self.meta = json.load(file)
+        if self.meta.get("version") != DEF_INDEX_VERSION:
+            raise ValueError(f"Unsupported index version {self.meta.get('version')} in {index_dir}")
+
+        self.grid_deg = self.meta["grid_deg"]
+        load = lambda name: np.load(os.path.join(index_dir, name + ".npy"), mmap_mode="r")
+        self.iss, self.valid, self.outlook, self.masks, self.bbox, self.alt = (load(name) for name in ("iss", "valid", "outlook", "masks", "bbox", "alt"))
+        self.offsets = load("offsets")
+        self.max_span = self.meta.get("max_span")
+        if self.max_span is None: #built before max_span was recorded
+            self.max_span = int(np.max(self.valid - self.iss)) if len(self.iss) else 0
+        self.cell_keys, self.cell_starts, self.cell_ids = load("cell_keys"), load("cell_starts"), load("cell_ids")
+        self._fd = os.open(os.path.join(index_dir, "entries.ndjson"), os.O_RDONLY)
+
+    def __len__(self):
+        return len(self.iss)
+
+    def _grid_ids(self, cell):
+        key = cell_key(cell)
+        pos = int(np.searchsorted(self.cell_keys, key))
+        if pos >= len(self.cell_keys) or self.cell_keys[pos] != key:
+            return np.empty(0, dtype=np.int64)
+        return np.asarray(self.cell_ids[self.cell_starts[pos]:self.cell_starts[pos + 1]])
+
+    def _entry(self, idx):
+        #pread, so concurrent request threads don't share a file position
+        start, end = int(self.offsets[idx]), int(self.offsets[idx + 1])
+        return json.loads(os.pread(self._fd, end - start, start))
+
+    def close(self):
+        os.close(self._fd)
+
+class MappedAirmetStore():
+    ''' AirmetStore stand-in for a prebuilt index
+        directory. The index is static, refresh()
+        never changes it.
+    '''
+
+    def __init__(self, index_dir, **kwargs):
+
+        self.index = MappedAirmetIndex(index_dir)
+        self.generation = 1
+
+    def refresh(self):
+        return False
+
+    @property
+    def num_files(self):
+        return self.index.meta.get("files", 0)
+
+class AirmetStore():
+    ''' Keeps an AirmetIndex over every daily
+        AllAIRMETS_YYYYMMDD.json(.gz/.zst) file in
+        data_dir. refresh() only re-reads files
+        whose size or mtime changed, then swaps in
+        a new index and bumps generation; readers
+        always see one complete index.
+    '''
+
+    def __init__(self, data_dir, **kwargs):
+
+        self.data_dir = data_dir
+        self.verbose = airmet.str_to_bool(kwargs.get("verbose"))
+        self.generation = 0
+        self.index = AirmetIndex([])
+        self._files = {} #path -> (mtime_ns, size, entries)
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        '''Returns True if the index changed.'''
+
+        with self._lock:
+            changed = False
+            paths = set()
+            for file_name in sorted(os.listdir(self.data_dir)):
+                if not DEF_DAILY_FILE_RE.match(file_name):
+                    continue
+                path = os.path.join(self.data_dir, file_name)
+                paths.add(path)
+                stat = os.stat(path)
+                known = self._files.get(path)
+                if known and known[0] == stat.st_mtime_ns and known[1] == stat.st_size:
+                    continue
+                try:
+                    entries = load_entries(path)
+                except (ValueError, OSError) as e:
+                    if self.verbose:
+                        print(f"SERVICE: Could not load {path}: {e}")
+                    continue
+                self._files[path] = (stat.st_mtime_ns, stat.st_size, entries)
+                changed = True
+                if self.verbose:
+                    print(f"SERVICE: Loaded {len(entries)} subgroup(s) from {file_name}")
+
+            for path in list(self._files):
+                if path not in paths:
+                    del self._files[path]
+                    changed = True
+
+            if changed:
+                self.index = AirmetIndex([entry for _, _, entries in self._files.values() for entry in entries])
+                self.generation += 1
+            return changed
+
+    @property
+    def num_files(self):
+        return len(self._files)
+
+def parse_query(params):
+    '''Turns query string parameters (as from
+       parse_qs) into AirmetIndex.query kwargs.
+       Raises ValueError (or TypeError, for a lat
+       without a lon) on malformed input.
+    '''
+
+    def single(name):
+        values = params.get(name)
+        return values[-1] if values else None
+
+    query = {}
+    if single("lat") is not None or single("lon") is not None:
+        query["point"] = (float(single("lat")), float(single("lon")))
+    if single("bbox"):
+        min_lon, min_lat, max_lon, max_lat = (float(value) for value in single("bbox").split(","))
+        query["bbox"] = (min_lat, min_lon, max_lat, max_lon)
+    for name in ("at", "start", "end"):
+        if single(name):
+            query[name] = _parse_time(single(name))
+    if single("states"):
+        query["states"] = single("states").upper().split(",")
+    if single("hazard"):
+        query["hazard"] = single("hazard").upper()
+    if single("alt"):
+        altitude = [float(value) for value in single("alt").split(",")]
+        query["altitude"] = tuple(altitude) if len(altitude) == 2 else altitude[0]
+    if single("outlooks"):
+        query["outlooks"] = airmet.str_to_bool(single("outlooks"))
+    query["limit"] = int(single("limit") or DEF_RESULT_LIMIT)
+    return query
+
+def _parse_time(time_str):
+    for fmt in ("%Y-%m-%dT%H:%MZ", "%Y-%m-%dT%H:%M", "%Y%m%d%H%M"):
+        try:
+            return datetime.strptime(time_str, fmt)
+        except ValueError:
+            pass
+    raise ValueError(f"invalid time '{time_str}', expected YYYY-MM-DDTHH:MMZ")
+
+def _public(entry):
+    return {key : value for key, value in entry.items() if not key.startswith("_")}
+
+class AirmetQueryService():
+    ''' Local HTTP/JSON query service over a
+        directory of parsed daily files:
+
+        - /query?lat=&lon=  (or bbox=min_lon,min_lat,max_lon,max_lat)
+                 &at= (or start=&end=) &states=CA,NV &hazard=ICE
+                 &outlooks=1 &limit=
+        - /stats
+        - /health
+
+        Encoded responses are kept in an LRU cache
+        with a TTL, keyed on the index generation so
+        a reload never serves stale results. A
+        background thread re-scans data_dir every
+        reload_interval seconds, so new daily output
+        is picked up without a restart.
+
+        If data_dir is an index directory built by
+        chunked.build_index, that index is served
+        as is instead.
+    '''
+
+    def __init__(self, data_dir, **kwargs):
+
+        self.host = kwargs.get("host", "127.0.0.1")
+        self.port = kwargs.get("port", DEF_SERVICE_PORT)
+        self.reload_interval = kwargs.get("reload_interval", DEF_RELOAD_INTERVAL_S)
+        self.verbose = airmet.str_to_bool(kwargs.get("verbose"))
+
+        if os.path.exists(os.path.join(data_dir, DEF_INDEX_META_FILE)):
+            self.store = MappedAirmetStore(data_dir)
+        else:
+            self.store = AirmetStore(data_dir, verbose=self.verbose)
+        self.cache = LRUCache(maxsize=kwargs.get("cache_size", DEF_CACHE_SIZE), ttl=kwargs.get("cache_ttl", DEF_CACHE_TTL_S))
+        self.num_requests = 0
+
+        self._httpd = None
+        self._stop_event = threading.Event()
+        self._reload_thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self._httpd.server_address[1]}"
+
+    def start(self):
+        self.reload()
+        self._httpd = ThreadingHTTPServer((self.host, self.port), _make_handler(self))
+        self._httpd.daemon_threads = True
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        if self.reload_interval:
+            self._stop_event.clear()
+            self._reload_thread = threading.Thread(target=self._reload_loop, daemon=True)
+            self._reload_thread.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def reload(self):
+        if self.store.refresh():
+            self.cache.clear()
+            return True
+        return False
+
+    def _reload_loop(self):
+        while not self._stop_event.wait(self.reload_interval):
+            try:
+                self.reload()
+            except Exception as e:
+                if self.verbose:
+                    print(f"SERVICE: Reload failed: {e}")
+
+    def query(self, query_string):
+        '''Answers a /query request. Returns (status, body).'''
+
+        with self._lock:
+            self.num_requests += 1
+
+        params = parse_qs(query_string)
+        key = (self.store.generation, urlencode(sorted(params.items()), doseq=True))
+        body = self.cache.get(key)
+        if body is not None:
+            return 200, body
+
+        try:
+            query = parse_query(params)
+        except (ValueError, TypeError) as e:
+            return 400, json.dumps({"error" : str(e)}).encode()
+
+        index = self.store.index
+        results = index.query(**query)
+        body = json.dumps({"count" : len(results), "generation" : key[0], "results" : [_public(entry) for entry in results]},
+                          separators=archive.DEF_COMPACT_SEPARATORS).encode()
+        self.cache.put(key, body)
+        return 200, body
+
+    def stats(self):
+        return {"requests" : self.num_requests, "generation" : self.store.generation, "files" : self.store.num_files,
+                "entries" : len(self.store.index), "cache_size" : len(self.cache), "cache" : dict(self.cache.stats)}
+
+def _make_handler(service):
+
+    class QueryHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            parsed = urlparse(self.path)
+
+            if parsed.path == "/query":
+                status, body = service.query(parsed.query)
+                self._send(status, body)
+            elif parsed.path == "/stats":
+                self._send(200, json.dumps(service.stats()).encode())
+            elif parsed.path == "/health":
+                self._send(200, json.dumps({"status" : "ok", "generation" : service.store.generation}).encode())
+            else:
+                self._send(404, json.dumps({"error" : "not found"}).encode())
+
+        def _send(self, status, body):
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            try:
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+        def log_message(self, format, *args):
+            pass
+
+    return QueryHandler
+
+###Load testing
+
+def sample_queries(index, num_queries, **kwargs):
+    '''Draws query strings that hit real data: points
+       inside indexed polygons at times they were valid,
+       mixed with state, hazard and bbox queries. Works
+       on an AirmetIndex or a MappedAirmetIndex, only
+       reading the entries it draws.
+    '''
+
+    rng = random.Random(kwargs.get("seed", 0))
+    candidates = np.flatnonzero(~np.asarray(index.outlook) & ~np.isnan(np.asarray(index.bbox)[:, 0]))
+    if not len(candidates):
+        raise ValueError("No resolvable AIRMETs indexed, nothing to query")
+
+    queries = []
+    for _ in range(num_queries):
+        idx = int(candidates[rng.randrange(len(candidates))])
+        entry = index._entry(idx)
+        at = DEF_EPOCH + timedelta(minutes=rng.randint(int(index.iss[idx]), int(index.valid[idx])))
+        params = {"at" : at.strftime("%Y-%m-%dT%H:%MZ")}
+        kind = rng.random()
+        if kind < 0.5:
+            lats = [lat for lat, _ in entry["polygon"]]
+            lons = [lon for _, lon in entry["polygon"]]
+            params["lat"], params["lon"] = f"{sum(lats) / len(lats):.2f}", f"{sum(lons) / len(lons):.2f}"
+        elif kind < 0.7 and entry["states"]:
+            params["states"] = rng.choice(entry["states"])
+        elif kind < 0.85 and entry["qualifiers"]:
+            params["hazard"] = entry["qualifiers"][0].split(" ")[-1]
+        else:
+            lat, lon = rng.choice(entry["polygon"])
+            params["bbox"] = f"{lon - 2:.1f},{lat - 2:.1f},{lon + 2:.1f},{lat + 2:.1f}"
+        queries.append(urlencode(params))
+    return queries
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, max(0, math.ceil(pct / 100 * len(sorted_values)) - 1))]
+
+def load_test(url, queries, **kwargs):
+    '''Replays queries (drawn with replacement, so
+       popular queries repeat as they would in
+       practice) from concurrency threads and
+       reports latency percentiles in ms.
+    '''
+
+    import urllib.request
+    import urllib.error
+    from concurrent.futures import ThreadPoolExecutor
+
+    num_requests = kwargs.get("num_requests", 1000)
+    concurrency = kwargs.get("concurrency", 8)
+    rng = random.Random(kwargs.get("seed", 0))
+    plan = [rng.choice(queries) for _ in range(num_requests)]
+
+    def timed_request(query_string):
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(f"{url}/query?{query_string}", timeout=30) as response:
+                response.read()
+                ok = response.status == 200
+        except (urllib.error.URLError, OSError):
+            ok = False
+        return (time.perf_counter() - start) * 1000, ok
+
+    with urllib.request.urlopen(f"{url}/stats") as response:
+        stats_before = json.load(response)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        timings = list(executor.map(timed_request, plan))
+    wall_s = time.perf_counter() - start
+
+    with urllib.request.urlopen(f"{url}/stats") as response:
+        stats_after = json.load(response)
+
+    latencies = sorted(latency for latency, _ in timings)
+    hits = stats_after["cache"]["hits"] - stats_before["cache"]["hits"]
+    return {
+        "requests" : num_requests,
+        "errors" : sum(1 for _, ok in timings if not ok),
+        "concurrency" : concurrency,
+        "wall_s" : wall_s,
+        "requests_per_s" : num_requests / wall_s if wall_s > 0 else 0,
+        "p50_ms" : _percentile(latencies, 50),
+        "p90_ms" : _percentile(latencies, 90),
+        "p99_ms" : _percentile(latencies, 99),
+        "max_ms" : latencies[-1] if latencies else 0,
+        "cache_hit_rate" : hits / num_requests if num_requests else 0,
+    }
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Local query service over parsed AllAIRMETS_*.json files.")
+    parser.add_argument("data_dir")
+    parser.add_argument("--port", type=int, default=DEF_SERVICE_PORT)
+    parser.add_argument("--cache-size", type=int, default=DEF_CACHE_SIZE)
+    parser.add_argument("--cache-ttl", type=float, default=DEF_CACHE_TTL_S)
+    parser.add_argument("--reload-interval", type=float, default=DEF_RELOAD_INTERVAL_S)
+    parser.add_argument("--load-test", type=int, metavar="N", help="serve on a free port, replay N sampled queries and print latency stats")
+    parser.add_argument("--distinct-queries", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    service = AirmetQueryService(args.data_dir, port=0 if args.load_test else args.port, cache_size=args.cache_size,
+                                 cache_ttl=args.cache_ttl, reload_interval=args.reload_interval, verbose=args.verbose)
+
+    with service:
+        if args.load_test:
+            queries = sample_queries(service.store.index, args.distinct_queries)
+            print(json.dumps(load_test(service.url, queries, num_requests=args.load_test, concurrency=args.concurrency), indent=2))
+            sys.exit(0)
+
+        print(f"Serving {service.store.num_files} file(s), {len(service.store.index)} subgroup(s) on {service.url}")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
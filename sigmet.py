@@ -0,0 +1,223 @@
+import sys
+import re
+from datetime import datetime, timedelta
+
+from subclasses import parse_vor_string, decode_conditions
+
+#Hazards a (non-convective) SIGMET can be issued for, as they appear in the description
+DEF_SIGMET_HAZARDS = ("SEV TURB", "SEV ICE", "DS", "SS", "VA")
+
+#A VOR list line that was wrapped mid-list: ends in "-", "TO" or a distance/direction offset ("100NNW")
+DEF_VOR_LINE_CONTINUES_RE = re.compile(r"(-|\bTO|\b\d+[A-Z]{1,3})$")
+
+DEF_STATES_LINE_RE = re.compile(r"^(([A-Z]{2}\s)*[A-Z]{2})?(\s?(AND\s)?CSTL\sWTRS)?$")
+
+def _body_lines(raw_text):
+    '''Returns (office line, lines after it) of a raw
+       KKCI product, skipping the AFOS/WMO preamble.
+    '''
+    lines = [line.strip() for line in raw_text.replace("\x01", "").split("\n")]
+    for idx, line in enumerate(lines):
+        if line.startswith("\x1e"):
+            return line[1:].strip(), [line for line in lines[idx + 1:] if line != "\x03"]
+    #No record separator, the office line is the one after the pil
+    lines = [line for line in lines if line]
+    return (lines[3] if len(lines) > 3 else ""), lines[4:]
+
+def _is_states_line(line):
+    return bool(line) and bool(DEF_STATES_LINE_RE.match(line))
+
+def _parse_states(line):
+    #Same output as airmet._pop_states, coastal waters as a single "CSTL WTRS" entry
+    states = line.replace("AND CSTL WTRS", "CSTL_WTRS").replace("CSTL WTRS", "CSTL_WTRS").split(" ")
+    return [state.replace("CSTL_WTRS", "CSTL WTRS") for state in states if state]
+
+def _split_area(lines):
+    '''Splits the lines of one area into (states, vors,
+       desc). The VOR block starts at the first line with
+       VORs and runs over wrapped continuation lines
+       (see DEF_VOR_LINE_CONTINUES_RE, or a next line
+       starting with "TO"/"-").
+    '''
+
+    states = []
+    if lines and _is_states_line(lines[0]):
+        states = _parse_states(lines[0])
+        lines = lines[1:]
+
+    vor_start = None
+    for idx, line in enumerate(lines):
+        if parse_vor_string(line):
+            vor_start = idx
+            break
+    if vor_start is None:
+        return states, [], " ".join(lines)
+
+    vor_end = vor_start + 1
+    while vor_end < len(lines) and (DEF_VOR_LINE_CONTINUES_RE.search(lines[vor_end - 1]) or lines[vor_end].startswith(("TO ", "-"))):
+        vor_end += 1
+
+    vor_text = " ".join(lines[vor_start:vor_end]).replace("- ", "-").replace(" -", "-")
+    desc = " ".join(lines[:vor_start] + lines[vor_end:])
+    return states, parse_vor_string(vor_text), desc
+
+def _time_fields(prefix, year, month, day, hour, minute):
+    return {
+        f"{prefix}_year" : year,
+        f"{prefix}_month" : month,
+        f"{prefix}_day" : day,
+        f"{prefix}_hour" : hour,
+        f"{prefix}_minute" : minute,
+        f"{prefix}_time_str" : f"{day:02d}{hour:02d}{minute:02d}",
+    }
+
+def _header_dict(office_line, year, month):
+    #e.g. "BOSN WS 131530" or "MKCC WST 131655", optionally followed by AMD/COR
+    parts = office_line.split(" ")
+    iss_time_str = next((part for part in parts if re.match(r"^\d{6}$", part)), "000000")
+    header_dict = {"iss_airport" : parts[0] if parts else ""}
+    header_dict.update(_time_fields("iss", year, month, int(iss_time_str[:2]), int(iss_time_str[2:4]), int(iss_time_str[4:6])))
+    return header_dict, "AMD" in parts or "COR" in parts
+
+def _valid_day(year, month, iss_day, iss_hhmm, valid_hhmm):
+    #Convective SIGMETs only carry HHMMZ, valid times before the issuance time are on the next day
+    if valid_hhmm >= iss_hhmm:
+        return iss_day
+    return (datetime(year, month, iss_day) + timedelta(days=1)).day
+
+def parse_sigmet(raw_text, year, month, **kwargs):
+    '''Parses the raw text of a single (non-convective)
+       SIGMET, e.g.
+
+       BOSN WS 131530
+       SIGMET NOVEMBER 1 VALID UNTIL 131930
+       ME NH VT
+       FROM 50N PQI TO 40ESE HUL TO 50N PQI
+       OCNL SEV TURB BTN FL280 AND FL380...
+
+       into the same layout as airmet.parse_airmet(),
+       with "sigmet_id"/"sigmet_type" in place of the
+       AIRMET fields and one subgroup for the area.
+       Cancellations have no subgroups and
+       "cancelled" set.
+    '''
+
+    office_line, lines = _body_lines(raw_text)
+    header_dict, amended = _header_dict(office_line, year, month)
+    lines = [line for line in lines if line]
+
+    sigmet_dict = {"sigmet_id" : None, "sigmet_type" : "SIGMET", "cancelled" : False}
+    sigmet_dict.update(header_dict)
+
+    title_idx = next((idx for idx, line in enumerate(lines) if re.search(r"SIGMET\s[A-Z]+\s\d+", line)), None)
+    if title_idx is None:
+        sigmet_dict.update({"raw_text" : raw_text.replace('\x01', '').replace('\x1e', ''), "subgroups" : [],
+                            "error" : "No SIGMET title line found."})
+        return sigmet_dict
+
+    title = lines[title_idx]
+    series_match = re.search(r"SIGMET\s([A-Z]+\s\d+)", title)
+    valid_match = re.search(r"VALID\sUNTIL\s(\d{6})", title)
+    sigmet_dict["sigmet_id"] = series_match.group(1) + (" AMD" if amended else "")
+    sigmet_dict["cancelled"] = title.startswith("CANCEL")
+
+    if valid_match:
+        valid_str = valid_match.group(1)
+        sigmet_dict.update(_time_fields("valid", year, month, int(valid_str[:2]), int(valid_str[2:4]), int(valid_str[4:6])))
+    else:
+        sigmet_dict.update(_time_fields("valid", year, month, sigmet_dict["iss_day"], sigmet_dict["iss_hour"], sigmet_dict["iss_minute"]))
+
+    subgroups = []
+    if not sigmet_dict["cancelled"]:
+        states, vors, desc = _split_area(lines[title_idx + 1:])
+        qualifiers = [f"SIGMET {series_match.group(1)}"]
+        subgroups.append({"qualifiers" : qualifiers, "vors" : vors, "states" : states, "desc" : desc,
+                          "conditions" : decode_conditions(qualifiers, desc)})
+        sigmet_dict["conditions"] = [hazard for hazard in DEF_SIGMET_HAZARDS if re.search(rf"\b{hazard}\b", desc)]
+    else:
+        sigmet_dict["conditions"] = []
+
+    sigmet_dict.update({"raw_text" : raw_text.replace('\x01', '').replace('\x1e', ''), "subgroups" : subgroups})
+    return sigmet_dict
+
+def _sections(lines, header_re):
+    #Splits lines at every line matching header_re, dropping anything before the first one
+    sections = []
+    for line in lines:
+        if re.match(header_re, line):
+            sections.append([line])
+        elif sections and line:
+            sections[-1].append(line)
+    return sections
+
+def parse_convective_sigmet(raw_text, year, month, **kwargs):
+    '''Parses the raw text of a convective SIGMET
+       bulletin (one region's WST issuance), e.g.
+
+       MKCC WST 131655
+       CONVECTIVE SIGMET 45C
+       VALID UNTIL 1855Z
+       TX OK
+       FROM 40NW SPS-30ESE SPS-40S SPS-40NW SPS
+       AREA TS MOV FROM 25025KT. TOPS TO FL450.
+       (more CONVECTIVE SIGMET sections)
+       OUTLOOK VALID 131855-132255
+       AREA 1...FROM 60NW ISN-INL-50SE DLH
+       ...
+
+       Each SIGMET and each outlook area becomes a
+       subgroup (qualifiers ["CONVECTIVE SIGMET 45C"]
+       or ["OUTLOOK VALID 131855-132255"]). A bulletin
+       reading CONVECTIVE SIGMET...NONE has none.
+    '''
+
+    office_line, lines = _body_lines(raw_text)
+    header_dict, amended = _header_dict(office_line, year, month)
+    pil = next((line for line in raw_text.replace("\x01", "").split("\n")[3:4]), "").strip()
+
+    sigmet_dict = {"sigmet_id" : (pil or office_line.split(" ")[0]) + (" AMD" if amended else ""), "sigmet_type" : "CONVECTIVE SIGMET",
+                   "conditions" : ["TS"]}
+    sigmet_dict.update(header_dict)
+    iss_hhmm = sigmet_dict["iss_time_str"][2:]
+
+    subgroups = []
+    valid_hhmm = None
+    for section in _sections(lines, r"^(CONVECTIVE SIGMET|OUTLOOK VALID)"):
+        title = section[0]
+        if title.startswith("OUTLOOK"):
+            areas = _sections(section[1:], r"^AREA\s\d") or [section[1:]]
+            for area in areas:
+                area_lines = [re.sub(r"^AREA\s\d+\.*", "", area[0]).strip()] + area[1:]
+                states, vors, desc = _split_area([line for line in area_lines if line])
+                subgroups.append({"qualifiers" : [title], "vors" : vors, "states" : states, "desc" : desc,
+                                  "conditions" : decode_conditions(["CONVECTIVE SIGMET"], desc)})
+            continue
+
+        if title.find("NONE") != -1:
+            continue
+        body = section[1:]
+        valid_match = re.match(r"VALID\sUNTIL\s(\d{4})Z", body[0]) if body else None
+        if valid_match:
+            body = body[1:]
+            valid_hhmm = valid_hhmm or valid_match.group(1)
+        states, vors, desc = _split_area(body)
+        subgroups.append({"qualifiers" : [title], "vors" : vors, "states" : states, "desc" : desc,
+                          "conditions" : decode_conditions([title], desc),
+                          "valid_until" : valid_match.group(1) + "Z" if valid_match else None})
+
+    valid_hhmm = valid_hhmm or iss_hhmm
+    valid_day = _valid_day(year, month, sigmet_dict["iss_day"], iss_hhmm, valid_hhmm)
+    sigmet_dict.update(_time_fields("valid", year, month, valid_day, int(valid_hhmm[:2]), int(valid_hhmm[2:])))
+
+    sigmet_dict.update({"raw_text" : raw_text.replace('\x01', '').replace('\x1e', ''), "subgroups" : subgroups})
+    return sigmet_dict
+
+if __name__ == "__main__":
+
+    import json
+    import archive
+
+    year, month = int(sys.argv[2][0:4]), int(sys.argv[2][4:6])
+    text = archive.read_text(sys.argv[1])
+    parser = parse_convective_sigmet if text.find("CONVECTIVE SIGMET") != -1 else parse_sigmet
+    print(json.dumps(parser(text, year, month), indent=2))
@@ -0,0 +1,287 @@
+import sys
+import os
+import time
+import json
+import random
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import airmet
+import archive
+
+class StandinIEMServer():
+    ''' A local stand-in for the IEM endpoints
+        used by airmet.download() and the watcher:
+
+        - /api/1/nws/afos/list.json?cccc=kkci&date=YYYY-MM-DD
+        - /api/1/nwstext/{product_id}
+
+        Serves a fixed corpus of products, each a
+        dict with "product_id", "pil" and "text",
+        and optionally "release_s", the number of
+        seconds after start() at which the product
+        starts being listed. This lets a test
+        release products over time. advance()
+        moves the server clock forward without
+        having to actually wait.
+
+        Network conditions and faults, all off by
+        default and drawn from a seeded RNG:
+
+        - latency_s: delay before every response,
+          a number or a (min, max) range
+        - bytes_per_s: throughput cap per response
+        - error_rate: fraction of requests answered
+          with a 500/502/503
+        - timeout_rate: fraction of requests that
+          stall for hang_s before answering
+        - truncate_rate: fraction of responses cut
+          off halfway through the body
+    '''
+
+    def __init__(self, products, **kwargs):
+
+        self.host = kwargs.get("host", "127.0.0.1")
+        self.port = kwargs.get("port", 0)
+        self.release_interval = kwargs.get("release_interval")
+
+        self.latency_s = kwargs.get("latency_s", 0)
+        self.bytes_per_s = kwargs.get("bytes_per_s")
+        self.error_rate = kwargs.get("error_rate", 0)
+        self.timeout_rate = kwargs.get("timeout_rate", 0)
+        self.truncate_rate = kwargs.get("truncate_rate", 0)
+        self.hang_s = kwargs.get("hang_s", 60)
+        self._random = random.Random(kwargs.get("seed", 0))
+
+        self.products = {}
+        for idx, prod in enumerate(products):
+            prod = dict(prod)
+            if "release_s" not in prod:
+                prod["release_s"] = idx * self.release_interval if self.release_interval else 0
+            self.products[prod["product_id"]] = prod
+
+        self.request_counts = {}
+        self.fault_counts = {"error" : 0, "timeout" : 0, "truncate" : 0}
+        self._offset_s = 0
+        self._start_time = None
+        self._httpd = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self._httpd.server_address[1]}"
+
+    def start(self):
+        self._httpd = ThreadingHTTPServer((self.host, self.port), _make_handler(self))
+        self._httpd.daemon_threads = True
+        self._start_time = time.monotonic()
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+    def advance(self, seconds):
+        with self._lock:
+            self._offset_s += seconds
+
+    def elapsed(self):
+        if self._start_time is None:
+            return 0
+        return time.monotonic() - self._start_time + self._offset_s
+
+    def released_products(self, date=None):
+        elapsed = self.elapsed()
+        date_prefix = date.replace("-", "") if date else ""
+        return [prod for prod in self.products.values()
+                if prod["release_s"] <= elapsed and prod["product_id"].startswith(date_prefix)]
+
+    def _count(self, endpoint):
+        with self._lock:
+            self.request_counts[endpoint] = self.request_counts.get(endpoint, 0) + 1
+
+    def _draw_fault(self):
+        '''Returns None or one of "error", "timeout",
+           "truncate" for the next request.
+        '''
+        with self._lock:
+            draw = self._random.random()
+            latency = self._random.uniform(*self.latency_s) if isinstance(self.latency_s, (tuple, list)) else self.latency_s
+        fault = None
+        if draw < self.error_rate:
+            fault = "error"
+        elif draw < self.error_rate + self.timeout_rate:
+            fault = "timeout"
+        elif draw < self.error_rate + self.timeout_rate + self.truncate_rate:
+            fault = "truncate"
+        if fault:
+            with self._lock:
+                self.fault_counts[fault] += 1
+        return fault, latency
+
+    @classmethod
+    def from_raw_text_files(cls, raw_text_paths, **kwargs):
+        '''Serves recorded AllAIRMET_RawText_YYYYMMDD.txt files.'''
+        products = []
+        for raw_path in raw_text_paths:
+            date = os.path.basename(raw_path).split("_")[-1][:8]
+            products += airmet.split_raw_products(archive.read_text(raw_path), date)
+        return cls(products, **kwargs)
+
+    @classmethod
+    def from_synthetic(cls, start_date, num_days, **kwargs):
+        '''Serves a synthetic.SyntheticCorpus.'''
+        import synthetic
+
+        generator = synthetic.SyntheticCorpus(seed=kwargs.get("seed", 0))
+        products = []
+        for _, day_products in generator.corpus(start_date, num_days, num_extra=kwargs.get("num_extra", 0),
+                                                     sigmets=kwargs.get("sigmets", False)):
+            products += day_products
+        return cls(products, **kwargs)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+def _make_handler(server):
+
+    class StandinHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            parsed = urlparse(self.path)
+
+            if parsed.path == "/api/1/nws/afos/list.json":
+                server._count("list")
+                query = parse_qs(parsed.query)
+                date = query.get("date", [None])[0]
+                data = [{"product_id" : prod["product_id"],
+                         "pil" : prod["pil"],
+                         "cccc" : "KKCI",
+                         "entered" : _product_id_to_entered(prod["product_id"])}
+                        for prod in server.released_products(date)]
+                self._send(200, json.dumps({"data" : data}).encode(), "application/json")
+
+            elif parsed.path.startswith("/api/1/nwstext/"):
+                server._count("nwstext")
+                product_id = parsed.path[len("/api/1/nwstext/"):]
+                prod = server.products.get(product_id)
+                if prod is None or prod["release_s"] > server.elapsed():
+                    self._send(404, b"Not Found", "text/plain", faults=False)
+                else:
+                    self._send(200, prod["text"].encode(), "text/plain")
+
+            else:
+                self._send(404, b"Not Found", "text/plain", faults=False)
+
+        def _send(self, status, body, content_type, faults=True):
+            fault, latency = server._draw_fault() if faults else (None, 0)
+
+            if latency:
+                time.sleep(latency)
+
+            if fault == "timeout":
+                time.sleep(server.hang_s)
+            elif fault == "error":
+                status = server._random.choice((500, 502, 503))
+                body = b"Internal Server Error"
+
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+
+            if fault == "truncate":
+                body = body[:len(body) // 2]
+                self.close_connection = True
+
+            try:
+                if server.bytes_per_s:
+                    chunk_size = max(1, int(server.bytes_per_s / 20))
+                    for idx in range(0, len(body), chunk_size):
+                        self.wfile.write(body[idx:idx + chunk_size])
+                        self.wfile.flush()
+                        time.sleep(chunk_size / server.bytes_per_s)
+                else:
+                    self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                pass #client gave up (e.g. timed out), nothing to do
+
+        def log_message(self, format, *args):
+            pass
+
+    return StandinHandler
+
+def _product_id_to_entered(product_id):
+    stamp = product_id[:12]
+    return f"{stamp[0:4]}-{stamp[4:6]}-{stamp[6:8]}T{stamp[8:10]}:{stamp[10:12]}:00Z"
+
+def measure_download(server, year, month, day, **kwargs):
+    '''Runs a (pipelined by default) download against
+       the stand-in and reports end-to-end throughput
+       and how many requests had to be retried or failed.
+       kwargs are passed through to airmet.download().
+    '''
+
+    import tempfile
+
+    save_dir = kwargs.pop("save_dir", None) or tempfile.mkdtemp(prefix="airmet_standin_")
+    kwargs.setdefault("pipelined", True)
+
+    http_before = dict(airmet.http_stats)
+    faults_before = dict(server.fault_counts)
+
+    start = time.perf_counter()
+    status, _, result = airmet.download(save_dir, year, month, day, base_url=server.url, **kwargs)
+    elapsed_s = time.perf_counter() - start
+
+    num_products = len(server.released_products(f"{year:04d}-{month:02d}-{day:02d}"))
+    return {
+        "status" : status,
+        "result" : result,
+        "elapsed_s" : elapsed_s,
+        "products" : num_products,
+        "products_per_s" : num_products / elapsed_s if elapsed_s > 0 else 0,
+        "http" : {stat : airmet.http_stats[stat] - http_before[stat] for stat in http_before},
+        "faults" : {fault : server.fault_counts[fault] - faults_before[fault] for fault in faults_before},
+    }
+
+if __name__ == "__main__":
+
+    import argparse
+    from datetime import datetime
+
+    parser = argparse.ArgumentParser(description="Local stand-in for the IEM list.json/nwstext endpoints.")
+    parser.add_argument("raw_text", nargs="*", help="recorded AllAIRMET_RawText_*.txt files (default: one synthetic day)")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--release-interval", type=float)
+    parser.add_argument("--latency", type=float, default=0)
+    parser.add_argument("--bytes-per-s", type=float)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--timeout-rate", type=float, default=0)
+    parser.add_argument("--truncate-rate", type=float, default=0)
+    args = parser.parse_args()
+
+    server_kwargs = {"port" : args.port, "release_interval" : args.release_interval, "latency_s" : args.latency,
+                     "bytes_per_s" : args.bytes_per_s, "error_rate" : args.error_rate,
+                     "timeout_rate" : args.timeout_rate, "truncate_rate" : args.truncate_rate}
+    if args.raw_text:
+        server = StandinIEMServer.from_raw_text_files(args.raw_text, **server_kwargs)
+    else:
+        server = StandinIEMServer.from_synthetic(datetime(2020, 3, 1), 1, **server_kwargs)
+
+    server.start()
+    print(f"STANDIN: Serving {len(server.products)} products at {server.url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
@@ -3,8 +3,10 @@ import os
 from pathlib import Path, PurePath
 import math
 import re
+import numbers
 
-import pandas as pd
+#numpy and the VOR table are imported by the functions that use them, so
+#parsing a bulletin (airmet.parse_airmet) loads neither
 
 DEF_CARDINAL_DIR_TO_DEG_DICT = {
     "N" : 0,
@@ -27,6 +29,48 @@ DEF_CARDINAL_DIR_TO_DEG_DICT = {
 
 DEF_ANCILLARY_PATH_TO_VORS_RELATIVE_TO_SRC = "ancillary/vors.csv"
 
+#Fixed enumeration of every area code that can appear in a states block.
+#Order is part of the on-disk format of state masks, only ever append to it.
+DEF_STATE_CODES = (
+    "AL", "AK", "AZ", "AR", "CA", "CO", "CT", "DE", "DC", "FL",
+    "GA", "HI", "ID", "IL", "IN", "IA", "KS", "KY", "LA", "ME",
+    "MD", "MA", "MI", "MN", "MS", "MO", "MT", "NE", "NV", "NH",
+    "NJ", "NM", "NY", "NC", "ND", "OH", "OK", "OR", "PA", "RI",
+    "SC", "SD", "TN", "TX", "UT", "VT", "VA", "WA", "WV", "WI",
+    "WY", "AS", "GU", "MP", "PR", "TT", "VI", "LM", "LS", "LH",
+    "LE", "LO", "CSTL_WTRS",
+)
+
+DEF_STATE_TO_BIT_DICT = {state : 1 << idx for idx, state in enumerate(DEF_STATE_CODES)}
+
+###VOR patterns
+#Shared by parse_vor_string and airmet._pop_vors. They run on every
+#bulletin, garbled ones included, so they must stay linear time: every
+#unbounded repeat is a single character class that the text after it
+#can't start with, so a failed attempt never re-splits a run it
+#already scanned. No (x*)* or (x|y)+ nesting.
+
+#A VOR with a distance/direction offset, e.g. "40NW SPS" or "30SSW SPS"
+DEF_OFFSET_VOR_RE = r"[\dA-Z]{3,6}[\s\#][A-Z]{3}"
+
+#First VOR of scheme 1 (FROM [...]), and every following one (TO [...])
+DEF_SCHEME1_FROM_RE = rf"FROM[\s\#](?:{DEF_OFFSET_VOR_RE}|[A-Z]{{3}}(?!-))"
+DEF_SCHEME1_TO_RE = rf"TO[\s\#](?:{DEF_OFFSET_VOR_RE}|[A-Z]{{3}}(?!-))"
+
+#First VOR of scheme 2 (BOUNDED BY [...]), and every following one (-[...]),
+#which may be wrapped onto the next line ("-#")
+DEF_SCHEME2_BOUNDED_RE = rf"BOUNDED BY[\s\#](?:{DEF_OFFSET_VOR_RE}|[A-Z]{{3}})"
+DEF_SCHEME2_DASH_RE = rf"-(?:\#[\s\#]*)?(?:{DEF_OFFSET_VOR_RE}|[A-Z]{{3}})"
+
+#A VOR in a scheme 3 (dashed) list, with an optional distance/direction offset, e.g. "SPS" or "40NW SPS"
+DEF_SCHEME3_VOR_RE = r"(?:\d{1,3}[A-Z]{1,3}[\s\#])?[A-Z]{3}(?![A-Z\d])"
+
+#A scheme 3 list: each link holds exactly one "-", so links can't be split two ways
+DEF_SCHEME3_CHAIN_RE = rf"(?<![A-Z\d]){DEF_SCHEME3_VOR_RE}(?:[\s\#]*-[\s\#]*{DEF_SCHEME3_VOR_RE})+"
+
+#A lone scheme 3 VOR after FROM (isolated convective SIGMETs)
+DEF_SCHEME3_FROM_RE = rf"(?<=FROM[\s\#]){DEF_SCHEME3_VOR_RE}"
+
 class Bounds():
     ''' A "Bounds" object = A
         collection of VORs for a
@@ -59,9 +103,25 @@ class Bounds():
                 dir_args.append(dist_nm.strip())
                 dir_args.append(card_dir.strip())
 
-            vor_lat, vor_lon = self._vor_dir_to_lat_lon(vor)
+            if dir_args:
+                vor_lat, vor_lon = self._vor_dir_to_lat_lon(vor, dir_args)
+            else:
+                vor_lat, vor_lon = self._vor_dir_to_lat_lon(vor)
             self.latlon_points += [(vor_lat, vor_lon)]
 
+        self._lod_cache = {}
+
+    def simplified(self, level):
+        '''Lat/lon points at detail level `level` (an index
+           into geometry.DEF_LOD_TOLERANCES_DEG, 0 being the
+           points as issued). Each level is only simplified
+           once per Bounds.
+        '''
+        if level not in self._lod_cache:
+            from geometry import DEF_LOD_TOLERANCES_DEG, simplify_polygon
+            self._lod_cache[level] = simplify_polygon(self.latlon_points, DEF_LOD_TOLERANCES_DEG[level])
+        return self._lod_cache[level]
+
     def __iter__(self):
         self.num_points = len(self.latlon_points)
         self.iter_idx = 0
@@ -82,113 +142,7 @@ class Bounds():
         return self.raw_string
 
     def _parse_vor_string(self, vor_string):
-        '''
-        Complex function to parse VORs from
-        a string, and return a list of tuples
-        comprised of (VOR ID, Dist. from VOR [if any]).
-
-        3 parsing "schemes" are implemented.
-
-        Scheme 1 parses VORs formatted like:
-        FROM [DIR VOR|VOR] TO [DIR VOR|VOR] TO ...
-        Typical in: Std. AIRMET format, SIGMET format
-
-        Scheme 2 parses VORs formatted like:
-        BOUNDED BY [DIR VOR|VOR]-[DIR VOR|VOR]-...
-        Typical in: Other AIRMET products (outlooks,
-        LLWS potential)
-
-        Scheme 3 parses VORs formatted like:
-        [A-Z] [DIR VOR|VOR]-[DIR VOR|VOR]-...
-        Typical in: AIRMET complex FRZLVL,
-        convective SIGMETs.
-
-        Schemes 1 and 2 are checked for, and
-        if both fail scheme 3 is used.
-
-        '''
-
-        initalvor_scheme1 = re.search(r"FROM(\s|\#)(((\d|[A-Z]){3,6}(\s|\#)([A-Z]){3})|([A-Z]){3}(?!-))", vor_string) #Matches inital VOR (FROM [...]) in typical AIRMET scheme
-        vors_scheme1 = re.finditer(r"TO(\s|\#)(((\d|[A-Z]){3,6}(\s|\#)([A-Z]){3})|([A-Z]){3}(?!-))", vor_string) #Matches all other VORs (TO [...]) in typical AIRMET scheme
-        
-        initalvor_scheme2 = re.search(r"(BOUNDED BY)(\s|\#)(((\d|[A-Z]){3,6}(\s|\#)([A-Z]){3})|([A-Z]){3})", vor_string) #Matches inital VOR from alternate scheme (BOUNDED BY [...]-[...])
-        vors_scheme2 = re.finditer(r"-(\#(\s)*)*(((\d|[A-Z]){3,6}(\s|\#)([A-Z]){3})|([A-Z]){3})", vor_string) #Matches all other VORs from alternate scheme (BOUNDED BY [...]-[...])
-        
-        vors_with_endpos = []
-        start_pos_of_vors = 0
-        end_pos_of_vors = 0   
-
-        #VORS are in scheme 1 
-        if initalvor_scheme1:
-            # print("SCHEME 1")
-            # print(initalvor_scheme1)
-            vors_with_endpos.append((vor_string[initalvor_scheme1.start():initalvor_scheme1.end()], initalvor_scheme1.end()))
-            start_pos_of_vors = initalvor_scheme1.start()
-            end_pos_of_vors = 0       
-                             
-            for vor in vors_scheme1:
-                # print(vor)
-                vors_with_endpos.append((vor_string[vor.start():vor.end()], vor.end()))
-                if vor.end() > end_pos_of_vors:
-                    end_pos_of_vors = vor.end()
-                         
-            no_vor_text = vor_string[:start_pos_of_vors] + vor_string[end_pos_of_vors:]
-
-        elif initalvor_scheme2:
-            # print("SCHEME 2")
-            # print(initalvor_scheme2)
-            vors_with_endpos.append((vor_string[initalvor_scheme2.start():initalvor_scheme2.end()], initalvor_scheme2.end()))
-            start_pos_of_vors = initalvor_scheme2.start()
-            end_pos_of_vors = 0       
-                             
-            for vor in vors_scheme2:
-                # print(vor)
-                vors_with_endpos.append((vor_string[vor.start():vor.end()], vor.end()))
-                if vor.end() > end_pos_of_vors:
-                    end_pos_of_vors = vor.end()
-            
-        else:
-            #TODO: Implement Scheme 3
-            return []
-            
-        vor_tuples = []
-        for vor_and_endpos in vors_with_endpos: #quality checks and sanitizing
-            vor = vor_and_endpos[0]
-            endpos = vor_and_endpos[1]
-            
-            vor = vor.replace("#", " ").replace("BOUNDED BY ", "").replace("-", "").replace("FROM ", "").replace("TO ", "")
-            
-            time_match = re.match(r"(\d{2}|\d{2}00)Z", vor) #matches if VOR includes a time. Can happen when product references a period a period (e.g. 12Z-15Z)
-            level_match = re.match(r"\d+(?!\w)", vor) #matches if VOR is just a number. Can sometimes happen if description references a level (e.g. SFC-100 [FL])
-            caught_desc_match = re.match(r"(?<!\d)[A-Z]{3}\s[A-Z]+", vor) #matches if the VOR caught some of the description (e.g. parsed "YYZ MTNS OBSC" as "[YYZ MTN]S OBSC")
-            
-            #quality checks
-            if len(vor) > 10 or len(vor) < 3 or time_match or level_match:
-                if endpos == end_pos_of_vors:
-                    end_pos_of_vors = -999 #flagged for correction    
-                continue
-            
-            if caught_desc_match:
-                vor = vor.split(" ")[0] #save only first half of vor
-                end_pos_of_vors = end_pos_of_vors - 4
-                               
-            vor = vor.lstrip().rstrip()
-            # if vor.find(" ") != -1:
-            #     vor = tuple(vor.split(" "))
-                            
-            vor_tuples.append(vor)
-            
-        # if end_pos_of_vors == -999: #reset end position of VOR block if needed
-        #     new_endpos = 0
-        #     for vor_and_endpos in vors_with_endpos:
-        #         endpos = vor_and_endpos[1]
-        #         if endpos > new_endpos:
-        #             new_endpos = endpos
-        #     end_pos_of_vors = new_endpos
-                         
-        # no_vor_text = vor_string[:start_pos_of_vors] + vor_string[end_pos_of_vors:]
-
-        return vor_tuples
+        return parse_vor_string(vor_string)
 
     def _vor_dir_to_lat_lon(self, vor, *args):
 
@@ -201,18 +155,13 @@ class Bounds():
             bearing_deg = DEF_CARDINAL_DIR_TO_DEG_DICT.get(cardinal)
             complex_vor_flag = True
 
-        vor_path = PurePath.joinpath(Path.cwd(), DEF_ANCILLARY_PATH_TO_VORS_RELATIVE_TO_SRC)
-
-        vors_master_list = pd.read_csv(vor_path, sep=",", na_values = ["0","M"], index_col=0)
+        from vors import get_vor_resolver, DEF_ACCEPTED_CONFIDENCES
 
-        try:
-            vor_data = vors_master_list.loc[vor]
-        except:
-            print(f"ERROR: VOR data not found for '{vor}'. Please add an issue on Github with more details.")
+        match = get_vor_resolver().resolve(vor, near=self.latlon_points[-1] if self.latlon_points else None)
+        if match["confidence"] not in DEF_ACCEPTED_CONFIDENCES:
+            return math.nan, math.nan #listed in the resolver's report
+        vor_lat, vor_lon = match["lat"], match["lon"]
 
-        #print(vor_data)
-        vor_lat = vor_data.lat
-        vor_lon = vor_data.lon
         #print(f"LAT: {vor_lat}\nLON: {vor_lon}")
 
         if complex_vor_flag:
@@ -250,34 +199,344 @@ class Bounds():
 
         return airmet_pt_lat, airmet_pt_lon
 
+def parse_vor_string(vor_string):
+    '''
+    Complex function to parse VORs from
+    a string, and return a list of tuples
+    comprised of (VOR ID, Dist. from VOR [if any]).
+
+    3 parsing "schemes" are implemented.
+
+    Scheme 1 parses VORs formatted like:
+    FROM [DIR VOR|VOR] TO [DIR VOR|VOR] TO ...
+    Typical in: Std. AIRMET format, SIGMET format
+
+    Scheme 2 parses VORs formatted like:
+    BOUNDED BY [DIR VOR|VOR]-[DIR VOR|VOR]-...
+    Typical in: Other AIRMET products (outlooks,
+    LLWS potential)
+
+    Scheme 3 parses VORs formatted like:
+    [A-Z] [DIR VOR|VOR]-[DIR VOR|VOR]-...
+    Typical in: AIRMET complex FRZLVL,
+    convective SIGMETs.
+
+    Schemes 1 and 2 are checked for, and
+    if both fail scheme 3 is used. A FROM
+    followed by a dashed list (convective
+    SIGMETs: FROM 40NW SPS-30ESE SPS-...) is
+    scheme 3, not scheme 1.
+
+    '''
+
+    initalvor_scheme1 = re.search(DEF_SCHEME1_FROM_RE, vor_string) #Matches inital VOR (FROM [...]) in typical AIRMET scheme
+    vors_scheme1 = re.finditer(DEF_SCHEME1_TO_RE, vor_string) #Matches all other VORs (TO [...]) in typical AIRMET scheme
+    
+    initalvor_scheme2 = re.search(DEF_SCHEME2_BOUNDED_RE, vor_string) #Matches inital VOR from alternate scheme (BOUNDED BY [...]-[...])
+    vors_scheme2 = re.finditer(DEF_SCHEME2_DASH_RE, vor_string) #Matches all other VORs from alternate scheme (BOUNDED BY [...]-[...])
+    
+    vors_with_endpos = []
+    start_pos_of_vors = 0
+    end_pos_of_vors = 0   
+
+    #VORS are in scheme 1 
+    if initalvor_scheme1 and not vor_string[initalvor_scheme1.end():].lstrip(" #").startswith("-"):
+        # print("SCHEME 1")
+        # print(initalvor_scheme1)
+        vors_with_endpos.append((vor_string[initalvor_scheme1.start():initalvor_scheme1.end()], initalvor_scheme1.end()))
+        start_pos_of_vors = initalvor_scheme1.start()
+        end_pos_of_vors = 0       
+                         
+        for vor in vors_scheme1:
+            # print(vor)
+            vors_with_endpos.append((vor_string[vor.start():vor.end()], vor.end()))
+            if vor.end() > end_pos_of_vors:
+                end_pos_of_vors = vor.end()
+                     
+        no_vor_text = vor_string[:start_pos_of_vors] + vor_string[end_pos_of_vors:]
+
+    elif initalvor_scheme2:
+        # print("SCHEME 2")
+        # print(initalvor_scheme2)
+        vors_with_endpos.append((vor_string[initalvor_scheme2.start():initalvor_scheme2.end()], initalvor_scheme2.end()))
+        start_pos_of_vors = initalvor_scheme2.start()
+        end_pos_of_vors = 0       
+                         
+        for vor in vors_scheme2:
+            # print(vor)
+            vors_with_endpos.append((vor_string[vor.start():vor.end()], vor.end()))
+            if vor.end() > end_pos_of_vors:
+                end_pos_of_vors = vor.end()
+        
+    else:
+        #Scheme 3: the first dashed run of VORs, or a lone VOR after FROM (isolated convective SIGMETs)
+        chain_scheme3 = re.search(DEF_SCHEME3_CHAIN_RE, vor_string)
+        if not chain_scheme3:
+            chain_scheme3 = re.search(DEF_SCHEME3_FROM_RE, vor_string)
+        if not chain_scheme3:
+            return []
+
+        for vor in re.finditer(DEF_SCHEME3_VOR_RE, chain_scheme3.group()):
+            vors_with_endpos.append((vor.group(), chain_scheme3.start() + vor.end()))
+        start_pos_of_vors = chain_scheme3.start()
+        end_pos_of_vors = chain_scheme3.end()
+        
+    vor_tuples = []
+    for vor_and_endpos in vors_with_endpos: #quality checks and sanitizing
+        vor = vor_and_endpos[0]
+        endpos = vor_and_endpos[1]
+        
+        vor = vor.replace("#", " ").replace("BOUNDED BY ", "").replace("-", "").replace("FROM ", "").replace("TO ", "")
+        
+        time_match = re.match(r"(\d{2}|\d{2}00)Z", vor) #matches if VOR includes a time. Can happen when product references a period a period (e.g. 12Z-15Z)
+        level_match = re.match(r"\d+(?!\w)", vor) #matches if VOR is just a number. Can sometimes happen if description references a level (e.g. SFC-100 [FL])
+        caught_desc_match = re.match(r"(?<!\d)[A-Z]{3}\s[A-Z]+", vor) #matches if the VOR caught some of the description (e.g. parsed "YYZ MTNS OBSC" as "[YYZ MTN]S OBSC")
+        
+        #quality checks
+        if len(vor) > 10 or len(vor) < 3 or time_match or level_match:
+            if endpos == end_pos_of_vors:
+                end_pos_of_vors = -999 #flagged for correction    
+            continue
+        
+        if caught_desc_match:
+            vor = vor.split(" ")[0] #save only first half of vor
+            end_pos_of_vors = end_pos_of_vors - 4
+                           
+        vor = vor.lstrip().rstrip()
+        # if vor.find(" ") != -1:
+        #     vor = tuple(vor.split(" "))
+                        
+        vor_tuples.append(vor)
+        
+    # if end_pos_of_vors == -999: #reset end position of VOR block if needed
+    #     new_endpos = 0
+    #     for vor_and_endpos in vors_with_endpos:
+    #         endpos = vor_and_endpos[1]
+    #         if endpos > new_endpos:
+    #             new_endpos = endpos
+    #     end_pos_of_vors = new_endpos
+                     
+    # no_vor_text = vor_string[:start_pos_of_vors] + vor_string[end_pos_of_vors:]
+
+    return vor_tuples
+
+###Conditions
+#Hazard phrases of qualifiers and descriptions, normalized to the codes
+#AIRMET headers use (airmet._header_to_dict). Longest phrase wins, so
+#"STG SFC WNDS" is never read as "STG WNDS".
+DEF_HAZARD_TRANSLATION_TABLE = {
+    "IFR" : "IFR",
+    "CIG BLW" : "IFR",
+    "VIS BLW" : "IFR",
+    "MTN OBSCN" : "MTN_OBSCN",
+    "MTNS OBSC" : "MTN_OBSCN",
+    "TURB" : "TURB",
+    "ICE" : "ICE",
+    "ICG" : "ICE",
+    "STG SFC WNDS" : "STG_SFC_WNDS",
+    "SFC WINDS" : "STG_SFC_WNDS",
+    "STG WNDS" : "STG_SFC_WNDS",
+    "LLWS" : "LLWS",
+    "FRZLVL" : "FRZLVL",
+    "CONVECTIVE SIGMET" : "TS",
+    "TS" : "TS",
+    "TSTMS" : "TS",
+    "DS" : "DS",
+    "SS" : "SS",
+    "VA" : "VA",
+    "VOLCANIC ASH" : "VA",
+}
+
+#Bands of hazards that are defined by altitude and usually issued without one
+DEF_HAZARD_DEFAULT_BANDS = {
+    "LLWS" : (0, "SFC", 2000, "AGL"),
+}
+
+#Weakest first, a range ("LGT-MOD") decodes to its upper end
+DEF_INTENSITIES = ("LGT", "MOD", "SEV", "EXTRM")
+
+DEF_FREQUENCIES = ("ISOL", "OCNL", "FRQ", "CONS")
+
+#Vertical references of a band edge: a flight level/altitude (MSL), a cloud
+#ceiling height (AGL), the surface or the freezing level
+DEF_ALTITUDE_REFS = ("MSL", "AGL", "SFC", "FRZLVL")
+
+#An altitude token: FL220, 080 (hundreds of feet), SFC or FRZLVL
+DEF_ALTITUDE_TOKEN = r"(?:FL\d{3}|\d{3}(?!\d)|SFC|FRZLVL)"
+
 class Conditions():
     ''' A "Conditions" object = A
         collection of weather conditions
         or other type identifiers
         about the METInfo Object.
+
+        Decoded once from the qualifiers
+        (conds) and description, e.g.
+        "MOD ICE BTN FRZLVL AND FL220.
+        FRZLVL 080-120." gives hazard ICE,
+        intensity MOD, floor FRZLVL and
+        ceiling 22000 ft MSL. Altitudes are
+        in feet; a floor/ceiling of None
+        with a "FRZLVL" ref is relative to
+        the freezing level, a ceiling of
+        None with no ref is unbounded.
     '''
 
-    translation_table = 
-    
+    translation_table = DEF_HAZARD_TRANSLATION_TABLE
+
+    hazard_re = re.compile(r"(?<![A-Z])(" + "|".join(re.escape(phrase) for phrase in sorted(translation_table, key=len, reverse=True)) + r")(?![A-Z])")
+    intensity_re = re.compile(r"(?<![A-Z])((?:LGT|MOD|SEV|EXTRM)(?:-(?:LGT|MOD|SEV|EXTRM))?)(?![A-Z])")
+    frequency_re = re.compile(r"(?<![A-Z])(" + "|".join(DEF_FREQUENCIES) + r")(?![A-Z])")
+    between_re = re.compile(rf"\b(?:BTN|FROM|FM)\s({DEF_ALTITUDE_TOKEN})\s?(?:AND|TO|-)\s?({DEF_ALTITUDE_TOKEN})")
+    below_re = re.compile(rf"\b(CIG\s)?(?:BLW|TOPS\sTO|TOPS)\s({DEF_ALTITUDE_TOKEN})")
+    above_re = re.compile(rf"\b(TOPS\s)?ABV\s({DEF_ALTITUDE_TOKEN})")
+    frzlvl_range_re = re.compile(rf"\bFRZLVL\s(?:RANGING\sFROM\s)?({DEF_ALTITUDE_TOKEN})-({DEF_ALTITUDE_TOKEN})")
+
     def __init__(self, conds, desc_string):
 
         self.raw_conds = conds
         self.raw_desc = desc_string
 
-        pass
+        conds_string = " ".join(conds) if isinstance(conds, (list, tuple)) else (conds or "")
+        desc_string = desc_string or ""
+
+        self.hazard = self._decode_hazard(conds_string) or self._decode_hazard(desc_string)
+        self.intensity = self._decode_intensity(desc_string)
+        frequency_match = self.frequency_re.search(desc_string)
+        self.frequency = frequency_match.group(1) if frequency_match else None
+
+        self.floor_ft, self.floor_ref, self.ceiling_ft, self.ceiling_ref = self._decode_band(desc_string)
+        if self.hazard == "IFR" and self.ceiling_ref == "MSL":
+            self.ceiling_ref = "AGL" #an IFR band is a cloud ceiling, even with "CIG" lost to the parser
+        if self.floor_ref is None and self.ceiling_ref is None and self.hazard in DEF_HAZARD_DEFAULT_BANDS:
+            self.floor_ft, self.floor_ref, self.ceiling_ft, self.ceiling_ref = DEF_HAZARD_DEFAULT_BANDS[self.hazard]
+        frzlvl_match = self.frzlvl_range_re.search(desc_string)
+        self.frzlvl_range_ft = None
+        if frzlvl_match:
+            self.frzlvl_range_ft = (_altitude_ft(frzlvl_match.group(1))[0], _altitude_ft(frzlvl_match.group(2))[0])
+
+    def _decode_hazard(self, text):
+        match = self.hazard_re.search(text)
+        return self.translation_table[match.group(1)] if match else None
+
+    def _decode_intensity(self, text):
+        match = self.intensity_re.search(text)
+        if not match:
+            return None
+        return max(match.group(1).split("-"), key=DEF_INTENSITIES.index)
+
+    def _decode_band(self, text):
+        #(floor_ft, floor_ref, ceiling_ft, ceiling_ref), the first band stated wins
+        candidates = []
+        match = self.between_re.search(text)
+        if match:
+            candidates.append((match.start(), _altitude_ft(match.group(1)) + _altitude_ft(match.group(2))))
+        match = self.below_re.search(text)
+        if match:
+            ceiling_ft, ceiling_ref = _altitude_ft(match.group(2))
+            candidates.append((match.start(), (0, "SFC", ceiling_ft, "AGL" if match.group(1) else ceiling_ref)))
+        match = self.above_re.search(text)
+        if match:
+            #Convective tops above a level reach up from the surface, anything else starts there
+            floor = (0, "SFC") if match.group(1) else _altitude_ft(match.group(2))
+            candidates.append((match.start(), floor + (None, None)))
+        if not candidates:
+            return None, None, None, None
+        return min(candidates)[1]
+
+    def altitude_band(self):
+        return altitude_band(self.as_dict())
+
+    def overlaps(self, low_ft, high_ft):
+        return altitude_overlaps(self.as_dict(), low_ft, high_ft)
+
+    def as_dict(self):
+        '''The decoded fields, as stored on each parsed
+           subgroup under "conditions".
+        '''
+        return {
+            "hazard" : self.hazard,
+            "intensity" : self.intensity,
+            "frequency" : self.frequency,
+            "floor_ft" : self.floor_ft,
+            "floor_ref" : self.floor_ref,
+            "ceiling_ft" : self.ceiling_ft,
+            "ceiling_ref" : self.ceiling_ref,
+            "frzlvl_range_ft" : list(self.frzlvl_range_ft) if self.frzlvl_range_ft else None,
+        }
+
+def _altitude_ft(token):
+    #(feet, ref) of one DEF_ALTITUDE_TOKEN
+    if token == "SFC":
+        return 0, "SFC"
+    if token == "FRZLVL":
+        return None, "FRZLVL"
+    return int(token.replace("FL", "")) * 100, "MSL"
+
+def decode_conditions(conds, desc_string):
+    return Conditions(conds, desc_string).as_dict()
+
+def altitude_band(conditions):
+    '''(low_ft, high_ft) a decoded conditions dict
+       spans, for vertical filtering: a freezing
+       level floor is taken at the lowest stated
+       freezing level and a freezing level ceiling
+       at the highest. An unknown floor is the
+       surface, an unbounded or unknown ceiling
+       is inf.
+    '''
+    if not conditions or (conditions.get("floor_ref") is None and conditions.get("ceiling_ref") is None):
+        return 0.0, math.inf
+    frzlvl_range = conditions.get("frzlvl_range_ft") or (None, None)
+
+    def edge(feet, ref, frzlvl_ft, default):
+        if ref == "FRZLVL":
+            feet = frzlvl_ft
+        return float(feet) if feet is not None else default
+
+    return (edge(conditions.get("floor_ft"), conditions.get("floor_ref"), frzlvl_range[0], 0.0),
+            edge(conditions.get("ceiling_ft"), conditions.get("ceiling_ref"), frzlvl_range[1], math.inf))
+
+def altitude_overlaps(conditions, low_ft, high_ft):
+    band_low, band_high = altitude_band(conditions)
+    return band_low <= high_ft and low_ft <= band_high
+
+def altitude_band_column(list_of_conditions):
+    '''Builds a float (n, 2) NumPy column of
+       altitude_band() rows, for vectorized
+       vertical filters over an index.
+    '''
+    import numpy as np
+
+    column = np.empty((len(list_of_conditions), 2), dtype=np.float64)
+    for idx, conditions in enumerate(list_of_conditions):
+        column[idx] = altitude_band(conditions)
+    return column
 
 class States():
+    ''' A "States" object = The
+        set of states (plus Great
+        Lakes and coastal waters)
+        covered by a MET Info obj.
+
+        The states are interned to
+        DEF_STATE_CODES and held as
+        an integer bitmask, so
+        membership and any-of/all-of
+        checks are single integer ops.
+    '''
 
     def __init__(self, state_string):
 
         self.raw_string = state_string
         self.states = self._parse_state_string(state_string)
+        self.mask = states_to_mask(self.states)
 
     def __contains__(self, item):
-        for state in self.states:
-            if item == state:
-                return True
-        return False
+        bit = DEF_STATE_TO_BIT_DICT.get(_normalize_state(item))
+        if bit is None:
+            return False
+        return (self.mask & bit) != 0
 
     def __iter__(self):
         self.num_states = len(self.states)
@@ -292,13 +551,80 @@ class States():
         else:
             raise StopIteration
 
+    def __int__(self):
+        return self.mask
+
     def __str__(self):
         return self.raw_string
 
+    def any_of(self, states):
+        return (self.mask & states_to_mask(states)) != 0
+
+    def all_of(self, states):
+        selected_mask = states_to_mask(states)
+        return (self.mask & selected_mask) == selected_mask
+
     def _parse_state_string(self, state_string):
         clean_str = state_string.replace("AND CSTL WTRS", "CSTL_WTRS")
         return clean_str.split(" ")
 
+def _normalize_state(state):
+    #Parsed JSON output stores coastal waters as "CSTL WTRS", the enumeration uses "CSTL_WTRS"
+    return state.strip().replace("AND CSTL WTRS", "CSTL_WTRS").replace("CSTL WTRS", "CSTL_WTRS")
+
+def states_to_mask(states):
+    '''Interns an iterable of state codes (or a
+       States object, or an existing mask) into
+       an integer bitmask. Unknown codes are ignored.
+    '''
+    if isinstance(states, States):
+        return states.mask
+    if isinstance(states, numbers.Integral): #NumPy integers included
+        return int(states)
+    if isinstance(states, str):
+        states = _normalize_state(states).split(" ")
+
+    mask = 0
+    for state in states:
+        mask |= DEF_STATE_TO_BIT_DICT.get(_normalize_state(state), 0)
+    return mask
+
+def mask_to_states(mask):
+    '''Inverse of states_to_mask, returns the
+       state codes set in the mask, in enumeration order.
+    '''
+    mask = int(mask)
+    return [state for idx, state in enumerate(DEF_STATE_CODES) if (mask >> idx) & 1]
+
+def states_mask_column(list_of_states):
+    '''Builds a uint64 NumPy column of state masks,
+       one entry per item in list_of_states (e.g. the
+       "states" list of every subgroup in an archive).
+    '''
+    import numpy as np
+
+    return np.fromiter((states_to_mask(states or []) for states in list_of_states),
+                       dtype=np.uint64, count=len(list_of_states))
+
+def filter_any_of(masks, states):
+    '''Vectorized any-of filter. Returns a boolean
+       array, True where the mask shares at least
+       one state with states.
+    '''
+    import numpy as np
+
+    return (np.asarray(masks, dtype=np.uint64) & np.uint64(states_to_mask(states))) != 0
+
+def filter_all_of(masks, states):
+    '''Vectorized all-of filter. Returns a boolean
+       array, True where the mask contains every
+       state in states.
+    '''
+    import numpy as np
+
+    selected_mask = np.uint64(states_to_mask(states))
+    return (np.asarray(masks, dtype=np.uint64) & selected_mask) == selected_mask
+
 
 if __name__ == "__main__":
 
@@ -0,0 +1,382 @@
+import sys
+import math
+import json
+import random
+
+import numpy as np
+
+import airmet
+import geometry
+from subclasses import DEF_STATE_CODES, states_to_mask, decode_conditions
+
+#Watched points, lines and polygons are bucketed into this lat/lon grid
+DEF_SUB_GRID_DEG = 1.0
+
+DEF_SUBSCRIPTION_KINDS = ("point", "line", "polygon", "states")
+
+#Area synthetic subscriptions are scattered over (min_lat, min_lon, max_lat, max_lon)
+DEF_SYNTHETIC_BBOX = (24.0, -125.0, 50.0, -66.0)
+
+#Share of each kind among synthetic subscriptions
+DEF_SYNTHETIC_MIX = (("point", 0.7), ("line", 0.15), ("polygon", 0.1), ("states", 0.05))
+
+class SubscriptionRegistry():
+    ''' Watched points (airports), lines (routes),
+        polygons (custom areas) and state codes,
+        indexed so a new AIRMET polygon only meets
+        the subscriptions near it:
+
+        - points are bucketed by grid cell and kept as
+          coordinate arrays, tested against a polygon
+          in one vectorized even-odd pass over the
+          cells its bounding box covers;
+        - lines are bucketed into every cell they pass
+          through, polygons into every cell they cross
+          or enclose;
+        - state subscriptions are listed per state bit
+          and met through the subgroup's state mask.
+
+        Cells wholly inside the polygon accept their
+        subscriptions outright, so exact (vectorized)
+        tests are left to those near its outline and
+        the work per polygon doesn't grow with the
+        number of subscriptions.
+    '''
+
+    def __init__(self, **kwargs):
+
+        self.grid_deg = kwargs.get("grid_deg", DEF_SUB_GRID_DEG)
+        self.subscriptions = {} #sub_id -> subscription dict
+        self._point_cells = {} #cell -> [sub_id]
+        self._shape_cells = {} #cell -> [sub_id]
+        self._first_cells = {} #cell of a line or polygon's first point -> [sub_id]
+        self._state_subs = [[] for _ in DEF_STATE_CODES] #state bit -> [sub_id]
+        self._point_arrays = {} #cell -> (sub_ids, lats, lons), rebuilt when the cell changes
+        self._segment_arrays = {} #cell -> (sub_ids, start lats, start lons, end lats, end lons), the same
+        self._limited = set() #sub_ids limited to some hazards
+        self._hazard_subs = {} #hazard -> set of sub_ids limited to it (among others)
+
+    def __len__(self):
+        return len(self.subscriptions)
+
+    def __contains__(self, sub_id):
+        return sub_id in self.subscriptions
+
+    def _cell(self, lat, lon):
+        return (math.floor(lat / self.grid_deg), math.floor(lon / self.grid_deg))
+
+    def _cells(self, min_lat, min_lon, max_lat, max_lon):
+        for lat_cell in range(math.floor(min_lat / self.grid_deg), math.floor(max_lat / self.grid_deg) + 1):
+            for lon_cell in range(math.floor(min_lon / self.grid_deg), math.floor(max_lon / self.grid_deg) + 1):
+                yield (lat_cell, lon_cell)
+
+    def add(self, sub_id, **kwargs):
+        '''Registers (or replaces) a subscription
+           watching exactly one of:
+
+           - point: (lat, lon), or a VOR/station id
+           - line: list of (lat, lon) or VOR ids
+           - polygon: list of (lat, lon) or VOR ids
+           - states: list of state codes
+
+           hazards optionally limits it to these
+           decoded hazard codes (e.g. ["ICE", "TURB"]).
+           Returns the subscription dict.
+        '''
+
+        kinds = [kind for kind in DEF_SUBSCRIPTION_KINDS if kwargs.get(kind) is not None]
+        if len(kinds) != 1:
+            raise ValueError(f"Subscription '{sub_id}' needs exactly one of {list(DEF_SUBSCRIPTION_KINDS)}, got {kinds}")
+        kind = kinds[0]
+        if sub_id in self.subscriptions:
+            self.remove(sub_id)
+
+        subscription = {"sub_id" : sub_id, "kind" : kind, "hazards" : set(kwargs.get("hazards") or [])}
+        if subscription["hazards"]:
+            self._limited.add(sub_id)
+            for hazard in subscription["hazards"]:
+                self._hazard_subs.setdefault(hazard, set()).add(sub_id)
+        if kind == "states":
+            subscription["mask"] = states_to_mask(kwargs["states"])
+            for idx in range(len(DEF_STATE_CODES)):
+                if (subscription["mask"] >> idx) & 1:
+                    self._state_subs[idx].append(sub_id)
+        else:
+            points = _resolve_points([kwargs[kind]] if kind == "point" else kwargs[kind])
+            if kind == "polygon" and len(points) < 3 or kind == "line" and len(points) < 2:
+                raise ValueError(f"Subscription '{sub_id}' has too few points for a {kind}")
+            subscription["points"] = points
+            subscription["bbox"] = geometry.bbox(points)
+            if kind == "point":
+                cell = self._cell(*points[0])
+                self._point_cells.setdefault(cell, []).append(sub_id)
+                self._point_arrays.pop(cell, None)
+            else:
+                subscription["segments"] = _segments(points, closed=kind == "polygon")
+                subscription["cells"] = self._shape_cover(kind, subscription["segments"], subscription["bbox"])
+                for cell in subscription["cells"]:
+                    self._shape_cells.setdefault(cell, []).append(sub_id)
+                    self._segment_arrays.pop(cell, None)
+                self._first_cells.setdefault(self._cell(*points[0]), []).append(sub_id)
+
+        self.subscriptions[sub_id] = subscription
+        return subscription
+
+    def remove(self, sub_id):
+        subscription = self.subscriptions.pop(sub_id, None)
+        if subscription is None:
+            return False
+        self._limited.discard(sub_id)
+        for hazard in subscription["hazards"]:
+            self._hazard_subs[hazard].discard(sub_id)
+        if subscription["kind"] == "states":
+            for idx in range(len(DEF_STATE_CODES)):
+                if (subscription["mask"] >> idx) & 1:
+                    self._state_subs[idx].remove(sub_id)
+        elif subscription["kind"] == "point":
+            cell = self._cell(*subscription["points"][0])
+            self._point_cells[cell].remove(sub_id)
+            self._point_arrays.pop(cell, None)
+        else:
+            for cell in subscription["cells"]:
+                self._shape_cells[cell].remove(sub_id)
+                self._segment_arrays.pop(cell, None)
+            self._first_cells[self._cell(*subscription["points"][0])].remove(sub_id)
+        return True
+
+    def _points_of_cell(self, cell):
+        arrays = self._point_arrays.get(cell)
+        if arrays is None:
+            sub_ids = self._point_cells.get(cell) or []
+            arrays = (np.array(sub_ids, dtype=object),
+                      np.fromiter((self.subscriptions[sub_id]["points"][0][0] for sub_id in sub_ids), dtype=float, count=len(sub_ids)),
+                      np.fromiter((self.subscriptions[sub_id]["points"][0][1] for sub_id in sub_ids), dtype=float, count=len(sub_ids)))
+            self._point_arrays[cell] = arrays
+        return arrays
+
+    def _segment_cells(self, start, end):
+        '''Every cell the segment passes through or
+           touches (a slight superset, it's padded by a
+           hair against rounding).
+        '''
+        eps = self.grid_deg * 1e-9
+        (lat_j, lon_j), (lat_i, lon_i) = start, end
+        low_lat, high_lat = min(lat_i, lat_j), max(lat_i, lat_j)
+        cells = []
+        for lat_cell in range(math.floor((low_lat - eps) / self.grid_deg), math.floor((high_lat + eps) / self.grid_deg) + 1):
+            #Longitudes the segment spans within this row of cells
+            if lat_i == lat_j:
+                lons = (lon_i, lon_j)
+            else:
+                row_low = max(lat_cell * self.grid_deg, low_lat)
+                row_high = min((lat_cell + 1) * self.grid_deg, high_lat)
+                lons = [lon_i + (lon_j - lon_i) * (lat - lat_i) / (lat_j - lat_i) for lat in (row_low, row_high)]
+            for lon_cell in range(math.floor((min(lons) - eps) / self.grid_deg), math.floor((max(lons) + eps) / self.grid_deg) + 1):
+                cells.append((lat_cell, lon_cell))
+        return cells
+
+    def _segments_of_cell(self, cell):
+        arrays = self._segment_arrays.get(cell)
+        if arrays is None:
+            segments = [(sub_id, segment) for sub_id in self._shape_cells.get(cell) or [] for segment in self.subscriptions[sub_id]["segments"]]
+            coords = np.array([(start[0], start[1], end[0], end[1]) for _, (start, end) in segments], dtype=float).reshape(-1, 4)
+            arrays = (np.array([sub_id for sub_id, _ in segments], dtype=object), coords[:, 0], coords[:, 1], coords[:, 2], coords[:, 3])
+            self._segment_arrays[cell] = arrays
+        return arrays
+
+    def _shape_cover(self, kind, segments, box):
+        #Cells a line passes through, or a polygon's outline passes through or encloses
+        cells = set()
+        for start, end in segments:
+            cells.update(self._segment_cells(start, end))
+        if kind == "polygon":
+            others = [cell for cell in self._cells(*box) if cell not in cells]
+            if others:
+                centres = (np.array(others, dtype=float) + 0.5) * self.grid_deg
+                ring = [start for start, _ in segments]
+                cells.update(cell for cell, is_inside in zip(others, geometry.points_in_polygon(centres[:, 0], centres[:, 1], ring)) if is_inside)
+        return frozenset(cells)
+
+    def _classify_cells(self, polygon, box, edge_cells):
+        '''Splits the occupied cells under polygon's
+           bounding box into those wholly inside it and
+           those its outline (edge_cells) crosses. The
+           rest are wholly outside.
+        '''
+        occupied = [cell for cell in self._cells(*box) if cell in self._point_cells or cell in self._shape_cells]
+        boundary = {cell for cell in occupied if cell in edge_cells}
+        others = [cell for cell in occupied if cell not in edge_cells]
+        if not others:
+            return set(), boundary
+        #No edge crosses these cells, so their centre tells which side the whole cell is on
+        centres = (np.array(others, dtype=float) + 0.5) * self.grid_deg
+        inside = geometry.points_in_polygon(centres[:, 0], centres[:, 1], polygon)
+        return {cell for cell, is_inside in zip(others, inside) if is_inside}, boundary
+
+    def match(self, polygon, states=None, **kwargs):
+        '''Set of sub_ids watching anything inside or
+           crossing polygon (a list of (lat, lon), or a
+           subclasses.Bounds), or any of states (codes,
+           a subclasses.States or a mask). hazard
+           drops subscriptions limited to other hazards.
+
+           Points, lines and polygons in a cell wholly
+           inside the polygon match without a test; only
+           those near its outline get an exact one.
+        '''
+
+        matched = set()
+        polygon = list(polygon) if polygon is not None else []
+        if len(polygon) >= 3 and not any(math.isnan(lat) or math.isnan(lon) for lat, lon in polygon):
+            box = geometry.bbox(polygon)
+            edges = [(edge, self._segment_cells(*edge)) for edge in _segments(polygon)]
+            inside, boundary = self._classify_cells(polygon, box, {cell for _, cells in edges for cell in cells})
+
+            for cell in inside:
+                matched.update(self._point_cells.get(cell) or ())
+                matched.update(self._shape_cells.get(cell) or ())
+            point_arrays = [self._points_of_cell(cell) for cell in boundary if self._point_cells.get(cell)]
+            if point_arrays:
+                sub_ids = np.concatenate([arrays[0] for arrays in point_arrays])
+                lats = np.concatenate([arrays[1] for arrays in point_arrays])
+                lons = np.concatenate([arrays[2] for arrays in point_arrays])
+                matched.update(sub_ids[geometry.points_in_polygon(lats, lons, polygon)])
+
+            #Lines and polygons crossing an edge, tested against the segments in the edge's cells
+            for (start, end), cells in edges:
+                segment_arrays = [self._segments_of_cell(cell) for cell in cells if self._shape_cells.get(cell)]
+                if segment_arrays:
+                    sub_ids = np.concatenate([arrays[0] for arrays in segment_arrays])
+                    coords = [np.concatenate([arrays[idx] for arrays in segment_arrays]) for idx in range(1, 5)]
+                    matched.update(sub_ids[geometry.segments_intersect_many(start, end, *coords)])
+
+            #Crossing no edge, the rest are wholly inside (or outside) the polygon, or enclose it
+            candidates = set()
+            for cell in boundary:
+                candidates.update(self._first_cells.get(cell) or ())
+            candidates = list(candidates - matched)
+            if candidates:
+                firsts = np.array([self.subscriptions[sub_id]["points"][0] for sub_id in candidates], dtype=float)
+                matched.update(sub_id for sub_id, is_inside in zip(candidates, geometry.points_in_polygon(firsts[:, 0], firsts[:, 1], polygon)) if is_inside)
+            for sub_id in self._shape_cells.get(self._cell(*polygon[0])) or ():
+                subscription = self.subscriptions[sub_id]
+                if subscription["kind"] == "polygon" and sub_id not in matched and geometry.point_in_polygon(*polygon[0], subscription["points"]):
+                    matched.add(sub_id)
+
+        mask = states_to_mask(states) if states is not None else 0
+        idx = 0
+        while mask:
+            if mask & 1:
+                matched.update(self._state_subs[idx])
+            mask >>= 1
+            idx += 1
+
+        if self._limited:
+            matched -= (matched & self._limited) - self._hazard_subs.get(kwargs.get("hazard"), set())
+        return matched
+
+    def match_bulletin(self, airmet_dict, **kwargs):
+        '''Matches every subgroup of a parsed bulletin.
+           Returns {sub_id : [subgroup indices]}.
+           Outlook subgroups are skipped unless
+           outlooks=True.
+        '''
+
+        matches = {}
+        for group_idx, group in enumerate(airmet_dict.get("subgroups") or []):
+            qualifiers = group.get("qualifiers") or []
+            if not kwargs.get("outlooks") and any(qual.startswith("OTLK") for qual in qualifiers):
+                continue
+            polygon = geometry.subgroup_polygon(group.get("vors")) if group.get("vors") else None
+            conditions = group.get("conditions") or decode_conditions(qualifiers, group.get("desc", ""))
+            for sub_id in self.match(polygon, group.get("states") or [], hazard=conditions.get("hazard")):
+                matches.setdefault(sub_id, []).append(group_idx)
+        return matches
+
+    def watch_callback(self, notify, **kwargs):
+        '''A watch.AirmetWatcher callback that calls
+           notify(sub_id, airmet_dict, subgroup indices)
+           for every subscription a new bulletin matches.
+        '''
+
+        def callback(airmet_dict, product_entry):
+            for sub_id, group_ids in self.match_bulletin(airmet_dict, **kwargs).items():
+                notify(sub_id, airmet_dict, group_ids)
+
+        return callback
+
+def _segments(points, **kwargs):
+    #(start, end) pairs of a ring, or of a polyline with closed=False
+    points = [tuple(point) for point in points]
+    if kwargs.get("closed", True):
+        return list(zip([points[-1]] + points[:-1], points))
+    return list(zip(points[:-1], points[1:]))
+
+def _resolve_points(points):
+    resolved = []
+    for point in points:
+        if isinstance(point, str):
+            point = airmet.resolve_vor(point.strip().upper())
+        lat, lon = float(point[0]), float(point[1])
+        if math.isnan(lat) or math.isnan(lon):
+            raise ValueError(f"Can't resolve subscription point '{point}'")
+        resolved.append((lat, lon))
+    return resolved
+
+def load_subscriptions(path, **kwargs):
+    '''Builds a registry from an NDJSON file, one
+       subscription per line: {"id": ..., plus one of
+       "point", "line", "polygon" or "states", and
+       optionally "hazards"}.
+    '''
+
+    registry = SubscriptionRegistry(**kwargs)
+    with open(path) as file:
+        for line in file:
+            if not line.strip():
+                continue
+            spec = json.loads(line)
+            registry.add(spec.pop("id"), **spec)
+    return registry
+
+def synthetic_subscriptions(num_subscriptions, **kwargs):
+    '''Yields (sub_id, kwargs for add()) for random
+       airports, routes, areas and state lists over
+       DEF_SYNTHETIC_BBOX, for benchmarks.
+    '''
+
+    rng = random.Random(kwargs.get("seed", 0))
+    min_lat, min_lon, max_lat, max_lon = kwargs.get("bbox", DEF_SYNTHETIC_BBOX)
+    kinds = [kind for kind, _ in DEF_SYNTHETIC_MIX]
+    weights = [weight for _, weight in DEF_SYNTHETIC_MIX]
+
+    def random_point():
+        return (rng.uniform(min_lat, max_lat), rng.uniform(min_lon, max_lon))
+
+    for idx in range(num_subscriptions):
+        kind = rng.choices(kinds, weights)[0]
+        if kind == "point":
+            spec = {"point" : random_point()}
+        elif kind == "line":
+            start = random_point()
+            spec = {"line" : [start] + [(start[0] + rng.uniform(-3, 3), start[1] + rng.uniform(-4, 4)) for _ in range(rng.randint(1, 3))]}
+        elif kind == "polygon":
+            lat, lon = random_point()
+            size = rng.uniform(0.2, 1.5)
+            spec = {"polygon" : [(lat, lon), (lat + size, lon), (lat + size, lon + size), (lat, lon + size), (lat, lon)]}
+        else:
+            spec = {"states" : rng.sample(DEF_STATE_CODES, rng.randint(1, 3))}
+        if rng.random() < 0.2:
+            spec["hazards"] = [rng.choice(("ICE", "TURB", "IFR", "MTN_OBSCN"))]
+        yield f"sub{idx}", spec
+
+if __name__ == "__main__":
+
+    import archive
+
+    registry = load_subscriptions(sys.argv[1])
+    for path in sys.argv[2:]:
+        for airmet_dict in archive.load_airmets(path):
+            matches = registry.match_bulletin(airmet_dict)
+            if matches:
+                print(json.dumps({"airmet_id" : airmet_dict.get("airmet_id"), "matches" : matches}))
@@ -0,0 +1,404 @@
+import sys
+import os
+import math
+import random
+import textwrap
+from datetime import datetime, timedelta
+
+import airmet
+
+#(office, WMO header) for each AIRMET issuing region, with the states
+#(and Great Lakes/coastal waters) each region's bulletins usually cover
+DEF_REGIONS = {
+    "SFO" : ("WAUS46", 6, ["WA", "OR", "CA", "AND CSTL WTRS"]),
+    "SLC" : ("WAUS45", 5, ["ID", "MT", "WY", "NV", "UT", "CO", "AZ", "NM"]),
+    "CHI" : ("WAUS43", 3, ["ND", "SD", "NE", "KS", "MN", "IA", "MO", "WI", "LM", "LS", "MI", "LH", "IL", "IN", "KY"]),
+    "DFW" : ("WAUS44", 4, ["OK", "TX", "AR", "TN", "LA", "MS", "AL", "AND CSTL WTRS"]),
+    "BOS" : ("WAUS41", 1, ["ME", "NH", "VT", "MA", "RI", "CT", "NY", "LO", "NJ", "PA", "OH", "LE", "WV", "MD", "DC", "DE", "VA", "AND CSTL WTRS"]),
+    "MIA" : ("WAUS42", 2, ["NC", "SC", "GA", "FL", "AND CSTL WTRS"]),
+}
+
+#series letter -> (AIRMET name, header conditions, [(group qualifier, description), ...])
+DEF_SERIES = {
+    "S" : ("SIERRA", "IFR AND MTN OBSCN", [
+        ("AIRMET IFR", "CIG BLW 010/VIS BLW 3SM BR. CONDS CONTG BYD 21Z THRU 03Z."),
+        ("AIRMET IFR", "CIG BLW 010/VIS BLW 3SM PCPN/BR. CONDS ENDG 18Z-21Z."),
+        ("AIRMET MTN OBSCN", "MTNS OBSC BY CLDS/PCPN/BR. CONDS CONTG BYD 21Z THRU 03Z."),
+    ]),
+    "T" : ("TANGO", "TURB STG WNDS AND LLWS", [
+        ("AIRMET TURB", "MOD TURB BLW FL180. CONDS CONTG BYD 21Z THRU 03Z."),
+        ("AIRMET TURB", "MOD TURB BTN FL240 AND FL410. CONDS CONTG BYD 21Z ENDG 00Z-03Z."),
+        ("AIRMET STG SFC WNDS", "SUSTAINED SFC WINDS GTR THAN 30KT EXP. CONDS CONTG BYD 21Z ENDG 21Z-00Z."),
+    ]),
+    "Z" : ("ZULU", "ICE AND FRZLVL", [
+        ("AIRMET ICE", "MOD ICE BTN FRZLVL AND FL220. FRZLVL 080-120. CONDS CONTG BYD 21Z THRU 03Z."),
+        ("AIRMET ICE", "MOD ICE BLW 120. CONDS CONTG BYD 21Z ENDG 00Z-03Z."),
+    ]),
+}
+
+#SIGMET series names, each office issuing from its own subset
+DEF_SIGMET_SERIES = ("NOVEMBER", "OSCAR", "PAPA", "QUEBEC", "ROMEO", "UNIFORM", "VICTOR", "WHISKEY", "XRAY", "YANKEE")
+
+DEF_SIGMET_DESCS = (
+    "OCNL SEV TURB BTN FL280 AND FL380. DUE TO JTST. RPTD BY ACFT. CONDS CONTG BYD {valid}Z.",
+    "OCNL SEV ICE BTN 060 AND FL200. RPTD BY ACFT. CONDS CONTG BYD {valid}Z.",
+    "OCNL SEV TURB BLW 120. DUE TO STG LOW LVL WNDS. CONDS CONTG BYD {valid}Z.",
+)
+
+#Convective SIGMET regions (E/C/W), each as the states it covers
+DEF_CONVECTIVE_REGIONS = {
+    "E" : ["ME", "NY", "PA", "OH", "WV", "VA", "NC", "SC", "GA", "FL", "AL"],
+    "C" : ["ND", "SD", "NE", "KS", "OK", "TX", "MN", "IA", "MO", "AR", "LA", "WI", "IL"],
+    "W" : ["WA", "OR", "CA", "ID", "NV", "UT", "AZ", "MT", "WY", "CO", "NM"],
+}
+
+DEF_CARDINAL_DIRS = list(airmet.DEF_CARDINAL_DIR_TO_DEG_DICT)
+
+#Rough (south, north, west, east) bounds of every area code in DEF_REGIONS
+#and DEF_CONVECTIVE_REGIONS, Great Lakes included. A group's VORs are
+#drawn from around the states it names, not from the whole table.
+DEF_STATE_BBOXES = {
+    "WA" : (45.5, 49.0, -124.8, -116.9), "OR" : (42.0, 46.3, -124.6, -116.5), "CA" : (32.5, 42.0, -124.4, -114.1),
+    "ID" : (42.0, 49.0, -117.2, -111.0), "MT" : (44.4, 49.0, -116.1, -104.0), "WY" : (41.0, 45.0, -111.1, -104.1),
+    "NV" : (35.0, 42.0, -120.0, -114.0), "UT" : (37.0, 42.0, -114.1, -109.0), "CO" : (37.0, 41.0, -109.1, -102.0),
+    "AZ" : (31.3, 37.0, -114.8, -109.0), "NM" : (31.3, 37.0, -109.1, -103.0), "ND" : (45.9, 49.0, -104.1, -96.6),
+    "SD" : (42.5, 45.9, -104.1, -96.4), "NE" : (40.0, 43.0, -104.1, -95.3), "KS" : (37.0, 40.0, -102.1, -94.6),
+    "MN" : (43.5, 49.4, -97.2, -89.5), "IA" : (40.4, 43.5, -96.6, -90.1), "MO" : (36.0, 40.6, -95.8, -89.1),
+    "WI" : (42.5, 47.1, -92.9, -86.8), "LM" : (41.6, 46.1, -88.0, -84.8), "LS" : (46.4, 49.0, -92.1, -84.4),
+    "MI" : (41.7, 48.3, -90.4, -82.4), "LH" : (43.0, 46.3, -84.8, -79.7), "IL" : (37.0, 42.5, -91.5, -87.5),
+    "IN" : (37.8, 41.8, -88.1, -84.8), "KY" : (36.5, 39.1, -89.6, -82.0), "OK" : (33.6, 37.0, -103.0, -94.4),
+    "TX" : (25.8, 36.5, -106.6, -93.5), "AR" : (33.0, 36.5, -94.6, -89.6), "TN" : (35.0, 36.7, -90.3, -81.6),
+    "LA" : (29.0, 33.0, -94.0, -89.0), "MS" : (30.2, 35.0, -91.7, -88.1), "AL" : (30.2, 35.0, -88.5, -84.9),
+    "ME" : (43.1, 47.5, -71.1, -66.9), "NH" : (42.7, 45.3, -72.6, -70.6), "VT" : (42.7, 45.0, -73.4, -71.5),
+    "MA" : (41.2, 42.9, -73.5, -69.9), "RI" : (41.1, 42.0, -71.9, -71.1), "CT" : (41.0, 42.1, -73.7, -71.8),
+    "NY" : (40.5, 45.0, -79.8, -71.9), "LO" : (43.2, 44.2, -79.8, -76.1), "NJ" : (38.9, 41.4, -75.6, -73.9),
+    "PA" : (39.7, 42.3, -80.5, -74.7), "OH" : (38.4, 42.0, -84.8, -80.5), "LE" : (41.4, 42.9, -83.5, -78.9),
+    "WV" : (37.2, 40.6, -82.6, -77.7), "MD" : (37.9, 39.7, -79.5, -75.0), "DC" : (38.8, 39.0, -77.1, -76.9),
+    "DE" : (38.5, 39.8, -75.8, -75.0), "VA" : (36.5, 39.5, -83.7, -75.2), "NC" : (33.8, 36.6, -84.3, -75.5),
+    "SC" : (32.0, 35.2, -83.4, -78.5), "GA" : (30.4, 35.0, -85.6, -80.8), "FL" : (24.5, 31.0, -87.6, -80.0),
+}
+
+#Degrees a states box is grown by, at a time, until it holds enough VORs
+DEF_BBOX_GROW_DEG = 1.0
+
+DEF_LINE_WIDTH = 66
+
+class SyntheticCorpus():
+    ''' Generates realistic KKCI WA bulletins
+        for benchmarking and for feeding the
+        stand-in server. Every bulletin has a
+        header, 1-n AIRMET groups using either the
+        FROM/TO or BOUNDED BY scheme with real VOR
+        ids, and optionally an AMD header, LLWS
+        potential, FRZLVL and outlook groups.
+
+        A group's VORs are drawn from around the
+        states it names (DEF_STATE_BBOXES) and its
+        polygon is ordered by angle around their
+        centroid, so it is a simple ring.
+
+        The same seed always gives the same corpus.
+    '''
+
+    def __init__(self, **kwargs):
+
+        self.seed = kwargs.get("seed", 0)
+        self.groups_per_bulletin = kwargs.get("groups_per_bulletin", (1, 4))
+        self.vors_per_group = kwargs.get("vors_per_group", (4, 14))
+        self.amd_rate = kwargs.get("amd_rate", 0.1)
+        self.llws_rate = kwargs.get("llws_rate", 0.3)
+        self.frzlvl_rate = kwargs.get("frzlvl_rate", 0.8)
+        self.outlook_rate = kwargs.get("outlook_rate", 0.5)
+        self.bounded_by_rate = kwargs.get("bounded_by_rate", 0.25)
+        self.offset_rate = kwargs.get("offset_rate", 0.6)
+        self.convective_none_rate = kwargs.get("convective_none_rate", 0.3)
+
+        self._random = random.Random(self.seed)
+        self.vors = kwargs.get("vors") or _load_vors() #[(id, lat, lon), ...]
+        self.vor_ids = [vor for vor, _, _ in self.vors]
+        self._vors_by_states = {} #states tuple -> VORs around them
+
+    def bulletin(self, iss_time, office, series, **kwargs):
+        '''Returns the raw text of one bulletin.'''
+
+        rand = self._random
+        wmo_header, region_num, region_states = DEF_REGIONS[office]
+        airmet_type, header_conds, groups = DEF_SERIES[series]
+        amended = kwargs.get("amended", rand.random() < self.amd_rate)
+
+        #Bulletins are valid until the top of the hour ~6h after issuance (e.g. 0245 -> 0900)
+        valid_time = (iss_time + timedelta(hours=6, minutes=59)).replace(minute=0)
+        iss_str = iss_time.strftime("%d%H%M")
+        valid_str = valid_time.strftime("%d%H%M")
+        pil = f"WA{region_num}{series}"
+
+        lines = ["\x01", "000 ", f"{wmo_header} KKCI {iss_str}{' AAA' if amended else ''}", f"{pil} ",
+                 f"\x1e{office}{series} WA {iss_str}{' AMD' if amended else ''}",
+                 f"AIRMET {airmet_type} UPDT {rand.randint(1, 4)} FOR {header_conds} VALID UNTIL {valid_str}",
+                 "."]
+
+        blocks = []
+        for _ in range(rand.randint(*self.groups_per_bulletin)):
+            qualifier, desc = rand.choice(groups)
+            states = self._states(region_states)
+            blocks.append(self._group(qualifier, states, self._vor_block(states), desc))
+
+        if series == "T" and rand.random() < self.llws_rate:
+            states = self._states(region_states)
+            blocks.append(self._group("LLWS POTENTIAL", states, self._vor_block(states, bounded_by=True), "LLWS EXP. CONDS CONTG BYD 21Z THRU 03Z."))
+
+        if series == "Z" and rand.random() < self.frzlvl_rate:
+            blocks.append(self._frzlvl_group(region_states))
+
+        if rand.random() < self.outlook_rate:
+            qualifier, desc = rand.choice(groups)
+            hazard = qualifier.replace("AIRMET ", "")
+            valid_from = valid_time.strftime("%H%M")
+            valid_to = (valid_time + timedelta(hours=6)).strftime("%H%M")
+            states = self._states(region_states)
+            blocks.append(self._group(f"OTLK VALID {valid_from}-{valid_to}Z", [hazard] + [" ".join(states)], self._vor_block(states, bounded_by=True), desc))
+
+        for block in blocks:
+            lines += block + ["."]
+        lines[-1] = "...."
+
+        return "\n".join(lines) + "\n\n"
+
+    def sigmet(self, iss_time, office, number, **kwargs):
+        '''Returns the raw text of one (non-convective)
+           SIGMET, valid for 4h.
+        '''
+
+        rand = self._random
+        wmo_header, region_num, region_states = DEF_REGIONS[office]
+        name = kwargs.get("name", DEF_SIGMET_SERIES[(region_num - 1) % len(DEF_SIGMET_SERIES)])
+        valid_time = iss_time + timedelta(hours=4)
+        iss_str = iss_time.strftime("%d%H%M")
+
+        states = self._states(region_states)
+        lines = ["\x01", "000 ", f"{wmo_header.replace('WA', 'WS')} KKCI {iss_str}", f"WS{region_num}{name[0]} ",
+                 f"\x1e{office}{name[0]} WS {iss_str}",
+                 f"SIGMET {name} {number} VALID UNTIL {valid_time.strftime('%d%H%M')}",
+                 " ".join(states)]
+        lines += textwrap.wrap("FROM " + " TO ".join(self._vor_list(states)), DEF_LINE_WIDTH, break_on_hyphens=False)
+        lines += textwrap.wrap(rand.choice(DEF_SIGMET_DESCS).format(valid=valid_time.strftime("%H%M")), DEF_LINE_WIDTH)
+
+        return "\n".join(lines) + "\n\n"
+
+    def convective_sigmet(self, iss_time, region, first_number, **kwargs):
+        '''Returns the raw text of one convective SIGMET
+           bulletin for region (E/C/W), numbered from
+           first_number, with an outlook. Returns
+           (text, number of SIGMETs in it).
+        '''
+
+        rand = self._random
+        region_states = DEF_CONVECTIVE_REGIONS[region]
+        valid_str = (iss_time + timedelta(hours=2)).strftime("%H%M")
+        iss_str = iss_time.strftime("%d%H%M")
+        wmo_header = {"E" : "WSUS31", "C" : "WSUS32", "W" : "WSUS33"}[region]
+
+        lines = ["\x01", "000 ", f"{wmo_header} KKCI {iss_str}", f"WST{region} ", f"\x1eMKC{region} WST {iss_str}"]
+
+        num_sigmets = 0 if rand.random() < self.convective_none_rate else rand.randint(1, 3)
+        if not num_sigmets:
+            lines += [f"CONVECTIVE SIGMET...NONE", ""]
+        for idx in range(num_sigmets):
+            states = self._states(region_states)
+            lines += [f"CONVECTIVE SIGMET {first_number + idx}{region}", f"VALID UNTIL {valid_str}Z", " ".join(states)]
+            kind = rand.choice(["AREA", "LINE", "ISOL"])
+            if kind == "ISOL":
+                lines += [f"FROM {self._vor(states)}", f"ISOL SEV TS D{rand.randint(1, 4) * 10}. MOV FROM {rand.randint(18, 32)}0{rand.randint(10, 45)}KT. TOPS TO FL{rand.randint(35, 50)}0."]
+            else:
+                vors = self._vor_list(states) if kind == "AREA" else self._vor_line(states, rand.randint(2, 4))
+                lines += textwrap.wrap("FROM " + "-".join(vors), DEF_LINE_WIDTH, break_on_hyphens=False)
+                width = f" {rand.randint(2, 4) * 10} NM WIDE" if kind == "LINE" else ""
+                lines += [f"{kind} TS{width} MOV FROM {rand.randint(18, 32)}0{rand.randint(10, 45)}KT. TOPS TO FL{rand.randint(35, 50)}0.", ""]
+
+        otlk_from = iss_time + timedelta(hours=2)
+        lines += [f"OUTLOOK VALID {otlk_from.strftime('%d%H%M')}-{(otlk_from + timedelta(hours=4)).strftime('%d%H%M')}"]
+        for area in range(1, rand.randint(1, 2) + 1):
+            lines += textwrap.wrap(f"AREA {area}...FROM " + "-".join(self._vor_list(self._states(region_states))), DEF_LINE_WIDTH, break_on_hyphens=False)
+            lines += ["WST ISSUANCES POSS. REFER TO MOST RECENT ACUS01 KWNS FROM STORM", "PREDICTION CENTER FOR SYNOPSIS AND METEOROLOGICAL DETAILS.", ""]
+
+        return "\n".join(lines) + "\n", num_sigmets
+
+    def sigmets_for_day(self, date, **kwargs):
+        '''Product dicts for one day of SIGMETs: hourly
+           convective SIGMET bulletins (pils WSTE/WSTC/WSTW)
+           at HH55 and num_sigmets random SIGMETs (pils
+           WS<region><series letter>).
+        '''
+
+        products = []
+        for hour in range(24):
+            iss_time = datetime(date.year, date.month, date.day, hour, 55)
+            for region in DEF_CONVECTIVE_REGIONS:
+                text, _ = self.convective_sigmet(iss_time, region, hour * 3 + 1)
+                wmo_header = text.split("\n")[2].split(" ")[0]
+                products.append({"product_id" : f"{iss_time.strftime('%Y%m%d%H%M')}-KKCI-{wmo_header}-WST{region}", "pil" : f"WST{region}", "text" : text})
+
+        for number in range(1, kwargs.get("num_sigmets", 4) + 1):
+            office = self._random.choice(list(DEF_REGIONS))
+            iss_time = datetime(date.year, date.month, date.day, self._random.randint(0, 23), self._random.randint(0, 59))
+            text = self.sigmet(iss_time, office, number)
+            header_lines = text.split("\n")
+            products.append({"product_id" : f"{iss_time.strftime('%Y%m%d%H%M')}-KKCI-{header_lines[2].split(' ')[0]}-{header_lines[3].strip()}",
+                             "pil" : header_lines[3].strip(), "text" : text})
+
+        return products
+
+    def bulletins_for_day(self, date, **kwargs):
+        '''Returns a list of product dicts ("product_id",
+           "pil", "text") like the IEM listing: every region
+           and series issued at the regular 0245/0845/1445/2045Z
+           times, plus num_extra random amendments. With
+           sigmets=True the day's SIGMETs and convective
+           SIGMETs (sigmets_for_day) are listed too.
+        '''
+
+        num_extra = kwargs.get("num_extra", 0)
+        products = []
+
+        issue_times = [datetime(date.year, date.month, date.day, hour, 45) for hour in (2, 8, 14, 20)]
+        schedule = [(iss_time, office, series, False) for iss_time in issue_times for office in DEF_REGIONS for series in DEF_SERIES]
+        for _ in range(num_extra):
+            amd_time = datetime(date.year, date.month, date.day, self._random.randint(0, 23), self._random.randint(0, 59))
+            schedule.append((amd_time, self._random.choice(list(DEF_REGIONS)), self._random.choice(list(DEF_SERIES)), True))
+        schedule.sort(key=lambda entry: entry[0])
+
+        for idx, (iss_time, office, series, amended) in enumerate(schedule):
+            text = self.bulletin(iss_time, office, series, amended=amended)
+            wmo_header, region_num, _ = DEF_REGIONS[office]
+            pil = f"WA{region_num}{series}"
+            product_id = f"{iss_time.strftime('%Y%m%d%H%M')}-KKCI-{wmo_header}-{pil}"
+            if any(prod["product_id"] == product_id for prod in products):
+                product_id += f"-{idx}"
+            products.append({"product_id" : product_id, "pil" : pil, "text" : text})
+
+        if kwargs.get("sigmets"):
+            products += self.sigmets_for_day(date, **kwargs)
+            products.sort(key=lambda prod: prod["product_id"][:12])
+
+        return products
+
+    def corpus(self, start_date, num_days, **kwargs):
+        '''Yields (date, products) for num_days days.'''
+        for day_idx in range(num_days):
+            date = start_date + timedelta(days=day_idx)
+            yield date, self.bulletins_for_day(date, **kwargs)
+
+    def _states(self, region_states):
+        rand = self._random
+        states = [state for state in region_states if state != "AND CSTL WTRS"]
+        chosen = rand.sample(states, rand.randint(1, min(len(states), 8)))
+        chosen.sort(key=states.index)
+        if "AND CSTL WTRS" in region_states and rand.random() < 0.3:
+            chosen.append("AND CSTL WTRS")
+        return chosen
+
+    def _region_vors(self, states):
+        #VORs inside the box around states, grown until it holds enough for a group
+        key = tuple(states)
+        if key not in self._vors_by_states:
+            boxes = [DEF_STATE_BBOXES[state] for state in states if state in DEF_STATE_BBOXES]
+            if not boxes:
+                self._vors_by_states[key] = self.vors
+                return self.vors
+            south, north = min(box[0] for box in boxes), max(box[1] for box in boxes)
+            west, east = min(box[2] for box in boxes), max(box[3] for box in boxes)
+            while True:
+                inside = [vor for vor in self.vors if south <= vor[1] <= north and west <= vor[2] <= east]
+                if len(inside) >= self.vors_per_group[1] or len(inside) == len(self.vors):
+                    break
+                south, north, west, east = south - DEF_BBOX_GROW_DEG, north + DEF_BBOX_GROW_DEG, west - DEF_BBOX_GROW_DEG, east + DEF_BBOX_GROW_DEG
+            self._vors_by_states[key] = inside
+        return self._vors_by_states[key]
+
+    def _offset(self, vor):
+        #(VOR string, approximate lat, lon of the point it names)
+        rand = self._random
+        name, lat, lon = vor
+        if rand.random() >= self.offset_rate:
+            return name, lat, lon
+        distance_nm, cardinal = rand.randint(1, 16) * 10, rand.choice(DEF_CARDINAL_DIRS)
+        bearing_rad = math.radians(airmet.DEF_CARDINAL_DIR_TO_DEG_DICT[cardinal])
+        return (f"{distance_nm}{cardinal} {name}", lat + distance_nm / 60 * math.cos(bearing_rad),
+                lon + distance_nm / 60 * math.sin(bearing_rad) / max(math.cos(math.radians(lat)), 0.1))
+
+    def _vor(self, states):
+        return self._offset(self._random.choice(self._region_vors(states)))[0]
+
+    def _vor_line(self, states, num_vors):
+        #An open line of VORs, west to east
+        candidates = self._region_vors(states)
+        points = [self._offset(vor) for vor in self._random.sample(candidates, min(num_vors, len(candidates)))]
+        points.sort(key=lambda point: point[2])
+        return [point[0] for point in points]
+
+    def _vor_list(self, states):
+        #Distinct VORs around states, in angle order around their centroid, closed like the real bulletins
+        candidates = self._region_vors(states)
+        num_vors = min(self._random.randint(*self.vors_per_group), len(candidates))
+        points = [self._offset(vor) for vor in self._random.sample(candidates, num_vors)]
+        center_lat = sum(point[1] for point in points) / len(points)
+        center_lon = sum(point[2] for point in points) / len(points)
+        points.sort(key=lambda point: math.atan2(point[1] - center_lat, (point[2] - center_lon) * math.cos(math.radians(center_lat))))
+        vors = [point[0] for point in points]
+        return vors + [vors[0]]
+
+    def _vor_block(self, states, **kwargs):
+        bounded_by = kwargs.get("bounded_by", self._random.random() < self.bounded_by_rate)
+        vors = self._vor_list(states)
+        if bounded_by:
+            text = "BOUNDED BY " + "-".join(vors)
+        else:
+            text = "FROM " + " TO ".join(vors)
+        return textwrap.wrap(text, DEF_LINE_WIDTH, break_on_hyphens=False)
+
+    def _group(self, qualifier, states, vor_lines, desc):
+        return [f"{qualifier}...{' '.join(states)}"] + vor_lines + textwrap.wrap(desc, DEF_LINE_WIDTH)
+
+    def _frzlvl_group(self, region_states):
+        rand = self._random
+        low = rand.choice(["SFC", "040", "060", "080"])
+        lines = [f"FRZLVL...RANGING FROM {low}-{rand.choice(['100', '120', '140'])} ACRS AREA"]
+        for level in ("SFC", "040", "080", "120")[:rand.randint(1, 4)]:
+            vors = self._vor_line(self._states(region_states), rand.randint(3, 6))
+            lines += textwrap.wrap(f"   {level} ALG " + "-".join(vors), DEF_LINE_WIDTH, subsequent_indent="   ", break_on_hyphens=False)
+        return lines
+
+def _load_vors():
+    from vors import get_vor_table
+
+    table = get_vor_table()
+    return [(vor_id.decode().rstrip("\0"), float(lat), float(lon)) for vor_id, lat, lon in zip(table.ids, table.lat, table.lon)
+            if lat == lat] #skip VORs without coordinates
+
+def write_corpus(save_dir, start_date, num_days, **kwargs):
+    '''Writes one AllAIRMET_RawText_YYYYMMDD.txt per day,
+       the same format download() saves. Returns the list
+       of paths written.
+    '''
+
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+
+    generator = SyntheticCorpus(**kwargs)
+    paths = []
+    for date, products in generator.corpus(start_date, num_days, num_extra=kwargs.get("num_extra", 0)):
+        path = os.path.join(save_dir, f"AllAIRMET_RawText_{date.strftime('%Y%m%d')}.txt")
+        with open(path, "w") as file:
+            for prod in products:
+                file.write(prod["text"])
+        paths.append(path)
+
+    return paths
+
+if __name__ == "__main__":
+
+    save_dir = sys.argv[1]
+    num_days = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+
+    paths = write_corpus(save_dir, datetime(2020, 3, 1), num_days, num_extra=8)
+    print(f"Wrote {len(paths)} day(s) of synthetic AIRMETs to {save_dir}")
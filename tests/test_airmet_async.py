@@ -0,0 +1,45 @@
+import os
+import sys
+import asyncio
+from datetime import datetime
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import airmet
+import quarantine
+import standin
+
+pytest.importorskip("aiohttp")
+
+import airmet_async
+
+def stuck_on_wa6s(raw_text, year, month, **kwargs):
+    #Never returns for the WA6S bulletins, parses the rest
+    while "WA6S" in raw_text[:200]:
+        pass
+    return airmet.parse_airmet(raw_text, year, month, **kwargs)
+
+@pytest.fixture(scope="module")
+def server():
+    with standin.StandinIEMServer.from_synthetic(datetime(2020, 3, 1), 1) as server:
+        yield server
+
+async def _collect(**kwargs):
+    async with airmet_async.AsyncAirmetClient(**kwargs) as client:
+        return [airmet_dict async for airmet_dict in client.iter_airmets(2020, 3, 1)], client.quarantine
+
+@pytest.mark.parametrize("parse_processes", [0, 1])
+def test_overrunning_parse_is_quarantined(server, tmp_path, parse_processes):
+    quarantine_path = str(tmp_path / "quarantine.ndjson")
+    airmets, held = asyncio.run(_collect(base_url=server.url, parser=stuck_on_wa6s, parse_budget=0.5,
+                                         parse_processes=parse_processes, quarantine_path=quarantine_path))
+
+    errors = [airmet_dict for airmet_dict in airmets if "error" in airmet_dict]
+    assert errors and all("ParseBudgetExceeded" in airmet_dict["error"] for airmet_dict in errors)
+    records = list(quarantine.load_quarantine(quarantine_path))
+    assert sorted(record["product_id"] for record in records) == sorted(airmet_dict["product_id"] for airmet_dict in errors)
+    assert all(record["pil"] == "WA6S" and "WA6S" in record["raw_text"] for record in records)
+    assert len(held) == len(records)
+    assert all("airmet_id" in airmet_dict for airmet_dict in airmets if "error" not in airmet_dict)
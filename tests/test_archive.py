@@ -0,0 +1,86 @@
+import os
+import sys
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import archive
+
+def _airmets(num):
+    airmets = []
+    for idx in range(num):
+        iss_time = datetime(2020, 3, 13) + timedelta(hours=6 * (idx // 3))
+        airmets.append({
+            "airmet_id" : f"WA{idx % 3 + 4}Z",
+            "iss_year" : iss_time.year, "iss_month" : iss_time.month, "iss_day" : iss_time.day,
+            "iss_hour" : iss_time.hour, "iss_minute" : 45,
+            "desc" : "MOD ICE BTN FRZLVL AND FL220 °" * (idx % 4), #non-ASCII, so offsets are bytes, not characters
+        })
+    return airmets
+
+def _write(path, airmets, **kwargs):
+    with archive.open_output(path, compression=kwargs.get("compression")) as output:
+        writer = archive.JSONArrayWriter(output, index=True, pretty=kwargs.get("pretty", False), block_records=kwargs.get("block_records", 4))
+        for idx, airmet_dict in enumerate(airmets):
+            writer.write(airmet_dict, product_id=f"P{idx:03d}")
+        writer.close()
+    return output.path
+
+@pytest.mark.parametrize("compression", [None, "gzip", "zstd"])
+@pytest.mark.parametrize("pretty", [False, True])
+def test_index_round_trip(tmp_path, compression, pretty):
+    if compression == "zstd":
+        pytest.importorskip("zstandard")
+    airmets = _airmets(23)
+    path = _write(str(tmp_path / "AllAIRMETS_20200313.json"), airmets, compression=compression, pretty=pretty)
+
+    assert archive.load_airmets(path) == airmets
+    index = archive.read_index(path)
+    assert index is not None and len(index["records"]) == len(airmets)
+    assert len({record[3] for record in index["records"]}) == 6 #blocks of 4
+
+    with archive.AirmetArchive(path) as airmet_archive:
+        assert list(airmet_archive) == airmets
+        assert [airmet_archive.read(pos) for pos in (22, 0, 9)] == [airmets[22], airmets[0], airmets[9]]
+        assert airmet_archive.get_product("P007") == airmets[7]
+        assert airmet_archive.get("WA5Z", iss_time=datetime(2020, 3, 13, 6, 45)) == airmets[4]
+        assert airmet_archive.find("WA5Z") == airmets[1::3]
+        with pytest.raises(KeyError):
+            airmet_archive.get("WA5Z", iss_time=datetime(2020, 3, 12, 6, 45))
+
+def test_stale_index_falls_back_to_loading(tmp_path):
+    airmets = _airmets(10)
+    path = _write(str(tmp_path / "AllAIRMETS_20200313.json"), airmets)
+    with open(path, "w") as file:
+        json.dump(airmets[:5], file)
+
+    assert archive.read_index(path) is None
+    with archive.AirmetArchive(path) as airmet_archive:
+        assert len(airmet_archive) == 5
+        assert airmet_archive.get("WA4Z", iss_time=datetime(2020, 3, 13, 6, 45)) == airmets[3]
+
+def test_rewrite_keeps_product_ids(tmp_path):
+    airmets = _airmets(10)
+    path = _write(str(tmp_path / "AllAIRMETS_20200313.json"), airmets)
+    new_path = archive.rewrite(path, compression="gzip")
+
+    assert new_path.endswith(".gz")
+    with archive.AirmetArchive(new_path) as airmet_archive:
+        assert airmet_archive.index is not None
+        assert airmet_archive.get_product("P009") == airmets[9]
+
+def test_lookup_opens_the_issuance_day(tmp_path):
+    airmets = _airmets(12)
+    _write(archive.daily_path(str(tmp_path), datetime(2020, 3, 13)), airmets, compression="gzip")
+
+    archives = {}
+    assert archive.lookup(str(tmp_path), "WA6Z", datetime(2020, 3, 13, 18, 45), archives=archives) == airmets[11]
+    assert archive.lookup(str(tmp_path), "WA4Z", datetime(2020, 3, 13, 0, 45)) == airmets[0]
+    assert len(archives) == 1
+    with pytest.raises(FileNotFoundError):
+        archive.lookup(str(tmp_path), "WA4Z", datetime(2020, 3, 14, 0, 45))
+    for airmet_archive in archives.values():
+        airmet_archive.close()
@@ -0,0 +1,59 @@
+import os
+import sys
+from datetime import timedelta
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import composite
+import geometry
+
+def _square(lat, lon, size=2.0):
+    return [(lat, lon), (lat, lon + size), (lat + size, lon + size), (lat + size, lon), (lat, lon)]
+
+def test_merge_dissolves_overlapping_polygons():
+    pytest.importorskip("shapely")
+    polygons = [_square(30.0, -100.0), _square(31.0, -99.0), _square(40.0, -90.0)]
+    merged = composite.merge_polygons(polygons)
+
+    assert len(merged) == 2
+    assert [rings[0] for rings in merged if len(rings[0]) == 5] == [_square(40.0, -90.0)]
+    [outline] = [rings for rings in merged if len(rings[0]) != 5]
+    assert len(outline) == 1 and len(outline[0]) == 9 #an L-shaped octagon, closed
+    assert geometry.polygon_area_nm2(outline[0]) == pytest.approx(geometry.polygon_area_nm2(_square(30.0, -100.0)) * 1.75, rel=0.02)
+
+def test_merge_without_shapely_raises(monkeypatch):
+    monkeypatch.setitem(sys.modules, "shapely.geometry", None)
+    with pytest.raises(ImportError, match="pip install shapely"):
+        composite.merge_polygons([_square(30.0, -100.0)])
+
+def _bulletin(vors, hour, **kwargs):
+    return {
+        "airmet_id" : kwargs.get("airmet_id", "WA4S"),
+        "airmet_type" : "SIERRA",
+        "iss_year" : 2020, "iss_month" : 3, "iss_day" : 1, "iss_hour" : hour, "iss_minute" : 45,
+        "valid_year" : 2020, "valid_month" : 3, "valid_day" : 1, "valid_hour" : hour + 6, "valid_minute" : 0,
+        "subgroups" : [{"qualifiers" : ["AIRMET IFR"], "states" : ["TX"], "vors" : vors}],
+    }
+
+def test_builder_expires_past_layers():
+    pytest.importorskip("shapely")
+    vors = ["LBB", "CDS", "ABI", "MAF", "LBB"]
+    builder = composite.CompositeBuilder()
+    [first] = builder.build([_bulletin(vors, 2)])
+    assert builder.build([_bulletin(vors, 2)]) == [first] and builder.stats["hits"] == 1
+
+    #The next issuance comes after the first one's valid time, so its layer goes
+    second = builder.build([_bulletin(vors, 2), _bulletin(vors, 8)])[1]
+    assert list(builder.cache) == [("IFR", second["valid_time"])] and builder.stats["expired"] == 1
+    assert builder.build([_bulletin(vors, 2)], now=second["valid_time"] + timedelta(minutes=1)) == [first]
+    assert builder.cache == {}
+
+def test_builder_polygon_cache_is_bounded():
+    builder = composite.CompositeBuilder(polygon_cache_size=2)
+    routes = [["LBB", "CDS", "ABI", "LBB"], ["TXK", "GGG", "LFK", "TXK"], ["MAF", "ABI", "SPS", "MAF"]]
+    for vors in routes + routes[2:]:
+        builder._polygon(vors)
+    builder._polygon(routes[1])
+    assert list(builder.polygon_cache) == [tuple(routes[2]), tuple(routes[1])]
@@ -0,0 +1,71 @@
+import os
+import sys
+import json
+import copy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import diff
+
+#Two IFR areas over Texas, west and east, both in TX only
+DEF_WEST_VORS = ["LBB", "CDS", "ABI", "MAF", "LBB"]
+DEF_EAST_VORS = ["TXK", "GGG", "LFK", "ACT", "SPS", "TXK"]
+
+def _bulletin(groups, hour, **kwargs):
+    return {
+        "airmet_id" : kwargs.get("airmet_id", "WA4S"),
+        "product_id" : f"20200301{hour:02d}45-KKCI-WAUS44-WA4S",
+        "iss_year" : 2020, "iss_month" : 3, "iss_day" : 1, "iss_hour" : hour, "iss_minute" : 45,
+        "valid_year" : 2020, "valid_month" : 3, "valid_day" : 1, "valid_hour" : hour + 6, "valid_minute" : 0,
+        "subgroups" : [{"qualifiers" : ["AIRMET IFR"], "states" : ["TX"], "vors" : vors, "desc" : desc} for vors, desc in groups],
+    }
+
+def _shifted(vors, offset):
+    return [f"{offset} {vor}" for vor in vors]
+
+def test_moved_area_pairs_by_overlap():
+    #Every VOR string of the west area changes, but it only moves 20nm north
+    old = _bulletin([(DEF_WEST_VORS, "CIG BLW 010."), (DEF_EAST_VORS, "CIG BLW 010.")], 2)
+    new = _bulletin([(DEF_EAST_VORS, "CIG BLW 010."), (_shifted(DEF_WEST_VORS, "20N"), "CIG BLW 010.")], 8)
+    delta = diff.diff_airmets(old, new)
+
+    assert (delta["added"], delta["removed"], delta["unchanged"]) == ([], [], 1)
+    [change] = delta["modified"]
+    assert change["before"]["vors"] == DEF_WEST_VORS
+    assert 0.3 < change["geometry"]["iou"] < 1
+    assert abs(change["geometry"]["area_change"]) < 0.1
+    assert [edit["op"] for edit in change["vertices"]] == ["replace"]
+
+def test_moved_areas_pair_with_their_own_successor():
+    #Both areas move and swap places in the list: only polygon overlap tells them apart
+    old = _bulletin([(DEF_WEST_VORS, "CIG BLW 010."), (DEF_EAST_VORS, "CIG BLW 010.")], 2)
+    new = _bulletin([(_shifted(DEF_EAST_VORS, "20N"), "CIG BLW 010."), (_shifted(DEF_WEST_VORS, "20N"), "CIG BLW 010.")], 8)
+    modified = diff.diff_airmets(old, new)["modified"]
+    assert sorted((change["before"]["vors"][0], change["after"]["vors"][0]) for change in modified) == [("LBB", "20N LBB"), ("TXK", "20N TXK")]
+
+def test_disjoint_area_is_added_and_removed():
+    old = _bulletin([(DEF_WEST_VORS, "CIG BLW 010.")], 2)
+    new = _bulletin([(DEF_EAST_VORS, "CIG BLW 010.")], 8)
+    old["subgroups"][0]["states"] = ["NM"]
+    delta = diff.diff_airmets(old, new)
+    assert [group["vors"] for group in delta["added"]] == [DEF_EAST_VORS]
+    assert [group["vors"] for group in delta["removed"]] == [DEF_WEST_VORS]
+    assert delta["modified"] == []
+
+def test_unresolvable_vors_fall_back_to_vertex_jaccard():
+    old = _bulletin([(["XXA", "XXB", "XXC", "XXD", "XXA"], "CIG BLW 010.")], 2)
+    new = _bulletin([(["XXA", "XXB", "XXC", "XXE", "XXA"], "CIG BLW 010.")], 8)
+    [change] = diff.diff_airmets(old, new)["modified"]
+    assert "geometry" not in change
+    assert change["vertices"] == [{"op" : "replace", "at" : 3, "before" : ["XXD"], "after" : ["XXE"]}]
+
+def test_tracker_state_round_trip():
+    bulletins = [_bulletin([(_shifted(DEF_WEST_VORS, f"{10 * hour}N"), f"CIG BLW 0{hour:02d}.")], hour) for hour in range(0, 12, 2)]
+    tracker = diff.DiffTracker()
+    for airmet_dict in bulletins[:3]:
+        tracker.update(airmet_dict)
+    restored = diff.DiffTracker(state=json.loads(json.dumps(tracker.state())))
+
+    for airmet_dict in bulletins[3:]:
+        assert tracker.update(copy.deepcopy(airmet_dict)) == restored.update(copy.deepcopy(airmet_dict))
+    assert tracker.update(bulletins[0]) is None #older than the latest of its series
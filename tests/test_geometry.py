@@ -0,0 +1,68 @@
+import os
+import sys
+import random
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import geometry
+
+def _edges(ring):
+    points = ring[:-1] if ring[0] == ring[-1] else ring
+    return [(points[idx], points[(idx + 1) % len(points)]) for idx in range(len(points))]
+
+def _simplification_crossings(simplified, ring):
+    #Crossing edge pairs of simplified, leaving out those between two edges of ring itself
+    original = set(_edges(ring))
+    edges = _edges(simplified)
+    crossings = 0
+    for pos_a in range(len(edges)):
+        for pos_b in range(pos_a + 2, len(edges)):
+            if pos_a == 0 and pos_b == len(edges) - 1:
+                continue
+            if edges[pos_a] in original and edges[pos_b] in original:
+                continue
+            crossings += geometry.segments_intersect(*edges[pos_a], *edges[pos_b])
+    return crossings
+
+def _random_ring(rng):
+    ring = [(40 + rng.uniform(0, 3), -100 + rng.uniform(0, 3)) for _ in range(rng.randint(6, 18))]
+    return ring + [ring[0]]
+
+def test_simplify_never_adds_crossings():
+    rng = random.Random(39)
+    for _ in range(300):
+        ring = _random_ring(rng)
+        for tolerance in geometry.DEF_LOD_TOLERANCES_DEG[1:]:
+            simplified = geometry.simplify_polygon(ring, tolerance)
+            assert _simplification_crossings(simplified, ring) == 0, (ring, tolerance)
+            assert simplified[0] == simplified[-1] and len(simplified) >= 4
+            assert set(simplified) <= set(ring)
+
+def test_simplify_repairs_past_an_original_crossing():
+    #The ring crosses itself as issued, and simplifying it makes a second crossing that must still be repaired
+    ring = [(41.2, -98.9), (42.0, -99.8), (40.6, -97.8), (41.1, -98.9), (42.9, -97.4), (42.6, -97.9), (41.2, -98.9)]
+    assert _simplification_crossings(geometry.simplify_polygon(ring, 0.2), ring) == 0
+
+def test_simplify_drops_only_near_vertices():
+    square = [(30.0, -100.0), (30.0, -99.0), (30.01, -98.5), (30.0, -98.0), (32.0, -98.0), (32.0, -100.0), (30.0, -100.0)]
+    assert geometry.simplify_polygon(square, 0.0) == square
+    assert geometry.simplify_polygon(square, 0.05) == [(30.0, -100.0), (30.0, -98.0), (32.0, -98.0), (32.0, -100.0), (30.0, -100.0)]
+
+def test_subgroup_lods_cached_and_bounded():
+    vors = ["LBB", "CDS", "ABI", "MAF", "LBB"]
+    lods = geometry.subgroup_lods(vors)
+    assert len(lods) == len(geometry.DEF_LOD_TOLERANCES_DEG)
+    assert lods[0] == geometry.subgroup_polygon(vors)
+    assert geometry.subgroup_lods(list(vors)) is lods
+    assert geometry.subgroup_lods(["XXA", "XXB", "XXC", "XXA"]) is None
+    assert geometry._cached_lods.cache_info().maxsize == geometry.DEF_LOD_CACHE_SIZE
+
+def test_polygon_iou():
+    square = [(30.0, -100.0), (30.0, -98.0), (32.0, -98.0), (32.0, -100.0), (30.0, -100.0)]
+    half = [(31.0, -100.0), (31.0, -98.0), (33.0, -98.0), (33.0, -100.0), (31.0, -100.0)]
+    away = [(40.0, -100.0), (40.0, -98.0), (42.0, -98.0), (42.0, -100.0), (40.0, -100.0)]
+    assert geometry.polygon_iou(square, square) == pytest.approx(1.0)
+    assert geometry.polygon_iou(square, half) == pytest.approx(1 / 3, abs=0.05)
+    assert geometry.polygon_iou(square, away) == 0
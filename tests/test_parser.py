@@ -0,0 +1,199 @@
+import os
+import re
+import sys
+import time
+import random
+from datetime import datetime
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import airmet
+import subclasses
+import synthetic
+
+#A WA6Z with every VOR scheme AIRMETs use: FROM/TO, BOUNDED BY with a
+#wrapped offset VOR ("40N#BKE"), and a FRZLVL contour list ended by a lone "."
+DEF_ZULU_BULLETIN = (
+    "\x01\n000 \nWAUS46 KKCI 010245\nWA6Z \n\x1eSFOZ WA 010245\n"
+    "AIRMET ZULU UPDT 3 FOR ICE AND FRZLVL VALID UNTIL 010900\n.\n"
+    "AIRMET ICE...WA OR CA AND CSTL WTRS\n"
+    "FROM 140NNE ENI TO PYE TO 80SE OAK TO 90E EHF TO 130NNE HEC TO BAM\n"
+    "TO 40ESE DNJ TO FCA TO MLP TO 140NNE BKE TO 90NNW BTG TO OED TO\n"
+    "140NNE ENI\n"
+    "MOD ICE BTN FRZLVL AND FL220. FRZLVL 080-120. CONDS CONTG BYD 21Z\n"
+    "THRU 03Z.\n.\n"
+    "AIRMET ICE...WA CA\n"
+    "BOUNDED BY 30WSW OAK-160SW BTY-70SW TWF-130SSW BOI-30WSW OAK\n"
+    "MOD ICE BLW 120. CONDS CONTG BYD 21Z ENDG 00Z-03Z.\n.\n"
+    "FRZLVL...RANGING FROM 040-140 ACRS AREA\n"
+    "   SFC ALG 160SW REO-IMB-20WNW MZB\n.\n"
+    "OTLK VALID 0900-1500Z...ICE WA CA AND CSTL WTRS\n"
+    "BOUNDED BY PYE-10SW FMG-40NNW MZB-BTY-130ENE TWF-DNJ-MLP-40N\n"
+    "BKE-30ENE IMB-PDX-DSD-80W HQM-EUG-PYE\n"
+    "MOD ICE BLW 120. CONDS CONTG BYD 21Z ENDG 00Z-03Z.\n....\n"
+)
+
+#The VOR patterns as they were before they were made linear time, kept to
+#check the shared DEF_*_RE constants in subclasses.py against
+DEF_OLD_SCHEME3_VOR_RE = r"(\d{1,3}[A-Z]{1,3}(\s|\#))?[A-Z]{3}(?![A-Z\d])"
+
+DEF_OLD_TO_NEW_PATTERNS = (
+    (r"FROM(\s|\#)(((\d|[A-Z]){3,6}(\s|\#)([A-Z]){3})|([A-Z]){3}(?!-))", subclasses.DEF_SCHEME1_FROM_RE),
+    (r"TO(\s|\#)(((\d|[A-Z]){3,6}(\s|\#)([A-Z]){3})|([A-Z]){3}(?!-))", subclasses.DEF_SCHEME1_TO_RE),
+    (r"(BOUNDED BY)(\s|\#)(((\d|[A-Z]){3,6}(\s|\#)([A-Z]){3})|([A-Z]){3})", subclasses.DEF_SCHEME2_BOUNDED_RE),
+    (r"-(\#(\s)*)*(((\d|[A-Z]){3,6}(\s|\#)([A-Z]){3})|([A-Z]){3})", subclasses.DEF_SCHEME2_DASH_RE),
+    (DEF_OLD_SCHEME3_VOR_RE, subclasses.DEF_SCHEME3_VOR_RE),
+    (rf"(?<![A-Z\d]){DEF_OLD_SCHEME3_VOR_RE}((\s|\#)*-(\s|\#)*{DEF_OLD_SCHEME3_VOR_RE})+", subclasses.DEF_SCHEME3_CHAIN_RE),
+    (rf"(?<=FROM(\s|\#)){DEF_OLD_SCHEME3_VOR_RE}", subclasses.DEF_SCHEME3_FROM_RE),
+)
+
+#"SEE SIGMET ... SERIES" in parse_airmet, old and new. The old one splits
+#every word after a "$" every possible way before it gives up.
+DEF_OLD_SIGMET_SERIES_RE = r"\$(\w+|\s)+\$\#\."
+DEF_SIGMET_SERIES_RE = r"\$[\w\s]+\$\#\."
+
+DEF_MUTATION_ALPHABET = "ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789 #-$."
+
+#Separators and offsets around each VOR, which the corpus rarely varies
+DEF_EDGE_CASE_SEPARATORS = ("", " ", "#", "##", "# #", "#  #", " #", "- ", "-", "#-#", " - ")
+DEF_EDGE_CASE_VORS = ("ABC", "40NW ABC", "40NW#ABC", "4N ABC", "1234567 ABC", "ABCD", "AB1", "12Z", "100")
+
+def _sanitized_corpus():
+    corpus = synthetic.SyntheticCorpus(seed=7)
+    for _, products in corpus.corpus(datetime(2020, 3, 1), 1):
+        for product in products:
+            yield airmet._sanitize_for_reading(product["text"])
+
+def _mutated(text, rng, num_edits):
+    chars = list(text)
+    for _ in range(num_edits):
+        pos = rng.randrange(len(chars))
+        op = rng.random()
+        if op < 0.4:
+            chars[pos] = rng.choice(DEF_MUTATION_ALPHABET)
+        elif op < 0.7:
+            del chars[pos]
+        else:
+            chars.insert(pos, rng.choice(DEF_MUTATION_ALPHABET))
+    return "".join(chars)
+
+def _equivalence_texts():
+    rng = random.Random(49)
+    texts = list(_sanitized_corpus())
+    texts += [_mutated(text, rng, rng.randint(1, 20)) for text in texts for _ in range(3)]
+    texts += ["".join(rng.choice(DEF_MUTATION_ALPHABET) for _ in range(rng.randint(1, 80))) for _ in range(2000)]
+    for lead in ("FROM", "TO", "BOUNDED BY", "-", "XYZ"):
+        for sep in DEF_EDGE_CASE_SEPARATORS:
+            for vor in DEF_EDGE_CASE_VORS:
+                texts += [f"{lead}{sep}{vor}", f"{lead}{sep}{vor}-{sep}{vor}#MOD", f"{lead}{sep}{vor}{sep}-{sep}{vor}{sep}-{vor}"]
+    return texts
+
+def _spans(pattern, text):
+    return [match.span() for match in re.finditer(pattern, text)]
+
+def _vors(airmet_dict):
+    return [(group["qualifiers"], group.get("vors")) for group in airmet_dict["subgroups"] if group["qualifiers"]]
+
+###VOR extraction
+
+def test_known_bulletin_vors():
+    airmet_dict = airmet.parse_airmet(DEF_ZULU_BULLETIN, 2020, 3)
+    assert _vors(airmet_dict) == [
+        (["AIRMET ICE"], ["140NNE ENI", "PYE", "80SE OAK", "90E EHF", "130NNE HEC", "BAM", "40ESE DNJ", "FCA", "MLP", "140NNE BKE", "90NNW BTG", "OED", "140NNE ENI"]),
+        (["AIRMET ICE"], ["30WSW OAK", "160SW BTY", "70SW TWF", "130SSW BOI", "30WSW OAK"]),
+        (["FRZLVL"], None),
+        (["OTLK VALID 0900-1500Z"], ["PYE", "10SW FMG", "40NNW MZB", "BTY", "130ENE TWF", "DNJ", "MLP", "40N BKE", "30ENE IMB", "PDX", "DSD", "80W HQM", "EUG", "PYE"]),
+    ]
+    assert airmet_dict["subgroups"][3]["contours"] == [{"level" : "SFC", "level_ft" : 0, "vors" : ["160SW REO", "IMB", "20WNW MZB"]}]
+
+def test_pop_vors_removes_vor_block():
+    text, vors = airmet._pop_vors("AIRMET IFR$WA OR#FROM 50ENE ORF TO SLT TO#HRV TO 50ENE ORF#CIG BLW 010/VIS BLW 3SM PCPN/BR. CONDS ENDG 18Z-21Z.")
+    assert vors == ["50ENE ORF", "SLT", "HRV", "50ENE ORF"]
+    assert text == "AIRMET IFR$WA OR##CIG BLW 010/VIS BLW 3SM PCPN/BR. CONDS ENDG 18Z-21Z."
+
+@pytest.mark.parametrize("vor_string, vors", [
+    ("FROM 40NW SPS TO 30ESE SPS TO ABI TO 40NW SPS#MOD TURB", ["40NW SPS", "30ESE SPS", "ABI", "40NW SPS"]),
+    ("BOUNDED BY 30WSW OAK-160SW BTY-#70SW TWF-OAK#MOD ICE", ["30WSW OAK", "160SW BTY", "70SW TWF", "OAK"]),
+    ("FROM 40NW SPS-30ESE SPS-20S ABI-40NW SPS#DMSHG AREA TS", ["40NW SPS", "30ESE SPS", "20S ABI", "40NW SPS"]),
+    ("VCNTY ABI#FROM 20S ABI#ISOL TS", ["20S ABI"]),
+    ("AREA TS MOV FROM 25025KT. TOPS TO FL450.", []),
+    ("FROM 12Z TO 15Z", []),
+])
+def test_parse_vor_string_schemes(vor_string, vors):
+    assert subclasses.parse_vor_string(vor_string) == vors
+
+def test_vor_patterns_match_old_patterns():
+    texts = _equivalence_texts()
+    for old, new in DEF_OLD_TO_NEW_PATTERNS:
+        for text in texts:
+            assert _spans(old, text) == _spans(new, text), (new, text)
+
+def test_sigmet_series_pattern_matches_old_pattern():
+    #Groups only, as parse_airmet searches them, and only those the old pattern gets through quickly
+    groups = [group for text in _equivalence_texts() for group in text.split("+")]
+    groups = [group for group in groups if all(sum(len(word) - 1 for word in re.findall(r"\w+", run)) <= 14 for run in re.findall(r"\$([\w\s]*)", group))]
+    groups += ["$SEE SIGMET XRAY SERIES$#.", "AIRMET IFR$SEE SIGMET$#.#FROM ABI TO SPS"]
+    assert len(groups) > 1000
+    for group in groups:
+        assert _spans(DEF_OLD_SIGMET_SERIES_RE, group) == _spans(DEF_SIGMET_SERIES_RE, group), group
+
+@pytest.mark.parametrize("text", [
+    "BOUNDED BY " + "-#" * 20000 + " ",
+    "FROM " + "A-" * 20000 + "1",
+    "$" + "A" * 20000 + "$#",
+    "TO " + "1A#" * 20000,
+])
+def test_vor_patterns_linear_time(text):
+    #Long malformed runs of the characters the patterns repeat over
+    start = time.perf_counter()
+    for _, new in DEF_OLD_TO_NEW_PATTERNS + ((DEF_OLD_SIGMET_SERIES_RE, DEF_SIGMET_SERIES_RE),):
+        _spans(new, text)
+    subclasses.parse_vor_string(text)
+    assert time.perf_counter() - start < 2
+
+###Sanitizer
+
+def test_sanitizer_lone_period_ends_frzlvl_group():
+    san_text = airmet._sanitize_for_reading("FRZLVL...RANGING FROM 040-140 ACRS AREA\n   SFC ALG 160SW REO-IMB-20WNW MZB\n.\nOTLK VALID 0900-1500Z...ICE WA\n....\n")
+    assert san_text == "FRZLVL$RANGING FROM 040-140 ACRS AREA#   SFC ALG 160SW REO-IMB-20WNW MZB+#OTLK VALID 0900-1500Z$ICE WA#=#"
+
+def test_sanitizer_keeps_group_and_header_breaks():
+    #The lone "." rule must leave ".\n." and the header end as they were
+    san_text = airmet._sanitize_for_reading("VALID UNTIL 010900\n.\nAIRMET IFR...WA\nCONDS ENDG 18Z.\n.\nOTLK VALID 0900-1500Z...IFR WA\n....\n")
+    assert san_text == "VALID UNTIL 010900*+AIRMET IFR$WA#CONDS ENDG 18Z.+#OTLK VALID 0900-1500Z$IFR WA#=#"
+
+def test_frzlvl_group_does_not_swallow_outlook():
+    qualifiers = [group["qualifiers"] for group in airmet.parse_airmet(DEF_ZULU_BULLETIN, 2020, 3)["subgroups"]]
+    assert qualifiers[-2:] == [["FRZLVL"], ["OTLK VALID 0900-1500Z"]]
+
+###Conditions
+
+@pytest.mark.parametrize("conds, desc, expected", [
+    (["AIRMET IFR"], "CIG BLW 010/VIS BLW 3SM BR.",
+        {"hazard" : "IFR", "intensity" : None, "frequency" : None, "floor_ft" : 0, "floor_ref" : "SFC", "ceiling_ft" : 1000, "ceiling_ref" : "AGL", "frzlvl_range_ft" : None}),
+    (["AIRMET ICE"], "MOD ICE BTN FRZLVL AND FL220. FRZLVL 080-120.",
+        {"hazard" : "ICE", "intensity" : "MOD", "frequency" : None, "floor_ft" : None, "floor_ref" : "FRZLVL", "ceiling_ft" : 22000, "ceiling_ref" : "MSL", "frzlvl_range_ft" : [8000, 12000]}),
+    (["AIRMET TURB"], "MOD TURB BTN FL180 AND FL390.",
+        {"hazard" : "TURB", "intensity" : "MOD", "frequency" : None, "floor_ft" : 18000, "floor_ref" : "MSL", "ceiling_ft" : 39000, "ceiling_ref" : "MSL", "frzlvl_range_ft" : None}),
+    ([], "SEV-EXTRM TURB ABV FL300",
+        {"hazard" : "TURB", "intensity" : "EXTRM", "frequency" : None, "floor_ft" : 30000, "floor_ref" : "MSL", "ceiling_ft" : None, "ceiling_ref" : None, "frzlvl_range_ft" : None}),
+    (["CONVECTIVE SIGMET"], "FRQ TS TOPS ABV FL450.",
+        {"hazard" : "TS", "intensity" : None, "frequency" : "FRQ", "floor_ft" : 0, "floor_ref" : "SFC", "ceiling_ft" : None, "ceiling_ref" : None, "frzlvl_range_ft" : None}),
+    (["AIRMET MTN OBSCN"], "MTNS OBSC BY CLDS/PCPN/BR.",
+        {"hazard" : "MTN_OBSCN", "intensity" : None, "frequency" : None, "floor_ft" : None, "floor_ref" : None, "ceiling_ft" : None, "ceiling_ref" : None, "frzlvl_range_ft" : None}),
+])
+def test_decode_conditions(conds, desc, expected):
+    assert subclasses.decode_conditions(conds, desc) == expected
+
+@pytest.mark.parametrize("desc, band", [
+    ("MOD ICE BTN FRZLVL AND FL220. FRZLVL 080-120.", (8000.0, 22000.0)),
+    ("MOD TURB BTN FL180 AND FL390.", (18000.0, 39000.0)),
+    ("SEV-EXTRM TURB ABV FL300", (30000.0, float("inf"))),
+    ("MTNS OBSC BY CLDS/PCPN/BR.", (0.0, float("inf"))),
+])
+def test_altitude_band(desc, band):
+    conditions = subclasses.decode_conditions([], desc)
+    assert subclasses.altitude_band(conditions) == band
+    assert subclasses.altitude_overlaps(conditions, band[0], band[0])
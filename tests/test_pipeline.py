@@ -0,0 +1,69 @@
+import os
+import sys
+import json
+import sqlite3
+from datetime import datetime
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import airmet
+import pipeline
+import router
+import standin
+
+class _FlakySource(pipeline.NetworkSource):
+    ''' Fails to fetch one product of the day.'''
+
+    def fetch(self, unit):
+        if unit["product_id"] == "202003010845-KKCI-WAUS46-WA6S":
+            raise IOError("connection reset")
+        return super().fetch(unit)
+
+def garbled_on_wa5t(raw_text, year, month, **kwargs):
+    if "WA5T" in raw_text[:200]:
+        raise ValueError("garbled")
+    return airmet.parse_airmet(raw_text, year, month, **kwargs)
+
+@pytest.fixture(scope="module")
+def server():
+    with standin.StandinIEMServer.from_synthetic(datetime(2020, 3, 1), 1) as server:
+        yield server
+
+def test_complete_day_is_written(server, tmp_path):
+    status = pipeline.download_pipelined(str(tmp_path), 2020, 3, 1, base_url=server.url)
+    assert status[0] == 1
+    assert sorted(os.listdir(tmp_path)) == ["AllAIRMETS_20200301.json", "AllAIRMETS_20200301.json.idx", "AllAIRMET_RawText_20200301.txt"]
+    with open(status[2]) as file:
+        assert len(json.load(file)) > 0
+
+@pytest.mark.parametrize("stage", ["fetch", "parse"])
+def test_failed_day_leaves_no_outputs(server, tmp_path, stage):
+    kwargs = {"source" : _FlakySource(2020, 3, 1, base_url=server.url)} if stage == "fetch" else {"parser" : garbled_on_wa5t, "base_url" : server.url}
+    status = pipeline.download_pipelined(str(tmp_path), 2020, 3, 1, **kwargs)
+    assert status[0] == 0
+    assert status[2] and {error["stage"] for error in status[2]} == {stage}
+    assert os.listdir(tmp_path) == []
+
+def test_routed_failed_day_leaves_no_outputs(server, tmp_path):
+    status = router.download_all(str(tmp_path), 2020, 3, 1, source=_FlakySource(2020, 3, 1, base_url=server.url))
+    assert status[0] == 0
+    assert os.listdir(tmp_path) == []
+
+def test_errors_kept_without_abort_on_error(server, tmp_path):
+    path = str(tmp_path / "airmets.json")
+    stats = pipeline.Pipeline(_FlakySource(2020, 3, 1, base_url=server.url), [pipeline.JSONSink(path)]).run()
+    assert len(stats["errors"]) == 1
+    with open(path) as file:
+        assert len(json.load(file)) > 0
+
+def test_sqlite_abort_rolls_back_uncommitted_rows(tmp_path):
+    path = str(tmp_path / "airmets.db")
+    sink = pipeline.SQLiteSink(path, commit_every=2)
+    sink.open()
+    for idx in range(3):
+        sink.write({"unit" : {"product_id" : f"P{idx}"}, "airmet" : {"airmet_id" : "WA6S"}})
+    pipeline.abort_sink(sink)
+    with sqlite3.connect(path) as conn:
+        assert [row[0] for row in conn.execute("SELECT product_id FROM airmets ORDER BY product_id")] == ["P0", "P1"]
@@ -0,0 +1,90 @@
+import os
+import sys
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import chunked
+import pipeline
+import service
+import standin
+
+def _entry(iss_time, valid_hours, polygon, **kwargs):
+    return {
+        "airmet_id" : kwargs.get("airmet_id", "WA4Z"),
+        "outlook" : kwargs.get("outlook", False),
+        "qualifiers" : kwargs.get("qualifiers", ["AIRMET ICE"]),
+        "states" : kwargs.get("states", ["TX"]),
+        "conditions" : None,
+        "polygon" : polygon,
+        "_iss" : service._minutes(iss_time),
+        "_valid" : service._minutes(iss_time + timedelta(hours=valid_hours)),
+    }
+
+def _key(entry):
+    return (entry["_iss"], entry["_valid"], tuple(entry["qualifiers"]), tuple(entry["states"]))
+
+def _brute_force(entries, start, end):
+    return sorted(_key(entry) for entry in entries if not entry["outlook"]
+                  and (end is None or entry["_iss"] <= service._minutes(end))
+                  and (start is None or entry["_valid"] >= service._minutes(start)))
+
+@pytest.fixture(scope="module")
+def day_index(tmp_path_factory):
+    save_dir = tmp_path_factory.mktemp("data")
+    with standin.StandinIEMServer.from_synthetic(datetime(2020, 3, 1), 2) as server:
+        for day in (1, 2):
+            assert pipeline.download_pipelined(str(save_dir), 2020, 3, day, base_url=server.url)[0] == 1
+    paths = sorted(str(save_dir / name) for name in os.listdir(save_dir) if name.startswith("AllAIRMETS_") and name.endswith(".json"))
+    index_dir = str(tmp_path_factory.mktemp("index") / "index")
+    chunked.build_index(paths, index_dir)
+    entries = [entry for path in paths for entry in service.load_entries(path)]
+    mapped = service.MappedAirmetIndex(index_dir)
+    yield service.AirmetIndex(entries), mapped
+    mapped.close()
+
+def test_long_validity_issued_early_is_found():
+    square = [(30.0, -100.0), (30.0, -98.0), (32.0, -98.0), (32.0, -100.0), (30.0, -100.0)]
+    base = datetime(2020, 3, 1)
+    entries = [_entry(base, 24, square, airmet_id="WA4S")]
+    entries += [_entry(base + timedelta(hours=hour), 1, square) for hour in range(1, 20)]
+    index = service.AirmetIndex(entries)
+
+    at = base + timedelta(hours=20, minutes=30)
+    assert [entry["airmet_id"] for entry in index.query(at=at)] == ["WA4S"]
+    assert [entry["airmet_id"] for entry in index.query(point=(31.0, -99.0), at=at)] == ["WA4S"]
+    assert index.query(point=(35.0, -99.0), at=at) == []
+    assert index.query(at=base + timedelta(hours=24, minutes=1)) == []
+
+def test_time_queries_match_brute_force(day_index):
+    index, mapped = day_index
+    assert len(index) == len(mapped) and index.max_span == mapped.max_span
+
+    rng = random.Random(36)
+    low, high = int(index.iss.min()), int(index.valid.max())
+    for _ in range(500):
+        start = service.DEF_EPOCH + timedelta(minutes=rng.randint(low - 600, high + 600))
+        end = start + timedelta(minutes=rng.choice([0, 30, 400]))
+        kwargs = rng.choice([{"at" : start}, {"start" : start, "end" : end}, {"start" : start}, {"end" : end}])
+        want = _brute_force(index.entries, kwargs.get("start", kwargs.get("at")), kwargs.get("end", kwargs.get("at")))
+        assert sorted(_key(entry) for entry in index.query(limit=10 ** 9, **kwargs)) == want
+        assert sorted(_key(entry) for entry in mapped.query(limit=10 ** 9, **kwargs)) == want
+
+def test_sample_queries_on_mapped_index(day_index):
+    index, mapped = day_index
+    assert service.sample_queries(index, 40, seed=1) == service.sample_queries(mapped, 40, seed=1)
+
+def test_lru_cache_evicts_and_expires():
+    now = [0.0]
+    cache = service.LRUCache(maxsize=2, ttl=10, now=lambda: now[0])
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert cache.get("b") is None and cache.get("a") == 1
+    now[0] = 11
+    assert cache.get("a") is None
+    assert cache.stats["evictions"] == 1 and cache.stats["expirations"] == 1
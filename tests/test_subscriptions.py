@@ -0,0 +1,70 @@
+import os
+import sys
+import math
+import random
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import geometry
+import subscriptions
+from subclasses import states_to_mask
+
+#Small enough that most AIRMET polygons land on cell edges and inside whole cells
+DEF_TEST_BBOX = (30.0, -105.0, 40.0, -90.0)
+
+def _random_polygon(rng):
+    #A star-shaped ring of a few degrees, the size of an AIRMET area
+    lat, lon = rng.uniform(31, 39), rng.uniform(-104, -91)
+    angles = sorted(rng.uniform(0, 6.283) for _ in range(rng.randint(3, 9)))
+    ring = [(lat + rng.uniform(0.2, 3) * math.sin(angle), lon + rng.uniform(0.2, 4) * math.cos(angle)) for angle in angles]
+    return ring + [ring[0]]
+
+def _brute_force(registry, polygon, states, hazard):
+    matched = set()
+    for sub_id, subscription in registry.subscriptions.items():
+        if subscription["hazards"] and hazard not in subscription["hazards"]:
+            continue
+        if subscription["kind"] == "states":
+            is_match = bool(subscription["mask"] & states_to_mask(states))
+        elif subscription["kind"] == "point":
+            is_match = geometry.point_in_polygon(*subscription["points"][0], polygon)
+        elif subscription["kind"] == "line":
+            is_match = geometry.line_intersects_polygon(subscription["points"], polygon)
+        else:
+            is_match = geometry.polygons_intersect(subscription["points"], polygon)
+        if is_match:
+            matched.add(sub_id)
+    return matched
+
+@pytest.mark.parametrize("grid_deg", [0.5, 1.0, 3.0])
+def test_match_agrees_with_brute_force(grid_deg):
+    registry = subscriptions.SubscriptionRegistry(grid_deg=grid_deg)
+    for sub_id, spec in subscriptions.synthetic_subscriptions(1500, seed=47, bbox=DEF_TEST_BBOX):
+        registry.add(sub_id, **spec)
+    #Enclosing every AIRMET area, so only the polygon[0] test can find it
+    registry.add("big", polygon=[(25.0, -110.0), (45.0, -110.0), (45.0, -85.0), (25.0, -85.0)])
+
+    rng = random.Random(47)
+    for _ in range(200):
+        polygon = _random_polygon(rng)
+        states = rng.sample(["TX", "OK", "NM", "KS"], rng.randint(0, 2))
+        hazard = rng.choice([None, "ICE", "TURB", "IFR"])
+        want = _brute_force(registry, polygon, states, hazard)
+        assert registry.match(polygon, states, hazard=hazard) == want
+        assert "big" in want
+
+def test_removed_subscription_stops_matching():
+    square = [(30.0, -100.0), (30.0, -98.0), (32.0, -98.0), (32.0, -100.0), (30.0, -100.0)]
+    registry = subscriptions.SubscriptionRegistry()
+    registry.add("airport", point=(31.0, -99.0))
+    registry.add("route", line=[(29.0, -99.0), (33.0, -99.5)], hazards=["ICE"])
+    assert registry.match(square, hazard="ICE") == {"airport", "route"}
+    assert registry.match(square, hazard="TURB") == {"airport"}
+
+    assert registry.remove("airport") and not registry.remove("airport")
+    registry.add("route", point=(35.0, -99.0)) #replaced
+    assert registry.match(square) == set() and len(registry) == 1
+    with pytest.raises(ValueError):
+        registry.add("both", point=(31.0, -99.0), states=["TX"])
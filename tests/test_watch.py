@@ -0,0 +1,70 @@
+import os
+import sys
+import json
+from datetime import datetime
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import standin
+import watch
+
+def _now():
+    return datetime(2020, 3, 1, 12)
+
+@pytest.fixture(scope="module")
+def server():
+    with standin.StandinIEMServer.from_synthetic(datetime(2020, 3, 1), 1) as server:
+        yield server
+
+class _FailOnce():
+    ''' A callback that raises on the fail_at'th
+        call only, recording what it was given.
+    '''
+
+    def __init__(self, fail_at):
+
+        self.fail_at = fail_at
+        self.calls = []
+        self.delivered = []
+
+    def __call__(self, airmet_dict, prod):
+        self.calls.append(prod["product_id"])
+        if len(self.calls) == self.fail_at:
+            raise RuntimeError("sink down")
+        self.delivered.append(prod["product_id"])
+
+def _saved_seen(cursor_path):
+    with open(cursor_path) as file:
+        return {product_id for ids in json.load(file)["seen"].values() for product_id in ids}
+
+@pytest.mark.parametrize("deltas", [False, True])
+def test_raising_callback_is_retried_next_poll(server, tmp_path, deltas):
+    cursor_path = str(tmp_path / "cursor.json")
+    watcher = watch.AirmetWatcher(base_url=server.url, cursor_path=cursor_path, now=_now, deltas=deltas)
+    callback = watcher.register_callback(_FailOnce(3))
+
+    with pytest.raises(RuntimeError):
+        watcher.poll_once()
+    failed = callback.calls[-1]
+    assert failed not in _saved_seen(cursor_path)
+    assert _saved_seen(cursor_path) >= set(callback.delivered)
+
+    watcher.poll_once()
+    assert failed in callback.delivered
+    assert len(callback.delivered) == len(set(callback.delivered))
+    assert _saved_seen(cursor_path) >= set(callback.delivered)
+
+def test_restart_resumes_from_cursor(server, tmp_path):
+    cursor_path = str(tmp_path / "cursor.json")
+    first = watch.AirmetWatcher(base_url=server.url, cursor_path=cursor_path, now=_now)
+    callback = first.register_callback(_FailOnce(6))
+    with pytest.raises(RuntimeError):
+        first.poll_once()
+
+    restarted = watch.AirmetWatcher(base_url=server.url, cursor_path=cursor_path, now=_now)
+    resumed = [airmet_dict["product_id"] for airmet_dict in restarted.poll_once()]
+    assert resumed[0] == callback.calls[-1]
+    assert not set(resumed) & set(callback.delivered)
+    assert restarted.poll_once() == []
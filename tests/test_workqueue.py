@@ -0,0 +1,94 @@
+import os
+import sys
+import json
+import threading
+from datetime import datetime
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import archive
+import pipeline
+import standin
+import workqueue
+
+class _Clock():
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+def _units(num):
+    return [{"product_id" : f"202003010{idx}45-KKCI-WAUS46-WA6S", "pil" : "WA6S"} for idx in range(num)]
+
+@pytest.fixture
+def queue_path(tmp_path):
+    return str(tmp_path / "queue.db")
+
+def test_expired_lease_is_taken_over_and_committed_once(queue_path):
+    clock = _Clock()
+    with workqueue.WorkQueue(queue_path, lease_s=60, now=clock) as queue:
+        queue.enqueue("2020-03-01", _units(2))
+        [first, _] = queue.claim("w1", 2)
+        assert queue.claim("w2", 2) == []
+
+        clock.now += 30
+        assert queue.heartbeat("w1", [first]) == [first]
+        clock.now += 45 #past the unrenewed lease, within the renewed one
+        [taken] = queue.claim("w2", 2)
+        assert taken["product_id"] != first["product_id"]
+
+        clock.now += 60 #now the renewed one has expired too
+        [taken_over] = queue.claim("w2", 2)
+        assert taken_over["product_id"] == first["product_id"] and taken_over["token"] != first["token"]
+        assert queue.heartbeat("w1", [first]) == []
+        assert queue.complete("w1", first, "RAW", {"by" : "w1"}) is False
+        assert queue.complete("w2", taken_over, "RAW", {"by" : "w2"}) is True
+        assert queue.complete("w2", taken_over, "RAW", {"by" : "w2"}) is False
+        assert queue.fail("w1", first, "late") is None
+
+        rows = queue._conn.execute("SELECT data FROM results").fetchall()
+        assert [json.loads(row[0]) for row in rows] == [{"by" : "w2"}]
+        assert queue.status()["units"]["done"] == 1
+
+def test_fail_retries_until_max_attempts(queue_path):
+    with workqueue.WorkQueue(queue_path, max_attempts=2) as queue:
+        queue.enqueue("2020-03-01", _units(1))
+        assert queue.fail("w1", queue.claim("w1")[0], "reset") == "pending"
+        [lease] = queue.claim("w1")
+        queue.release("w1", [lease]) #a release doesn't count as an attempt
+        assert queue.fail("w1", queue.claim("w1")[0], "reset") == "failed"
+        assert queue.claim("w1") == [] and queue.remaining() == 0
+        assert queue.retry_failed() == 1
+        assert len(queue.claim("w1")) == 1
+
+def test_enqueue_is_idempotent(queue_path):
+    with workqueue.WorkQueue(queue_path) as queue:
+        assert queue.enqueue("2020-03-01", _units(3)) == 3
+        assert queue.enqueue("2020-03-01", _units(4)) == 1
+        assert queue.status()["units"]["pending"] == 4
+
+def test_workers_export_the_same_day_as_download(queue_path, tmp_path):
+    with standin.StandinIEMServer.from_synthetic(datetime(2020, 3, 1), 1) as server:
+        with workqueue.WorkQueue(queue_path) as queue:
+            queue.enqueue_days(datetime(2020, 3, 1), datetime(2020, 3, 1), base_url=server.url)
+
+        counts = {}
+        threads = [threading.Thread(target=lambda worker_id=worker_id: counts.setdefault(worker_id, workqueue.run_worker(
+                       queue_path, worker_id=worker_id, base_url=server.url, batch=3, idle_poll_s=0.05))) for worker_id in ("w1", "w2")]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        expected = pipeline.download_pipelined(str(tmp_path / "expected"), 2020, 3, 1, base_url=server.url)[2]
+
+    with workqueue.WorkQueue(queue_path) as queue:
+        exported = queue.export_ready(str(tmp_path / "exported"))
+        assert queue.export_ready(str(tmp_path / "exported")) == {}
+
+    assert sum(worker["done"] for worker in counts.values()) == len(archive.load_airmets(expected))
+    assert archive.load_airmets(exported["2020-03-01"]["airmet"]) == archive.load_airmets(expected)
@@ -0,0 +1,466 @@
+import sys
+import os
+import math
+import gzip
+import json
+import time
+import struct
+import sqlite3
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+import airmet
+import archive
+import geometry
+
+DEF_TILE_EXTENT = 4096
+
+#Features are clipped this many tile units outside the tile so outlines don't show seams
+DEF_TILE_BUFFER = 64
+
+DEF_MIN_ZOOM = 0
+
+DEF_MAX_ZOOM = 8
+
+DEF_LAYER_NAME = "airmets"
+
+DEF_TILES_PER_TASK = 64
+
+DEF_MAX_LAT = 85.0511287798
+
+#Coarsest detail level (geometry.DEF_LOD_TOLERANCES_DEG) used at or below each zoom
+DEF_ZOOM_TO_LOD = ((3, 3), (5, 2), (7, 1))
+
+DEF_MBTILES_SCHEMA = """
+CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB);
+CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row);
+CREATE TABLE IF NOT EXISTS airmet_sources (source TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER);
+CREATE TABLE IF NOT EXISTS airmet_features (id INTEGER PRIMARY KEY, source TEXT, props TEXT, lods TEXT);
+CREATE INDEX IF NOT EXISTS airmet_features_source ON airmet_features (source);
+CREATE VIRTUAL TABLE IF NOT EXISTS airmet_feature_bounds USING rtree (id, min_lon, max_lon, min_lat, max_lat);
+"""
+
+###Mapbox Vector Tile encoding (protobuf, vector_tile.proto v2)
+
+def _varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+def _zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+def _len_field(field_num, payload):
+    return _varint((field_num << 3) | 2) + _varint(len(payload)) + payload
+
+def _varint_field(field_num, value):
+    return _varint(field_num << 3) + _varint(value)
+
+def _packed_field(field_num, values):
+    return _len_field(field_num, b"".join(_varint(value) for value in values))
+
+def _encode_value(value):
+    if isinstance(value, bool):
+        return _varint_field(7, int(value))
+    if isinstance(value, int):
+        return _varint_field(6, _zigzag(value))
+    if isinstance(value, float):
+        return _varint((3 << 3) | 1) + struct.pack("<d", value)
+    return _len_field(1, str(value).encode("utf-8"))
+
+def _command(command_id, count):
+    return (command_id & 0x7) | (count << 3)
+
+def _ring_area(ring):
+    return sum(ring[idx - 1][0] * ring[idx][1] - ring[idx][0] * ring[idx - 1][1] for idx in range(len(ring))) / 2
+
+def encode_geometry(polygons):
+    '''Encodes tile-coordinate polygons (each a list of
+       integer (x, y) rings, exterior first) into MVT
+       geometry commands. Exterior rings are wound to a
+       positive area (clockwise with y down), holes the
+       other way, as the spec requires.
+    '''
+
+    commands = []
+    cursor_x, cursor_y = 0, 0
+    for rings in polygons:
+        for ring_idx, ring in enumerate(rings):
+            area = _ring_area(ring)
+            if (ring_idx == 0) != (area > 0):
+                ring = ring[::-1]
+            commands.append(_command(1, 1))
+            for point_idx, (x, y) in enumerate(ring):
+                if point_idx == 1:
+                    commands.append(_command(2, len(ring) - 1))
+                commands += [_zigzag(x - cursor_x), _zigzag(y - cursor_y)]
+                cursor_x, cursor_y = x, y
+            commands.append(_command(7, 1))
+    return commands
+
+def encode_layer(name, features, **kwargs):
+    '''features is a list of (id, polygons, props).'''
+
+    keys, values = {}, {}
+    feature_bytes = []
+    for feature_id, polygons, props in features:
+        tags = []
+        for key, value in props.items():
+            if value is None:
+                continue
+            tags.append(keys.setdefault(key, len(keys)))
+            tags.append(values.setdefault((type(value).__name__, value), len(values)))
+        feature_bytes.append(_len_field(2, _varint_field(1, feature_id) + _packed_field(2, tags) +
+                                        _varint_field(3, 3) + _packed_field(4, encode_geometry(polygons))))
+
+    layer = _varint_field(15, 2) + _len_field(1, name.encode("utf-8")) + b"".join(feature_bytes)
+    layer += b"".join(_len_field(3, key.encode("utf-8")) for key in keys)
+    layer += b"".join(_len_field(4, _encode_value(value)) for _, value in values)
+    layer += _varint_field(5, kwargs.get("extent", DEF_TILE_EXTENT))
+    return _len_field(3, layer)
+
+###Tile math (XYZ scheme, Web Mercator)
+
+def project(lat, lon, zoom):
+    '''Returns the (x, y) position of lat/lon in tile units at zoom.'''
+    lat = max(-DEF_MAX_LAT, min(DEF_MAX_LAT, lat))
+    num_tiles = 2 ** zoom
+    x = (lon + 180) / 360 * num_tiles
+    y = (1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * num_tiles
+    return x, y
+
+def tile_bounds(zoom, x, y):
+    '''Returns (min_lat, min_lon, max_lat, max_lon) of an XYZ tile.'''
+    num_tiles = 2 ** zoom
+    lon = lambda tile_x: tile_x / num_tiles * 360 - 180
+    lat = lambda tile_y: math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * tile_y / num_tiles))))
+    return (lat(y + 1), lon(x), lat(y), lon(x + 1))
+
+def tiles_for_bbox(bbox, zoom):
+    min_lat, min_lon, max_lat, max_lon = bbox
+    min_x, min_y = project(max_lat, min_lon, zoom)
+    max_x, max_y = project(min_lat, max_lon, zoom)
+    last = 2 ** zoom - 1
+    for x in range(max(0, int(min_x)), min(last, int(max_x)) + 1):
+        for y in range(max(0, int(min_y)), min(last, int(max_y)) + 1):
+            yield (x, y)
+
+def zoom_lod(zoom):
+    for max_zoom, level in DEF_ZOOM_TO_LOD:
+        if zoom <= max_zoom:
+            return level
+    return 0
+
+def _clip_ring(ring, low, high):
+    #Sutherland-Hodgman against the square [low, high]^2
+    for axis, bound, keep_above in ((0, low, True), (0, high, False), (1, low, True), (1, high, False)):
+        if not ring:
+            break
+        inside = (lambda point: point[axis] >= bound) if keep_above else (lambda point: point[axis] <= bound)
+        clipped = []
+        prev = ring[-1]
+        for point in ring:
+            if inside(point):
+                if not inside(prev):
+                    clipped.append(_crossing(prev, point, axis, bound))
+                clipped.append(point)
+            elif inside(prev):
+                clipped.append(_crossing(prev, point, axis, bound))
+            prev = point
+        ring = clipped
+    return ring
+
+def _crossing(start, end, axis, bound):
+    t = (bound - start[axis]) / (end[axis] - start[axis])
+    other = 1 - axis
+    point = [0, 0]
+    point[axis] = bound
+    point[other] = start[other] + t * (end[other] - start[other])
+    return tuple(point)
+
+def tile_polygons(rings_by_polygon, zoom, x, y, **kwargs):
+    '''Projects, clips and quantizes lat/lon polygons
+       into one tile's integer coordinates. Rings that
+       vanish at this zoom are dropped.
+    '''
+
+    extent = kwargs.get("extent", DEF_TILE_EXTENT)
+    buffer = kwargs.get("buffer", DEF_TILE_BUFFER)
+
+    polygons = []
+    for rings in rings_by_polygon:
+        tile_rings = []
+        for ring in rings:
+            if len(ring) > 1 and ring[0] == ring[-1]:
+                ring = ring[:-1]
+            local = []
+            for lat, lon in ring:
+                world_x, world_y = project(lat, lon, zoom)
+                local.append(((world_x - x) * extent, (world_y - y) * extent))
+            quantized = []
+            for point_x, point_y in _clip_ring(local, -buffer, extent + buffer):
+                point = (int(round(point_x)), int(round(point_y)))
+                if not quantized or quantized[-1] != point:
+                    quantized.append(point)
+            if len(quantized) > 1 and quantized[0] == quantized[-1]:
+                quantized.pop()
+            if len(quantized) >= 3 and _ring_area(quantized) != 0:
+                tile_rings.append(quantized)
+            elif not tile_rings:
+                break #exterior vanished, so does the polygon
+        if tile_rings:
+            polygons.append(tile_rings)
+    return polygons
+
+def _render_tiles(mbtiles_path, zoom, tile_coords, layer_name):
+    '''Worker: renders a range of tiles of one zoom
+       from the feature tables. Returns a list of
+       (x, y, gzipped tile or None if empty).
+    '''
+
+    conn = sqlite3.connect(f"file:{mbtiles_path}?mode=ro", uri=True)
+    level = zoom_lod(zoom)
+    features = {}
+    rendered = []
+
+    for x, y in tile_coords:
+        min_lat, min_lon, max_lat, max_lon = tile_bounds(zoom, x, y)
+        pad_lat = (max_lat - min_lat) * DEF_TILE_BUFFER / DEF_TILE_EXTENT
+        pad_lon = (max_lon - min_lon) * DEF_TILE_BUFFER / DEF_TILE_EXTENT
+        rows = conn.execute("SELECT id FROM airmet_feature_bounds WHERE max_lon >= ? AND min_lon <= ? AND max_lat >= ? AND min_lat <= ?",
+                            (min_lon - pad_lon, max_lon + pad_lon, min_lat - pad_lat, max_lat + pad_lat)).fetchall()
+
+        tile_features = []
+        for (feature_id,) in sorted(rows):
+            if feature_id not in features:
+                props, lods = conn.execute("SELECT props, lods FROM airmet_features WHERE id = ?", (feature_id,)).fetchone()
+                features[feature_id] = (json.loads(props), json.loads(lods))
+            props, lods = features[feature_id]
+            polygons = tile_polygons(lods[min(level, len(lods) - 1)], zoom, x, y)
+            if polygons:
+                tile_features.append((feature_id, polygons, props))
+
+        data = gzip.compress(encode_layer(layer_name, tile_features), mtime=0) if tile_features else None
+        rendered.append((x, y, data))
+
+    conn.close()
+    return rendered
+
+def airmet_features(airmets, **kwargs):
+    '''Yields (props, lods, bbox) for every plottable,
+       resolvable subgroup of the given bulletins. lods
+       holds, per geometry.DEF_LOD_TOLERANCES_DEG level,
+       the polygons to draw (a single [ring] here).
+    '''
+
+    from composite import composite_hazard
+
+    product_ids = kwargs.get("product_ids") or []
+    for pos, airmet_dict in enumerate(airmets):
+        if "iss_day" not in airmet_dict:
+            continue
+        iss_time, valid_time = airmet.airmet_times(airmet_dict)
+        for group in airmet_dict.get("subgroups") or []:
+            hazard = composite_hazard(group)
+            if hazard is None:
+                continue
+            lods = geometry.subgroup_lods(group.get("vors"))
+            if lods is None:
+                continue
+            props = {
+                "airmet_id" : airmet_dict["airmet_id"],
+                "product_id" : product_ids[pos] if pos < len(product_ids) else airmet_dict.get("product_id"),
+                "airmet_type" : airmet_dict.get("airmet_type"),
+                "hazard" : hazard,
+                "iss_time" : iss_time.strftime("%Y-%m-%dT%H:%MZ"),
+                "valid_time" : valid_time.strftime("%Y-%m-%dT%H:%MZ"),
+                "valid_from" : int((iss_time - datetime(1970, 1, 1)).total_seconds()),
+                "valid_to" : int((valid_time - datetime(1970, 1, 1)).total_seconds()),
+                "states" : ",".join(group.get("states") or []),
+                "desc" : group.get("desc", ""),
+            }
+            yield props, [[[ring]] for ring in lods], geometry.bbox(lods[0])
+
+class MBTilesStore():
+    ''' An MBTiles file of AIRMET vector tiles that can
+        be updated in place. Alongside the standard
+        metadata/tiles tables it keeps every ingested
+        feature (with its detail levels precomputed) in
+        airmet_features, indexed by an R*Tree, keyed by
+        the daily file it came from. Re-ingesting a day
+        replaces its features, and render() only redraws
+        the tiles the changed features touch.
+
+        Tiles are rendered in parallel on a process pool,
+        one task per zoom level and range of tiles.
+    '''
+
+    def __init__(self, path, **kwargs):
+
+        self.path = path
+        self.min_zoom = kwargs.get("min_zoom", DEF_MIN_ZOOM)
+        self.max_zoom = kwargs.get("max_zoom", DEF_MAX_ZOOM)
+        self.layer_name = kwargs.get("layer_name", DEF_LAYER_NAME)
+        self.processes = kwargs.get("processes", os.cpu_count() or 1)
+        self.verbose = airmet.str_to_bool(kwargs.get("verbose"))
+
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(DEF_MBTILES_SCHEMA)
+        self._dirty_bboxes = []
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def ingest(self, airmets, source, **kwargs):
+        '''Replaces the features of source with those of
+           airmets. Returns the number of features added.
+        '''
+
+        with self.conn:
+            old_ids = [row[0] for row in self.conn.execute("SELECT id FROM airmet_features WHERE source = ?", (source,))]
+            for feature_id in old_ids:
+                bounds = self.conn.execute("SELECT min_lat, min_lon, max_lat, max_lon FROM airmet_feature_bounds WHERE id = ?", (feature_id,)).fetchone()
+                if bounds:
+                    self._dirty_bboxes.append(bounds)
+                self.conn.execute("DELETE FROM airmet_feature_bounds WHERE id = ?", (feature_id,))
+            self.conn.execute("DELETE FROM airmet_features WHERE source = ?", (source,))
+
+            num_added = 0
+            for props, lods, bbox in airmet_features(airmets, product_ids=kwargs.get("product_ids")):
+                cursor = self.conn.execute("INSERT INTO airmet_features (source, props, lods) VALUES (?, ?, ?)",
+                                           (source, json.dumps(props, separators=archive.DEF_COMPACT_SEPARATORS),
+                                            json.dumps(lods, separators=archive.DEF_COMPACT_SEPARATORS)))
+                min_lat, min_lon, max_lat, max_lon = bbox
+                self.conn.execute("INSERT INTO airmet_feature_bounds VALUES (?, ?, ?, ?, ?)", (cursor.lastrowid, min_lon, max_lon, min_lat, max_lat))
+                self._dirty_bboxes.append(bbox)
+                num_added += 1
+        return num_added
+
+    def ingest_file(self, json_path, **kwargs):
+        '''Ingests a daily AllAIRMETS file, unless it is
+           unchanged since it was last ingested (force=True
+           to ingest anyway). Returns the number of features
+           added, or None if skipped.
+        '''
+
+        json_path = archive.resolve_input_path(json_path)
+        source = os.path.basename(json_path).split(".")[0]
+        stat = os.stat(json_path)
+        known = self.conn.execute("SELECT mtime_ns, size FROM airmet_sources WHERE source = ?", (source,)).fetchone()
+        if known == (stat.st_mtime_ns, stat.st_size) and not kwargs.get("force"):
+            if self.verbose:
+                print(f"TILES: {source} unchanged, skipping...")
+            return None
+
+        with archive.AirmetArchive(json_path) as json_file:
+            product_ids = [record[2] for record in json_file.records()]
+            num_added = self.ingest(list(json_file), source, product_ids=product_ids)
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO airmet_sources VALUES (?, ?, ?)", (source, stat.st_mtime_ns, stat.st_size))
+        if self.verbose:
+            print(f"TILES: Ingested {num_added} feature(s) from {source}")
+        return num_added
+
+    def dirty_tiles(self):
+        '''{zoom : set of (x, y)} touched by features added
+           or removed since the last render().
+        '''
+        tiles = {}
+        for zoom in range(self.min_zoom, self.max_zoom + 1):
+            tiles[zoom] = set()
+            for bbox in self._dirty_bboxes:
+                tiles[zoom].update(tiles_for_bbox(bbox, zoom))
+        return tiles
+
+    def all_tiles(self):
+        tiles = {zoom : set() for zoom in range(self.min_zoom, self.max_zoom + 1)}
+        for min_lon, max_lon, min_lat, max_lat in self.conn.execute("SELECT min_lon, max_lon, min_lat, max_lat FROM airmet_feature_bounds"):
+            for zoom in tiles:
+                tiles[zoom].update(tiles_for_bbox((min_lat, min_lon, max_lat, max_lon), zoom))
+        return tiles
+
+    def render(self, **kwargs):
+        '''Renders the dirty tiles (every tile with
+           full=True). Returns stats.
+        '''
+
+        start = time.perf_counter()
+        tiles = self.all_tiles() if kwargs.get("full") else self.dirty_tiles()
+
+        tasks = []
+        for zoom, coords in sorted(tiles.items()):
+            coords = sorted(coords)
+            for idx in range(0, len(coords), DEF_TILES_PER_TASK):
+                tasks.append((self.path, zoom, coords[idx:idx + DEF_TILES_PER_TASK], self.layer_name))
+
+        if self.processes > 1 and len(tasks) > 1:
+            with ProcessPoolExecutor(max_workers=self.processes) as executor:
+                results = list(executor.map(_render_tiles, *zip(*tasks)))
+        else:
+            results = [_render_tiles(*task) for task in tasks]
+
+        num_written = num_deleted = 0
+        with self.conn:
+            for (_, zoom, _, _), rendered in zip(tasks, results):
+                for x, y, data in rendered:
+                    tile_row = 2 ** zoom - 1 - y #MBTiles rows are TMS, counted from the south
+                    if data is None:
+                        num_deleted += self.conn.execute("DELETE FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                                                         (zoom, x, tile_row)).rowcount
+                    else:
+                        self.conn.execute("INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)", (zoom, x, tile_row, data))
+                        num_written += 1
+            self._write_metadata()
+
+        self._dirty_bboxes = []
+        return {"tasks" : len(tasks), "tiles_written" : num_written, "tiles_deleted" : num_deleted,
+                "wall_s" : time.perf_counter() - start}
+
+    def _write_metadata(self):
+        bounds = self.conn.execute("SELECT min(min_lon), min(min_lat), max(max_lon), max(max_lat) FROM airmet_feature_bounds").fetchone()
+        fields = {"airmet_id" : "String", "product_id" : "String", "airmet_type" : "String", "hazard" : "String",
+                  "iss_time" : "String", "valid_time" : "String", "valid_from" : "Number", "valid_to" : "Number",
+                  "states" : "String", "desc" : "String"}
+        metadata = {
+            "name" : "AIRMETs",
+            "format" : "pbf",
+            "type" : "overlay",
+            "minzoom" : str(self.min_zoom),
+            "maxzoom" : str(self.max_zoom),
+            "json" : json.dumps({"vector_layers" : [{"id" : self.layer_name, "fields" : fields,
+                                                      "minzoom" : self.min_zoom, "maxzoom" : self.max_zoom}]}),
+        }
+        if bounds[0] is not None:
+            metadata["bounds"] = ",".join(f"{value:.4f}" for value in bounds)
+        self.conn.executemany("INSERT OR REPLACE INTO metadata VALUES (?, ?)", metadata.items())
+
+def export_mbtiles(mbtiles_path, json_paths, **kwargs):
+    '''Ingests the given daily files (skipping ones
+       already ingested and unchanged) and renders the
+       affected tiles. kwargs go to MBTilesStore.
+    '''
+
+    full = kwargs.pop("full", False)
+    with MBTilesStore(mbtiles_path, **kwargs) as store:
+        for json_path in json_paths:
+            store.ingest_file(json_path)
+        return store.render(full=full)
+
+if __name__ == "__main__":
+
+    stats = export_mbtiles(sys.argv[1], sys.argv[2:], verbose=True)
+    print(json.dumps(stats, indent=2))
@@ -0,0 +1,361 @@
+import sys
+import os
+import csv
+import math
+import json
+import struct
+import threading
+from pathlib import Path
+
+import numpy as np
+
+DEF_VOR_CSV_PATH = Path(__file__).parent / "ancillary" / "vors.csv"
+
+DEF_VOR_BIN_PATH = Path(__file__).parent / "ancillary" / "vors.bin"
+
+DEF_VOR_ALIASES_CSV_PATH = Path(__file__).parent / "ancillary" / "vor_aliases.csv"
+
+DEF_VOR_CSV_NA_VALUES = ("0", "M", "")
+
+DEF_VOR_ID_WIDTH = 8
+
+#Binary layout (all little endian):
+#  magic (8 bytes) | count (uint32) | id width (uint32) | reserved (uint64)
+#  ids   (count * id width bytes, NUL padded ASCII, sorted)
+#  lat   (count * float64), aligned to 8 bytes
+#  lon   (count * float64)
+DEF_VOR_BIN_MAGIC = b"VORTBL01"
+
+DEF_VOR_BIN_HEADER = struct.Struct("<8sIIQ")
+
+def compile_vor_table(csv_path=DEF_VOR_CSV_PATH, bin_path=DEF_VOR_BIN_PATH):
+    '''Build step: compiles the VOR CSV into the
+       binary table read by VorTable. Missing coordinates
+       ("0" or "M", as with the old pandas na_values) are
+       stored as NaN. Returns the number of VORs written.
+    '''
+
+    names = []
+    lats = []
+    lons = []
+
+    with open(csv_path, newline="") as file:
+        for row in csv.DictReader(file):
+            name = row["name"].strip()
+            if not name:
+                continue
+            if len(name) > DEF_VOR_ID_WIDTH:
+                raise ValueError(f"VOR identifier '{name}' is longer than {DEF_VOR_ID_WIDTH} characters")
+            names.append(name)
+            lats.append(_csv_float(row["lat"]))
+            lons.append(_csv_float(row["lon"]))
+
+    order = sorted(range(len(names)), key=lambda idx: names[idx])
+    ids = np.array([names[idx] for idx in order], dtype=f"S{DEF_VOR_ID_WIDTH}")
+    lat = np.array([lats[idx] for idx in order], dtype="<f8")
+    lon = np.array([lons[idx] for idx in order], dtype="<f8")
+
+    if len(ids) != len(np.unique(ids)):
+        raise ValueError("Duplicate VOR identifiers in " + str(csv_path))
+
+    #Write to a temp file and swap it in, so processes that already mapped the old table are unaffected
+    tmp_path = str(bin_path) + f".tmp{os.getpid()}"
+    with open(tmp_path, "wb") as file:
+        file.write(DEF_VOR_BIN_HEADER.pack(DEF_VOR_BIN_MAGIC, len(ids), DEF_VOR_ID_WIDTH, 0))
+        file.write(ids.tobytes())
+        file.write(b"\0" * (-file.tell() % 8))
+        file.write(lat.tobytes())
+        file.write(lon.tobytes())
+    os.replace(tmp_path, bin_path)
+
+    return len(ids)
+
+def _csv_float(value):
+    value = value.strip()
+    if value in DEF_VOR_CSV_NA_VALUES:
+        return math.nan
+    return float(value)
+
+class VorTable():
+    ''' Read-only, memory-mapped VOR table.
+
+        The identifier, lat and lon columns are
+        np.memmap views into the compiled file, so
+        every worker process that loads the table
+        shares the same page cache pages. Lookups
+        binary search the sorted identifier column.
+    '''
+
+    def __init__(self, bin_path=DEF_VOR_BIN_PATH):
+
+        self.bin_path = bin_path
+
+        with open(bin_path, "rb") as file:
+            magic, count, id_width, _ = DEF_VOR_BIN_HEADER.unpack(file.read(DEF_VOR_BIN_HEADER.size))
+        if magic != DEF_VOR_BIN_MAGIC:
+            raise ValueError(f"{bin_path} is not a compiled VOR table")
+
+        ids_offset = DEF_VOR_BIN_HEADER.size
+        lat_offset = ids_offset + count * id_width
+        lat_offset += -lat_offset % 8
+        lon_offset = lat_offset + count * 8
+
+        self.count = count
+        self.ids = np.memmap(bin_path, dtype=f"S{id_width}", mode="r", offset=ids_offset, shape=(count,))
+        self.lat = np.memmap(bin_path, dtype="<f8", mode="r", offset=lat_offset, shape=(count,))
+        self.lon = np.memmap(bin_path, dtype="<f8", mode="r", offset=lon_offset, shape=(count,))
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, vor):
+        return self.index(vor) is not None
+
+    def index(self, vor):
+        '''Returns the row of vor, or None.'''
+        key = vor.encode("ascii", "replace")
+        idx = int(np.searchsorted(self.ids, key))
+        if idx < self.count and self.ids[idx] == key:
+            return idx
+        return None
+
+    def lookup(self, vor):
+        '''Returns (lat, lon) of vor, raises KeyError
+           if the VOR is not in the table.
+        '''
+        idx = self.index(vor)
+        if idx is None:
+            raise KeyError(vor)
+        return float(self.lat[idx]), float(self.lon[idx])
+
+    def lookup_many(self, vors):
+        '''Vectorized lookup. Returns (lat, lon, found)
+           arrays; lat/lon are NaN where found is False.
+        '''
+        keys = np.array([vor.encode("ascii", "replace") for vor in vors], dtype=self.ids.dtype)
+        idxs = np.searchsorted(self.ids, keys)
+        clipped = np.minimum(idxs, self.count - 1)
+        found = (idxs < self.count) & (self.ids[clipped] == keys)
+        lat = np.where(found, self.lat[clipped], np.nan)
+        lon = np.where(found, self.lon[clipped], np.nan)
+        return lat, lon, found
+
+_vor_table = None
+
+def get_vor_table(**kwargs):
+    '''Returns the process-wide VorTable, compiling
+       the CSV first if the binary is missing or older
+       than the CSV.
+    '''
+    global _vor_table
+
+    csv_path = kwargs.get("csv_path", DEF_VOR_CSV_PATH)
+    bin_path = kwargs.get("bin_path", DEF_VOR_BIN_PATH)
+
+    if _vor_table is not None and str(_vor_table.bin_path) == str(bin_path):
+        return _vor_table
+
+    if (not os.path.exists(bin_path)) or (os.path.exists(csv_path) and os.path.getmtime(csv_path) > os.path.getmtime(bin_path)):
+        compile_vor_table(csv_path, bin_path)
+
+    _vor_table = VorTable(bin_path)
+    return _vor_table
+
+###Resolution
+#VorResolver.resolve() tries, in order: the table itself, the alias table
+#(decommissioned fixes with their last coordinates, renamed ones with
+#their replacement) and a trigram index over the table's identifiers,
+#ranked by edit distance. Every identifier is resolved once and cached;
+#fuzzy matches and unresolved identifiers are counted for report().
+
+#Resolution confidence, best first
+DEF_CONFIDENCES = ("exact", "alias", "high", "low")
+
+#Confidences whose coordinates resolve_vor() uses, anything else is NaN
+DEF_ACCEPTED_CONFIDENCES = ("exact", "alias", "high")
+
+#Identifiers are padded before splitting into trigrams, so a single
+#garbled letter of a 3 letter identifier still shares two of them
+DEF_TRIGRAM_PAD = "$$"
+
+#Farthest edit distance tried
+DEF_FUZZY_MAX_DISTANCE = 2
+
+#A fuzzy match is only "high" confidence at edit distance 1 and at most
+#this far from the near= point; ties are broken by distance to it. With
+#no near= point to check against, every fuzzy match is "low".
+DEF_NEAR_MAX_NM = 400
+
+def _trigrams(vor):
+    padded = DEF_TRIGRAM_PAD + vor + DEF_TRIGRAM_PAD
+    return {padded[idx:idx + 3] for idx in range(len(padded) - 2)}
+
+def edit_distance(word_a, word_b):
+    '''Optimal string alignment distance: insertions,
+       deletions, substitutions and adjacent
+       transpositions ("GEG" -> "EGG") all cost 1.
+    '''
+    rows = [list(range(len(word_b) + 1))]
+    for idx_a in range(1, len(word_a) + 1):
+        row = [idx_a] + [0] * len(word_b)
+        for idx_b in range(1, len(word_b) + 1):
+            cost = 0 if word_a[idx_a - 1] == word_b[idx_b - 1] else 1
+            row[idx_b] = min(rows[-1][idx_b] + 1, row[idx_b - 1] + 1, rows[-1][idx_b - 1] + cost)
+            if idx_a > 1 and idx_b > 1 and word_a[idx_a - 1] == word_b[idx_b - 2] and word_a[idx_a - 2] == word_b[idx_b - 1]:
+                row[idx_b] = min(row[idx_b], rows[-2][idx_b - 2] + 1)
+        rows.append(row)
+    return rows[-1][-1]
+
+def _distance_nm(lat_a, lon_a, lat_b, lon_b):
+    lat_a, lon_a, lat_b, lon_b = (math.radians(value) for value in (lat_a, lon_a, lat_b, lon_b))
+    hav = math.sin((lat_b - lat_a) / 2) ** 2 + math.cos(lat_a) * math.cos(lat_b) * math.sin((lon_b - lon_a) / 2) ** 2
+    return 2 * 3440.065 * math.asin(min(1, math.sqrt(hav)))
+
+def load_aliases(csv_path=DEF_VOR_ALIASES_CSV_PATH):
+    '''Reads the alias table: name -> (lat, lon,
+       replacement). Lines starting with "#" are
+       comments. Missing file, no aliases.
+    '''
+    aliases = {}
+    if not os.path.exists(csv_path):
+        return aliases
+    with open(csv_path, newline="") as file:
+        for row in csv.DictReader(line for line in file if not line.startswith("#")):
+            name = (row.get("name") or "").strip()
+            if name:
+                aliases[name] = (_csv_float(row.get("lat") or ""), _csv_float(row.get("lon") or ""), (row.get("replacement") or "").strip() or None)
+    return aliases
+
+class VorResolver():
+    ''' Resolves VOR identifiers, including
+        unknown or garbled ones, to a match dict:
+        {"vor", "match", "lat", "lon", "confidence",
+        "distance"}, confidence one of
+        DEF_CONFIDENCES or None (unresolved, lat and
+        lon NaN). Thread safe.
+    '''
+
+    def __init__(self, table, **kwargs):
+
+        self.table = table
+        self.aliases = kwargs.get("aliases") if kwargs.get("aliases") is not None else load_aliases()
+        self.ids = [vor_id.decode("ascii").rstrip("\0") for vor_id in table.ids]
+
+        postings = {}
+        for row, vor in enumerate(self.ids):
+            for trigram in _trigrams(vor):
+                postings.setdefault(trigram, []).append(row)
+        self.postings = {trigram : np.array(rows, dtype=np.int64) for trigram, rows in postings.items()}
+
+        self._cache = {} #vor -> (confidence, [(distance, row or alias name), ...])
+        self.fuzzy = {} #"garbled->match" -> count
+        self.unresolved = {} #vor -> count
+        self.suggestions = {} #unresolved vor -> best low confidence guess
+        self._lock = threading.Lock()
+
+    def _candidates(self, vor):
+        #(confidence, [(edit distance, match name, lat, lon), ...]) best first
+        row = self.table.index(vor)
+        if row is not None and not math.isnan(self.table.lat[row]):
+            return "exact", [(0, vor, float(self.table.lat[row]), float(self.table.lon[row]))]
+
+        if vor in self.aliases:
+            lat, lon, replacement = self.aliases[vor]
+            if replacement is not None and self.table.index(replacement) is not None:
+                lat, lon = self.table.lookup(replacement)
+            if not math.isnan(lat):
+                return "alias", [(0, replacement or vor, lat, lon)]
+        if row is not None:
+            return None, [] #known identifier without coordinates, don't guess a neighbour
+
+        rows = [self.postings[trigram] for trigram in _trigrams(vor) if trigram in self.postings]
+        if not rows:
+            return None, []
+        scored = []
+        for row in np.unique(np.concatenate(rows)):
+            distance = edit_distance(vor, self.ids[row])
+            if distance <= DEF_FUZZY_MAX_DISTANCE and not math.isnan(self.table.lat[row]):
+                scored.append((distance, self.ids[row], float(self.table.lat[row]), float(self.table.lon[row])))
+        if not scored:
+            return None, []
+        scored.sort()
+        #Graded "low" here, resolve() decides whether the near= point backs it up
+        return "low", [candidate for candidate in scored if candidate[0] == scored[0][0]]
+
+    def resolve(self, vor, **kwargs):
+        '''Resolves one identifier. near=(lat, lon), e.g.
+           the previous point of the polygon, breaks ties
+           between equally close fuzzy candidates, and a
+           fuzzy match is only accepted ("high") within
+           DEF_NEAR_MAX_NM of it.
+        '''
+        vor = vor.strip().upper()
+        with self._lock:
+            if vor not in self._cache:
+                self._cache[vor] = self._candidates(vor)
+            confidence, candidates = self._cache[vor]
+
+        if confidence is None:
+            with self._lock:
+                self.unresolved[vor] = self.unresolved.get(vor, 0) + 1
+            return {"vor" : vor, "match" : None, "lat" : math.nan, "lon" : math.nan, "confidence" : None, "distance" : None}
+
+        best = candidates[0]
+        near = kwargs.get("near")
+        if confidence == "low" and near is not None and not math.isnan(near[0]):
+            best = min(candidates, key=lambda candidate: _distance_nm(near[0], near[1], candidate[2], candidate[3]))
+            if best[0] == 1 and _distance_nm(near[0], near[1], best[2], best[3]) <= DEF_NEAR_MAX_NM:
+                confidence = "high"
+
+        if confidence in ("high", "low"):
+            with self._lock:
+                #Guesses callers won't use count as unresolved, with the guess as a suggestion
+                if confidence in DEF_ACCEPTED_CONFIDENCES:
+                    key = f"{vor}->{best[1]}"
+                    self.fuzzy[key] = self.fuzzy.get(key, 0) + 1
+                else:
+                    self.unresolved[vor] = self.unresolved.get(vor, 0) + 1
+                    self.suggestions[vor] = best[1]
+        return {"vor" : vor, "match" : best[1], "lat" : best[2], "lon" : best[3], "confidence" : confidence, "distance" : best[0]}
+
+    def report(self):
+        '''Accepted fuzzy matches and unresolved
+           identifiers (with the best guess, if any)
+           seen so far, with counts, most frequent first.
+        '''
+        with self._lock:
+            return {"unresolved" : {vor : {"count" : count, "suggestion" : self.suggestions.get(vor)}
+                                    for vor, count in sorted(self.unresolved.items(), key=lambda item: -item[1])},
+                    "fuzzy" : dict(sorted(self.fuzzy.items(), key=lambda item: -item[1]))}
+
+    def write_report(self, path):
+        with open(path, "w") as file:
+            json.dump(self.report(), file, indent=2)
+        return path
+
+    def reset_report(self):
+        with self._lock:
+            self.fuzzy.clear()
+            self.unresolved.clear()
+            self.suggestions.clear()
+
+_vor_resolver = None
+
+def get_vor_resolver(**kwargs):
+    '''Returns the process-wide VorResolver over
+       get_vor_table().
+    '''
+    global _vor_resolver
+
+    table = get_vor_table(**kwargs)
+    if _vor_resolver is None or _vor_resolver.table is not table:
+        _vor_resolver = VorResolver(table, aliases=kwargs.get("aliases"))
+    return _vor_resolver
+
+if __name__ == "__main__":
+
+    csv_path = sys.argv[1] if len(sys.argv) > 1 else DEF_VOR_CSV_PATH
+    bin_path = sys.argv[2] if len(sys.argv) > 2 else DEF_VOR_BIN_PATH
+
+    num_vors = compile_vor_table(csv_path, bin_path)
+    print(f"Compiled {num_vors} VORs from {csv_path} to {bin_path} ({os.path.getsize(bin_path)} bytes)")
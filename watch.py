@@ -0,0 +1,268 @@
+import sys
+import os
+import time
+import random
+import json
+import threading
+from datetime import datetime, timedelta, timezone
+
+import airmet
+import quarantine
+
+DEF_POLL_INTERVAL_S = 30
+
+DEF_MAX_BACKOFF_S = 600
+
+DEF_SEEN_RETENTION_DAYS = 2
+
+class AirmetWatcher():
+    ''' A long-running poller that keeps
+        a cursor into the KKCI product list
+        and only fetches/parses products it
+        hasn't seen yet.
+
+        Every parsed AIRMET is pushed to all
+        registered callbacks (called as
+        callback(airmet_dict, product_entry))
+        and, if given, written as one JSON
+        line to output_stream.
+
+        The cursor (seen product_ids and the
+        newest product_id) can be persisted to
+        cursor_path so restarts don't re-emit
+        old products. A product only counts as
+        seen once every callback has returned, so
+        one whose callback raises is delivered
+        again on the next poll (callbacks before
+        the raising one see it twice). With deltas=True the
+        DiffTracker state is kept in the same
+        file, so the first bulletin of each series
+        after a restart is still diffed against
+        the one before it.
+
+        With deltas=True, what is emitted is the
+        diff.DiffTracker delta from the previous
+        issuance of the same series instead of the
+        full bulletin, and bulletins that change
+        nothing are not emitted at all.
+
+        Every parse runs under a budget of
+        parse_budget seconds (0 disables it). A
+        product that overruns is marked seen but
+        not emitted, and is appended to the
+        quarantine file at quarantine_path (if any).
+    '''
+
+    def __init__(self, **kwargs):
+
+        self.base_url = kwargs.get("base_url", airmet.DEF_IEM_BASE_URL)
+        self.poll_interval = kwargs.get("poll_interval", DEF_POLL_INTERVAL_S)
+        self.max_backoff = kwargs.get("max_backoff", DEF_MAX_BACKOFF_S)
+        self.pil_prefix = kwargs.get("pil_prefix", "WA")
+        self.output_stream = kwargs.get("output_stream")
+        self.cursor_path = kwargs.get("cursor_path")
+        self.http_kwargs = airmet.http_kwargs(kwargs)
+        self.parse_budget = kwargs.get("parse_budget", quarantine.DEF_PARSE_BUDGET_S)
+        self.quarantine = quarantine.Quarantine(kwargs.get("quarantine_path"))
+        self.verbose = airmet.str_to_bool(kwargs.get("verbose"))
+        self.debug = airmet.str_to_bool(kwargs.get("debug"))
+        if self.debug:
+            self.verbose = True
+
+        #Injectable clock/sleep, used when driving the watcher against a stand-in server
+        self._now = kwargs.get("now", lambda: datetime.now(timezone.utc))
+        self._sleep = kwargs.get("sleep")
+
+        self.diff_tracker = None
+        if airmet.str_to_bool(kwargs.get("deltas")):
+            import diff
+            self.diff_tracker = diff.DiffTracker()
+
+        self.callbacks = []
+        self.seen = {} #date str -> set of product_ids
+        self.cursor = ""
+        self.consecutive_failures = 0
+        self.num_polls = 0
+        self.num_emitted = 0
+        self._stop_event = threading.Event()
+
+        if self.cursor_path and os.path.exists(self.cursor_path):
+            self._load_cursor()
+
+    def register_callback(self, callback):
+        self.callbacks.append(callback)
+        return callback
+
+    def stop(self):
+        self._stop_event.set()
+
+    def poll_once(self):
+        '''Polls the product list once, fetching
+           and parsing every new matching product.
+           Returns a list of the parsed AIRMET dicts.
+        '''
+
+        now = self._now()
+        dates = [now.strftime("%Y-%m-%d")]
+        #Products issued just before 00Z can still be listed late, so keep checking yesterday for a while
+        if now.hour == 0:
+            dates.insert(0, (now - timedelta(days=1)).strftime("%Y-%m-%d"))
+
+        new_airmets = []
+
+        for date in dates:
+            product_list = airmet.fetch_product_list(date, base_url=self.base_url, verbose=self.debug, **self.http_kwargs)
+            seen_today = self.seen.setdefault(date, set())
+
+            new_products = [prod for prod in product_list
+                            if prod["pil"].startswith(self.pil_prefix) and prod["product_id"] not in seen_today]
+            new_products.sort(key=lambda prod: prod["product_id"])
+
+            if self.verbose:
+                print(f"WATCHER: {len(new_products)} new product(s) listed for {date}")
+
+            for prod in new_products:
+                product_id = prod["product_id"]
+                airmet_raw_text = airmet.fetch_product_text(product_id, base_url=self.base_url, verbose=self.debug, **self.http_kwargs)
+
+                year, month = int(product_id[0:4]), int(product_id[4:6])
+                try:
+                    airmet_dict = quarantine.parse_with_budget(airmet.parse_airmet, airmet_raw_text, year, month, budget_s=self.parse_budget, debug=self.debug)
+                except quarantine.ParseBudgetExceeded as e:
+                    self.quarantine.add(airmet_raw_text, e, product_id=product_id, pil=prod["pil"])
+                    if self.verbose:
+                        print(f"WATCHER: Product {product_id} quarantined, {e}")
+                    self._mark_seen(seen_today, product_id)
+                    self._save_cursor()
+                    continue
+                except Exception as e:
+                    if self.verbose:
+                        print(f"WATCHER: Could not parse product {product_id}: {e}")
+                    airmet_dict = {"product_id" : product_id, "raw_text" : airmet_raw_text, "error" : str(e)}
+                airmet_dict["product_id"] = product_id
+
+                self._emit(airmet_dict, prod)
+                #Only marked seen once delivered, so a failed fetch or a raising callback is retried on the next poll
+                self._mark_seen(seen_today, product_id)
+                new_airmets.append(airmet_dict)
+                #Saved per product, so a poll that fails (or a process killed) partway through doesn't re-emit what it already emitted
+                self._save_cursor()
+
+        self._prune_seen(now)
+        self._save_cursor()
+
+        return new_airmets
+
+    def _mark_seen(self, seen_today, product_id):
+        seen_today.add(product_id)
+        if product_id > self.cursor:
+            self.cursor = product_id
+
+    def run(self, **kwargs):
+        '''Polls until stop() is called, or max_polls
+           polls have been made. Failed polls back off
+           exponentially (with jitter) up to max_backoff.
+        '''
+
+        max_polls = kwargs.get("max_polls")
+        sleep = self._sleep if self._sleep else self._stop_event.wait
+
+        if self.verbose:
+            print(f"WATCHER: Watching {self.base_url} for {self.pil_prefix}* products every {self.poll_interval}s")
+
+        while not self._stop_event.is_set():
+            try:
+                self.poll_once()
+                self.consecutive_failures = 0
+                delay = self.poll_interval
+            except Exception as e:
+                self.consecutive_failures += 1
+                delay = self._backoff_delay()
+                if self.verbose:
+                    print(f"WATCHER: Poll failed ({e}), retry #{self.consecutive_failures} in {delay:.1f}s")
+
+            self.num_polls += 1
+            if max_polls is not None and self.num_polls >= max_polls:
+                break
+
+            sleep(delay)
+
+        quarantine.close_sandbox()
+        return self.num_emitted
+
+    def _backoff_delay(self):
+        delay = min(self.max_backoff, self.poll_interval * (2 ** self.consecutive_failures))
+        return random.uniform(delay / 2, delay)
+
+    def _emit(self, airmet_dict, prod):
+        if self.diff_tracker is None:
+            self._deliver(airmet_dict, prod)
+            return
+
+        import diff
+        latest = dict(self.diff_tracker.latest)
+        try:
+            delta = self.diff_tracker.update(airmet_dict)
+            if delta is None or diff.is_empty(delta):
+                if self.verbose:
+                    print(f"WATCHER: No changes in {airmet_dict.get('airmet_id')} ({prod['product_id']})")
+                return
+            self._deliver(delta, prod)
+        except BaseException:
+            #Undelivered, so the retry is diffed against the same previous issuance
+            self.diff_tracker.latest = latest
+            raise
+
+    def _deliver(self, airmet_dict, prod):
+        if self.verbose:
+            print(f"WATCHER: New AIRMET {airmet_dict.get('airmet_id')} ({prod['product_id']})")
+
+        for callback in self.callbacks:
+            callback(airmet_dict, prod)
+
+        if self.output_stream is not None:
+            self.output_stream.write(json.dumps(airmet_dict) + "\n")
+            self.output_stream.flush()
+        self.num_emitted += 1
+
+    def _prune_seen(self, now):
+        oldest = (now - timedelta(days=DEF_SEEN_RETENTION_DAYS)).strftime("%Y-%m-%d")
+        for date in list(self.seen):
+            if date < oldest:
+                del self.seen[date]
+
+    def _save_cursor(self):
+        if not self.cursor_path:
+            return
+        state = {"cursor" : self.cursor, "seen" : {date : sorted(ids) for date, ids in self.seen.items()}}
+        if self.diff_tracker is not None:
+            state["diff"] = self.diff_tracker.state()
+        tmp_path = self.cursor_path + ".tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(state, file)
+        os.replace(tmp_path, self.cursor_path)
+
+    def _load_cursor(self):
+        with open(self.cursor_path) as file:
+            state = json.load(file)
+        self.cursor = state.get("cursor", "")
+        self.seen = {date : set(ids) for date, ids in state.get("seen", {}).items()}
+        if self.diff_tracker is not None and state.get("diff"):
+            import diff
+            self.diff_tracker = diff.DiffTracker(state=state["diff"])
+
+def watch(**kwargs):
+    '''Convenience wrapper, builds an AirmetWatcher
+       and runs it. Callbacks can be passed as a
+       list with callbacks=[...].
+    '''
+
+    watcher = AirmetWatcher(**kwargs)
+    for callback in kwargs.get("callbacks", []):
+        watcher.register_callback(callback)
+
+    return watcher.run(max_polls=kwargs.get("max_polls"))
+
+if __name__ == "__main__":
+
+    watch(output_stream=sys.stdout, verbose=True)
@@ -0,0 +1,506 @@
+import sys
+import os
+import time
+import json
+import uuid
+import socket
+import sqlite3
+import threading
+import contextlib
+from datetime import datetime, timedelta
+
+import airmet
+import archive
+import router
+import quarantine
+
+#A lease not renewed within DEF_LEASE_S expires and its unit goes back to
+#the pool. Workers renew theirs every DEF_HEARTBEAT_S.
+DEF_LEASE_S = 120
+
+DEF_HEARTBEAT_S = 30
+
+DEF_CLAIM_BATCH = 8
+
+#A unit that fails this many times is parked as "failed" instead of retried
+DEF_MAX_ATTEMPTS = 5
+
+DEF_BUSY_TIMEOUT_S = 60
+
+DEF_IDLE_POLL_S = 5
+
+#Window over which status() reports each worker's recent throughput
+DEF_RATE_WINDOW_S = 300
+
+###Queue
+#One SQLite file holds the units of every enqueued day, their leases and
+#the results committed for them. Completing a unit checks its lease
+#token and stores the result in the same transaction, so a unit whose
+#lease expired (and was claimed again) can't be committed twice.
+#The default rollback journal keeps the file usable on a shared
+#filesystem; pass journal_mode="WAL" for a queue on local disk.
+
+DEF_SCHEMA = """
+CREATE TABLE IF NOT EXISTS days (
+    date TEXT PRIMARY KEY,
+    num_units INTEGER,
+    listed_at REAL,
+    exported_at REAL);
+CREATE TABLE IF NOT EXISTS units (
+    date TEXT,
+    product_id TEXT,
+    pil TEXT,
+    seq INTEGER,
+    state TEXT DEFAULT 'pending',
+    worker_id TEXT,
+    token TEXT,
+    lease_expires REAL,
+    attempts INTEGER DEFAULT 0,
+    error TEXT,
+    done_at REAL,
+    PRIMARY KEY (date, product_id));
+CREATE INDEX IF NOT EXISTS units_state ON units (state, lease_expires);
+CREATE TABLE IF NOT EXISTS results (
+    date TEXT,
+    product_id TEXT,
+    raw_text TEXT,
+    data TEXT,
+    PRIMARY KEY (date, product_id));
+CREATE TABLE IF NOT EXISTS workers (
+    worker_id TEXT PRIMARY KEY,
+    host TEXT,
+    pid INTEGER,
+    started_at REAL,
+    last_heartbeat REAL,
+    units_done INTEGER DEFAULT 0,
+    units_failed INTEGER DEFAULT 0);
+"""
+
+class WorkQueue():
+    ''' Shared queue of (date, product_id) work
+        units with leases. Any number of processes,
+        on any number of nodes, can open the same
+        file: claim() leases units, heartbeat()
+        renews the leases, complete() commits a
+        unit's result exactly once and fail() puts
+        it back for a retry.
+
+        Each process (and thread) should open its
+        own WorkQueue.
+    '''
+
+    def __init__(self, db_path, **kwargs):
+
+        self.db_path = db_path
+        self.lease_s = kwargs.get("lease_s", DEF_LEASE_S)
+        self.max_attempts = kwargs.get("max_attempts", DEF_MAX_ATTEMPTS)
+        self._now = kwargs.get("now", time.time)
+
+        self._conn = sqlite3.connect(db_path, timeout=kwargs.get("busy_timeout", DEF_BUSY_TIMEOUT_S), isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute(f"PRAGMA journal_mode={kwargs.get('journal_mode', 'DELETE')}")
+        self._conn.executescript(DEF_SCHEMA)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        #BEGIN IMMEDIATE takes the write lock up front, so two claimers never read the same pending rows
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self._conn
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def enqueue(self, date, units):
+        '''Adds a day's units (product entries with
+           "product_id" and "pil", in listing order).
+           Units already queued are left as they are.
+           Returns the number added.
+        '''
+        with self._transaction() as conn:
+            before = conn.total_changes
+            conn.executemany("INSERT OR IGNORE INTO units (date, product_id, pil, seq) VALUES (?, ?, ?, ?)",
+                             [(date, unit["product_id"], unit.get("pil"), seq) for seq, unit in enumerate(units)])
+            added = conn.total_changes - before
+            conn.execute("INSERT OR REPLACE INTO days (date, num_units, listed_at, exported_at) VALUES "
+                         "(?, (SELECT COUNT(*) FROM units WHERE date = ?), ?, (SELECT exported_at FROM days WHERE date = ?))",
+                         (date, date, self._now(), date))
+        return added
+
+    def enqueue_days(self, start_date, end_date, **kwargs):
+        '''Lists every day from start_date to end_date
+           (inclusive) and enqueues its units, for the
+           route names in kwargs["routes"] (AIRMETs
+           only by default, None for every route).
+           Days listed before are skipped unless
+           relist=True. Returns {date : units added}.
+        '''
+
+        names = kwargs.get("routes", ["airmet"])
+        prefixes = tuple(route.pil_prefix for route in router.routes(names))
+        added = {}
+        date = start_date
+        while date <= end_date:
+            date_str = date.strftime("%Y-%m-%d")
+            listed = self._conn.execute("SELECT 1 FROM days WHERE date = ?", (date_str,)).fetchone()
+            if kwargs.get("relist") or not listed:
+                product_list = airmet.fetch_product_list(date_str, base_url=kwargs.get("base_url", airmet.DEF_IEM_BASE_URL), **airmet.http_kwargs(kwargs))
+                units = [unit for unit in product_list if unit["pil"].startswith(prefixes)]
+                added[date_str] = self.enqueue(date_str, units)
+            date += timedelta(days=1)
+        return added
+
+    def register_worker(self, worker_id, **kwargs):
+        now = self._now()
+        with self._transaction() as conn:
+            conn.execute("INSERT OR IGNORE INTO workers (worker_id, host, pid, started_at, last_heartbeat) VALUES (?, ?, ?, ?, ?)",
+                         (worker_id, kwargs.get("host", socket.gethostname()), kwargs.get("pid", os.getpid()), now, now))
+
+    def claim(self, worker_id, num_units=DEF_CLAIM_BATCH):
+        '''Leases up to num_units pending units (or
+           units whose lease expired), oldest day and
+           listing position first. Returns a list of
+           lease dicts: date, product_id, pil, seq,
+           token.
+        '''
+        now = self._now()
+        with self._transaction() as conn:
+            rows = conn.execute("SELECT date, product_id, pil, seq FROM units "
+                                "WHERE state = 'pending' OR (state = 'leased' AND lease_expires < ?) "
+                                "ORDER BY date, seq LIMIT ?", (now, num_units)).fetchall()
+            leases = []
+            for row in rows:
+                lease = dict(row)
+                lease["token"] = uuid.uuid4().hex
+                conn.execute("UPDATE units SET state = 'leased', worker_id = ?, token = ?, lease_expires = ?, attempts = attempts + 1 "
+                             "WHERE date = ? AND product_id = ?", (worker_id, lease["token"], now + self.lease_s, lease["date"], lease["product_id"]))
+                leases.append(lease)
+            conn.execute("UPDATE workers SET last_heartbeat = ? WHERE worker_id = ?", (now, worker_id))
+        return leases
+
+    def heartbeat(self, worker_id, leases):
+        '''Renews the given leases. Returns the ones
+           still held; a lease missing from the result
+           expired and may be processed by another
+           worker, its result would be rejected.
+        '''
+        now = self._now()
+        held = []
+        with self._transaction() as conn:
+            for lease in leases:
+                cursor = conn.execute("UPDATE units SET lease_expires = ? WHERE date = ? AND product_id = ? AND token = ? AND state = 'leased'",
+                                      (now + self.lease_s, lease["date"], lease["product_id"], lease["token"]))
+                if cursor.rowcount:
+                    held.append(lease)
+            conn.execute("UPDATE workers SET last_heartbeat = ? WHERE worker_id = ?", (now, worker_id))
+        return held
+
+    def complete(self, worker_id, lease, raw_text, result):
+        '''Commits a unit's raw text and parsed result,
+           if the lease is still held. Returns False
+           (and stores nothing) if it isn't.
+        '''
+        now = self._now()
+        with self._transaction() as conn:
+            cursor = conn.execute("UPDATE units SET state = 'done', done_at = ?, token = NULL, error = NULL "
+                                  "WHERE date = ? AND product_id = ? AND token = ? AND state = 'leased'",
+                                  (now, lease["date"], lease["product_id"], lease["token"]))
+            if not cursor.rowcount:
+                return False
+            conn.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                         (lease["date"], lease["product_id"], raw_text, json.dumps(result, separators=archive.DEF_COMPACT_SEPARATORS)))
+            conn.execute("UPDATE workers SET units_done = units_done + 1, last_heartbeat = ? WHERE worker_id = ?", (now, worker_id))
+        return True
+
+    def fail(self, worker_id, lease, error):
+        '''Gives a unit back for a retry, or parks it as
+           "failed" after max_attempts. Returns the new
+           state, or None if the lease was lost.
+        '''
+        now = self._now()
+        with self._transaction() as conn:
+            row = conn.execute("SELECT attempts FROM units WHERE date = ? AND product_id = ? AND token = ? AND state = 'leased'",
+                               (lease["date"], lease["product_id"], lease["token"])).fetchone()
+            if row is None:
+                return None
+            state = "failed" if row["attempts"] >= self.max_attempts else "pending"
+            conn.execute("UPDATE units SET state = ?, token = NULL, lease_expires = NULL, error = ? WHERE date = ? AND product_id = ?",
+                         (state, str(error), lease["date"], lease["product_id"]))
+            conn.execute("UPDATE workers SET units_failed = units_failed + 1, last_heartbeat = ? WHERE worker_id = ?", (now, worker_id))
+        return state
+
+    def quarantine(self, worker_id, lease, raw_text, record):
+        '''Parks a unit that overran its parse budget
+           as "quarantined", keeping its raw text and
+           quarantine record (see quarantine.py) for
+           export. Not retried. Returns False if the
+           lease was lost.
+        '''
+        now = self._now()
+        record = {key : value for key, value in record.items() if key != "raw_text"}
+        with self._transaction() as conn:
+            cursor = conn.execute("UPDATE units SET state = 'quarantined', done_at = ?, token = NULL, error = ? "
+                                  "WHERE date = ? AND product_id = ? AND token = ? AND state = 'leased'",
+                                  (now, "parse budget exceeded", lease["date"], lease["product_id"], lease["token"]))
+            if not cursor.rowcount:
+                return False
+            conn.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                         (lease["date"], lease["product_id"], raw_text, json.dumps(record, separators=archive.DEF_COMPACT_SEPARATORS)))
+            conn.execute("UPDATE workers SET units_failed = units_failed + 1, last_heartbeat = ? WHERE worker_id = ?", (now, worker_id))
+        return True
+
+    def release(self, worker_id, leases):
+        '''Hands unprocessed leases back right away
+           (e.g. on shutdown), without counting an
+           attempt.
+        '''
+        with self._transaction() as conn:
+            for lease in leases:
+                conn.execute("UPDATE units SET state = 'pending', token = NULL, lease_expires = NULL, attempts = MAX(attempts - 1, 0) "
+                             "WHERE date = ? AND product_id = ? AND token = ? AND state = 'leased'",
+                             (lease["date"], lease["product_id"], lease["token"]))
+
+    def retry_failed(self):
+        '''Puts every failed unit back in the pool.'''
+        with self._transaction() as conn:
+            return conn.execute("UPDATE units SET state = 'pending', attempts = 0 WHERE state = 'failed'").rowcount
+
+    def remaining(self):
+        #Units not done or failed, leased ones included
+        return self._conn.execute("SELECT COUNT(*) FROM units WHERE state IN ('pending', 'leased')").fetchone()[0]
+
+    def status(self):
+        '''Unit counts by state, day progress and, per
+           worker, units done/failed, lifetime and
+           recent (DEF_RATE_WINDOW_S) throughput in
+           units per minute, and leases held.
+        '''
+        now = self._now()
+        conn = self._conn
+        states = {row["state"] : row["count"] for row in conn.execute("SELECT state, COUNT(*) AS count FROM units GROUP BY state")}
+        days = conn.execute("SELECT COUNT(*) AS total, SUM(exported_at IS NOT NULL) AS exported FROM days").fetchone()
+        complete_days = conn.execute("SELECT COUNT(*) FROM days WHERE NOT EXISTS "
+                                     "(SELECT 1 FROM units WHERE units.date = days.date AND state IN ('pending', 'leased'))").fetchone()[0]
+        recent = {row["worker_id"] : row["count"] for row in conn.execute(
+            "SELECT worker_id, COUNT(*) AS count FROM units WHERE state = 'done' AND done_at >= ? GROUP BY worker_id", (now - DEF_RATE_WINDOW_S,))}
+        leased = {row["worker_id"] : row["count"] for row in conn.execute(
+            "SELECT worker_id, COUNT(*) AS count FROM units WHERE state = 'leased' AND lease_expires >= ? GROUP BY worker_id", (now,))}
+
+        workers = []
+        for row in conn.execute("SELECT * FROM workers ORDER BY worker_id"):
+            lifetime_min = max(row["last_heartbeat"] - row["started_at"], 1e-9) / 60
+            workers.append({"worker_id" : row["worker_id"], "host" : row["host"], "pid" : row["pid"],
+                            "units_done" : row["units_done"], "units_failed" : row["units_failed"],
+                            "units_per_min" : round(row["units_done"] / lifetime_min, 2),
+                            "recent_units_per_min" : round(recent.get(row["worker_id"], 0) / (DEF_RATE_WINDOW_S / 60), 2),
+                            "leased" : leased.get(row["worker_id"], 0),
+                            "last_heartbeat_age_s" : round(now - row["last_heartbeat"], 1)})
+
+        return {"units" : {state : states.get(state, 0) for state in ("pending", "leased", "done", "failed", "quarantined")},
+                "days" : {"total" : days["total"], "complete" : complete_days, "exported" : days["exported"] or 0},
+                "workers" : workers}
+
+    def export_day(self, date, save_dir, **kwargs):
+        '''Writes a completed day's results to the same
+           daily raw text and JSON files as download()
+           (per route, see router.py), in listing order.
+           Returns {route name : JSON path}, or None if
+           the day still has pending or leased units.
+           Failed units are left out, quarantined ones
+           go to the day's quarantine file instead.
+        '''
+
+        conn = self._conn
+        if conn.execute("SELECT 1 FROM units WHERE date = ? AND state IN ('pending', 'leased') LIMIT 1", (date,)).fetchone():
+            return None
+        if not os.path.exists(save_dir):
+            os.makedirs(save_dir)
+
+        date_str = date.replace("-", "")
+        compression = kwargs.get("compression")
+        outputs = {}
+        held = []
+        rows = conn.execute("SELECT units.product_id, units.pil, units.state, results.raw_text, results.data FROM units "
+                            "JOIN results ON results.date = units.date AND results.product_id = units.product_id "
+                            "WHERE units.date = ? AND units.state IN ('done', 'quarantined') ORDER BY units.seq", (date,))
+        try:
+            for row in rows:
+                route = router.route_for(row["pil"] or "")
+                if route is None:
+                    continue
+                if route.name not in outputs:
+                    raw_file = archive.open_output(route.raw_path(save_dir, date_str), compression=compression)
+                    json_file = archive.open_output(route.json_path(save_dir, date_str), compression=compression)
+                    writer = archive.JSONArrayWriter(json_file, pretty=airmet.str_to_bool(kwargs.get("pretty")), index=True)
+                    outputs[route.name] = (raw_file, json_file, writer)
+                raw_file, _, writer = outputs[route.name]
+                raw_file.write(row["raw_text"])
+                if row["state"] == "quarantined":
+                    held.append(dict(json.loads(row["data"]), raw_text=row["raw_text"]))
+                else:
+                    writer.write(json.loads(row["data"]), product_id=row["product_id"])
+        except BaseException:
+            for raw_file, json_file, _ in outputs.values():
+                raw_file.abort()
+                json_file.abort()
+            raise
+
+        paths = {}
+        for name, (raw_file, json_file, writer) in outputs.items():
+            writer.close()
+            raw_file.close()
+            json_file.close()
+            paths[name] = json_file.path
+        if held:
+            with archive.open_output(quarantine.quarantine_path(save_dir, date_str)) as quarantine_file:
+                for record in held:
+                    quarantine_file.write(json.dumps(record) + "\n")
+        with self._transaction() as conn:
+            conn.execute("UPDATE days SET exported_at = ? WHERE date = ?", (self._now(), date))
+        return paths
+
+    def export_ready(self, save_dir, **kwargs):
+        '''Exports every completed day not exported yet
+           (or every completed day, with force=True).
+           Returns {date : {route name : JSON path}}.
+        '''
+        dates = [row[0] for row in self._conn.execute("SELECT date FROM days WHERE exported_at IS NULL OR ? ORDER BY date",
+                                                      (bool(kwargs.get("force")),))]
+        exported = {}
+        for date in dates:
+            paths = self.export_day(date, save_dir, **kwargs)
+            if paths is not None:
+                exported[date] = paths
+        return exported
+
+###Workers
+
+class _Heartbeat():
+    ''' Renews a worker's leases in the background,
+        on its own connection, while the worker is
+        busy with them.
+    '''
+
+    def __init__(self, db_path, worker_id, **kwargs):
+        self.queue = None
+        self.db_path = db_path
+        self.worker_id = worker_id
+        self.interval = kwargs.get("heartbeat_s", DEF_HEARTBEAT_S)
+        self.queue_kwargs = kwargs
+        self.leases = []
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def hold(self, leases):
+        with self._lock:
+            self.leases = list(leases)
+
+    def drop(self, lease):
+        with self._lock:
+            self.leases = [held for held in self.leases if held["token"] != lease["token"]]
+
+    def _run(self):
+        queue = WorkQueue(self.db_path, **self.queue_kwargs)
+        try:
+            while not self._stop_event.wait(self.interval):
+                with self._lock:
+                    leases = list(self.leases)
+                if leases:
+                    queue.heartbeat(self.worker_id, leases)
+        finally:
+            queue.close()
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join()
+
+def run_worker(db_path, **kwargs):
+    '''Claims, fetches, parses and commits units
+       until the queue has none left (or max_units
+       have been processed). Products are fetched
+       from base_url (or with kwargs["source"], any
+       object with fetch(unit)) and parsed with
+       router.parse_product, under a budget of
+       parse_budget seconds (0 disables it); units
+       that overrun are quarantined. Returns the
+       worker's counts.
+    '''
+
+    worker_id = kwargs.get("worker_id") or f"{socket.gethostname()}-{os.getpid()}"
+    batch = kwargs.get("batch", DEF_CLAIM_BATCH)
+    max_units = kwargs.get("max_units")
+    verbose = airmet.str_to_bool(kwargs.get("verbose"))
+    queue_kwargs = {key : kwargs[key] for key in ("lease_s", "max_attempts", "journal_mode", "busy_timeout") if key in kwargs}
+    base_url = kwargs.get("base_url", airmet.DEF_IEM_BASE_URL)
+    source = kwargs.get("source")
+    parse_budget = kwargs.get("parse_budget", quarantine.DEF_PARSE_BUDGET_S)
+    fetch = source.fetch if source is not None else (lambda unit: airmet.fetch_product_text(unit["product_id"], base_url=base_url, **airmet.http_kwargs(kwargs)))
+
+    counts = {"worker_id" : worker_id, "done" : 0, "failed" : 0, "quarantined" : 0, "lost" : 0}
+    queue = WorkQueue(db_path, **queue_kwargs)
+    queue.register_worker(worker_id)
+    heartbeat = _Heartbeat(db_path, worker_id, heartbeat_s=kwargs.get("heartbeat_s", DEF_HEARTBEAT_S), **queue_kwargs).start()
+    leases = []
+    try:
+        while max_units is None or counts["done"] + counts["failed"] + counts["quarantined"] < max_units:
+            leases = queue.claim(worker_id, batch if max_units is None else min(batch, max_units - counts["done"] - counts["failed"] - counts["quarantined"]))
+            if not leases:
+                if not queue.remaining():
+                    break
+                time.sleep(kwargs.get("idle_poll_s", DEF_IDLE_POLL_S)) #units are leased by others, wait for them to finish or expire
+                continue
+            heartbeat.hold(leases)
+            while leases:
+                lease = leases[0]
+                try:
+                    raw_text = fetch(lease)
+                    year, month = int(lease["product_id"][0:4]), int(lease["product_id"][4:6])
+                    result = quarantine.parse_with_budget(router.parse_product, raw_text, year, month, budget_s=parse_budget, pil=lease["pil"])
+                except quarantine.ParseBudgetExceeded as e:
+                    counts["quarantined"] += 1
+                    queue.quarantine(worker_id, lease, raw_text, quarantine.quarantine_record(raw_text, e, product_id=lease["product_id"], pil=lease["pil"]))
+                    if verbose:
+                        print(f"WORKER {worker_id}: {lease['product_id']} quarantined, {e}")
+                except Exception as e:
+                    counts["failed"] += 1
+                    queue.fail(worker_id, lease, e)
+                    if verbose:
+                        print(f"WORKER {worker_id}: {lease['product_id']} failed: {e}")
+                else:
+                    if queue.complete(worker_id, lease, raw_text, result):
+                        counts["done"] += 1
+                    else:
+                        counts["lost"] += 1 #lease expired and was taken over, the other worker's commit wins
+                heartbeat.drop(lease)
+                leases = leases[1:]
+    finally:
+        quarantine.close_sandbox()
+        heartbeat.stop()
+        if leases:
+            queue.release(worker_id, leases)
+        queue.close()
+
+    if verbose:
+        print(f"WORKER {worker_id}: {counts['done']} done, {counts['failed']} failed, {counts['quarantined']} quarantined, {counts['lost']} lost")
+    return counts
+
+if __name__ == "__main__":
+
+    db_path = sys.argv[1]
+    with WorkQueue(db_path) as work_queue:
+        print(json.dumps(work_queue.status(), indent=2))